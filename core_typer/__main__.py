@@ -1,24 +1,72 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import csv
 import datetime
 import json
 import logging
 import os
-import shutil
+import subprocess
+import sys
+import tempfile
 
 from . import __version__
 from . import alignment
+from . import alignment_cache
 from . import allele_calling
-from . import qc
+from . import assembly
+from . import batch
+from . import clustering
+from . import benchmark
+from . import qc_summary
 from . import config
+from . import distance
+from . import indexing
+from . import merge_profiles
+from . import novel_alleles
 from . import parsers
+from . import pipeline
+from . import profile_store
+from . import query
+from . import scheme
+from . import server
+from . import sharding
 from . import utils
 
 
-def main():
-    parser = argparse.ArgumentParser(description='A cgMLST Typing Tool')
+def _add_typing_arguments(parser, server=False):
+    """
+    Add the typing options that are shared by core-typer, core-typer batch and core-typer serve.
+
+    :param parser: The argument parser to add the options to
+    :type parser: argparse.ArgumentParser
+    :param server: Leave out options that are set for each job submitted to the server, rather than for the server
+    :type server: bool
+    :return: None
+    """
+    parser.add_argument('--io-mode', choices=alignment.IO_MODES, default='disk', help='Where kma writes its outputs: the tmpdir (disk), {tmpfs} (tmpfs), or named pipes that are parsed as kma writes them (fifo) (default: disk)'.format(tmpfs=alignment.TMPFS_DIR))
+    if not server:
+        parser.add_argument('--novel-alleles', action='store_true', help='Call novel alleles at loci whose best hit meets --min-coverage but not --min-identity, named by a hash of the consensus sequence, and write them to novel_alleles.csv and novel_alleles.fasta')
+        parser.add_argument('--target-depth', type=float, help='Downsample read pairs to approximately this depth before alignment (default: use all reads)')
+        parser.add_argument('--genome-size', type=int, help='Genome size in bp, used to estimate read depth for --target-depth (default: estimated scheme length, from the kma index)')
+    parser.add_argument('--alignment-cache', help='Directory to cache kma outputs in. Re-typing the same reads against the same scheme skips alignment (default: no cache)')
+    parser.add_argument('--alignment-cache-max-size', type=float, default=alignment_cache.DEFAULT_MAX_BYTES / 1024 ** 3, help='Maximum size of the alignment cache in GB. Least recently used alignments are evicted (default: %(default)s)')
+    parser.add_argument('--novel-allele-hash', choices=novel_alleles.HASH_METHODS, default='sha1', help='Hash used to name novel alleles (default: sha1)')
+    parser.add_argument('--scheme-shards', help='Directory of scheme shards built with `core-typer shard-scheme`. Reads are aligned against the shards concurrently, and the results merged')
+    parser.add_argument('--max-concurrent-shards', type=int, help='Maximum number of scheme shards to align against at once (default: --threads)')
+    parser.add_argument('--profile-store', help='Append the allele calls for each sample to this profile store (created if it does not exist)')
+    parser.add_argument('--query-db', help='Profile store to search for the profiles nearest to each sample')
+    parser.add_argument('--query-k', type=int, default=10, help='Number of nearest profiles to report (default: 10)')
+    parser.add_argument('--query-max-distance', type=int, help='Report all profiles within this many allele differences, instead of the nearest --query-k')
+
+
+def main_type(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='core-typer',
+        description='A cgMLST Typing Tool',
+        epilog='Subcommands: batch, distance, cluster, store, query, benchmark, serve, submit, shard-scheme, assembly-index, qc-summary, merge-profiles, index. Run `core-typer <subcommand> -h` for details.',
+    )
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
     parser.add_argument('-t', '--threads', type=int, default=1, help='Number of CPU threads to use (default: 1)')
     parser.add_argument('-p', '--prefix', help='Prefix for output files (default: taken from R1 fastq file name)')
@@ -26,69 +74,635 @@ def main():
     parser.add_argument('--min-coverage', type=float, default=100.0, help='Minimum percent coverage (default: 100.0)')
     parser.add_argument('--R1', help='Read 1')
     parser.add_argument('--R2', help='Read 2')
+    parser.add_argument('--assembly', help='Assembly (FASTA) to type, instead of --R1 and --R2. Alleles found exactly are called with the assembly index, and only the other loci are aligned')
+    parser.add_argument('--assembly-index', help='Assembly index built with `core-typer assembly-index` (default: <scheme>.core-typer-assembly-index)')
     parser.add_argument('--scheme', help='cgMLST scheme')
     parser.add_argument('--tmpdir', default='./tmp', help='Temporary directory (default: ./tmp)')
     parser.add_argument('--no-cleanup', action='store_true', help='Do not cleanup temporary directory')
+    _add_typing_arguments(parser, server=False)
+    parser.add_argument('--sweep', help='Also evaluate allele calls for a range of thresholds, eg. identity=95:100:0.5,coverage=90:100:1 (START:STOP:STEP, including STOP), and write them to threshold_sweep.csv')
+    parser.add_argument('--metrics-json', help='Write timing, resource usage and input size metrics to this file')
+    parser.add_argument('--profile', action='store_true', help='Write cProfile stats and tracemalloc snapshots for each stage to a \'profile\' sub-directory of the output directory')
     parser.add_argument('--log-level', default='info', help='Log level (default: info)')
     parser.add_argument('--outdir', help='Output directory')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    args = utils.validate_args(args, parser)
+    if args.assembly is not None:
+        args = utils.validate_args(args, parser, required_args=('assembly', 'scheme', 'outdir'))
+        if args.R1 is not None or args.R2 is not None:
+            parser.error("--assembly can't be used with --R1 and --R2")
+    else:
+        args = utils.validate_args(args, parser)
 
     config.configure_logging({'log_level': args.log_level})
 
-    now_str = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    analysis_tmpdir = os.path.join(args.tmpdir, f"{now_str}-core-typer-tmp")
-    if not os.path.exists(analysis_tmpdir):
-        os.makedirs(analysis_tmpdir)
+    sweep = None
+    if args.sweep:
+        try:
+            sweep = allele_calling.parse_threshold_sweep(args.sweep, default_min_identity=args.min_identity, default_min_coverage=args.min_coverage)
+        except ValueError as e:
+            parser.error(str(e))
 
-    if not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
-
-    alignment_params = {
+    typing_params = {
         'R1': args.R1,
         'R2': args.R2,
+        'assembly': args.assembly,
+        'assembly_index': args.assembly_index,
+        'scheme': args.scheme,
         'threads': args.threads,
+        'tmpdir': args.tmpdir,
+        'outdir': args.outdir,
+        'min_identity': args.min_identity,
+        'min_coverage': args.min_coverage,
+        'no_cleanup': args.no_cleanup,
+        'sample_id': args.prefix,
+        'profile_store': args.profile_store,
+        'query_db': args.query_db,
+        'query_k': args.query_k,
+        'query_max_distance': args.query_max_distance,
+        'io_mode': args.io_mode,
+        'target_depth': args.target_depth,
+        'genome_size': args.genome_size,
+        'alignment_cache': args.alignment_cache,
+        'alignment_cache_max_bytes': int(args.alignment_cache_max_size * 1024 ** 3),
+        'novel_alleles': args.novel_alleles,
+        'novel_allele_hash': args.novel_allele_hash,
+        'scheme_shards': args.scheme_shards,
+        'max_concurrent_shards': args.max_concurrent_shards,
+        'sweep': sweep,
+        'metrics_json': args.metrics_json,
+        'profile': args.profile,
+    }
+
+    pipeline.run_typing(typing_params)
+
+
+def main_batch(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer batch', description='Type all samples in a sample sheet')
+    parser.add_argument('--samples', help='Sample sheet (CSV with columns: ID, R1, R2)')
+    parser.add_argument('-t', '--total-threads', type=int, default=1, help='Total number of CPU threads to share between samples (default: 1)')
+    parser.add_argument('--max-threads-per-sample', type=int, help='Maximum number of CPU threads to use for a single sample (default: no limit)')
+    parser.add_argument('--min-identity', type=float, default=100.0, help='Minimum percent identity (default: 100.0)')
+    parser.add_argument('--min-coverage', type=float, default=100.0, help='Minimum percent coverage (default: 100.0)')
+    parser.add_argument('--scheme', help='cgMLST scheme')
+    parser.add_argument('--tmpdir', default='./tmp', help='Temporary directory (default: ./tmp)')
+    parser.add_argument('--no-cleanup', action='store_true', help='Do not cleanup temporary directories')
+    _add_typing_arguments(parser, server=False)
+    parser.add_argument('--metrics-json', action='store_true', help='Write timing, resource usage and input size metrics to metrics.json in each sample\'s output directory')
+    parser.add_argument('--profile', action='store_true', help='Write cProfile stats and tracemalloc snapshots for each stage to a \'profile\' sub-directory of each sample\'s output directory')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory. Outputs for each sample are written to a sub-directory named by sample ID')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('samples', 'scheme', 'outdir'))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    samples = batch.parse_sample_sheet(args.samples)
+    logging.info(f"Parsed {len(samples)} samples from sample sheet: {args.samples}")
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    batch_params = {
         'scheme': args.scheme,
-        'tmpdir': analysis_tmpdir,
+        'tmpdir': args.tmpdir,
+        'outdir': args.outdir,
+        'min_identity': args.min_identity,
+        'min_coverage': args.min_coverage,
+        'no_cleanup': args.no_cleanup,
+        'profile_store': args.profile_store,
+        'query_db': args.query_db,
+        'query_k': args.query_k,
+        'query_max_distance': args.query_max_distance,
+        'io_mode': args.io_mode,
+        'target_depth': args.target_depth,
+        'genome_size': args.genome_size,
+        'alignment_cache': args.alignment_cache,
+        'alignment_cache_max_bytes': int(args.alignment_cache_max_size * 1024 ** 3),
+        'novel_alleles': args.novel_alleles,
+        'novel_allele_hash': args.novel_allele_hash,
+        'scheme_shards': args.scheme_shards,
+        'max_concurrent_shards': args.max_concurrent_shards,
+        'metrics': args.metrics_json,
+        'profile': args.profile,
+        'total_threads': args.total_threads,
+        'max_threads_per_sample': args.max_threads_per_sample,
     }
+    summaries = batch.run_batch(samples, batch_params)
+
+    batch_summary_file = os.path.join(args.outdir, 'batch_summary.csv')
+    logging.info(f"Writing batch summary: {batch_summary_file}")
+    batch.write_batch_summary(summaries, batch_summary_file)
+
+    failed_sample_ids = [summary['sample_id'] for summary in summaries if summary['status'] != 'completed']
+    if failed_sample_ids:
+        logging.error(f"Typing failed for {len(failed_sample_ids)} of {len(summaries)} samples: {', '.join(failed_sample_ids)}")
+        sys.exit(1)
+    logging.info(f"Typing completed for all {len(summaries)} samples")
+
+
+def main_distance(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer distance', description='Calculate pairwise allele distances between allele profiles')
+    parser.add_argument('profiles', nargs='*', help='Allele profile files (allele_profile.csv). Sample IDs are taken from the name of the directory containing each file')
+    parser.add_argument('--profiles-list', help='File listing allele profile files, one per line')
+    parser.add_argument('--missing', choices=['pairwise', 'complete'], default='pairwise', help='Ignore missing loci per pair of samples (pairwise), or drop loci missing in any sample (complete) (default: pairwise)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of worker processes to use (default: 1)')
+    parser.add_argument('--block-size', type=int, default=256, help='Number of rows of the distance matrix calculated per task (default: 256)')
+    parser.add_argument('--format', dest='output_format', choices=['tsv', 'csv', 'npy'], default='tsv', help='Output format (default: tsv)')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('-o', '--output', help='Output file')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('output',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    allele_profile_paths = utils.collect_paths(args.profiles, args.profiles_list)
+    if not allele_profile_paths:
+        parser.print_help()
+        sys.exit(1)
+
+    logging.info(f"Reading {len(allele_profile_paths)} allele profiles")
+    sample_ids, locus_ids, allele_ids_by_sample = distance.read_allele_profiles(allele_profile_paths, threads=args.threads)
+    profiles, _ = distance.encode_allele_profiles(allele_ids_by_sample, len(locus_ids))
+    del allele_ids_by_sample
+
+    logging.info(f"Calculating distances between {len(sample_ids)} samples over {len(locus_ids)} loci")
+    distance_matrix = distance.calculate_distance_matrix(profiles, missing=args.missing, threads=args.threads, block_size=args.block_size)
 
-    alignment.run_alignment(alignment_params)
-
-    kma_result_file = os.path.join(analysis_tmpdir, "kma-out.res")
-    logging.debug(f"Parsing kma result file: {kma_result_file}")
-    parsed_kma_result = parsers.parse_kma_result(kma_result_file)
-    logging.debug(f"Parsing kma result file completed: {kma_result_file}")
-
-    allele_calls = []
-    for locus_id, kma_results in parsed_kma_result.items():
-        best_allele = allele_calling.choose_best_allele(kma_results, min_identity=args.min_identity, min_coverage=args.min_coverage)
-        allele_calls.append(best_allele)
-
-    qc_stats = qc.calculate_qc_stats(allele_calls)
-
-    qc_stats_file = os.path.join(args.outdir, 'qc.csv')
-    logging.info(f"Writing QC stats: {qc_stats_file}")
-    qc.write_qc_stats(qc_stats, qc_stats_file)
-    logging.debug(f"Writing QC stats completed: {qc_stats_file}")
-
-    kma_mapstat_file = os.path.join(analysis_tmpdir, "kma-out.mapstat")
-    logging.info(f"Parsing kma mapstat file: {kma_mapstat_file}")
-    parsed_kma_mapstat = parsers.parse_kma_mapstat(kma_mapstat_file)
-    logging.debug(f"Parsing kma mapstat file completed: {kma_mapstat_file}")
-
-    allele_calls_file = os.path.join(args.outdir, "allele_calls.csv")
-    logging.info(f"Writing allele calls: {allele_calls_file}")
-    allele_calling.write_allele_calls(allele_calls_file, allele_calls)
-    logging.debug(f"Writing allele calls completed: {allele_calls_file}")
-
-    allele_profile_file = os.path.join(args.outdir, "allele_profile.csv")
-    logging.info(f"Writing allele profile: {allele_profile_file}")
-    allele_calling.write_allele_profile(allele_calls, args.scheme, allele_profile_file)
-    logging.debug(f"Writing allele calls completed: {allele_calls_file}")
-    
-    if not args.no_cleanup:
-        shutil.rmtree(analysis_tmpdir)
-        logging.info(f"Deleted tmp directory: {analysis_tmpdir}")
+    logging.info(f"Writing distance matrix: {args.output}")
+    distance.write_distance_matrix(sample_ids, distance_matrix, args.output, output_format=args.output_format)
+
+
+def main_cluster(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer cluster', description='Build a minimum spanning tree of allele profiles and assign single-linkage cluster codes')
+    parser.add_argument('profiles', nargs='*', help='Allele profile files (allele_profile.csv). Sample IDs are taken from the name of the directory containing each file')
+    parser.add_argument('--profiles-list', help='File listing allele profile files, one per line')
+    parser.add_argument('--thresholds', help='Comma-separated clustering thresholds, in allele differences (default: 5,10,25, or the thresholds of --previous)')
+    parser.add_argument('--previous', help='Output directory of a previous clustering run, to add samples to. Profiles of the previously clustered samples must also be provided')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of files to read concurrently (default: 1)')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('outdir',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    allele_profile_paths = utils.collect_paths(args.profiles, args.profiles_list)
+    if not allele_profile_paths:
+        parser.print_help()
+        sys.exit(1)
+
+    logging.info(f"Reading {len(allele_profile_paths)} allele profiles")
+    sample_ids, locus_ids, allele_ids_by_sample = distance.read_allele_profiles(allele_profile_paths, threads=args.threads)
+    profiles, _ = distance.encode_allele_profiles(allele_ids_by_sample, len(locus_ids))
+    del allele_ids_by_sample
+
+    try:
+        previous = clustering.load_clustering(args.previous, locus_ids) if args.previous is not None else None
+        if args.thresholds is not None:
+            thresholds = [int(threshold) for threshold in args.thresholds.split(',')]
+        elif previous is not None:
+            thresholds = previous['thresholds']
+        else:
+            thresholds = clustering.DEFAULT_THRESHOLDS
+        sample_clustering = clustering.cluster_profiles(sample_ids, profiles, thresholds, previous=previous)
+    except (OSError, ValueError) as e:
+        logging.error(e)
+        sys.exit(1)
+
+    logging.info(f"Writing clustering results: {args.outdir}")
+    clustering.write_clustering(sample_clustering, locus_ids, args.outdir)
+
+
+def main_store(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer store', description='Manage a profile store')
+    subparsers = parser.add_subparsers(dest='action', metavar='{import,export,index,info}')
+    import_parser = subparsers.add_parser('import', help='Import allele profile files into a profile store (created if it does not exist)')
+    import_parser.add_argument('profiles', nargs='*', help='Allele profile files (allele_profile.csv). Sample IDs are taken from the name of the directory containing each file')
+    import_parser.add_argument('--profiles-list', help='File listing allele profile files, one per line')
+    import_parser.add_argument('--scheme', help='cgMLST scheme. Required when creating a new profile store')
+    export_parser = subparsers.add_parser('export', help='Export profiles as a samples x loci matrix')
+    export_parser.add_argument('-o', '--output', required=True, help='Output file')
+    export_parser.add_argument('--format', dest='output_format', choices=['csv', 'tsv'], default='csv', help='Output format (default: csv)')
+    index_parser = subparsers.add_parser('index', help='(Re-)build the allele index used to speed up nearest-profile queries')
+    info_parser = subparsers.add_parser('info', help='Print the number of samples and loci in a profile store')
+    for subparser in [import_parser, export_parser, index_parser, info_parser]:
+        subparser.add_argument('--store', help='Profile store directory')
+        subparser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('action',))
+    args = utils.validate_args(args, subparsers.choices[args.action], required_args=('store',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    if args.action == 'import':
+        allele_profile_paths = utils.collect_paths(args.profiles, args.profiles_list)
+        if os.path.exists(os.path.join(args.store, profile_store.LOCI_FILENAME)):
+            store = profile_store.ProfileStore(args.store)
+        elif args.scheme is not None:
+            store = profile_store.ProfileStore.open_or_create(args.store, scheme.load_scheme_index(args.scheme)['locus_ids'])
+        else:
+            logging.error(f"Profile store not found, and no --scheme provided to create it: {args.store}")
+            sys.exit(1)
+        try:
+            num_imported = store.import_allele_profiles(allele_profile_paths)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+        logging.info(f"Imported {num_imported} allele profiles into profile store: {args.store}")
+    elif args.action == 'export':
+        store = profile_store.ProfileStore(args.store)
+        delimiter = '\t' if args.output_format == 'tsv' else ','
+        logging.info(f"Exporting {store.num_samples} profiles: {args.output}")
+        store.export_csv(args.output, delimiter=delimiter)
+    elif args.action == 'index':
+        store = profile_store.ProfileStore(args.store)
+        query.build_allele_index(store)
+    elif args.action == 'info':
+        store = profile_store.ProfileStore(args.store)
+        allele_index = query.load_allele_index(store)
+        store_info = {
+            'samples': store.num_samples,
+            'loci': len(store.locus_ids),
+            'indexed_samples': allele_index['num_samples'] if allele_index is not None else 0,
+        }
+        print(json.dumps(store_info))
+
+
+def main_query(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer query', description='Find the profiles in a profile store that are nearest to an allele profile')
+    parser.add_argument('--store', help='Profile store to search')
+    parser.add_argument('--profile', help='Allele profile file (allele_profile.csv) to query with')
+    parser.add_argument('-k', type=int, default=10, help='Number of nearest profiles to report (default: 10)')
+    parser.add_argument('--max-distance', type=int, help='Report all profiles within this many allele differences, instead of the nearest k')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('-o', '--output', help='Output file')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('store', 'profile', 'output'))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    allele_profile = parsers.parse_allele_profile(args.profile)
+    allele_ids_by_locus_id = dict(zip(allele_profile['locus_ids'], allele_profile['allele_ids']))
+    store = profile_store.ProfileStore(args.store)
+    query_start_timestamp = datetime.datetime.now()
+    nearest_profiles = query.query_profile_store(
+        store,
+        allele_ids_by_locus_id,
+        k=args.k,
+        max_distance=args.max_distance,
+        exclude_sample_id=distance.get_sample_id(args.profile),
+    )
+    query_elapsed_time = datetime.datetime.now() - query_start_timestamp
+    logging.info(f"Query completed against {store.num_samples} profiles. Elapsed time: {round(query_elapsed_time.total_seconds(), 3)} seconds.")
+
+    query.write_nearest_profiles(nearest_profiles, args.output)
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer benchmark', description='Time the parsers, allele calling, QC and output writers against synthetic kma outputs (kma is not required)')
+    parser.add_argument('--num-loci', type=int, nargs='+', default=benchmark.DEFAULT_NUM_LOCI, help=f"Number of loci in each synthetic scheme (default: {' '.join(map(str, benchmark.DEFAULT_NUM_LOCI))})")
+    parser.add_argument('--max-hits-per-locus', type=int, default=5, help='Maximum number of kma hits for each locus (default: 5)')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of timed runs of each benchmark (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic kma outputs (default: 0)')
+    parser.add_argument('--tmpdir', default='/tmp', help='Directory for synthetic kma outputs (default: /tmp)')
+    parser.add_argument('--baseline', help='Benchmark results from a previous run to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=1.2, help='Report a regression if a benchmark takes more than this many times the baseline time or memory (default: 1.2)')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('-o', '--output', help='Output file (CSV)')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('output',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    benchmark_results = []
+    with tempfile.TemporaryDirectory(prefix='core-typer-benchmark-', dir=args.tmpdir) as work_dir:
+        for num_loci in args.num_loci:
+            benchmark_results += benchmark.run_benchmarks(
+                num_loci,
+                os.path.join(work_dir, str(num_loci)),
+                repeats=args.repeats,
+                max_hits_per_locus=args.max_hits_per_locus,
+                seed=args.seed,
+            )
+    benchmark.write_benchmark_results(benchmark_results, args.output)
+
+    if args.baseline:
+        regressions = benchmark.compare_benchmark_results(benchmark_results, benchmark.parse_benchmark_results(args.baseline), max_slowdown=args.max_slowdown)
+        for regression in regressions:
+            logging.error(f"Regression in {regression['benchmark']} ({regression['num_loci']} loci): {regression['metric']} {regression['value']} vs. baseline {regression['baseline']} ({regression['ratio']}x)")
+        if regressions:
+            sys.exit(1)
+        logging.info(f"No regressions compared to baseline: {args.baseline}")
+
+
+def main_qc_summary(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer qc-summary', description='Summarize QC across the output directories of many typing runs, including per-locus call rates')
+    parser.add_argument('outdirs', nargs='*', help='Output directories of typing runs (containing qc.csv, allele_calls.csv and allele_profile.csv)')
+    parser.add_argument('--outdirs-list', help='File listing output directories, one per line')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of output directories to read concurrently (default: 1)')
+    parser.add_argument('--depth-bin-width', type=float, default=qc_summary.DEFAULT_DEPTH_BIN_WIDTH, help='Width of histogram bins for depth (default: %(default)s)')
+    parser.add_argument('--num-depth-bins', type=int, default=qc_summary.DEFAULT_NUM_DEPTH_BINS, help='Number of histogram bins for depth. Higher depths are counted in the last bin (default: %(default)s)')
+    parser.add_argument('--min-locus-call-rate', type=float, default=90.0, help='Report loci called in less than this percent of samples (default: 90.0)')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('outdir',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    output_dirs = utils.collect_paths(args.outdirs, args.outdirs_list)
+    if not output_dirs:
+        parser.print_help()
+        sys.exit(1)
+
+    logging.info(f"Summarizing QC for {len(output_dirs)} output directories")
+    cohort_qc = qc_summary.summarize_cohort_qc(output_dirs, threads=args.threads, depth_bin_width=args.depth_bin_width, num_depth_bins=args.num_depth_bins)
+    logging.info(f"Summarized QC for {cohort_qc['num_samples']} samples ({cohort_qc['num_skipped']} skipped)")
+    if cohort_qc['num_samples'] == 0:
+        logging.error("No output directories could be read")
+        sys.exit(1)
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    qc_summary_file = os.path.join(args.outdir, 'qc_summary.csv')
+    logging.info(f"Writing QC summary: {qc_summary_file}")
+    qc_summary.write_qc_summary(cohort_qc, qc_summary_file)
+    qc_histograms_file = os.path.join(args.outdir, 'qc_histograms.csv')
+    logging.info(f"Writing QC histograms: {qc_histograms_file}")
+    qc_summary.write_qc_histograms(cohort_qc, qc_histograms_file)
+    locus_call_rates_file = os.path.join(args.outdir, 'locus_call_rates.csv')
+    logging.info(f"Writing locus call rates: {locus_call_rates_file}")
+    qc_summary.write_locus_call_rates(cohort_qc, locus_call_rates_file)
+
+    low_call_rate_loci = [row for row in cohort_qc['locus_call_rates'].iter_rows() if row['percent_called'] < args.min_locus_call_rate]
+    if low_call_rate_loci:
+        low_call_rate_loci.sort(key=lambda row: row['percent_called'])
+        worst_loci_str = ', '.join(f"{row['locus_id']} ({row['percent_called']}%)" for row in low_call_rate_loci[:10])
+        logging.warning(f"{len(low_call_rate_loci)} loci called in less than {args.min_locus_call_rate}% of samples. Lowest: {worst_loci_str}")
+
+
+def main_merge_profiles(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer merge-profiles', description='Merge allele profile files into a samples x loci matrix')
+    parser.add_argument('profiles', nargs='*', help='Allele profile files (allele_profile.csv). Sample IDs are taken from the name of the directory containing each file')
+    parser.add_argument('--profiles-list', help='File listing allele profile files, one per line')
+    parser.add_argument('--scheme', help='cgMLST scheme. Loci of each profile must match the scheme, in order (default: match the loci of the first profile)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of files to read concurrently (default: 1)')
+    parser.add_argument('--skip-mismatched', action='store_true', help='Skip files that can\'t be read, whose loci don\'t match, or whose sample ID is a duplicate, instead of failing')
+    parser.add_argument('-o', '--output', help='Output file for the matrix')
+    parser.add_argument('--format', dest='output_format', choices=['csv', 'tsv'], default='csv', help='Output format (default: csv)')
+    parser.add_argument('--store', help='Also append the profiles to this profile store (created if it does not exist), as a compact binary matrix')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    args = parser.parse_args(argv)
+
+    config.configure_logging({'log_level': args.log_level})
+
+    if args.output is None and args.store is None:
+        logging.error("At least one of --output or --store is required")
+        sys.exit(1)
+    allele_profile_paths = utils.collect_paths(args.profiles, args.profiles_list)
+    if not allele_profile_paths:
+        parser.print_help()
+        sys.exit(1)
+
+    locus_ids = scheme.load_scheme_index(args.scheme)['locus_ids'] if args.scheme is not None else None
+    store = None
+    if args.store is not None:
+        if os.path.exists(os.path.join(args.store, profile_store.LOCI_FILENAME)):
+            store = profile_store.ProfileStore(args.store)
+        elif locus_ids is not None:
+            store = profile_store.ProfileStore.open_or_create(args.store, locus_ids)
+        else:
+            logging.error(f"Profile store not found, and no --scheme provided to create it: {args.store}")
+            sys.exit(1)
+
+    delimiter = '\t' if args.output_format == 'tsv' else ','
+    logging.info(f"Merging {len(allele_profile_paths)} allele profiles")
+    try:
+        counts = merge_profiles.merge_allele_profiles(allele_profile_paths, output_path=args.output, locus_ids=locus_ids,
+                                                      delimiter=delimiter, store=store, threads=args.threads,
+                                                      skip_mismatched=args.skip_mismatched)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+    logging.info(f"Merged {counts['num_merged']} allele profiles ({counts['num_skipped']} skipped)")
+
+
+def main_shard_scheme(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer shard-scheme', description='Split a scheme into locus-disjoint kma indexes (shards), to align against concurrently with --scheme-shards')
+    parser.add_argument('--scheme', help='cgMLST scheme')
+    parser.add_argument('--num-shards', type=int, help='Number of shards')
+    parser.add_argument('--fasta', help='FASTA file of all alleles in the scheme, with headers <locus_id>_<allele_id> (default: extracted from the kma index with `kma seq2fasta`)')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory for the shards')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('scheme', 'num_shards', 'outdir'))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    try:
+        shard_manifest = sharding.build_scheme_shards(args.scheme, args.num_shards, args.outdir, fasta_path=args.fasta)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    for shard in shard_manifest['shards']:
+        logging.info(f"Scheme shard {shard['name']}: {shard['num_loci']} loci ({shard['first_locus_id']} to {shard['last_locus_id']}), total allele length {shard['total_allele_length']}")
+
+
+def main_assembly_index(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer assembly-index', description='Build an index of a scheme\'s allele sequences, for typing assemblies with --assembly')
+    parser.add_argument('--scheme', help='cgMLST scheme')
+    parser.add_argument('--fasta', help='FASTA file of all alleles in the scheme, with headers <locus_id>_<allele_id> (default: extracted from the kma index with `kma seq2fasta`)')
+    parser.add_argument('-k', '--kmer-size', type=int, default=assembly.DEFAULT_KMER_SIZE, help='Size of the anchor k-mers used to find alleles in assemblies, at most {max_kmer_size} (default: %(default)s)'.format(max_kmer_size=assembly.MAX_KMER_SIZE))
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory for the index (default: <scheme>.core-typer-assembly-index)')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('scheme',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    index_dir = args.outdir or assembly.get_default_assembly_index_dir(args.scheme)
+    try:
+        assembly.build_assembly_index(args.scheme, index_dir, fasta_path=args.fasta, kmer_size=args.kmer_size)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+
+def main_index(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer index', description='Build or update a sharded kma index of a scheme from per-locus FASTA files. Only shards with changed loci are re-indexed')
+    parser.add_argument('loci', nargs='*', help='Per-locus FASTA files, with headers <locus_id>_<allele_id>, or directories of them. New loci are added to the scheme in this order')
+    parser.add_argument('--loci-list', help='File listing per-locus FASTA files, one per line')
+    parser.add_argument('--num-shards', type=int, help='Number of shards to split a new index into (default: {default_num_shards}). Existing indexes keep their shards, unless --rebuild is given'.format(default_num_shards=indexing.DEFAULT_NUM_SHARDS))
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of shards to index concurrently (default: 1)')
+    parser.add_argument('--combined', action='store_true', help='Also build a single kma index of the whole scheme (at <outdir>/scheme), to type without --scheme-shards. It is rebuilt whenever any locus changes')
+    parser.add_argument('--rebuild', action='store_true', help='Re-partition the scheme into --num-shards shards and re-index every shard. Locus order is kept')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory for the index')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('outdir',))
+
+    config.configure_logging({'log_level': args.log_level})
+
+    locus_fasta_paths = indexing.find_locus_fasta_files(utils.collect_paths(args.loci, args.loci_list))
+    if not locus_fasta_paths:
+        logging.error("No per-locus FASTA files found")
+        sys.exit(1)
+
+    try:
+        counts = indexing.build_index(locus_fasta_paths, args.outdir, num_shards=args.num_shards, threads=args.threads,
+                                      combined=args.combined, rebuild=args.rebuild)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        logging.error(str(e))
+        sys.exit(1)
+    logging.info(f"Indexed {counts['num_loci']} loci ({counts['num_alleles']} alleles): {counts['num_loci_added']} added, {counts['num_loci_changed']} changed, "
+                 f"{counts['num_loci_removed']} removed. Re-indexed {counts['num_shards_indexed']} of {counts['num_shards']} shards")
+    logging.info(f"Type with: --scheme {indexing.get_scheme_path(args.outdir)} --scheme-shards {args.outdir}")
+
+
+def main_serve(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer serve', description='Run a typing server that keeps the scheme loaded, and types samples submitted with `core-typer submit`')
+    parser.add_argument('--scheme', help='cgMLST scheme')
+    parser.add_argument('--socket', help='Unix socket to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on, with --port (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, help='TCP port to listen on (instead of --socket)')
+    parser.add_argument('--allow-remote', action='store_true', help='Allow --host to be a non-loopback address. Clients are not authenticated, so anyone who can connect can submit jobs')
+    parser.add_argument('--output-root', help='Directory that submitted output directories and metrics files must be inside (default: the current directory)')
+    parser.add_argument('--max-jobs', type=int, default=1, help='Maximum number of samples to type at once (default: 1)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of CPU threads to use for each sample (default: 1)')
+    parser.add_argument('--min-identity', type=float, default=100.0, help='Default minimum percent identity (default: 100.0)')
+    parser.add_argument('--min-coverage', type=float, default=100.0, help='Default minimum percent coverage (default: 100.0)')
+    parser.add_argument('--tmpdir', default='./tmp', help='Temporary directory (default: ./tmp)')
+    parser.add_argument('--no-cleanup', action='store_true', help='Do not cleanup temporary directories')
+    _add_typing_arguments(parser, server=True)
+    parser.add_argument('--no-kma-shm', action='store_true', help='Do not load the kma index into shared memory')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('scheme',))
+    if args.socket is None and args.port is None:
+        parser.error('one of --socket or --port is required')
+    if args.socket is None and args.host not in server.LOOPBACK_HOSTS and not args.allow_remote:
+        parser.error(f"--host {args.host} is not a loopback address, and clients are not authenticated. Add --allow-remote to listen on it anyway")
+    if args.output_root is not None and not os.path.isdir(args.output_root):
+        parser.error(f"--output-root is not a directory: {args.output_root}")
+
+    config.configure_logging({'log_level': args.log_level})
+
+    server_params = {
+        'scheme': args.scheme,
+        'threads': args.threads,
+        'tmpdir': args.tmpdir,
+        'min_identity': args.min_identity,
+        'min_coverage': args.min_coverage,
+        'no_cleanup': args.no_cleanup,
+        'io_mode': args.io_mode,
+        'alignment_cache': args.alignment_cache,
+        'alignment_cache_max_bytes': int(args.alignment_cache_max_size * 1024 ** 3),
+        'novel_allele_hash': args.novel_allele_hash,
+        'scheme_shards': args.scheme_shards,
+        'max_concurrent_shards': args.max_concurrent_shards,
+        'profile_store': args.profile_store,
+        'query_db': args.query_db,
+        'query_k': args.query_k,
+        'query_max_distance': args.query_max_distance,
+    }
+    server.run_server(
+        server_params,
+        socket_path=args.socket,
+        host=args.host,
+        port=args.port,
+        max_concurrent_jobs=args.max_jobs,
+        kma_shm=not args.no_kma_shm,
+        output_root=args.output_root,
+    )
+
+
+def main_submit(argv=None):
+    parser = argparse.ArgumentParser(prog='core-typer submit', description='Submit samples to a typing server started with `core-typer serve`, and print results (JSON, one per line) as each sample completes')
+    parser.add_argument('--socket', help='Unix socket of the server')
+    parser.add_argument('--host', default='127.0.0.1', help='Host of the server, with --port (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, help='TCP port of the server (instead of --socket)')
+    parser.add_argument('--samples', help='Sample sheet (CSV with columns: ID, R1, R2). Outputs for each sample are written to a sub-directory of --outdir named by sample ID')
+    parser.add_argument('--R1', help='Read 1 (instead of --samples)')
+    parser.add_argument('--R2', help='Read 2 (instead of --samples)')
+    parser.add_argument('--min-identity', type=float, help='Minimum percent identity (default: the server\'s default)')
+    parser.add_argument('--min-coverage', type=float, help='Minimum percent coverage (default: the server\'s default)')
+    parser.add_argument('--target-depth', type=float, help='Downsample read pairs to approximately this depth before alignment (default: use all reads)')
+    parser.add_argument('--genome-size', type=int, help='Genome size in bp, used to estimate read depth for --target-depth (default: estimated scheme length, from the kma index)')
+    parser.add_argument('--novel-alleles', action='store_true', help='Call novel alleles at loci whose best hit meets --min-coverage but not --min-identity')
+    parser.add_argument('--log-level', default='info', help='Log level (default: info)')
+    parser.add_argument('--outdir', help='Output directory')
+    args = parser.parse_args(argv)
+
+    args = utils.validate_args(args, parser, required_args=('outdir',))
+    if args.socket is None and args.port is None:
+        parser.error('one of --socket or --port is required')
+    if not args.samples and not (args.R1 and args.R2):
+        parser.error('either --samples, or --R1 and --R2, are required')
+
+    config.configure_logging({'log_level': args.log_level})
+
+    if args.samples:
+        samples = batch.parse_sample_sheet(args.samples)
+        jobs = [{'job_id': sample['ID'], 'sample_id': sample['ID'], 'R1': sample['R1'], 'R2': sample['R2'], 'outdir': os.path.abspath(os.path.join(args.outdir, sample['ID']))} for sample in samples]
+    else:
+        jobs = [{'R1': os.path.abspath(args.R1), 'R2': os.path.abspath(args.R2), 'outdir': os.path.abspath(args.outdir)}]
+    job_options = {
+        'min_identity': args.min_identity,
+        'min_coverage': args.min_coverage,
+        'target_depth': args.target_depth,
+        'genome_size': args.genome_size,
+        'novel_alleles': args.novel_alleles or None,
+    }
+    for job in jobs:
+        job.update({option: value for option, value in job_options.items() if value is not None})
+
+    async def print_messages():
+        failed_job_ids = []
+        async for message in server.submit_jobs(jobs, socket_path=args.socket, host=args.host, port=args.port):
+            print(json.dumps(message), flush=True)
+            if message['event'] in ['failed', 'error']:
+                failed_job_ids.append(message.get('job_id'))
+        return failed_job_ids
+
+    failed_job_ids = asyncio.run(print_messages())
+    if failed_job_ids:
+        logging.error(f"Typing failed for {len(failed_job_ids)} of {len(jobs)} samples")
+        sys.exit(1)
+
+
+def main():
+    subcommands = {
+        'batch': main_batch,
+        'distance': main_distance,
+        'cluster': main_cluster,
+        'store': main_store,
+        'query': main_query,
+        'benchmark': main_benchmark,
+        'serve': main_serve,
+        'submit': main_submit,
+        'shard-scheme': main_shard_scheme,
+        'assembly-index': main_assembly_index,
+        'qc-summary': main_qc_summary,
+        'merge-profiles': main_merge_profiles,
+        'index': main_index,
+    }
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        subcommands[sys.argv[1]](sys.argv[2:])
     else:
-        logging.info(f"Skipped deleting tmp directory: {analysis_tmpdir}")
+        main_type(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,30 @@
+import concurrent.futures
 import datetime
 import json
 import os
 import sys
 import logging
+import tempfile
 
 from . import utils
 
+IO_MODES = ['disk', 'tmpfs', 'fifo']
+
+TMPFS_DIR = '/dev/shm'
+
+EXPECTED_OUTPUT_EXTENSIONS = [
+    'res',
+    'mapstat',
+]
+
+
 def build_alignment_command(params):
     """
     Build the kma alignment command line.
 
-    :param params: Dictionary of parameters. Keys of params are: 'threads', 'scheme', 'R1', 'R2', 'tmpdir'
+    :param params: Dictionary of parameters. Keys of params are: 'threads', 'scheme', 'R1', 'R2', 'tmpdir', plus optional
+                   'kma_shm' (use the kma index loaded into shared memory by kma shm, at this shared memory level) and
+                   'assembly' (align the contigs in this FASTA file, instead of R1 and R2)
     :type params: dict
     :return: Alignment command line
     :rtype: list
@@ -25,38 +39,156 @@ def build_alignment_command(params):
         "-mem_mode",
         "-and",
         "-t_db", params['scheme'],
-        "-ipe", params['R1'], params['R2'],
+    ]
+    if params.get('assembly'):
+        kma_command += ["-i", params['assembly']]
+    else:
+        kma_command += ["-ipe", params['R1'], params['R2']]
+    kma_command += [
         "-tmp", os.path.join(params['tmpdir'], "kma-tmp"),
         "-o", os.path.join(params['tmpdir'], "kma-out"),
     ]
+    if params.get('kma_shm'):
+        kma_command += ["-shm", str(params['kma_shm'])]
 
     return kma_command
 
 
-def run_alignment(alignment_params):
+def get_output_paths(params, extensions):
+    """
+    Get the paths to the kma output files.
+
+    :param params: Dictionary of parameters, as for build_alignment_command
+    :type params: dict
+    :param extensions: The output file extensions (eg. 'res', 'mapstat')
+    :type extensions: Iterable[str]
+    :return: The paths to the output files, indexed by extension
+    :rtype: dict[str, str]
+    """
+    output_paths = {
+        extension: os.path.abspath(os.path.join(params['tmpdir'], f"kma-out.{extension}"))
+        for extension in extensions
+    }
+
+    return output_paths
+
+
+def create_analysis_tmpdir(base_tmpdir, io_mode='disk', sample_id=None):
+    """
+    Create a new, uniquely-named temporary directory for a single analysis.
+
+    :param base_tmpdir: The directory to create the analysis tmpdir in (for io_mode 'disk')
+    :type base_tmpdir: str
+    :param io_mode: One of 'disk' (create under base_tmpdir), 'tmpfs' or 'fifo' (create under TMPFS_DIR if it
+                    exists, otherwise fall back to base_tmpdir)
+    :type io_mode: str
+    :param sample_id: Sample ID, included in the directory name
+    :type sample_id: str|None
+    :return: The path to the analysis tmpdir
+    :rtype: str
+    :raises ValueError: If the I/O mode is not recognized
+    """
+    if io_mode not in IO_MODES:
+        raise ValueError(f"Unknown I/O mode: {io_mode}")
+    if io_mode in ['tmpfs', 'fifo']:
+        if os.path.isdir(TMPFS_DIR):
+            base_tmpdir = TMPFS_DIR
+        else:
+            logging.warning(f"tmpfs directory not found: {TMPFS_DIR}. Using tmpdir: {base_tmpdir}")
+    os.makedirs(base_tmpdir, exist_ok=True)
+    now_str = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    if sample_id:
+        prefix = f"{now_str}-{sample_id}-core-typer-tmp-"
+    else:
+        prefix = f"{now_str}-core-typer-tmp-"
+    analysis_tmpdir = tempfile.mkdtemp(prefix=prefix, dir=base_tmpdir)
+
+    return analysis_tmpdir
+
+
+def _release_fifo_reader(fifo_path):
     """
-    Run the alignment.
+    Unblock a reader waiting on a named pipe that will never be opened for writing
+    (eg. because kma failed), by opening and closing the write end.
+    """
+    try:
+        fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    os.close(fd)
+
 
-    :param alignment_command: The alignment command
-    :type alignment_command: list
-    :return: None
-    :rtype: None
+def run_alignment(alignment_params, output_parsers=None, metrics=None, process_name='kma'):
     """
+    Run the alignment, and parse its output files.
+
+    With io_mode 'fifo', the output files are created as named pipes before kma starts, and
+    each parser reads its file concurrently, as kma writes it. Otherwise the parsers are run
+    after kma completes.
+
+    :param alignment_params: Dictionary of parameters. Keys are the same as for build_alignment_command, plus
+                             optional 'io_mode' (default: 'disk') and 'exit_on_failure' (default: True). If
+                             'exit_on_failure' is False, failures raise an exception instead of exiting the program.
+    :type alignment_params: dict
+    :param output_parsers: Parsers for the kma output files, indexed by output file extension (eg. 'res', 'mapstat').
+                           Each parser is called with the path to its output file
+    :type output_parsers: dict[str, Callable[[str], object]]|None
+    :param metrics: If provided, kma's resource usage is recorded here
+    :type metrics: metrics.Metrics|None
+    :param process_name: The name to record kma's resource usage under
+    :type process_name: str
+    :return: The parsed outputs, indexed by output file extension
+    :rtype: dict[str, object]
+    :raises subprocess.CalledProcessError: If kma fails and exit_on_failure is False
+    :raises FileNotFoundError: If kma output files are missing and exit_on_failure is False
+    """
+    exit_on_failure = alignment_params.get('exit_on_failure', True)
+    io_mode = alignment_params.get('io_mode', 'disk')
+    output_parsers = output_parsers or {}
     alignment_command = build_alignment_command(alignment_params)
     alignment_command_str = " ".join(alignment_command)
+    output_paths = get_output_paths(alignment_params, set(EXPECTED_OUTPUT_EXTENSIONS) | set(output_parsers))
+
+    parsed_outputs = {}
+    if io_mode == 'fifo':
+        for extension in output_parsers:
+            os.mkfifo(output_paths[extension])
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(output_parsers)))
+        parser_futures = {
+            extension: executor.submit(output_parser, output_paths[extension])
+            for extension, output_parser in output_parsers.items()
+        }
+
     logging.info(f"Alignment started with command: {alignment_command_str}")
     alignment_start_timestamp = datetime.datetime.now()
-    alignment_result = utils.run_command(alignment_command_str)
+    try:
+        alignment_result = utils.run_command(alignment_command, exit_on_failure=exit_on_failure)
+    finally:
+        if io_mode == 'fifo':
+            for extension in output_parsers:
+                _release_fifo_reader(output_paths[extension])
+            executor.shutdown(wait=True)
     alignment_end_timestamp = datetime.datetime.now()
     alignment_elapsed_time = alignment_end_timestamp - alignment_start_timestamp
-    expected_alignment_result_files = {
-        "kma_res": os.path.abspath(os.path.join(alignment_params['tmpdir'], "kma-out.res")),
-        "kma_mapstat": os.path.abspath(os.path.join(alignment_params['tmpdir'], "kma-out.mapstat")),
-    }
-    for alignment_result_file_type, alignment_result_file in expected_alignment_result_files.items():
+    if metrics is not None:
+        metrics.record_rusage(process_name, alignment_result.rusage)
+
+    for extension in EXPECTED_OUTPUT_EXTENSIONS:
+        alignment_result_file = output_paths[extension]
         if not os.path.exists(alignment_result_file):
             logging.error(f"Alignment failed. Missing output file: {alignment_result_file}")
+            if not exit_on_failure:
+                raise FileNotFoundError(f"Missing alignment output file: {alignment_result_file}")
             sys.exit(-1)
     alignment_elapsed_time_seconds_str = str(round(alignment_elapsed_time.total_seconds(), 2))
     logging.info(f"Alignment completed. Elapsed time: {alignment_elapsed_time_seconds_str} seconds.")
-    
+
+    for extension, output_parser in output_parsers.items():
+        if io_mode == 'fifo':
+            parsed_outputs[extension] = parser_futures[extension].result()
+        else:
+            logging.debug(f"Parsing kma output file: {output_paths[extension]}")
+            parsed_outputs[extension] = output_parser(output_paths[extension])
+            logging.debug(f"Parsing kma output file completed: {output_paths[extension]}")
+
+    return parsed_outputs
@@ -0,0 +1,281 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from . import alignment
+from . import scheme
+
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+KMA_INDEX_EXTENSIONS = [
+    'name',
+    'length.b',
+    'comp.b',
+    'seq.b',
+]
+
+ENTRIES_DIRNAME = 'entries'
+HASHES_DIRNAME = 'hashes'
+TMP_DIRNAME = 'tmp'
+ENTRY_METADATA_FILENAME = 'entry.json'
+LOCK_FILENAME = '.lock'
+
+
+class AlignmentCache(object):
+    """
+    A persistent cache of kma output files, keyed by the contents of everything that determines them:
+    the reads, the kma index files and the kma arguments.
+
+    The cache is a directory containing:
+
+      entries/<ab>/<key>/  One directory per cached alignment, holding the kma output files
+                           and entry.json (metadata). The directory mtime is the last use time.
+      hashes/              Content hashes of input files, keyed by path, size, mtime and inode,
+                           so unchanged files are only hashed once
+      tmp/                 Entries being written
+      .lock                Lock file (see below)
+
+    Entries are written to tmp/ and renamed into place, so readers never see a partial entry.
+    Reading an entry holds a shared lock, and evicting entries holds an exclusive lock, so
+    several processes can use the same cache concurrently. When the total size of all entries
+    exceeds the size limit, the least recently used entries are evicted.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param cache_dir: The cache directory (created if it does not exist)
+        :type cache_dir: str
+        :param max_bytes: Maximum total size of all cache entries, in bytes
+        :type max_bytes: int
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        for dirname in [ENTRIES_DIRNAME, HASHES_DIRNAME, TMP_DIRNAME]:
+            os.makedirs(os.path.join(cache_dir, dirname), exist_ok=True)
+
+    def hash_input_file(self, path):
+        """
+        Get the sha1 hash of a file's contents, reusing the stored hash if the file is unchanged.
+
+        :param path: The path to the file
+        :type path: str
+        :return: The hex digest of the file's sha1 hash
+        :rtype: str
+        """
+        path_stat = os.stat(path)
+        file_version = f"{os.path.abspath(path)}\0{path_stat.st_size}\0{path_stat.st_mtime_ns}\0{path_stat.st_ino}"
+        hash_file_path = os.path.join(self.cache_dir, HASHES_DIRNAME, hashlib.sha1(file_version.encode('utf-8')).hexdigest())
+        try:
+            with open(hash_file_path, 'r') as f:
+                file_hash = f.read().strip()
+            if len(file_hash) == 40:
+                return file_hash
+        except FileNotFoundError:
+            pass
+
+        logging.debug(f"Hashing file for alignment cache: {path}")
+        file_hash = scheme.hash_file(path)
+        _write_atomic(hash_file_path, file_hash + '\n', os.path.join(self.cache_dir, TMP_DIRNAME))
+
+        return file_hash
+
+    def hash_kma_index(self, index_path):
+        """
+        Get the sha1 hashes of the files of a kma index (see hash_input_file). Missing files are skipped.
+
+        :param index_path: The path to the kma index (as passed to kma -t_db)
+        :type index_path: str
+        :return: The hex digest of each file's sha1 hash, indexed by extension
+        :rtype: dict[str, str]
+        """
+        kma_index_hashes = {}
+        for extension in KMA_INDEX_EXTENSIONS:
+            kma_index_file = f"{index_path}.{extension}"
+            if os.path.exists(kma_index_file):
+                kma_index_hashes[extension] = self.hash_input_file(kma_index_file)
+
+        return kma_index_hashes
+
+    def make_key(self, read_paths, scheme_path, alignment_command, extra=None):
+        """
+        Make the cache key for an alignment.
+
+        :param read_paths: The paths to the read files
+        :type read_paths: list[str]
+        :param scheme_path: The path to the kma index (as passed to kma -t_db)
+        :type scheme_path: str
+        :param alignment_command: The kma command line, with paths and thread counts replaced by placeholders
+                                  (see normalize_alignment_command)
+        :type alignment_command: list[str]
+        :param extra: Anything else that changes the alignment outputs (eg. downsampling parameters). Must be JSON-serializable
+        :type extra: dict|None
+        :return: The cache key
+        :rtype: str
+        """
+        key_inputs = {
+            'version': CACHE_VERSION,
+            'reads': [self.hash_input_file(path) for path in read_paths],
+            'scheme': self.hash_kma_index(scheme_path),
+            'command': alignment_command,
+            'extra': extra or {},
+        }
+
+        return hashlib.sha256(json.dumps(key_inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, ENTRIES_DIRNAME, key[:2], key)
+
+    @contextlib.contextmanager
+    def lookup(self, key):
+        """
+        Look up a cache entry. The entry can't be evicted until the context exits, so its files
+        should be read inside the context.
+
+        :param key: The cache key, as returned by make_key
+        :type key: str
+        :return: The entry, or None if the key is not in the cache. Keys of the entry are: 'paths'
+                 (paths to the cached files, indexed by kma output file extension), 'metadata'
+        :rtype: dict|None
+        """
+        entry_dir = self._get_entry_dir(key)
+        with _locked(self.cache_dir, fcntl.LOCK_SH):
+            entry = None
+            try:
+                with open(os.path.join(entry_dir, ENTRY_METADATA_FILENAME), 'r') as f:
+                    entry_metadata = json.load(f)
+            except (FileNotFoundError, ValueError):
+                entry_metadata = None
+            if entry_metadata is not None:
+                os.utime(entry_dir)
+                entry = {
+                    'paths': {extension: os.path.join(entry_dir, filename) for extension, filename in entry_metadata['files'].items()},
+                    'metadata': entry_metadata['metadata'],
+                }
+            yield entry
+
+    def put(self, key, output_paths, metadata=None):
+        """
+        Add kma output files to the cache, then evict least recently used entries if the cache is over its size limit.
+        If the key is already in the cache (eg. added concurrently by another process), the existing entry is kept.
+
+        :param key: The cache key, as returned by make_key
+        :type key: str
+        :param output_paths: Paths to the kma output files to cache, indexed by extension (eg. 'res', 'mapstat')
+        :type output_paths: dict[str, str]
+        :param metadata: Anything else to store with the entry. Must be JSON-serializable
+        :type metadata: dict|None
+        :return: None
+        """
+        tmp_entry_dir = tempfile.mkdtemp(prefix=f"{key}-", dir=os.path.join(self.cache_dir, TMP_DIRNAME))
+        try:
+            entry_metadata = {
+                'key': key,
+                'created': time.time(),
+                'size_bytes': 0,
+                'files': {},
+                'metadata': metadata or {},
+            }
+            for extension, output_path in output_paths.items():
+                filename = f"kma-out.{extension}"
+                shutil.copyfile(output_path, os.path.join(tmp_entry_dir, filename))
+                entry_metadata['files'][extension] = filename
+                entry_metadata['size_bytes'] += os.path.getsize(output_path)
+            with open(os.path.join(tmp_entry_dir, ENTRY_METADATA_FILENAME), 'w') as f:
+                json.dump(entry_metadata, f)
+            os.chmod(tmp_entry_dir, 0o755)
+
+            entry_dir = self._get_entry_dir(key)
+            with _locked(self.cache_dir, fcntl.LOCK_EX):
+                os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+                if not os.path.exists(entry_dir):
+                    os.rename(tmp_entry_dir, entry_dir)
+                    logging.info(f"Added alignment to cache: {entry_dir}")
+                self._evict()
+        finally:
+            shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+
+    def evict(self):
+        """
+        Evict least recently used entries until the cache is within its size limit.
+
+        :return: None
+        """
+        with _locked(self.cache_dir, fcntl.LOCK_EX):
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total_bytes = 0
+        entries_dir = os.path.join(self.cache_dir, ENTRIES_DIRNAME)
+        for prefix_entry in os.scandir(entries_dir):
+            if not prefix_entry.is_dir():
+                continue
+            for entry in os.scandir(prefix_entry.path):
+                try:
+                    with open(os.path.join(entry.path, ENTRY_METADATA_FILENAME), 'r') as f:
+                        size_bytes = json.load(f)['size_bytes']
+                    last_used = entry.stat().st_mtime_ns
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((last_used, size_bytes, entry.path))
+                total_bytes += size_bytes
+
+        entries.sort()
+        for last_used, size_bytes, entry_dir in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            logging.info(f"Evicting alignment from cache: {entry_dir}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size_bytes
+
+
+def normalize_alignment_command(alignment_params):
+    """
+    Build the kma command line with the read paths, scheme path, tmpdir and thread count replaced
+    by placeholders (and without kma shm options), so that it only reflects the options that change kma's outputs.
+
+    :param alignment_params: The alignment parameters, as for alignment.build_alignment_command
+    :type alignment_params: dict
+    :return: The normalized kma command line
+    :rtype: list[str]
+    """
+    placeholder_params = dict(alignment_params)
+    placeholder_params.update({
+        'threads': '{threads}',
+        'scheme': '{scheme}',
+        'R1': '{R1}',
+        'R2': '{R2}',
+        'tmpdir': '{tmpdir}',
+        'kma_shm': None,
+    })
+
+    return alignment.build_alignment_command(placeholder_params)
+
+
+def _write_atomic(path, contents, tmpdir):
+    fd, tmp_path = tempfile.mkstemp(dir=tmpdir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _locked(cache_dir, operation):
+    with open(os.path.join(cache_dir, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
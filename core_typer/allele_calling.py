@@ -1,7 +1,12 @@
 import csv
+import itertools
 import logging
 
+import numpy as np
+
 from . import parsers
+from . import records
+from . import scheme
 
 logger = logging.getLogger(__name__)
 
@@ -9,33 +14,126 @@ def choose_best_allele(kma_results, min_identity=100.0, min_coverage=100.0):
     """
     Given a list of kma results for a specific locus, choose the best allele.
     Best allele is chosen based on score. If multiple alleles have the same
-    score, the first allele is chosen. If no alleles meet the minimum identity
-    or coverage, the allele id is set to "-".
+    score, the first allele is chosen. If the best allele doesn't meet the minimum
+    identity or coverage, the allele id is set to "-". The kma results are not modified.
     
     :param kma_results: The kma results for a specific locus
-    :type kma_results: list[dict]
+    :type kma_results: list[records.KmaHit]
     :param min_identity: The minimum identity required to call an allele
     :type min_identity: float
     :param min_coverage: The minimum coverage required to call an allele
     :type min_coverage: float
-    :return: The best allele
-    :rtype: dict
+    :return: The allele call, or None if there are no kma results
+    :rtype: records.AlleleCall|None
     """
-    best_allele = None
+    best_hit = None
     for kma_result in kma_results:
-        if kma_result["template_identity"] < min_identity:
-            kma_result["allele_id"] = "-"
-        if kma_result["template_coverage"] < min_coverage:
-            kma_result["allele_id"] = "-"
-        if best_allele is None:
-            best_allele = kma_result
-        else:
-            if kma_result["score"] > best_allele["score"]:
-                best_allele = kma_result
+        if best_hit is None or kma_result.score > best_hit.score:
+            best_hit = kma_result
+    if best_hit is None:
+        return None
+
+    allele_id = best_hit.allele_id
+    if best_hit.template_identity < min_identity or best_hit.template_coverage < min_coverage:
+        allele_id = "-"
+    best_allele = records.AlleleCall(
+        locus_id=best_hit.locus_id,
+        allele_id=allele_id,
+        score=best_hit.score,
+        template_length=best_hit.template_length,
+        percent_identity=best_hit.template_identity,
+        percent_coverage=best_hit.template_coverage,
+        depth=best_hit.depth,
+        template=best_hit.template,
+    )
 
     return best_allele
 
 
+def call_alleles(kma_result_columns, min_identity=100.0, min_coverage=100.0, kma_mapstat_columns=None):
+    """
+    Call alleles for all loci at once, from kma results as columns (see parsers.parse_kma_result_columnar).
+
+    This follows the same rule as choose_best_allele, in one vectorized group-by pass: the highest-scoring
+    hit is chosen for each locus (the first one, if several hits share the top score), then its allele id
+    is set to "-" if it doesn't meet the minimum identity or coverage.
+
+    If kma mapstat columns are given, each call's best hit is joined to its mapstat row by template name,
+    in a single pass over the mapstat rows, to fill in the read and variant counts (see records.ALLELE_CALL_MAPSTAT_FIELDS).
+    Only the best hits are indexed by name, so the index needs memory proportional to the number of loci, not hits.
+
+    :param kma_result_columns: The kma results, as returned by parsers.parse_kma_result_columnar
+    :type kma_result_columns: dict[str, object]
+    :param min_identity: The minimum identity required to call an allele
+    :type min_identity: float
+    :param min_coverage: The minimum coverage required to call an allele
+    :type min_coverage: float
+    :param kma_mapstat_columns: The kma mapstat, as returned by parsers.parse_kma_mapstat_columnar, with (at least)
+                                the columns in records.ALLELE_CALL_MAPSTAT_FIELDS
+    :type kma_mapstat_columns: dict[str, object]|None
+    :return: The allele calls, one per locus with hits, in the order of kma_result_columns['locus_ids']
+    :rtype: list[records.AlleleCall]
+    """
+    best_rows = parsers.select_top_n_per_locus(kma_result_columns['locus_index'], kma_result_columns['score'], top_n=1)
+    identities = kma_result_columns['template_identity'][best_rows]
+    coverages = kma_result_columns['template_coverage'][best_rows]
+    below_threshold = (identities < min_identity) | (coverages < min_coverage)
+    allele_ids = np.where(below_threshold, "-", kma_result_columns['allele_id'][best_rows])
+    locus_ids = kma_result_columns['locus_ids']
+    templates = kma_result_columns['template'][best_rows].tolist()
+
+    allele_call_columns = [
+        [locus_ids[locus_idx] for locus_idx in kma_result_columns['locus_index'][best_rows].tolist()],
+        allele_ids.tolist(),
+        kma_result_columns['score'][best_rows].tolist(),
+        kma_result_columns['template_length'][best_rows].tolist(),
+        identities.tolist(),
+        coverages.tolist(),
+        kma_result_columns['depth'][best_rows].tolist(),
+        templates,
+    ]
+    if kma_mapstat_columns is not None:
+        mapstat_rows = join_mapstat_rows(templates, kma_mapstat_columns['ref_sequence'])
+        joined_positions = np.flatnonzero(mapstat_rows >= 0)
+        for field in records.ALLELE_CALL_MAPSTAT_FIELDS:
+            joined_values = kma_mapstat_columns[field][mapstat_rows[joined_positions]].tolist()
+            if len(joined_positions) == len(templates):
+                allele_call_columns.append(joined_values)
+                continue
+            values = [None] * len(templates)
+            for position, value in zip(joined_positions.tolist(), joined_values):
+                values[position] = value
+            allele_call_columns.append(values)
+    else:
+        allele_call_columns.extend([[None] * len(templates)] * len(records.ALLELE_CALL_MAPSTAT_FIELDS))
+
+    allele_calls = list(map(records.AlleleCall._make, zip(*allele_call_columns)))
+
+    return allele_calls
+
+
+def join_mapstat_rows(templates, ref_sequences):
+    """
+    Find the kma mapstat row for each template, in a single pass over the mapstat rows.
+    If a template has more than one row, the first one is used.
+
+    :param templates: The templates to find (eg. the best hit for each locus)
+    :type templates: list[str]
+    :param ref_sequences: The template name of each mapstat row (the 'ref_sequence' column)
+    :type ref_sequences: numpy.ndarray
+    :return: The mapstat row index for each template, or -1 if it has no mapstat row
+    :rtype: numpy.ndarray
+    """
+    positions = {template: position for position, template in enumerate(templates)}
+    row_positions = np.fromiter(map(positions.get, ref_sequences.tolist(), itertools.repeat(-1)), dtype=np.intp, count=len(ref_sequences))
+    joined_rows = np.flatnonzero(row_positions >= 0)
+    joined_positions, first_row_idxs = np.unique(row_positions[joined_rows], return_index=True)
+    mapstat_rows = np.full(len(templates), -1, dtype=np.intp)
+    mapstat_rows[joined_positions] = joined_rows[first_row_idxs]
+
+    return mapstat_rows
+
+
 def write_allele_calls(allele_calls_file, allele_calls):
     """
     Write allele calls to a CSV file.
@@ -43,55 +141,169 @@ def write_allele_calls(allele_calls_file, allele_calls):
     :param allele_calls_file: The path to the allele calls file
     :type allele_calls_file: str
     :param allele_calls: The allele calls
-    :type allele_calls: list[dict]
+    :type allele_calls: list[records.AlleleCall]
     :return: None
     """
-    output_fieldnames = [
-        "locus_id",
-        "allele_id",
-        "score",
-        "template_length",
-        "percent_identity",
-        "percent_coverage",
-        "depth",
-    ]
+    output_fieldnames = records.ALLELE_CALL_FIELDNAMES
     with open(allele_calls_file, 'w') as f:
-        writer = csv.DictWriter(f, delimiter=',', fieldnames=output_fieldnames)
-        writer.writeheader()
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(output_fieldnames)
         for allele_call in allele_calls:
-            output_record = {}
-            for fieldname in output_fieldnames:
-                if fieldname in allele_call:
-                    output_record[fieldname] = allele_call[fieldname]
-                elif fieldname == "percent_identity":
-                    output_record[fieldname] = allele_call["template_identity"]
-                elif fieldname == "percent_coverage":
-                    output_record[fieldname] = allele_call["template_coverage"]
-            writer.writerow(output_record)
+            writer.writerow([getattr(allele_call, field) for field in output_fieldnames])
 
 
 def write_allele_profile(allele_calls, scheme_path, allele_profile_path):
     """
-    """
+    Write an allele profile to a CSV file. The header contains all locus IDs
+    in the scheme, in the order that they appear in the scheme's .name file.
+    Loci without an allele call are written as "-".
 
-    names_file = f"{scheme_path}.name"
-    locus_ids = parsers.parse_locus_names(names_file)
+    :param allele_calls: The allele calls
+    :type allele_calls: list[records.AlleleCall]
+    :param scheme_path: The path to the kma index for the scheme
+    :type scheme_path: str
+    :param allele_profile_path: The path to the allele profile file
+    :type allele_profile_path: str
+    :return: None
+    :raises ValueError: If there is more than one allele call for a locus
+    """
+    locus_ids = scheme.load_scheme_index(scheme_path)['locus_ids']
     allele_calls_by_locus_id = {}
     for allele_call in allele_calls:
-        locus_id = allele_call['locus_id']
+        locus_id = allele_call.locus_id
         if locus_id not in allele_calls_by_locus_id:
             allele_calls_by_locus_id[locus_id] = allele_call
         else:
             raise ValueError(f"Duplicate allele call found for locus {locus_id}")
 
+    allele_ids = []
+    for locus_id in locus_ids:
+        if locus_id in allele_calls_by_locus_id:
+            allele_ids.append(allele_calls_by_locus_id[locus_id].allele_id)
+        else:
+            allele_ids.append('-')
+
     with open(allele_profile_path, 'w') as f:
         f.write(','.join(locus_ids) + '\n')
-        for locus_id in locus_ids:
-            if locus_id in allele_calls_by_locus_id:
-                allele_id = allele_calls_by_locus_id[locus_id]['allele_id']
-            else:
-                allele_id = '-'
-            f.write(allele_id)
-            if locus_id != locus_ids[-1]:
-                f.write(',')
-        f.write('\n')
+        f.write(','.join(allele_ids) + '\n')
+
+
+def parse_threshold_sweep(sweep_spec, default_min_identity=100.0, default_min_coverage=100.0):
+    """
+    Parse a threshold sweep specification, eg. 'identity=95:100:0.5,coverage=90:100:1'.
+    Each range is 'start:stop:step', and includes stop. A single value may be given instead of
+    a range. If identity or coverage is not specified, only the default threshold is used.
+
+    :param sweep_spec: The threshold sweep specification
+    :type sweep_spec: str
+    :param default_min_identity: The identity threshold to use if identity is not specified
+    :type default_min_identity: float
+    :param default_min_coverage: The coverage threshold to use if coverage is not specified
+    :type default_min_coverage: float
+    :return: The thresholds to evaluate. Keys are: 'min_identity', 'min_coverage'
+    :rtype: dict[str, numpy.ndarray]
+    :raises ValueError: If the specification can't be parsed
+    """
+    thresholds = {
+        'min_identity': np.array([default_min_identity]),
+        'min_coverage': np.array([default_min_coverage]),
+    }
+    for sweep_range in sweep_spec.split(','):
+        name, _, range_spec = sweep_range.partition('=')
+        threshold_name = f"min_{name.strip()}"
+        if threshold_name not in thresholds or not range_spec:
+            raise ValueError(f"Invalid threshold sweep: {sweep_range} (expected identity=START:STOP:STEP or coverage=START:STOP:STEP)")
+        try:
+            range_values = [float(value) for value in range_spec.split(':')]
+        except ValueError:
+            raise ValueError(f"Invalid threshold sweep range: {sweep_range}")
+        if len(range_values) == 1:
+            thresholds[threshold_name] = np.array(range_values)
+            continue
+        if len(range_values) != 3 or range_values[2] <= 0 or range_values[1] < range_values[0]:
+            raise ValueError(f"Invalid threshold sweep range: {sweep_range} (expected START:STOP:STEP, with STEP > 0 and STOP >= START)")
+        start, stop, step = range_values
+        num_steps = int(np.floor((stop - start) / step + 1e-9)) + 1
+        # Round so that thresholds compare equal to the same values parsed from kma's output (eg. 99.7, not 99.69999999999999).
+        thresholds[threshold_name] = np.round(start + step * np.arange(num_steps), 6)
+
+    return thresholds
+
+
+def sweep_thresholds(kma_result_columns, identity_thresholds, coverage_thresholds):
+    """
+    Evaluate allele calls for every combination of identity and coverage thresholds at once.
+
+    The best-scoring hit for each locus doesn't depend on the thresholds (see call_alleles),
+    so each combination only decides whether each locus's best hit is called or not. This is
+    done for all combinations in a single vectorized comparison.
+
+    :param kma_result_columns: The kma results, as returned by parsers.parse_kma_result_columnar
+    :type kma_result_columns: dict[str, object]
+    :param identity_thresholds: The minimum identity thresholds to evaluate
+    :type identity_thresholds: numpy.ndarray
+    :param coverage_thresholds: The minimum coverage thresholds to evaluate
+    :type coverage_thresholds: numpy.ndarray
+    :return: The sweep results. Keys are: 'locus_ids' (loci with hits), 'allele_ids' (allele ID of the best hit for each locus),
+             'min_identity' and 'min_coverage' (the thresholds for each combination), 'called' (bool array, combinations x loci)
+    :rtype: dict
+    """
+    best_rows = parsers.select_top_n_per_locus(kma_result_columns['locus_index'], kma_result_columns['score'], top_n=1)
+    locus_ids = [kma_result_columns['locus_ids'][locus_idx] for locus_idx in kma_result_columns['locus_index'][best_rows].tolist()]
+    allele_ids = kma_result_columns['allele_id'][best_rows].tolist()
+    identities = kma_result_columns['template_identity'][best_rows]
+    coverages = kma_result_columns['template_coverage'][best_rows]
+
+    min_identity, min_coverage = np.meshgrid(identity_thresholds, coverage_thresholds, indexing='ij')
+    min_identity = min_identity.ravel()
+    min_coverage = min_coverage.ravel()
+    called = (identities[None, :] >= min_identity[:, None]) & (coverages[None, :] >= min_coverage[:, None])
+
+    sweep_result = {
+        'locus_ids': locus_ids,
+        'allele_ids': allele_ids,
+        'min_identity': min_identity,
+        'min_coverage': min_coverage,
+        'called': called,
+    }
+
+    return sweep_result
+
+
+def write_threshold_sweep(sweep_result, scheme_path, threshold_sweep_path):
+    """
+    Write threshold sweep results to a CSV file, with one row per combination of thresholds.
+    Columns are the thresholds, the number and percent of loci called, then the allele call for every
+    locus in the scheme. As for the QC stats, percent called is relative to the loci with kma hits.
+
+    :param sweep_result: The sweep results, as returned by sweep_thresholds
+    :type sweep_result: dict
+    :param scheme_path: The path to the kma index for the scheme
+    :type scheme_path: str
+    :param threshold_sweep_path: The path to the threshold sweep file
+    :type threshold_sweep_path: str
+    :return: None
+    """
+    scheme_locus_ids = scheme.load_scheme_index(scheme_path)['locus_ids']
+    hit_positions = {locus_id: position for position, locus_id in enumerate(sweep_result['locus_ids'])}
+    scheme_hit_positions = [hit_positions.get(locus_id) for locus_id in scheme_locus_ids]
+    num_loci = len(sweep_result['locus_ids'])
+    num_called = sweep_result['called'].sum(axis=1)
+
+    header = ['min_identity', 'min_coverage', 'num_loci', 'num_called', 'percent_called'] + scheme_locus_ids
+    with open(threshold_sweep_path, 'w') as f:
+        f.write(','.join(header) + '\n')
+        for combination_idx, called in enumerate(sweep_result['called']):
+            percent_called = round(num_called[combination_idx] / num_loci * 100, 3) if num_loci > 0 else 0.0
+            allele_calls = [
+                sweep_result['allele_ids'][position] if position is not None and called[position] else '-'
+                for position in scheme_hit_positions
+            ]
+            row = [
+                str(sweep_result['min_identity'][combination_idx]),
+                str(sweep_result['min_coverage'][combination_idx]),
+                str(num_loci),
+                str(num_called[combination_idx]),
+                str(percent_called),
+            ]
+            f.write(','.join(row + allele_calls) + '\n')
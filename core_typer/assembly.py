@@ -0,0 +1,368 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import subprocess
+
+import numpy as np
+
+from . import records
+from . import scheme
+from . import sharding
+
+ASSEMBLY_INDEX_VERSION = 1
+ASSEMBLY_INDEX_MANIFEST_FILENAME = 'assembly_index.json'
+
+DEFAULT_KMER_SIZE = 31
+MAX_KMER_SIZE = 32
+
+# Number of low bits of each k-mer used to index the anchor filter (see load_assembly_index)
+ANCHOR_FILTER_BITS = 24
+
+# Arrays in an assembly index, stored as .npy files so they can be memory-mapped
+ASSEMBLY_INDEX_ARRAYS = [
+    'allele_loci',
+    'allele_sequence_offsets',
+    'allele_name_offsets',
+    'sequence_hashes',
+    'sequence_hash_alleles',
+    'anchor_kmers',
+    'anchor_loci',
+    'anchor_lengths',
+    'locus_alleles',
+    'locus_allele_offsets',
+]
+SEQUENCES_FILENAME = 'sequences.bin'
+NAMES_FILENAME = 'names.bin'
+
+# 2-bit codes for A, C, G, T (either case). Other bases are coded as 4, and k-mers containing them are skipped.
+_BASE_CODES = np.full(256, 4, dtype=np.uint64)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    for _base in _bases:
+        _BASE_CODES[_base] = _code
+
+_REVERSE_COMPLEMENT = bytes.maketrans(b'ACGTacgtNn', b'TGCAtgcaNn')
+
+_BASE_DIGITS = bytes.maketrans(b'ACGT', b'0123')
+
+
+def get_default_assembly_index_dir(scheme_path):
+    """
+    Get the default location of the assembly index for a scheme, which is stored next to the kma index.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :return: The path to the assembly index directory
+    :rtype: str
+    """
+    return f"{scheme_path}.core-typer-assembly-index"
+
+
+def hash_sequence(sequence):
+    """
+    Hash an allele sequence, for exact-match lookup.
+
+    :param sequence: The sequence (upper case)
+    :type sequence: bytes
+    :return: A 64-bit hash of the sequence
+    :rtype: int
+    """
+    return int.from_bytes(hashlib.blake2b(sequence, digest_size=8).digest(), 'little')
+
+
+def encode_kmers(sequence, kmer_size):
+    """
+    Encode every k-mer of a sequence as an integer (2 bits per base).
+
+    :param sequence: The sequence
+    :type sequence: bytes
+    :param kmer_size: The k-mer size (at most 32)
+    :type kmer_size: int
+    :return: The code of the k-mer starting at each position, and whether it contains only A, C, G and T
+    :rtype: tuple[numpy.ndarray, numpy.ndarray]
+    """
+    num_kmers = len(sequence) - kmer_size + 1
+    if num_kmers <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    base_codes = _BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    # Codes of all substrings of length 1, 2, 4, 8, ..., each built from two of the previous length,
+    # then combined into k-mers, so only about 2 * log2(k) passes are made over the sequence
+    substring_codes = {1: base_codes & np.uint64(3)}
+    substring_length = 1
+    while substring_length * 2 <= kmer_size:
+        codes = substring_codes[substring_length]
+        substring_codes[substring_length * 2] = (codes[:-substring_length] << np.uint64(2 * substring_length)) | codes[substring_length:]
+        substring_length *= 2
+    kmers = np.zeros(num_kmers, dtype=np.uint64)
+    offset = 0
+    for substring_length in sorted(substring_codes, reverse=True):
+        if offset + substring_length <= kmer_size:
+            kmers = (kmers << np.uint64(2 * substring_length)) | substring_codes[substring_length][offset:offset + num_kmers]
+            offset += substring_length
+    num_invalid_bases = np.concatenate([[0], np.cumsum(base_codes > 3)])
+    valid = num_invalid_bases[kmer_size:] == num_invalid_bases[:num_kmers]
+
+    return kmers, valid
+
+
+def encode_kmer(kmer):
+    """
+    Encode a single k-mer as an integer, as for encode_kmers.
+
+    :param kmer: The k-mer (upper case)
+    :type kmer: bytes
+    :return: The code of the k-mer, or None if it contains bases other than A, C, G and T
+    :rtype: int|None
+    """
+    digits = kmer.translate(_BASE_DIGITS)
+    if digits.strip(b'0123'):
+        return None
+
+    return int(digits, 4)
+
+
+def build_assembly_index(scheme_path, index_dir, fasta_path=None, kmer_size=DEFAULT_KMER_SIZE):
+    """
+    Build an index of a scheme's allele sequences, for typing assemblies without alignment (see find_exact_alleles).
+
+    Allele sequences are taken from fasta_path if given, otherwise they are extracted from the kma index with
+    `kma seq2fasta`. The index holds:
+
+      - The allele sequences and names ('<locus_id>_<allele_id>', as in the kma index), and the alleles of each locus
+      - A sorted table of sequence hashes, to look up alleles by their sequence
+      - A sorted table of anchor k-mers (the first k bases of each allele), with the locus and lengths of the
+        alleles that start with each one, to find where alleles might start in an assembly
+
+    Arrays are written as .npy files, and sequences and names as flat binary files, so the index can be memory-mapped.
+    The manifest (assembly_index.json) records the k-mer size and the .name file hash of the scheme it was built from.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :param index_dir: The directory to write the index to (created if it does not exist)
+    :type index_dir: str
+    :param fasta_path: A FASTA file of all alleles in the scheme, with headers '<locus_id>_<allele_id>'
+    :type fasta_path: str|None
+    :param kmer_size: The anchor k-mer size (at most 32)
+    :type kmer_size: int
+    :return: The assembly index (see load_assembly_index)
+    :rtype: dict
+    :raises ValueError: If the k-mer size is out of range, or the allele sequences don't match the scheme's .name file
+    """
+    if not 1 <= kmer_size <= MAX_KMER_SIZE:
+        raise ValueError(f"k-mer size must be between 1 and {MAX_KMER_SIZE}: {kmer_size}")
+    os.makedirs(index_dir, exist_ok=True)
+    scheme_index = scheme.load_scheme_index(scheme_path)
+    extracted_fasta = fasta_path is None
+    if extracted_fasta:
+        fasta_path = os.path.join(index_dir, 'scheme.fasta')
+        logging.info(f"Extracting allele sequences from kma index: {scheme_path}")
+        with open(fasta_path, 'w') as f:
+            subprocess.run(["kma", "seq2fasta", "-t_db", scheme_path], stdout=f, check=True)
+
+    allele_loci = []
+    allele_sequence_offsets = [0]
+    allele_name_offsets = [0]
+    sequence_hashes = []
+    anchors = set()
+    num_unanchored = 0
+    with open(os.path.join(index_dir, SEQUENCES_FILENAME), 'wb') as sequences_file, open(os.path.join(index_dir, NAMES_FILENAME), 'wb') as names_file:
+        for header, sequence in sharding.iter_fasta(fasta_path):
+            locus_position = scheme_index['locus_positions'].get(header.split('_')[0])
+            if locus_position is None:
+                raise ValueError(f"Allele {header} in {fasta_path} is not in scheme: {scheme_path}")
+            sequence = sequence.upper().encode('ascii')
+            name = header.encode('utf-8')
+            sequences_file.write(sequence)
+            names_file.write(name)
+            allele_loci.append(locus_position)
+            allele_sequence_offsets.append(allele_sequence_offsets[-1] + len(sequence))
+            allele_name_offsets.append(allele_name_offsets[-1] + len(name))
+            sequence_hashes.append(hash_sequence(sequence))
+            anchor_kmer = encode_kmer(sequence[:kmer_size]) if len(sequence) >= kmer_size else None
+            if anchor_kmer is not None:
+                anchors.add((anchor_kmer, locus_position, len(sequence)))
+            else:
+                num_unanchored += 1
+    if extracted_fasta:
+        os.remove(fasta_path)
+
+    num_alleles = len(allele_loci)
+    allele_loci = np.array(allele_loci, dtype=np.uint32)
+    sequence_hashes = np.array(sequence_hashes, dtype=np.uint64)
+    hash_order = np.argsort(sequence_hashes, kind='stable')
+    anchors = np.array(sorted(anchors), dtype=np.uint64).reshape(-1, 3)
+    locus_alleles = np.argsort(allele_loci, kind='stable').astype(np.uint32)
+    index_arrays = {
+        'allele_loci': allele_loci,
+        'allele_sequence_offsets': np.array(allele_sequence_offsets, dtype=np.uint64),
+        'allele_name_offsets': np.array(allele_name_offsets, dtype=np.uint64),
+        'sequence_hashes': sequence_hashes[hash_order],
+        'sequence_hash_alleles': hash_order.astype(np.uint32),
+        'anchor_kmers': anchors[:, 0],
+        'anchor_loci': anchors[:, 1].astype(np.uint32),
+        'anchor_lengths': anchors[:, 2].astype(np.uint32),
+        'locus_alleles': locus_alleles,
+        'locus_allele_offsets': np.searchsorted(allele_loci[locus_alleles], np.arange(len(scheme_index['locus_ids']) + 1)).astype(np.uint64),
+    }
+    for array_name, array in index_arrays.items():
+        np.save(os.path.join(index_dir, f"{array_name}.npy"), array)
+
+    manifest = {
+        'version': ASSEMBLY_INDEX_VERSION,
+        'kmer_size': kmer_size,
+        'num_alleles': num_alleles,
+        'num_loci': len(scheme_index['locus_ids']),
+        'scheme_names_file_hash': scheme.hash_file(scheme.get_names_file(scheme_path)),
+    }
+    with open(os.path.join(index_dir, ASSEMBLY_INDEX_MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(f"Built assembly index of {num_alleles} alleles ({len(anchors)} anchor k-mers): {index_dir}")
+    if num_unanchored > 0:
+        logging.warning(f"{num_unanchored} alleles are shorter than {kmer_size} bp or start with a base other than A, C, G or T. They can only be called by alignment")
+
+    return load_assembly_index(index_dir, scheme_path)
+
+
+def load_assembly_index(index_dir, scheme_path):
+    """
+    Load an assembly index (memory-mapped), and check that it was built from the scheme.
+
+    :param index_dir: The assembly index directory, as created by build_assembly_index
+    :type index_dir: str
+    :param scheme_path: The path to the kma index (as passed to kma -t_db) that the index should have been built from
+    :type scheme_path: str
+    :return: The assembly index. Keys are: 'manifest', 'locus_ids', 'sequences' and 'names' (memory-mapped bytes),
+             'anchor_filter' (whether any anchor k-mer has each value of the low ANCHOR_FILTER_BITS bits, so most k-mers
+             of an assembly can be ruled out without searching the anchors), plus one memory-mapped array per entry in ASSEMBLY_INDEX_ARRAYS
+    :rtype: dict
+    :raises ValueError: If the index version is not supported, or the index was built from a different scheme
+    """
+    manifest_file = os.path.join(index_dir, ASSEMBLY_INDEX_MANIFEST_FILENAME)
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != ASSEMBLY_INDEX_VERSION:
+        raise ValueError(f"Unsupported assembly index version {manifest.get('version')}: {manifest_file}")
+    if manifest['scheme_names_file_hash'] != scheme.hash_file(scheme.get_names_file(scheme_path)):
+        raise ValueError(f"Assembly index in {index_dir} was not built from scheme: {scheme_path}. Rebuild it with `core-typer assembly-index`")
+
+    assembly_index = {
+        'manifest': manifest,
+        'locus_ids': scheme.load_scheme_index(scheme_path)['locus_ids'],
+    }
+    for array_name in ASSEMBLY_INDEX_ARRAYS:
+        assembly_index[array_name] = np.load(os.path.join(index_dir, f"{array_name}.npy"), mmap_mode='r')
+    for key, filename in [('sequences', SEQUENCES_FILENAME), ('names', NAMES_FILENAME)]:
+        with open(os.path.join(index_dir, filename), 'rb') as f:
+            # mmap can't map an empty file
+            assembly_index[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+    assembly_index['anchor_filter'] = np.zeros(2 ** ANCHOR_FILTER_BITS, dtype=bool)
+    assembly_index['anchor_filter'][assembly_index['anchor_kmers'] & np.uint64(2 ** ANCHOR_FILTER_BITS - 1)] = True
+
+    return assembly_index
+
+
+def get_allele_sequence(assembly_index, allele_idx):
+    """
+    :param assembly_index: The assembly index, as returned by load_assembly_index
+    :type assembly_index: dict
+    :param allele_idx: The allele's position in the index
+    :type allele_idx: int
+    :return: The allele sequence (upper case)
+    :rtype: bytes
+    """
+    offsets = assembly_index['allele_sequence_offsets']
+    return assembly_index['sequences'][int(offsets[allele_idx]):int(offsets[allele_idx + 1])]
+
+
+def get_allele_name(assembly_index, allele_idx):
+    """
+    :param assembly_index: The assembly index, as returned by load_assembly_index
+    :type assembly_index: dict
+    :param allele_idx: The allele's position in the index
+    :type allele_idx: int
+    :return: The allele name, '<locus_id>_<allele_id>'
+    :rtype: str
+    """
+    offsets = assembly_index['allele_name_offsets']
+    return assembly_index['names'][int(offsets[allele_idx]):int(offsets[allele_idx + 1])].decode('utf-8')
+
+
+def _lookup_allele(assembly_index, sequence, locus_position):
+    # Find the first allele of the locus with exactly this sequence, or None
+    sequence_hashes = assembly_index['sequence_hashes']
+    sequence_hash = np.uint64(hash_sequence(sequence))
+    hash_idx = int(np.searchsorted(sequence_hashes, sequence_hash))
+    allele_idxs = []
+    while hash_idx < len(sequence_hashes) and sequence_hashes[hash_idx] == sequence_hash:
+        allele_idx = int(assembly_index['sequence_hash_alleles'][hash_idx])
+        if assembly_index['allele_loci'][allele_idx] == locus_position and get_allele_sequence(assembly_index, allele_idx) == sequence:
+            allele_idxs.append(allele_idx)
+        hash_idx += 1
+
+    return min(allele_idxs, default=None)
+
+
+def find_exact_alleles(assembly_path, assembly_index):
+    """
+    Find alleles that occur exactly (full length, 100% identity, either strand) in an assembly.
+
+    Each contig is scanned for anchor k-mers on both strands. At each anchor, the sequence of each allele length
+    starting with that k-mer is looked up by its hash (and compared in full, so hash collisions can't cause a false call).
+    If a locus matches more than one distinct allele (eg. a duplicated locus), it isn't called here, and is left for alignment.
+
+    :param assembly_path: The path to the assembly (FASTA)
+    :type assembly_path: str
+    :param assembly_index: The assembly index, as returned by load_assembly_index
+    :type assembly_index: dict
+    :return: The exact matches, as kma hits (score and template length are the allele length, identities and
+             coverages 100, depth 1), indexed by locus ID, in scheme order
+    :rtype: dict[str, records.KmaHit]
+    """
+    kmer_size = assembly_index['manifest']['kmer_size']
+    anchor_kmers = assembly_index['anchor_kmers']
+    anchor_filter_mask = np.uint64(2 ** ANCHOR_FILTER_BITS - 1)
+    allele_idxs_by_locus_position = {}
+    for contig_id, contig_sequence in sharding.iter_fasta(assembly_path):
+        contig_sequence = contig_sequence.upper().encode('ascii')
+        for strand_sequence in [contig_sequence, contig_sequence[::-1].translate(_REVERSE_COMPLEMENT)]:
+            kmers, valid = encode_kmers(strand_sequence, kmer_size)
+            candidate_positions = np.flatnonzero(valid & assembly_index['anchor_filter'][kmers & anchor_filter_mask])
+            candidate_anchor_idxs = np.searchsorted(anchor_kmers, kmers[candidate_positions])
+            for position, anchor_idx in zip(candidate_positions.tolist(), candidate_anchor_idxs.tolist()):
+                kmer = kmers[position]
+                while anchor_idx < len(anchor_kmers) and anchor_kmers[anchor_idx] == kmer:
+                    locus_position = int(assembly_index['anchor_loci'][anchor_idx])
+                    allele_length = int(assembly_index['anchor_lengths'][anchor_idx])
+                    anchor_idx += 1
+                    if position + allele_length > len(strand_sequence):
+                        continue
+                    allele_idx = _lookup_allele(assembly_index, strand_sequence[position:position + allele_length], locus_position)
+                    if allele_idx is not None:
+                        allele_idxs_by_locus_position.setdefault(locus_position, set()).add(allele_idx)
+
+    exact_hits_by_locus_id = {}
+    for locus_position in sorted(allele_idxs_by_locus_position):
+        allele_idxs = allele_idxs_by_locus_position[locus_position]
+        locus_id = assembly_index['locus_ids'][locus_position]
+        if len(allele_idxs) > 1:
+            logging.info(f"Locus {locus_id} matches {len(allele_idxs)} alleles exactly. Leaving it for alignment")
+            continue
+        allele_idx = allele_idxs.pop()
+        template = get_allele_name(assembly_index, allele_idx)
+        allele_length = len(get_allele_sequence(assembly_index, allele_idx))
+        exact_hits_by_locus_id[locus_id] = records.KmaHit(
+            template=template,
+            locus_id=locus_id,
+            allele_id=template.split('_')[1],
+            score=allele_length,
+            template_length=allele_length,
+            template_identity=100.0,
+            template_coverage=100.0,
+            query_identity=100.0,
+            query_coverage=100.0,
+            depth=1.0,
+        )
+
+    return exact_hits_by_locus_id
+
@@ -0,0 +1,233 @@
+import concurrent.futures
+import csv
+import datetime
+import logging
+import os
+import threading
+
+from . import alignment_cache
+from . import pipeline
+
+
+class ThreadBudget(object):
+    """
+    Hands out CPU threads to concurrently-running jobs so that the total
+    number of threads in use never exceeds the budget.
+
+    Each job is granted an equal share of the currently-free threads among
+    the jobs that have not started yet, so the budget stays full when there
+    are fewer jobs than threads, and every job gets at least one thread.
+    """
+    def __init__(self, total_threads, num_jobs, max_threads_per_job=None):
+        """
+        :param total_threads: Total number of threads available
+        :type total_threads: int
+        :param num_jobs: Number of jobs that will be run
+        :type num_jobs: int
+        :param max_threads_per_job: Maximum number of threads to grant to any single job (default: no limit)
+        :type max_threads_per_job: int|None
+        """
+        self.total_threads = max(1, total_threads)
+        self.available_threads = self.total_threads
+        self.pending_jobs = num_jobs
+        self.max_threads_per_job = max_threads_per_job
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until at least one thread is free, then claim a share of the free threads.
+
+        :return: The number of threads granted
+        :rtype: int
+        """
+        with self.condition:
+            while self.available_threads < 1:
+                self.condition.wait()
+            granted_threads = max(1, self.available_threads // max(1, self.pending_jobs))
+            if self.max_threads_per_job is not None:
+                granted_threads = min(granted_threads, self.max_threads_per_job)
+            self.available_threads -= granted_threads
+            self.pending_jobs = max(0, self.pending_jobs - 1)
+
+        return granted_threads
+
+    def release(self, threads):
+        """
+        Return threads to the budget.
+
+        :param threads: The number of threads to return
+        :type threads: int
+        :return: None
+        """
+        with self.condition:
+            self.available_threads += threads
+            self.condition.notify_all()
+
+
+def parse_sample_sheet(sample_sheet_path):
+    """
+    Parse a sample sheet. The sample sheet is a CSV file with a header,
+    and columns 'ID', 'R1' and 'R2'. Relative read paths are resolved
+    relative to the directory containing the sample sheet.
+
+    :param sample_sheet_path: The path to the sample sheet
+    :type sample_sheet_path: str
+    :return: The samples. Keys of each sample are: 'ID', 'R1', 'R2'
+    :rtype: list[dict]
+    :raises ValueError: If a required column is missing, or a sample ID is duplicated
+    """
+    samples = []
+    required_fields = [
+        'ID',
+        'R1',
+        'R2',
+    ]
+    sample_sheet_dir = os.path.dirname(os.path.abspath(sample_sheet_path))
+    sample_ids = set()
+    with open(sample_sheet_path, 'r') as f:
+        reader = csv.DictReader(f, delimiter=',')
+        for field in required_fields:
+            if reader.fieldnames is None or field not in reader.fieldnames:
+                raise ValueError(f"Sample sheet missing required column: {field}")
+        for row in reader:
+            sample = {field: row[field].strip() for field in required_fields}
+            if not sample['ID']:
+                continue
+            if sample['ID'] in sample_ids:
+                raise ValueError(f"Duplicate sample ID found in sample sheet: {sample['ID']}")
+            sample_ids.add(sample['ID'])
+            for reads_field in ['R1', 'R2']:
+                sample[reads_field] = os.path.join(sample_sheet_dir, sample[reads_field])
+            samples.append(sample)
+
+    return samples
+
+
+def type_sample(sample, params, thread_budget):
+    """
+    Type a single sample from the batch, using threads from the shared budget.
+
+    :param sample: The sample. Keys are: 'ID', 'R1', 'R2'
+    :type sample: dict
+    :param params: The batch parameters. Keys are: 'scheme', 'tmpdir', 'outdir', 'min_identity', 'min_coverage', 'no_cleanup',
+                   'profile_store', 'query_db', 'query_k', 'query_max_distance', 'io_mode', 'target_depth', 'genome_size',
+                   'alignment_cache', 'alignment_cache_max_bytes', 'novel_alleles', 'novel_allele_hash', 'scheme_shards',
+                   'max_concurrent_shards', 'metrics', 'profile', 'profile_memory'
+    :type params: dict
+    :param thread_budget: The shared thread budget
+    :type thread_budget: ThreadBudget
+    :return: Summary of the typing run. Keys are: 'sample_id', 'status', 'threads', 'elapsed_seconds', 'percent_called', 'error'
+    :rtype: dict
+    """
+    threads = thread_budget.acquire()
+    logging.info(f"Typing sample {sample['ID']} started with {threads} threads")
+    start_timestamp = datetime.datetime.now()
+    summary = {
+        'sample_id': sample['ID'],
+        'status': None,
+        'threads': threads,
+        'elapsed_seconds': None,
+        'percent_called': None,
+        'error': None,
+    }
+    typing_params = {
+        'sample_id': sample['ID'],
+        'R1': sample['R1'],
+        'R2': sample['R2'],
+        'scheme': params['scheme'],
+        'threads': threads,
+        'tmpdir': params['tmpdir'],
+        'outdir': os.path.join(params['outdir'], sample['ID']),
+        'min_identity': params['min_identity'],
+        'min_coverage': params['min_coverage'],
+        'no_cleanup': params['no_cleanup'],
+        'profile_store': params.get('profile_store'),
+        'query_db': params.get('query_db'),
+        'query_k': params.get('query_k', 10),
+        'query_max_distance': params.get('query_max_distance'),
+        'io_mode': params.get('io_mode', 'disk'),
+        'target_depth': params.get('target_depth'),
+        'genome_size': params.get('genome_size'),
+        'alignment_cache': params.get('alignment_cache'),
+        'alignment_cache_max_bytes': params.get('alignment_cache_max_bytes', alignment_cache.DEFAULT_MAX_BYTES),
+        'novel_alleles': params.get('novel_alleles', False),
+        'novel_allele_hash': params.get('novel_allele_hash', 'sha1'),
+        'scheme_shards': params.get('scheme_shards'),
+        'max_concurrent_shards': params.get('max_concurrent_shards'),
+        'metrics_json': os.path.join(params['outdir'], sample['ID'], 'metrics.json') if params.get('metrics') else None,
+        'profile': params.get('profile', False),
+        'profile_memory': params.get('profile_memory', True),
+        'exit_on_failure': False,
+    }
+    try:
+        typing_result = pipeline.run_typing(typing_params)
+        summary['status'] = 'completed'
+        summary['percent_called'] = typing_result['qc_stats']['percent_called']
+    except Exception as e:
+        logging.error(f"Typing sample {sample['ID']} failed: {e!r}")
+        summary['status'] = 'failed'
+        summary['error'] = repr(e)
+    finally:
+        thread_budget.release(threads)
+
+    elapsed_time = datetime.datetime.now() - start_timestamp
+    summary['elapsed_seconds'] = round(elapsed_time.total_seconds(), 2)
+    logging.info(f"Typing sample {sample['ID']} {summary['status']}. Elapsed time: {summary['elapsed_seconds']} seconds.")
+
+    return summary
+
+
+def run_batch(samples, params):
+    """
+    Type all samples in a batch, running as many samples concurrently as the
+    thread budget allows. A failed sample is logged and recorded in the batch
+    summary, and does not stop the rest of the batch.
+
+    :param samples: The samples, as returned by parse_sample_sheet
+    :type samples: list[dict]
+    :param params: The batch parameters. Keys are: 'scheme', 'tmpdir', 'outdir', 'min_identity', 'min_coverage',
+                   'no_cleanup', 'profile_store', 'query_db', 'query_k', 'query_max_distance', 'io_mode', 'target_depth',
+                   'genome_size', 'alignment_cache', 'alignment_cache_max_bytes', 'novel_alleles', 'novel_allele_hash',
+                   'scheme_shards', 'max_concurrent_shards', 'metrics', 'profile', 'total_threads', 'max_threads_per_sample'
+    :type params: dict
+    :return: Summaries of each typing run, in the order that they completed
+    :rtype: list[dict]
+    """
+    thread_budget = ThreadBudget(params['total_threads'], len(samples), params['max_threads_per_sample'])
+    max_concurrent_samples = max(1, min(thread_budget.total_threads, len(samples)))
+    if params.get('profile') and max_concurrent_samples > 1:
+        # tracemalloc is process-wide, so concurrent samples would count each other's allocations.
+        logging.warning(f"Typing up to {max_concurrent_samples} samples at a time, so memory is not traced while profiling. Use --total-threads 1 to trace memory")
+        params = dict(params, profile_memory=False)
+    summaries = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_samples) as executor:
+        futures = [executor.submit(type_sample, sample, params, thread_budget) for sample in samples]
+        for future in concurrent.futures.as_completed(futures):
+            summaries.append(future.result())
+
+    return summaries
+
+
+def write_batch_summary(summaries, batch_summary_file):
+    """
+    Write the batch summary to a CSV file.
+
+    :param summaries: Summaries of each typing run, as returned by run_batch
+    :type summaries: list[dict]
+    :param batch_summary_file: The path to the batch summary file
+    :type batch_summary_file: str
+    :return: None
+    """
+    output_fieldnames = [
+        'sample_id',
+        'status',
+        'threads',
+        'elapsed_seconds',
+        'percent_called',
+        'error',
+    ]
+    with open(batch_summary_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=output_fieldnames, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        for summary in summaries:
+            writer.writerow(summary)
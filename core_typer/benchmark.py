@@ -0,0 +1,363 @@
+import collections
+import csv
+import logging
+import os
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+from . import __version__
+from . import allele_calling
+from . import parsers
+from . import qc
+from . import records
+from . import scheme
+
+DEFAULT_NUM_LOCI = [1700, 3000, 7000]
+
+KMA_RESULT_HEADER = [
+    "#Template",
+    "Score",
+    "Expected",
+    "Template_length",
+    "Template_Identity",
+    "Template_Coverage",
+    "Query_Identity",
+    "Query_Coverage",
+    "Depth",
+    "q_value",
+    "p_value",
+]
+
+KMA_MAPSTAT_COLUMN_NAMES = [
+    "refSequence",
+    "readCount",
+    "fragmentCount",
+    "mapScoreSum",
+    "refCoveredPositions",
+    "refConsensusSum",
+    "bpTotal",
+    "depthVariance",
+    "nucHighDepthVariance",
+    "depthMax",
+    "snpSum",
+    "insertSum",
+    "deletionSum",
+    "readCountAln",
+    "fragmentCountAln",
+]
+
+ALN_LINE_WIDTH = 60
+
+BENCHMARK_RESULT_FIELDNAMES = [
+    "benchmark",
+    "num_loci",
+    "num_hits",
+    "repeats",
+    "min_seconds",
+    "median_seconds",
+    "items",
+    "items_per_second",
+    "peak_memory_bytes",
+    "core_typer_version",
+    "python_version",
+]
+
+
+def write_synthetic_kma_outputs(output_dir, num_loci, max_hits_per_locus=5, alleles_per_locus=20, seed=0):
+    """
+    Write synthetic kma outputs (.res, .mapstat and .aln) and a scheme .name file, shaped like the
+    outputs of a real typing run. Each locus gets between 1 and max_hits_per_locus hits. Most best
+    hits are exact matches, and a few fall below the default identity or coverage thresholds.
+
+    :param output_dir: Directory to write the files to
+    :type output_dir: str
+    :param num_loci: Number of loci in the scheme
+    :type num_loci: int
+    :param max_hits_per_locus: Maximum number of hits for each locus
+    :type max_hits_per_locus: int
+    :param alleles_per_locus: Number of alleles for each locus in the scheme .name file
+    :type alleles_per_locus: int
+    :param seed: Seed for the random number generator, so that runs are repeatable
+    :type seed: int
+    :return: Paths to the synthetic files. Keys are: 'scheme', 'res', 'mapstat', 'aln', 'name', plus the number of hits ('num_hits') and the number of alleles in the scheme ('num_alleles')
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    scheme_path = os.path.join(output_dir, 'scheme')
+    kma_output_prefix = os.path.join(output_dir, 'kma-out')
+    synthetic_outputs = {
+        'scheme': scheme_path,
+        'res': kma_output_prefix + '.res',
+        'mapstat': kma_output_prefix + '.mapstat',
+        'aln': kma_output_prefix + '.aln',
+        'name': scheme.get_names_file(scheme_path),
+        'num_hits': 0,
+        'num_alleles': num_loci * alleles_per_locus,
+    }
+    locus_ids = [f"locus{locus_idx:05d}" for locus_idx in range(num_loci)]
+
+    with open(synthetic_outputs['name'], 'w') as f:
+        for locus_id in locus_ids:
+            for allele_id in range(1, alleles_per_locus + 1):
+                f.write(f"{locus_id}_{allele_id}\n")
+
+    with open(synthetic_outputs['res'], 'w') as res_file, \
+         open(synthetic_outputs['mapstat'], 'w') as mapstat_file, \
+         open(synthetic_outputs['aln'], 'w') as aln_file:
+        res_file.write('\t'.join(KMA_RESULT_HEADER) + '\n')
+        mapstat_file.write("## method\tKMA\n")
+        mapstat_file.write("## version\t1.4.9\n")
+        mapstat_file.write(f"## database\t{scheme_path}\n")
+        mapstat_file.write(f"## fragmentCount\t{num_loci * 500}\n")
+        mapstat_file.write("## date\t2024-01-01\n")
+        mapstat_file.write("## command\tkma\n")
+        mapstat_file.write("# " + '\t'.join(KMA_MAPSTAT_COLUMN_NAMES) + '\n')
+        for locus_id in locus_ids:
+            template_length = rng.randint(400, 2000)
+            num_hits = rng.randint(1, max_hits_per_locus)
+            allele_ids = rng.sample(range(1, alleles_per_locus + 1), min(num_hits, alleles_per_locus))
+            template_seq = ''.join(rng.choices('ACGT', k=template_length))
+            for hit_idx, allele_id in enumerate(allele_ids):
+                template = f"{locus_id}_{allele_id}"
+                if hit_idx == 0 and rng.random() < 0.97:
+                    identity = 100.0
+                    coverage = 100.0
+                else:
+                    identity = round(rng.uniform(90.0, 99.9), 2)
+                    coverage = round(rng.uniform(85.0, 100.0), 2)
+                depth = round(rng.uniform(20.0, 80.0), 2)
+                score = int(template_length * depth / 10 * identity / 100)
+                synthetic_outputs['num_hits'] += 1
+                res_file.write('\t'.join([
+                    template,
+                    f"{score:8d}",
+                    f"{rng.randint(10, 60):8d}",
+                    f"{template_length:8d}",
+                    f"{identity:8.2f}",
+                    f"{coverage:8.2f}",
+                    f"{identity:8.2f}",
+                    f"{coverage:8.2f}",
+                    f"{depth:8.2f}",
+                    f"{rng.uniform(100.0, 900.0):8.2f}",
+                    " 1.0e-26",
+                ]) + '\n')
+                read_count = int(depth * template_length / 100)
+                covered_positions = int(template_length * coverage / 100)
+                mapstat_file.write('\t'.join(str(value) for value in [
+                    template,
+                    read_count,
+                    read_count // 2,
+                    score,
+                    covered_positions,
+                    int(covered_positions * identity / 100),
+                    int(depth * template_length),
+                    round(rng.uniform(0.0, 10.0), 6),
+                    0,
+                    int(depth * 2),
+                    template_length - int(template_length * identity / 100),
+                    0,
+                    0,
+                    read_count,
+                    read_count // 2,
+                ]) + '\n')
+                aln_file.write(f"# {template}\n")
+                for line_start in range(0, template_length, ALN_LINE_WIDTH):
+                    seq_line = template_seq[line_start:line_start + ALN_LINE_WIDTH]
+                    aln_file.write(f"template: \t{seq_line}\n")
+                    aln_file.write(f"          \t{'|' * len(seq_line)}\n")
+                    aln_file.write(f"query:    \t{seq_line}\n")
+                    aln_file.write("\n")
+
+    return synthetic_outputs
+
+
+def time_function(func, repeats=5):
+    """
+    Time a function. The function is called once untimed with memory tracing enabled, to
+    measure its peak memory use, then called 'repeats' times without tracing to time it.
+
+    :param func: The function to time. Called with no arguments
+    :type func: Callable
+    :param repeats: Number of timed calls
+    :type repeats: int
+    :return: Timings. Keys are: 'repeats', 'min_seconds', 'median_seconds', 'peak_memory_bytes'
+    :rtype: dict
+    """
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1] - baseline_memory
+    if not already_tracing:
+        tracemalloc.stop()
+
+    elapsed_seconds = []
+    for _ in range(max(1, repeats)):
+        start_time = time.perf_counter()
+        func()
+        elapsed_seconds.append(time.perf_counter() - start_time)
+
+    timings = {
+        'repeats': len(elapsed_seconds),
+        'min_seconds': round(min(elapsed_seconds), 6),
+        'median_seconds': round(statistics.median(elapsed_seconds), 6),
+        'peak_memory_bytes': max(0, peak_memory),
+    }
+
+    return timings
+
+
+def run_benchmarks(num_loci, work_dir, repeats=5, max_hits_per_locus=5, seed=0):
+    """
+    Generate synthetic kma outputs for a scheme with num_loci loci, and time the parsers,
+    allele calling, QC and output writers against them.
+
+    :param num_loci: Number of loci in the synthetic scheme
+    :type num_loci: int
+    :param work_dir: Directory to write synthetic inputs and benchmark outputs to
+    :type work_dir: str
+    :param repeats: Number of timed calls of each benchmark
+    :type repeats: int
+    :param max_hits_per_locus: Maximum number of kma hits for each locus
+    :type max_hits_per_locus: int
+    :param seed: Seed for the random number generator
+    :type seed: int
+    :return: Benchmark results, one per benchmark. Keys are as in BENCHMARK_RESULT_FIELDNAMES
+    :rtype: list[dict]
+    """
+    logging.info(f"Generating synthetic kma outputs for {num_loci} loci")
+    synthetic_outputs = write_synthetic_kma_outputs(work_dir, num_loci, max_hits_per_locus=max_hits_per_locus, seed=seed)
+    num_hits = synthetic_outputs['num_hits']
+
+    parsed_kma_result = parsers.parse_kma_result(synthetic_outputs['res'])
+    kma_result_columns = parsers.parse_kma_result_columnar(synthetic_outputs['res'])
+    best_hit_templates = parsers.parse_kma_best_hits_columnar(synthetic_outputs['res'])['template'].tolist()
+    kma_mapstat_columns = parsers.parse_kma_mapstat_columnar(synthetic_outputs['mapstat'], columns=records.ALLELE_CALL_MAPSTAT_FIELDS, templates=best_hit_templates)
+    allele_calls = allele_calling.call_alleles(kma_result_columns, kma_mapstat_columns=kma_mapstat_columns)
+    # Build (or load) the scheme index up front, so that write_allele_profile is timed against a warm index,
+    # as it is for every sample after the first in a batch.
+    scheme.load_scheme_index(synthetic_outputs['scheme'])
+    allele_calls_file = os.path.join(work_dir, 'allele_calls.csv')
+    allele_profile_file = os.path.join(work_dir, 'allele_profile.csv')
+
+    def choose_best_alleles():
+        for kma_results in parsed_kma_result.values():
+            allele_calling.choose_best_allele(kma_results)
+
+    benchmarks = [
+        ('parse_kma_result', lambda: parsers.parse_kma_result(synthetic_outputs['res']), num_hits),
+        ('parse_kma_result_best_hit_only', lambda: parsers.parse_kma_result(synthetic_outputs['res'], best_hit_only=True), num_hits),
+        ('parse_kma_result_columnar', lambda: parsers.parse_kma_result_columnar(synthetic_outputs['res']), num_hits),
+        ('parse_kma_best_hits_columnar', lambda: parsers.parse_kma_best_hits_columnar(synthetic_outputs['res']), num_hits),
+        ('parse_kma_mapstat', lambda: parsers.parse_kma_mapstat(synthetic_outputs['mapstat']), num_hits),
+        ('parse_kma_mapstat_columnar', lambda: parsers.parse_kma_mapstat_columnar(synthetic_outputs['mapstat']), num_hits),
+        ('parse_kma_mapstat_best_hits', lambda: parsers.parse_kma_mapstat_columnar(synthetic_outputs['mapstat'], columns=records.ALLELE_CALL_MAPSTAT_FIELDS, templates=best_hit_templates), num_hits),
+        ('iter_kma_aln', lambda: collections.deque(parsers.iter_kma_aln(synthetic_outputs['aln']), maxlen=0), num_hits),
+        ('parse_locus_names', lambda: parsers.parse_locus_names(synthetic_outputs['name']), synthetic_outputs['num_alleles']),
+        ('choose_best_allele', choose_best_alleles, num_hits),
+        ('call_alleles', lambda: allele_calling.call_alleles(kma_result_columns), num_hits),
+        ('call_alleles_with_mapstat', lambda: allele_calling.call_alleles(kma_result_columns, kma_mapstat_columns=kma_mapstat_columns), num_hits),
+        ('calculate_qc_stats', lambda: qc.calculate_qc_stats(allele_calls), num_loci),
+        ('write_allele_calls', lambda: allele_calling.write_allele_calls(allele_calls_file, allele_calls), num_loci),
+        ('write_allele_profile', lambda: allele_calling.write_allele_profile(allele_calls, synthetic_outputs['scheme'], allele_profile_file), num_loci),
+    ]
+
+    benchmark_results = []
+    for benchmark_name, func, num_items in benchmarks:
+        timings = time_function(func, repeats=repeats)
+        benchmark_result = {
+            'benchmark': benchmark_name,
+            'num_loci': num_loci,
+            'num_hits': num_hits,
+            'items': num_items,
+            'items_per_second': round(num_items / timings['median_seconds'], 1) if timings['median_seconds'] > 0 else None,
+            'core_typer_version': __version__,
+            'python_version': platform.python_version(),
+        }
+        benchmark_result.update(timings)
+        logging.info(f"Benchmark {benchmark_name} ({num_loci} loci, {num_hits} hits): median {timings['median_seconds']} seconds, peak memory {timings['peak_memory_bytes']} bytes")
+        benchmark_results.append(benchmark_result)
+
+    return benchmark_results
+
+
+def write_benchmark_results(benchmark_results, benchmark_results_file):
+    """
+    Write benchmark results to a CSV file.
+
+    :param benchmark_results: Benchmark results, as returned by run_benchmarks
+    :type benchmark_results: list[dict]
+    :param benchmark_results_file: The path to the benchmark results file
+    :type benchmark_results_file: str
+    :return: None
+    """
+    with open(benchmark_results_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=BENCHMARK_RESULT_FIELDNAMES, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        for benchmark_result in benchmark_results:
+            writer.writerow(benchmark_result)
+
+
+def parse_benchmark_results(benchmark_results_file):
+    """
+    Parse a benchmark results file, as written by write_benchmark_results.
+
+    :param benchmark_results_file: The path to the benchmark results file
+    :type benchmark_results_file: str
+    :return: Benchmark results, indexed by (benchmark, num_loci)
+    :rtype: dict[tuple[str, int], dict]
+    """
+    benchmark_results = {}
+    with open(benchmark_results_file, 'r') as f:
+        reader = csv.DictReader(f, delimiter=',')
+        for row in reader:
+            row['num_loci'] = int(row['num_loci'])
+            row['median_seconds'] = float(row['median_seconds'])
+            row['peak_memory_bytes'] = int(row['peak_memory_bytes'])
+            benchmark_results[(row['benchmark'], row['num_loci'])] = row
+
+    return benchmark_results
+
+
+def compare_benchmark_results(benchmark_results, baseline_results, max_slowdown=1.2):
+    """
+    Compare benchmark results against a baseline. A benchmark has regressed if its median time,
+    or its peak memory, is more than max_slowdown times the baseline.
+
+    :param benchmark_results: Benchmark results, as returned by run_benchmarks
+    :type benchmark_results: list[dict]
+    :param baseline_results: Baseline benchmark results, as returned by parse_benchmark_results
+    :type baseline_results: dict[tuple[str, int], dict]
+    :param max_slowdown: Maximum allowed ratio of new to baseline time (or memory)
+    :type max_slowdown: float
+    :return: Regressions. Keys are: 'benchmark', 'num_loci', 'metric', 'baseline', 'value', 'ratio'
+    :rtype: list[dict]
+    """
+    regressions = []
+    for benchmark_result in benchmark_results:
+        baseline_result = baseline_results.get((benchmark_result['benchmark'], benchmark_result['num_loci']))
+        if baseline_result is None:
+            continue
+        for metric in ['median_seconds', 'peak_memory_bytes']:
+            baseline_value = baseline_result[metric]
+            value = benchmark_result[metric]
+            if baseline_value <= 0:
+                continue
+            ratio = value / baseline_value
+            if ratio > max_slowdown:
+                regressions.append({
+                    'benchmark': benchmark_result['benchmark'],
+                    'num_loci': benchmark_result['num_loci'],
+                    'metric': metric,
+                    'baseline': baseline_value,
+                    'value': value,
+                    'ratio': round(ratio, 3),
+                })
+
+    return regressions
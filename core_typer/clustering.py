@@ -0,0 +1,392 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from . import distance
+
+CLUSTERS_FILENAME = 'clusters.csv'
+MST_FILENAME = 'mst.csv'
+CLUSTERING_STATE_FILENAME = 'clustering.json'
+
+DEFAULT_THRESHOLDS = [5, 10, 25]
+
+NO_CLUSTER_CODE = 0
+
+_NOT_CONNECTED = np.iinfo(np.int64).max
+
+
+def hash_locus_ids(locus_ids):
+    """
+    Hash the locus IDs of a set of profiles, to check that profiles added later have the same loci.
+
+    :param locus_ids: The locus IDs, in order
+    :type locus_ids: list[str]
+    :return: The hex digest of the sha1 hash of the locus IDs
+    :rtype: str
+    """
+    return hashlib.sha1('\n'.join(locus_ids).encode('utf-8')).hexdigest()
+
+
+def build_minimum_spanning_tree(profiles, base_edges=None, num_base=0):
+    """
+    Build a minimum spanning tree of the allele distances between profiles, using Prim's algorithm.
+
+    Distances are calculated one row at a time, as each sample is added to the tree, so the full distance
+    matrix is never stored: time is O(n^2) and memory (apart from the profiles) is O(n).
+    Loci that are missing in either sample of a pair are not counted (see distance.calculate_distance_rows).
+
+    To add samples to an existing tree, put the samples already in the tree first (the first num_base profiles)
+    and pass the existing tree as base_edges. Only the existing tree edges and the distances involving the new samples
+    are considered, which is enough, since no other edge between two existing samples can be in the new tree.
+
+    Ties are broken in favour of edges found earlier, so the tree is the same for the same input order.
+
+    :param profiles: The encoded profiles (samples x loci), as returned by distance.encode_allele_profiles
+    :type profiles: numpy.ndarray
+    :param base_edges: The edges of a spanning tree of the first num_base profiles, as (sample index, sample index, distance)
+    :type base_edges: list[tuple[int, int, int]]|None
+    :param num_base: The number of profiles (at the start of profiles) spanned by base_edges
+    :type num_base: int
+    :return: The edges of the tree, as (parent sample index, child sample index, distance), in the order they were added
+    :rtype: list[tuple[int, int, int]]
+    """
+    num_profiles = profiles.shape[0]
+    if num_profiles == 0:
+        return []
+    base_edges = base_edges or []
+
+    # Adjacency lists of the existing tree, as index arrays (neighbours of sample i are
+    # base_neighbours[base_offsets[i]:base_offsets[i + 1]])
+    base_sources = np.array([edge[0] for edge in base_edges] + [edge[1] for edge in base_edges], dtype=np.int64)
+    base_targets = np.array([edge[1] for edge in base_edges] + [edge[0] for edge in base_edges], dtype=np.int64)
+    base_distances = np.array([edge[2] for edge in base_edges] * 2, dtype=np.int64)
+    base_order = np.argsort(base_sources, kind='stable')
+    base_neighbours = base_targets[base_order]
+    base_neighbour_distances = base_distances[base_order]
+    base_offsets = np.searchsorted(base_sources[base_order], np.arange(num_base + 1))
+
+    # Samples that are not yet in the tree (previously clustered and new samples separately, since distances between
+    # previously clustered samples are never needed) are kept packed, so each distance row is calculated over
+    # contiguous memory without copying the remaining profiles
+    outside_base = _PackedProfiles(profiles, 0, num_base)
+    outside_new = _PackedProfiles(profiles, num_base, num_profiles)
+
+    in_tree = np.zeros(num_profiles, dtype=bool)
+    nearest_distances = np.full(num_profiles, _NOT_CONNECTED, dtype=np.int64)
+    nearest_parents = np.full(num_profiles, -1, dtype=np.int64)
+    nearest_distances[0] = 0
+    edges = []
+    for _ in range(num_profiles):
+        sample_idx = int(np.argmin(nearest_distances))
+        if nearest_distances[sample_idx] == _NOT_CONNECTED:
+            raise ValueError(f"Existing tree does not span the first {num_base} samples")
+        if nearest_parents[sample_idx] >= 0:
+            edges.append((int(nearest_parents[sample_idx]), sample_idx, int(nearest_distances[sample_idx])))
+        in_tree[sample_idx] = True
+        nearest_distances[sample_idx] = _NOT_CONNECTED
+
+        if sample_idx < num_base:
+            outside_base.remove(sample_idx)
+            neighbour_start, neighbour_end = base_offsets[sample_idx], base_offsets[sample_idx + 1]
+            neighbours = base_neighbours[neighbour_start:neighbour_end]
+            outside_tree = ~in_tree[neighbours]
+            candidates = np.concatenate([outside_new.sample_idxs, neighbours[outside_tree]])
+            candidate_distances = np.concatenate([
+                outside_new.calculate_distances(profiles[sample_idx]),
+                base_neighbour_distances[neighbour_start:neighbour_end][outside_tree],
+            ])
+        else:
+            outside_new.remove(sample_idx)
+            candidates = np.concatenate([outside_new.sample_idxs, outside_base.sample_idxs])
+            candidate_distances = np.concatenate([
+                outside_new.calculate_distances(profiles[sample_idx]),
+                outside_base.calculate_distances(profiles[sample_idx]),
+            ])
+
+        closer = candidate_distances < nearest_distances[candidates]
+        nearest_distances[candidates[closer]] = candidate_distances[closer]
+        nearest_parents[candidates[closer]] = sample_idx
+
+    return edges
+
+
+class _PackedProfiles(object):
+    """
+    A (loci x samples) copy of the profiles of a set of samples, packed at the start of the array.
+    A sample is removed by moving the last sample into its place. Summing comparisons over loci
+    in this layout is done with vectorized row adds, which is much faster than summing over loci per sample.
+    """
+    def __init__(self, profiles, start, end):
+        self.profiles_by_locus = np.ascontiguousarray(profiles[start:end].T)
+        self.num_missing = np.count_nonzero(self.profiles_by_locus == distance.MISSING_ALLELE_CODE, axis=0)
+        self._sample_idxs = np.arange(start, end)
+        self._positions = {sample_idx: position for position, sample_idx in enumerate(range(start, end))}
+        self.num_samples = end - start
+
+    @property
+    def sample_idxs(self):
+        return self._sample_idxs[:self.num_samples]
+
+    def remove(self, sample_idx):
+        position = self._positions.pop(sample_idx)
+        last_position = self.num_samples - 1
+        if position != last_position:
+            last_sample_idx = int(self._sample_idxs[last_position])
+            self.profiles_by_locus[:, position] = self.profiles_by_locus[:, last_position]
+            self.num_missing[position] = self.num_missing[last_position]
+            self._sample_idxs[position] = last_sample_idx
+            self._positions[last_sample_idx] = position
+        self.num_samples -= 1
+
+    def calculate_distances(self, query_profile):
+        # As distance.calculate_distance_rows, for a single query. Loci missing in both profiles
+        # are only counted over the (usually few) loci missing in the query.
+        num_loci = self.profiles_by_locus.shape[0]
+        distances = np.empty(self.num_samples, dtype=np.int64)
+        query_missing_loci = np.flatnonzero(query_profile == distance.MISSING_ALLELE_CODE)
+        query_column = query_profile[:, None]
+        block_size = max(1, distance.MAX_BLOCK_ELEMENTS // max(1, num_loci))
+        for block_start in range(0, self.num_samples, block_size):
+            block_end = min(block_start + block_size, self.num_samples)
+            block = self.profiles_by_locus[:, block_start:block_end]
+            num_unequal = (block != query_column).sum(axis=0, dtype=np.int32)
+            both_missing = (block[query_missing_loci] == distance.MISSING_ALLELE_CODE).sum(axis=0, dtype=np.int32)
+            one_missing = len(query_missing_loci) + self.num_missing[block_start:block_end] - 2 * both_missing
+            distances[block_start:block_end] = num_unequal - one_missing
+
+        return distances
+
+
+def single_linkage_clusters(num_samples, edges, threshold):
+    """
+    Find single-linkage clusters: samples are in the same cluster if they are joined by a chain of samples,
+    each within threshold allele differences of the next. These are the connected components of the
+    minimum spanning tree after removing edges longer than the threshold.
+
+    :param num_samples: The number of samples
+    :type num_samples: int
+    :param edges: The edges of the minimum spanning tree, as (sample index, sample index, distance)
+    :type edges: list[tuple[int, int, int]]
+    :param threshold: The maximum number of allele differences between linked samples
+    :type threshold: int
+    :return: The cluster of each sample, numbered from 0 in order of the first sample in each cluster
+    :rtype: numpy.ndarray
+    """
+    roots = list(range(num_samples))
+
+    def find_root(sample_idx):
+        while roots[sample_idx] != sample_idx:
+            roots[sample_idx] = roots[roots[sample_idx]]
+            sample_idx = roots[sample_idx]
+        return sample_idx
+
+    for sample_idx_a, sample_idx_b, edge_distance in edges:
+        if edge_distance <= threshold:
+            root_a, root_b = find_root(sample_idx_a), find_root(sample_idx_b)
+            if root_a != root_b:
+                roots[max(root_a, root_b)] = min(root_a, root_b)
+
+    # Roots are always the lowest sample index in the cluster, so numbering unique roots
+    # numbers clusters in order of their first sample
+    _, clusters = np.unique(np.array([find_root(sample_idx) for sample_idx in range(num_samples)], dtype=np.int64), return_inverse=True)
+
+    return clusters.reshape(-1)
+
+
+def assign_cluster_codes(clusters, previous_codes, next_code):
+    """
+    Assign stable cluster codes. A cluster containing samples that already had a code keeps that code;
+    if a cluster contains samples with different codes (ie. new samples have merged existing clusters),
+    it takes the lowest (oldest) code. Other clusters get new codes, in order of their first sample.
+    Codes are never reused, so a code always refers to the same cluster (or the cluster it has merged into).
+
+    :param clusters: The cluster of each sample, numbered from 0 (as returned by single_linkage_clusters)
+    :type clusters: numpy.ndarray
+    :param previous_codes: The existing cluster code of each sample (NO_CLUSTER_CODE for new samples)
+    :type previous_codes: numpy.ndarray
+    :param next_code: The next unused cluster code
+    :type next_code: int
+    :return: The cluster code of each sample, the next unused cluster code, and the merged codes
+             (lists of codes that are now one cluster, lowest first)
+    :rtype: tuple[numpy.ndarray, int, list[list[int]]]
+    """
+    num_clusters = int(clusters.max()) + 1 if len(clusters) > 0 else 0
+    has_code = previous_codes != NO_CLUSTER_CODE
+    lowest_codes = np.full(num_clusters, _NOT_CONNECTED, dtype=np.int64)
+    highest_codes = np.full(num_clusters, NO_CLUSTER_CODE, dtype=np.int64)
+    np.minimum.at(lowest_codes, clusters[has_code], previous_codes[has_code])
+    np.maximum.at(highest_codes, clusters[has_code], previous_codes[has_code])
+
+    merged_codes = []
+    for cluster in np.flatnonzero(highest_codes > lowest_codes):
+        merged_codes.append(sorted(set(previous_codes[has_code & (clusters == cluster)].tolist())))
+
+    cluster_codes = lowest_codes
+    new_clusters = np.flatnonzero(cluster_codes == _NOT_CONNECTED)
+    cluster_codes[new_clusters] = np.arange(next_code, next_code + len(new_clusters))
+
+    return cluster_codes[clusters], next_code + len(new_clusters), merged_codes
+
+
+def cluster_profiles(sample_ids, profiles, thresholds, previous=None):
+    """
+    Build a minimum spanning tree of the profiles and assign single-linkage cluster codes at each threshold.
+
+    :param sample_ids: The sample IDs, in the same order as the profiles
+    :type sample_ids: list[str]
+    :param profiles: The encoded profiles (samples x loci)
+    :type profiles: numpy.ndarray
+    :param thresholds: The clustering thresholds (maximum number of allele differences between linked samples)
+    :type thresholds: list[int]
+    :param previous: Previous clustering results (as returned by load_clustering) to add the samples to.
+                     Every previously clustered sample must be in sample_ids
+    :type previous: dict|None
+    :return: Clustering results. Keys are: 'sample_ids', 'thresholds' (largest first), 'mst_edges' (as
+             (sample index, sample index, distance)), 'cluster_codes' (samples x thresholds), 'next_codes' (one per threshold)
+    :rtype: dict
+    :raises ValueError: If a previously clustered sample is missing, or the thresholds don't match the previous results
+    """
+    thresholds = sorted(set(thresholds), reverse=True)
+    num_base = 0
+    base_edges = None
+    previous_codes = np.full((len(sample_ids), len(thresholds)), NO_CLUSTER_CODE, dtype=np.int64)
+    next_codes = [NO_CLUSTER_CODE + 1] * len(thresholds)
+    if previous is not None:
+        if previous['thresholds'] != thresholds:
+            raise ValueError(f"Thresholds do not match the previous clustering: {previous['thresholds']}")
+        sample_positions = {sample_id: position for position, sample_id in enumerate(sample_ids)}
+        missing_sample_ids = [sample_id for sample_id in previous['sample_ids'] if sample_id not in sample_positions]
+        if missing_sample_ids:
+            raise ValueError(f"Profiles of {len(missing_sample_ids)} previously clustered samples were not provided, eg. {missing_sample_ids[0]}")
+
+        # Put previously clustered samples first, in their previous order, so that the
+        # previous tree edges and codes refer to the same sample indexes
+        previous_positions = [sample_positions[sample_id] for sample_id in previous['sample_ids']]
+        previous_sample_ids = set(previous['sample_ids'])
+        new_positions = [position for position, sample_id in enumerate(sample_ids) if sample_id not in previous_sample_ids]
+        order = previous_positions + new_positions
+        sample_ids = [sample_ids[position] for position in order]
+        profiles = profiles[order]
+        num_base = len(previous_positions)
+        base_edges = previous['mst_edges']
+        previous_codes[:num_base] = previous['cluster_codes']
+        next_codes = list(previous['next_codes'])
+        logging.info(f"Adding {len(new_positions)} samples to {num_base} previously clustered samples")
+
+    logging.info(f"Building minimum spanning tree of {len(sample_ids)} samples")
+    mst_edges = build_minimum_spanning_tree(profiles, base_edges=base_edges, num_base=num_base)
+
+    cluster_codes = np.zeros((len(sample_ids), len(thresholds)), dtype=np.int64)
+    for threshold_idx, threshold in enumerate(thresholds):
+        clusters = single_linkage_clusters(len(sample_ids), mst_edges, threshold)
+        cluster_codes[:, threshold_idx], next_codes[threshold_idx], merged_codes = assign_cluster_codes(
+            clusters, previous_codes[:, threshold_idx], next_codes[threshold_idx]
+        )
+        for codes in merged_codes:
+            logging.info(f"Clusters merged at threshold {threshold}: {', '.join(map(str, codes))} (now {codes[0]})")
+        logging.info(f"Threshold {threshold}: {int(clusters.max()) + 1 if len(clusters) > 0 else 0} clusters")
+
+    clustering = {
+        'sample_ids': sample_ids,
+        'thresholds': thresholds,
+        'mst_edges': mst_edges,
+        'cluster_codes': cluster_codes,
+        'next_codes': next_codes,
+    }
+
+    return clustering
+
+
+def write_clustering(clustering, locus_ids, output_dir):
+    """
+    Write clustering results to a directory, which can later be passed to load_clustering to add more samples:
+
+      clusters.csv     Cluster codes for each sample, one column per threshold (largest first), and
+                       'cluster_code', the codes joined by '.' (eg. '3.12.40')
+      mst.csv          The edges of the minimum spanning tree
+      clustering.json  Thresholds, next unused cluster codes and a hash of the locus IDs
+
+    :param clustering: Clustering results, as returned by cluster_profiles
+    :type clustering: dict
+    :param locus_ids: The locus IDs of the profiles
+    :type locus_ids: list[str]
+    :param output_dir: The output directory (created if it does not exist)
+    :type output_dir: str
+    :return: None
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    sample_ids = clustering['sample_ids']
+    threshold_fieldnames = [f"threshold_{threshold}" for threshold in clustering['thresholds']]
+
+    with open(os.path.join(output_dir, CLUSTERS_FILENAME), 'w') as f:
+        writer = csv.writer(f, dialect='unix', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['sample_id', 'cluster_code'] + threshold_fieldnames)
+        for sample_id, codes in zip(sample_ids, clustering['cluster_codes'].tolist()):
+            writer.writerow([sample_id, '.'.join(map(str, codes))] + codes)
+
+    with open(os.path.join(output_dir, MST_FILENAME), 'w') as f:
+        writer = csv.writer(f, dialect='unix', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['source', 'target', 'distance'])
+        for sample_idx_a, sample_idx_b, edge_distance in clustering['mst_edges']:
+            writer.writerow([sample_ids[sample_idx_a], sample_ids[sample_idx_b], edge_distance])
+
+    clustering_state = {
+        'thresholds': clustering['thresholds'],
+        'next_codes': clustering['next_codes'],
+        'num_samples': len(sample_ids),
+        'locus_ids_hash': hash_locus_ids(locus_ids),
+    }
+    with open(os.path.join(output_dir, CLUSTERING_STATE_FILENAME), 'w') as f:
+        json.dump(clustering_state, f, indent=2)
+
+
+def load_clustering(clustering_dir, locus_ids):
+    """
+    Load clustering results written by write_clustering.
+
+    :param clustering_dir: The directory the clustering results were written to
+    :type clustering_dir: str
+    :param locus_ids: The locus IDs of the profiles to be added, which must match the clustered profiles
+    :type locus_ids: list[str]
+    :return: Clustering results, as returned by cluster_profiles
+    :rtype: dict
+    :raises ValueError: If the results are inconsistent, or the loci don't match
+    """
+    with open(os.path.join(clustering_dir, CLUSTERING_STATE_FILENAME), 'r') as f:
+        clustering_state = json.load(f)
+    if clustering_state['locus_ids_hash'] != hash_locus_ids(locus_ids):
+        raise ValueError(f"Loci of the profiles do not match the previous clustering: {clustering_dir}")
+    thresholds = clustering_state['thresholds']
+
+    sample_ids = []
+    cluster_codes = []
+    with open(os.path.join(clustering_dir, CLUSTERS_FILENAME), 'r') as f:
+        reader = csv.DictReader(f)
+        threshold_fieldnames = [f"threshold_{threshold}" for threshold in thresholds]
+        for row in reader:
+            sample_ids.append(row['sample_id'])
+            cluster_codes.append([int(row[fieldname]) for fieldname in threshold_fieldnames])
+
+    sample_positions = {sample_id: position for position, sample_id in enumerate(sample_ids)}
+    mst_edges = []
+    with open(os.path.join(clustering_dir, MST_FILENAME), 'r') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            mst_edges.append((sample_positions[row['source']], sample_positions[row['target']], int(row['distance'])))
+
+    if len(sample_ids) != clustering_state['num_samples'] or len(mst_edges) != max(len(sample_ids) - 1, 0):
+        raise ValueError(f"Clustering results are incomplete: {clustering_dir}")
+
+    clustering = {
+        'sample_ids': sample_ids,
+        'thresholds': thresholds,
+        'mst_edges': mst_edges,
+        'cluster_codes': np.array(cluster_codes, dtype=np.int64).reshape(len(sample_ids), len(thresholds)),
+        'next_codes': clustering_state['next_codes'],
+    }
+
+    return clustering
@@ -0,0 +1,246 @@
+import concurrent.futures
+import logging
+import os
+
+import numpy as np
+
+from . import parsers
+
+MISSING_ALLELE = '-'
+MISSING_ALLELE_CODE = 0
+
+# Upper bound on the number of elements compared at once when calculating a block of distances,
+# so that the temporary (rows x columns x loci) comparison array stays small enough to fit in cache.
+MAX_BLOCK_ELEMENTS = 2 ** 22
+
+_worker_state = {}
+
+
+def get_sample_id(allele_profile_path):
+    """
+    Get the sample ID for an allele profile. The sample ID is taken to be the name
+    of the directory containing the allele profile (ie. the --outdir of the typing run).
+
+    :param allele_profile_path: The path to the allele profile file
+    :type allele_profile_path: str
+    :return: The sample ID
+    :rtype: str
+    """
+    return os.path.basename(os.path.dirname(os.path.abspath(allele_profile_path)))
+
+
+def read_allele_profiles(allele_profile_paths, threads=1):
+    """
+    Read many allele profile files. All profiles must have the same loci, in the same order.
+
+    :param allele_profile_paths: The paths to the allele profile files
+    :type allele_profile_paths: list[str]
+    :param threads: Number of files to read concurrently
+    :type threads: int
+    :return: Sample IDs, locus IDs and allele IDs (one list per sample, in locus order)
+    :rtype: tuple[list[str], list[str], list[list[str]]]
+    :raises ValueError: If the profiles have different loci, or sample IDs are duplicated
+    """
+    sample_ids = [get_sample_id(path) for path in allele_profile_paths]
+    seen_sample_ids = set()
+    for sample_id, path in zip(sample_ids, allele_profile_paths):
+        if sample_id in seen_sample_ids:
+            raise ValueError(f"Duplicate sample ID: {sample_id} ({path})")
+        seen_sample_ids.add(sample_id)
+
+    locus_ids = None
+    allele_ids_by_sample = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        for path, allele_profile in zip(allele_profile_paths, executor.map(parsers.parse_allele_profile, allele_profile_paths)):
+            if locus_ids is None:
+                locus_ids = allele_profile['locus_ids']
+            elif allele_profile['locus_ids'] != locus_ids:
+                raise ValueError(f"Loci in allele profile do not match the other profiles: {path}")
+            allele_ids_by_sample.append(allele_profile['allele_ids'])
+
+    return sample_ids, locus_ids or [], allele_ids_by_sample
+
+
+def encode_allele_profiles(allele_ids_by_sample, num_loci):
+    """
+    Encode allele IDs as small integers, so that profiles can be compared as integer arrays.
+    Codes are assigned per-locus, starting from 1. Missing alleles ("-") are encoded as 0.
+
+    :param allele_ids_by_sample: Allele IDs, one list per sample, in locus order
+    :type allele_ids_by_sample: list[list[str]]
+    :param num_loci: The number of loci
+    :type num_loci: int
+    :return: The encoded profiles (samples x loci), and the code for each allele ID at each locus
+    :rtype: tuple[numpy.ndarray, list[dict[str, int]]]
+    """
+    allele_codes = [{MISSING_ALLELE: MISSING_ALLELE_CODE} for _ in range(num_loci)]
+    profiles = np.zeros((len(allele_ids_by_sample), num_loci), dtype=np.uint32)
+    for sample_idx, allele_ids in enumerate(allele_ids_by_sample):
+        profile = profiles[sample_idx]
+        for locus_idx, allele_id in enumerate(allele_ids):
+            locus_allele_codes = allele_codes[locus_idx]
+            code = locus_allele_codes.get(allele_id)
+            if code is None:
+                code = len(locus_allele_codes)
+                locus_allele_codes[allele_id] = code
+            profile[locus_idx] = code
+
+    max_code = max((len(locus_allele_codes) - 1 for locus_allele_codes in allele_codes), default=0)
+    profiles = profiles.astype(np.min_scalar_type(max_code))
+
+    return profiles, allele_codes
+
+
+def drop_incomplete_loci(profiles):
+    """
+    Drop any loci that are missing in at least one profile (complete deletion).
+
+    :param profiles: The encoded profiles (samples x loci)
+    :type profiles: numpy.ndarray
+    :return: The encoded profiles, restricted to loci that are called in every sample
+    :rtype: numpy.ndarray
+    """
+    complete_loci = np.all(profiles != MISSING_ALLELE_CODE, axis=0)
+
+    return profiles[:, complete_loci]
+
+
+def calculate_distance_rows(query_profiles, profiles):
+    """
+    Calculate the number of allele differences between each query profile and each profile.
+    Loci that are missing in either profile of a pair are not counted (pairwise deletion).
+
+    The comparison is done in blocks of profiles, so memory use is bounded by MAX_BLOCK_ELEMENTS
+    regardless of the number of profiles.
+
+    :param query_profiles: The encoded query profiles (queries x loci)
+    :type query_profiles: numpy.ndarray
+    :param profiles: The encoded profiles to compare against (samples x loci)
+    :type profiles: numpy.ndarray
+    :return: The distances (queries x samples)
+    :rtype: numpy.ndarray
+    """
+    num_queries, num_loci = query_profiles.shape
+    num_profiles = profiles.shape[0]
+    distances = np.empty((num_queries, num_profiles), dtype=np.uint32)
+    if num_queries == 0 or num_profiles == 0:
+        return distances
+
+    # Two missing alleles compare equal, and a missing allele never equals a called allele, so the number
+    # of loci that differ with both alleles called is:
+    #   (number of unequal loci) - (number of loci missing in exactly one of the two profiles)
+    query_missing = (query_profiles == MISSING_ALLELE_CODE).astype(np.float32)
+    profiles_missing = (profiles == MISSING_ALLELE_CODE).astype(np.float32)
+    query_num_missing = query_missing.sum(axis=1)
+    profiles_num_missing = profiles_missing.sum(axis=1)
+
+    query_block_size = max(1, min(num_queries, MAX_BLOCK_ELEMENTS // max(1, num_loci * 64)))
+    profile_block_size = max(1, MAX_BLOCK_ELEMENTS // max(1, num_loci * query_block_size))
+    for query_start in range(0, num_queries, query_block_size):
+        query_end = min(query_start + query_block_size, num_queries)
+        query_block = query_profiles[query_start:query_end, None, :]
+        for profile_start in range(0, num_profiles, profile_block_size):
+            profile_end = min(profile_start + profile_block_size, num_profiles)
+            num_unequal = np.count_nonzero(query_block != profiles[None, profile_start:profile_end, :], axis=2)
+            both_missing = query_missing[query_start:query_end] @ profiles_missing[profile_start:profile_end].T
+            one_missing = query_num_missing[query_start:query_end, None] + profiles_num_missing[None, profile_start:profile_end] - 2 * both_missing
+            distances[query_start:query_end, profile_start:profile_end] = num_unequal - one_missing.astype(np.int64)
+
+    return distances
+
+
+def _init_distance_worker(profiles):
+    _worker_state['profiles'] = profiles
+
+
+def _calculate_distance_matrix_block(row_start, row_end):
+    profiles = _worker_state['profiles']
+
+    return row_start, row_end, calculate_distance_rows(profiles[row_start:row_end], profiles[row_start:])
+
+
+def calculate_distance_matrix(profiles, missing='pairwise', threads=1, block_size=256):
+    """
+    Calculate the pairwise allele distance matrix.
+
+    Blocks of rows are calculated in parallel across a process pool. Only the upper
+    triangle is calculated; the lower triangle is filled in by symmetry.
+
+    :param profiles: The encoded profiles (samples x loci)
+    :type profiles: numpy.ndarray
+    :param missing: How to handle missing alleles. 'pairwise': ignore loci that are missing in either sample of a pair,
+                    'complete': ignore loci that are missing in any sample
+    :type missing: str
+    :param threads: Number of worker processes
+    :type threads: int
+    :param block_size: Number of rows calculated by each task
+    :type block_size: int
+    :return: The distance matrix (samples x samples)
+    :rtype: numpy.ndarray
+    :raises ValueError: If the missing data mode is not recognized
+    """
+    if missing == 'complete':
+        profiles = drop_incomplete_loci(profiles)
+        logging.info(f"Complete deletion: using {profiles.shape[1]} loci that are called in all samples")
+    elif missing != 'pairwise':
+        raise ValueError(f"Unknown missing data mode: {missing}")
+
+    num_profiles, num_loci = profiles.shape
+    distance_dtype = np.min_scalar_type(max(num_loci, 1))
+    distance_matrix = np.zeros((num_profiles, num_profiles), dtype=distance_dtype)
+    row_blocks = [(row_start, min(row_start + block_size, num_profiles)) for row_start in range(0, num_profiles, block_size)]
+
+    def fill_block(row_start, row_end, block):
+        distance_matrix[row_start:row_end, row_start:] = block
+        distance_matrix[row_start:, row_start:row_end] = block.T
+
+    if threads <= 1 or len(row_blocks) <= 1:
+        _init_distance_worker(profiles)
+        for row_start, row_end in row_blocks:
+            fill_block(*_calculate_distance_matrix_block(row_start, row_end))
+        _worker_state.clear()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads, initializer=_init_distance_worker, initargs=(profiles,)) as executor:
+            futures = [executor.submit(_calculate_distance_matrix_block, row_start, row_end) for row_start, row_end in row_blocks]
+            for future in concurrent.futures.as_completed(futures):
+                fill_block(*future.result())
+
+    return distance_matrix
+
+
+def write_distance_matrix(sample_ids, distance_matrix, distance_matrix_path, output_format='tsv'):
+    """
+    Write a distance matrix.
+
+    :param sample_ids: The sample IDs, in the same order as the rows of the distance matrix
+    :type sample_ids: list[str]
+    :param distance_matrix: The distance matrix
+    :type distance_matrix: numpy.ndarray
+    :param distance_matrix_path: The path to the output file
+    :type distance_matrix_path: str
+    :param output_format: One of 'tsv', 'csv' (labelled text matrix) or 'npy' (NumPy binary matrix; sample IDs are
+                          written one per line to '<distance_matrix_path>.sample_ids.txt')
+    :type output_format: str
+    :return: None
+    :raises ValueError: If the output format is not recognized
+    """
+    if output_format == 'npy':
+        with open(distance_matrix_path, 'wb') as f:
+            np.save(f, distance_matrix)
+        with open(f"{distance_matrix_path}.sample_ids.txt", 'w') as f:
+            for sample_id in sample_ids:
+                f.write(sample_id + '\n')
+        return
+
+    delimiters = {
+        'tsv': '\t',
+        'csv': ',',
+    }
+    if output_format not in delimiters:
+        raise ValueError(f"Unknown distance matrix output format: {output_format}")
+    delimiter = delimiters[output_format]
+
+    with open(distance_matrix_path, 'w') as f:
+        f.write(delimiter.join(['sample_id'] + sample_ids) + '\n')
+        for sample_id, row in zip(sample_ids, distance_matrix):
+            f.write(sample_id + delimiter + delimiter.join(map(str, row.tolist())) + '\n')
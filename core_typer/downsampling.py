@@ -0,0 +1,245 @@
+import concurrent.futures
+import contextlib
+import gzip
+import logging
+import os
+import random
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+DEFAULT_SEED = 0
+
+
+def open_fastq(fastq_path):
+    """
+    Open a FASTQ file for reading in binary mode, decompressing it if it is gzipped.
+    Compression is detected from the file contents, not the file name.
+
+    :param fastq_path: The path to the FASTQ file
+    :type fastq_path: str
+    :return: The open file
+    :rtype: typing.BinaryIO
+    """
+    with open(fastq_path, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(fastq_path, 'rb')
+
+    return open(fastq_path, 'rb')
+
+
+def iter_fastq_records(fastq_file):
+    """
+    Iterate over the records of an open FASTQ file.
+
+    :param fastq_file: The open FASTQ file
+    :type fastq_file: typing.BinaryIO
+    :return: The FASTQ records, as tuples of (header, sequence, separator, quality) lines, including line endings
+    :rtype: Iterator[tuple[bytes, bytes, bytes, bytes]]
+    :raises ValueError: If the file ends part way through a record
+    """
+    lines = iter(fastq_file)
+    for header in lines:
+        record = (header, next(lines, None), next(lines, None), next(lines, None))
+        if record[3] is None:
+            raise ValueError(f"Truncated FASTQ record: {header.strip().decode(errors='replace')}")
+        yield record
+
+
+def count_fastq_bases(fastq_path):
+    """
+    Count the reads and bases in a FASTQ file.
+
+    :param fastq_path: The path to the FASTQ file (optionally gzipped)
+    :type fastq_path: str
+    :return: Counts. Keys are: 'num_reads', 'num_bases'
+    :rtype: dict[str, int]
+    """
+    num_reads = 0
+    num_bases = 0
+    with open_fastq(fastq_path) as f:
+        for _, sequence, _, _ in iter_fastq_records(f):
+            num_reads += 1
+            num_bases += len(sequence.rstrip())
+
+    counts = {
+        'num_reads': num_reads,
+        'num_bases': num_bases,
+    }
+
+    return counts
+
+
+def count_read_pairs(r1_path, r2_path):
+    """
+    Count the read pairs and bases in a pair of FASTQ files. Both files are read concurrently.
+
+    :param r1_path: The path to the R1 FASTQ file
+    :type r1_path: str
+    :param r2_path: The path to the R2 FASTQ file
+    :type r2_path: str
+    :return: Counts. Keys are: 'num_pairs', 'num_bases' (total over both files)
+    :rtype: dict[str, int]
+    :raises ValueError: If the files have different numbers of reads
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        r1_counts, r2_counts = executor.map(count_fastq_bases, [r1_path, r2_path])
+    if r1_counts['num_reads'] != r2_counts['num_reads']:
+        raise ValueError(f"Paired FASTQ files have different numbers of reads: {r1_path} ({r1_counts['num_reads']}), {r2_path} ({r2_counts['num_reads']})")
+
+    counts = {
+        'num_pairs': r1_counts['num_reads'],
+        'num_bases': r1_counts['num_bases'] + r2_counts['num_bases'],
+    }
+
+    return counts
+
+
+def iter_sampled_indices(num_records, num_records_to_keep, seed=DEFAULT_SEED):
+    """
+    Decide which records to keep, in a single pass, so that exactly num_records_to_keep
+    of num_records are kept and every subset is equally likely (Knuth's selection sampling).
+
+    The decisions depend only on the arguments, so calling this once for each file of a
+    read pair keeps the two files in sync without buffering reads.
+
+    :param num_records: The total number of records
+    :type num_records: int
+    :param num_records_to_keep: The number of records to keep
+    :type num_records_to_keep: int
+    :param seed: Seed for the random number generator
+    :type seed: int
+    :return: For each record in order, whether to keep it
+    :rtype: Iterator[bool]
+    """
+    rng = random.Random(seed)
+    num_kept = 0
+    for record_idx in range(num_records):
+        keep = (num_records - record_idx) * rng.random() < (num_records_to_keep - num_kept)
+        if keep:
+            num_kept += 1
+        yield keep
+
+
+def write_sampled_fastq(input_path, output_path, num_records, num_records_to_keep, seed=DEFAULT_SEED):
+    """
+    Write a random subsample of the records in a FASTQ file. The output is written uncompressed,
+    and may be a named pipe.
+
+    :param input_path: The path to the input FASTQ file (optionally gzipped)
+    :type input_path: str
+    :param output_path: The path to the output FASTQ file
+    :type output_path: str
+    :param num_records: The number of records in the input file
+    :type num_records: int
+    :param num_records_to_keep: The number of records to write
+    :type num_records_to_keep: int
+    :param seed: Seed for the random number generator
+    :type seed: int
+    :return: The number of bases written
+    :rtype: int
+    """
+    num_bases = 0
+    with open_fastq(input_path) as input_file, open(output_path, 'wb') as output_file:
+        for record, keep in zip(iter_fastq_records(input_file), iter_sampled_indices(num_records, num_records_to_keep, seed)):
+            if keep:
+                output_file.writelines(record)
+                num_bases += len(record[1].rstrip())
+
+    return num_bases
+
+
+def _release_fifo_writer(fifo_path):
+    """
+    Unblock a writer waiting on a named pipe that will never be opened for reading
+    (eg. because kma failed), by opening and closing the read end.
+    """
+    try:
+        fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    os.close(fd)
+
+
+@contextlib.contextmanager
+def downsampled_read_pairs(r1_path, r2_path, output_dir, num_pairs, num_pairs_to_keep, seed=DEFAULT_SEED, named_pipes=True):
+    """
+    Stream a random subsample of read pairs through a pair of named pipes, for kma to read.
+    R1 and R2 are sampled in separate threads with the same decisions, so pairs stay in sync.
+    If named_pipes is False, the reads are written to regular files before the context is entered
+    instead, so that they can be read more than once (eg. by kma for each scheme shard).
+
+    :param r1_path: The path to the R1 FASTQ file (optionally gzipped)
+    :type r1_path: str
+    :param r2_path: The path to the R2 FASTQ file (optionally gzipped)
+    :type r2_path: str
+    :param output_dir: Directory to create the named pipes in
+    :type output_dir: str
+    :param num_pairs: The number of read pairs in the input files
+    :type num_pairs: int
+    :param num_pairs_to_keep: The number of read pairs to keep
+    :type num_pairs_to_keep: int
+    :param seed: Seed for the random number generator
+    :type seed: int
+    :param named_pipes: Stream the reads through named pipes, rather than writing them to files
+    :type named_pipes: bool
+    :return: The paths to the named pipes (or files), and the number of bases written once the context exits.
+             Keys are: 'R1', 'R2', 'num_bases'
+    :rtype: dict
+    """
+    downsampled_reads = {
+        'R1': os.path.join(output_dir, 'downsampled_R1.fastq'),
+        'R2': os.path.join(output_dir, 'downsampled_R2.fastq'),
+        'num_bases': None,
+    }
+    if named_pipes:
+        for reads_field in ['R1', 'R2']:
+            os.mkfifo(downsampled_reads[reads_field])
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    writer_futures = [
+        executor.submit(write_sampled_fastq, input_path, downsampled_reads[reads_field], num_pairs, num_pairs_to_keep, seed)
+        for reads_field, input_path in [('R1', r1_path), ('R2', r2_path)]
+    ]
+    if not named_pipes:
+        concurrent.futures.wait(writer_futures)
+        for future in writer_futures:
+            future.result()
+    completed = False
+    try:
+        yield downsampled_reads
+        completed = True
+    finally:
+        # A writer may not have opened its pipe yet when it is first released, so keep releasing until all writers finish.
+        while not all(future.done() for future in writer_futures):
+            for reads_field in ['R1', 'R2']:
+                _release_fifo_writer(downsampled_reads[reads_field])
+            concurrent.futures.wait(writer_futures, timeout=0.1)
+        executor.shutdown(wait=True)
+
+    if completed:
+        downsampled_reads['num_bases'] = sum(future.result() for future in writer_futures)
+
+
+def calculate_num_pairs_to_keep(num_pairs, num_bases, target_length, target_depth):
+    """
+    Calculate how many read pairs to keep to reach a target depth.
+
+    :param num_pairs: The number of read pairs
+    :type num_pairs: int
+    :param num_bases: The number of bases in all reads
+    :type num_bases: int
+    :param target_length: The length that depth is measured over (eg. genome size), in bp
+    :type target_length: int
+    :param target_depth: The target depth
+    :type target_depth: float
+    :return: The number of read pairs to keep (num_pairs if the reads are already at or below the target depth)
+    :rtype: int
+    """
+    depth = num_bases / target_length
+    if depth <= target_depth or num_pairs == 0:
+        return num_pairs
+    num_pairs_to_keep = int(round(num_pairs * target_depth / depth))
+    logging.debug(f"Keeping {num_pairs_to_keep} of {num_pairs} read pairs to reach target depth {target_depth}")
+
+    return max(1, num_pairs_to_keep)
@@ -0,0 +1,391 @@
+import concurrent.futures
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from . import scheme
+from . import sharding
+from . import utils
+
+INDEX_MANIFEST_FILENAME = 'index.json'
+INDEX_MANIFEST_VERSION = 1
+SCHEME_NAME = 'scheme'
+DEFAULT_NUM_SHARDS = 8
+
+FASTA_EXTENSIONS = [
+    '.fasta',
+    '.fas',
+    '.fa',
+    '.fna',
+    '.tfa',
+]
+
+
+def get_index_manifest_file(index_dir):
+    """
+    Get the path to the index manifest in a scheme index directory.
+
+    :param index_dir: The scheme index directory, as created by build_index
+    :type index_dir: str
+    :return: The path to the index manifest
+    :rtype: str
+    """
+    return os.path.join(index_dir, INDEX_MANIFEST_FILENAME)
+
+
+def get_scheme_path(index_dir):
+    """
+    Get the scheme path (as passed to --scheme) of a scheme index directory.
+
+    :param index_dir: The scheme index directory, as created by build_index
+    :type index_dir: str
+    :return: The scheme path
+    :rtype: str
+    """
+    return os.path.join(index_dir, SCHEME_NAME)
+
+
+def find_locus_fasta_files(paths):
+    """
+    Expand directories into the per-locus FASTA files they contain (sorted by file name).
+    Other paths are kept as they are, in order.
+
+    :param paths: Per-locus FASTA files, or directories of them
+    :type paths: list[str]
+    :return: The per-locus FASTA files
+    :rtype: list[str]
+    """
+    locus_fasta_paths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            locus_fasta_paths.append(path)
+            continue
+        for filename in sorted(os.listdir(path)):
+            if os.path.splitext(filename)[1].lower() in FASTA_EXTENSIONS:
+                locus_fasta_paths.append(os.path.join(path, filename))
+
+    return locus_fasta_paths
+
+
+def read_locus_fasta(locus_fasta_path):
+    """
+    Read the allele names and lengths from a per-locus FASTA file, and hash its contents.
+
+    :param locus_fasta_path: The path to the FASTA file of one locus's alleles, with headers '<locus_id>_<allele_id>'
+    :type locus_fasta_path: str
+    :return: The locus. Keys are: 'locus_id', 'fasta', 'hash' (sha1 of the file), 'allele_names' (in file order),
+             'allele_lengths', 'total_allele_length'
+    :rtype: dict
+    :raises ValueError: If the file has no alleles, or alleles of more than one locus
+    """
+    allele_names = []
+    allele_lengths = []
+    locus_id = None
+    for header, sequence in sharding.iter_fasta(locus_fasta_path):
+        header_locus_id = header.split('_')[0]
+        if locus_id is None:
+            locus_id = header_locus_id
+        elif header_locus_id != locus_id:
+            raise ValueError(f"Alleles of more than one locus ({locus_id}, {header_locus_id}) in: {locus_fasta_path}")
+        allele_names.append(header)
+        allele_lengths.append(len(sequence))
+    if locus_id is None:
+        raise ValueError(f"No alleles found in: {locus_fasta_path}")
+
+    locus = {
+        'locus_id': locus_id,
+        'fasta': os.path.abspath(locus_fasta_path),
+        'hash': scheme.hash_file(locus_fasta_path),
+        'allele_names': allele_names,
+        'allele_lengths': allele_lengths,
+        'total_allele_length': sum(allele_lengths),
+    }
+
+    return locus
+
+
+def load_index_manifest(index_dir):
+    """
+    Load the manifest of a scheme index directory.
+
+    :param index_dir: The scheme index directory, as created by build_index
+    :type index_dir: str
+    :return: The index manifest, or None if the directory has no manifest. Keys are: 'version', 'target_shard_size',
+             'combined_extensions' (files of the combined kma index, if built), 'loci' (in scheme order). Keys of
+             each locus are: 'locus_id', 'fasta', 'hash', 'num_alleles', 'total_allele_length', 'shard'
+    :rtype: dict|None
+    :raises ValueError: If the manifest version is not supported
+    """
+    index_manifest_file = get_index_manifest_file(index_dir)
+    if not os.path.exists(index_manifest_file):
+        return None
+    with open(index_manifest_file, 'r') as f:
+        index_manifest = json.load(f)
+    if index_manifest.get('version') != INDEX_MANIFEST_VERSION:
+        raise ValueError(f"Unsupported index manifest version {index_manifest.get('version')}: {index_manifest_file}")
+
+    return index_manifest
+
+
+def assign_shards(locus_ids, locus_sizes, previous_shards, target_shard_size):
+    """
+    Assign loci to shards, keeping the shard of every locus that was already assigned one.
+
+    Loci are in scheme order, with new loci after all previous ones, so shards stay contiguous. New loci are added
+    to the last shard until it reaches target_shard_size, then to new shards, so existing shards (other than the last)
+    are unaffected by new loci.
+
+    :param locus_ids: The locus IDs, in scheme order
+    :type locus_ids: list[str]
+    :param locus_sizes: The size of each locus (total allele length), indexed by locus_id
+    :type locus_sizes: dict[str, int]
+    :param previous_shards: The shard name of each previously assigned locus, indexed by locus_id
+    :type previous_shards: dict[str, str]
+    :param target_shard_size: The total allele length at which a shard is full
+    :type target_shard_size: int
+    :return: The locus IDs in each shard, indexed by shard name, in scheme order
+    :rtype: dict[str, list[str]]
+    """
+    shards = {}
+    for locus_id in locus_ids:
+        if locus_id in previous_shards:
+            shards.setdefault(previous_shards[locus_id], []).append(locus_id)
+    shard_sizes = {shard_name: sum(locus_sizes[locus_id] for locus_id in shard_locus_ids) for shard_name, shard_locus_ids in shards.items()}
+    shard_numbers = [int(shard_name.rsplit('-', 1)[1]) for shard_name in set(previous_shards.values())]
+    next_shard_number = max(shard_numbers, default=0) + 1
+    last_shard_name = next(reversed(shards), None)
+    for locus_id in locus_ids:
+        if locus_id in previous_shards:
+            continue
+        if last_shard_name is None or shard_sizes[last_shard_name] >= target_shard_size:
+            last_shard_name = f"shard-{next_shard_number:03d}"
+            next_shard_number += 1
+            shards[last_shard_name] = []
+            shard_sizes[last_shard_name] = 0
+        shards[last_shard_name].append(locus_id)
+        shard_sizes[last_shard_name] += locus_sizes[locus_id]
+
+    return shards
+
+
+def _replace_file(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f".{os.path.basename(path)}-", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _get_index_files(index_dir, index_name):
+    prefix = f"{index_name}."
+    return {filename[len(prefix):]: os.path.join(index_dir, filename) for filename in os.listdir(index_dir) if filename.startswith(prefix)}
+
+
+def build_kma_index(locus_fasta_paths, index_dir, index_name):
+    """
+    Build a kma index of the alleles in per-locus FASTA files, in order.
+
+    The index is built under a temporary name in index_dir, then each of its files is moved into place,
+    so a failed build leaves the previous index as it was.
+
+    :param locus_fasta_paths: The per-locus FASTA files, in scheme order
+    :type locus_fasta_paths: list[str]
+    :param index_dir: The directory to write the index to
+    :type index_dir: str
+    :param index_name: The name of the index, in index_dir (the index is passed to kma -t_db as index_dir/index_name)
+    :type index_name: str
+    :return: The extensions of the index files (eg. 'name', 'length.b')
+    :rtype: list[str]
+    :raises subprocess.CalledProcessError: If kma fails
+    """
+    fasta_path = os.path.join(index_dir, f".{index_name}-alleles.fasta")
+    tmp_index_name = f".{index_name}.tmp"
+    try:
+        with open(fasta_path, 'w') as f:
+            for locus_fasta_path in locus_fasta_paths:
+                for header, sequence in sharding.iter_fasta(locus_fasta_path):
+                    f.write(f">{header}\n{sequence}\n")
+        utils.run_command(["kma", "index", "-i", fasta_path, "-o", os.path.join(index_dir, tmp_index_name)], exit_on_failure=False)
+    finally:
+        os.remove(fasta_path)
+
+    index_files = _get_index_files(index_dir, tmp_index_name)
+    for extension, tmp_path in index_files.items():
+        os.replace(tmp_path, os.path.join(index_dir, f"{index_name}.{extension}"))
+
+    return sorted(index_files)
+
+
+def build_index(locus_fasta_paths, index_dir, num_shards=None, threads=1, combined=False, rebuild=False):
+    """
+    Build or update a scheme index directory from per-locus FASTA files.
+
+    The scheme is split into locus-disjoint kma indexes (shards, see sharding.build_scheme_shards), and a manifest
+    (index.json) records the content hash of each locus's FASTA file. When the index is updated, only the shards
+    with loci that were added, changed or removed are re-indexed, concurrently. Locus order is kept from the previous
+    build, with new loci added at the end, and alleles are in the order of each locus's FASTA file, so the scheme's
+    .name file (and so the column order of allele profiles) is stable as the scheme grows.
+
+    The index directory holds a shard manifest (shards.json), so it can be passed to --scheme-shards, and the .name
+    and .length.b files of the whole scheme (at index_dir/scheme, see get_scheme_path). If combined is True, a
+    single kma index of the whole scheme is also built there (whenever any locus has changed), so that typing without
+    --scheme-shards works too.
+
+    :param locus_fasta_paths: The per-locus FASTA files, with headers '<locus_id>_<allele_id>'. New loci are added in this order
+    :type locus_fasta_paths: list[str]
+    :param index_dir: The scheme index directory (created if it does not exist)
+    :type index_dir: str
+    :param num_shards: The number of shards to split a new index into (default: DEFAULT_NUM_SHARDS). Existing indexes
+                       keep their shards unless rebuild is True
+    :type num_shards: int|None
+    :param threads: Number of FASTA files to read, and shards to index, concurrently
+    :type threads: int
+    :param combined: Also build a single kma index of the whole scheme
+    :type combined: bool
+    :param rebuild: Re-partition the scheme into num_shards shards, and re-index every shard. Locus order is kept
+    :type rebuild: bool
+    :return: Counts. Keys are: 'num_loci', 'num_alleles', 'num_shards', 'num_shards_indexed', 'num_loci_added',
+             'num_loci_changed', 'num_loci_removed'
+    :rtype: dict[str, int]
+    :raises ValueError: If a FASTA file has no alleles or alleles of more than one locus, or a locus is in more than one file
+    :raises subprocess.CalledProcessError: If kma fails
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    previous_manifest = load_index_manifest(index_dir)
+    if previous_manifest is not None and not rebuild and num_shards is not None and num_shards != len({locus['shard'] for locus in previous_manifest['loci']}):
+        logging.warning(f"Keeping the existing shards of {index_dir}. Use --rebuild to split it into {num_shards} shards")
+
+    logging.info(f"Reading {len(locus_fasta_paths)} locus FASTA files")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        loci = list(executor.map(read_locus_fasta, locus_fasta_paths))
+    loci_by_locus_id = {}
+    for locus in loci:
+        if locus['locus_id'] in loci_by_locus_id:
+            raise ValueError(f"Locus {locus['locus_id']} is in more than one FASTA file: {loci_by_locus_id[locus['locus_id']]['fasta']}, {locus['fasta']}")
+        loci_by_locus_id[locus['locus_id']] = locus
+
+    previous_loci = previous_manifest['loci'] if previous_manifest is not None else []
+    previous_loci_by_locus_id = {previous_locus['locus_id']: previous_locus for previous_locus in previous_loci}
+    locus_ids = [previous_locus['locus_id'] for previous_locus in previous_loci if previous_locus['locus_id'] in loci_by_locus_id]
+    locus_ids += [locus['locus_id'] for locus in loci if locus['locus_id'] not in previous_loci_by_locus_id]
+    removed_locus_ids = [previous_locus['locus_id'] for previous_locus in previous_loci if previous_locus['locus_id'] not in loci_by_locus_id]
+    changed_locus_ids = [
+        locus_id for locus_id in locus_ids
+        if locus_id in previous_loci_by_locus_id and previous_loci_by_locus_id[locus_id]['hash'] != loci_by_locus_id[locus_id]['hash']
+    ]
+    if removed_locus_ids:
+        logging.warning(f"Removing {len(removed_locus_ids)} loci that are no longer in the inputs, eg. {removed_locus_ids[0]}")
+
+    locus_sizes = {locus_id: loci_by_locus_id[locus_id]['total_allele_length'] for locus_id in locus_ids}
+    if previous_manifest is not None and not rebuild:
+        target_shard_size = previous_manifest['target_shard_size']
+        previous_shards = {locus_id: previous_loci_by_locus_id[locus_id]['shard'] for locus_id in locus_ids if locus_id in previous_loci_by_locus_id}
+    else:
+        initial_shards = sharding.partition_loci(locus_ids, locus_sizes, num_shards or DEFAULT_NUM_SHARDS)
+        target_shard_size = -(-sum(locus_sizes.values()) // len(initial_shards))
+        previous_shards = {locus_id: f"shard-{shard_idx + 1:03d}" for shard_idx, shard_locus_ids in enumerate(initial_shards) for locus_id in shard_locus_ids}
+    shards = assign_shards(locus_ids, locus_sizes, previous_shards, target_shard_size)
+
+    previous_shard_locus_ids = {}
+    for previous_locus in previous_loci:
+        previous_shard_locus_ids.setdefault(previous_locus['shard'], []).append(previous_locus['locus_id'])
+    changed_locus_ids_set = set(changed_locus_ids)
+    shards_to_index = [
+        shard_name for shard_name, shard_locus_ids in shards.items()
+        if rebuild
+        or shard_locus_ids != previous_shard_locus_ids.get(shard_name)
+        or any(locus_id in changed_locus_ids_set for locus_id in shard_locus_ids)
+        or not os.path.exists(scheme.get_names_file(os.path.join(index_dir, shard_name)))
+    ]
+
+    logging.info(f"Indexing {len(shards_to_index)} of {len(shards)} scheme shards")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        shard_futures = [
+            executor.submit(build_kma_index, [loci_by_locus_id[locus_id]['fasta'] for locus_id in shards[shard_name]], index_dir, shard_name)
+            for shard_name in shards_to_index
+        ]
+        # Wait for every shard, so no kma process outlives a failure, then re-raise the first error.
+        concurrent.futures.wait(shard_futures)
+        for shard_future in shard_futures:
+            shard_future.result()
+    for shard_name in previous_shard_locus_ids:
+        if shard_name not in shards:
+            logging.info(f"Removing empty scheme shard: {shard_name}")
+            for index_file in _get_index_files(index_dir, shard_name).values():
+                os.remove(index_file)
+
+    scheme_path = get_scheme_path(index_dir)
+    allele_names = [allele_name for locus_id in locus_ids for allele_name in loci_by_locus_id[locus_id]['allele_names']]
+    allele_lengths = [allele_length for locus_id in locus_ids for allele_length in loci_by_locus_id[locus_id]['allele_lengths']]
+    names_file = scheme.get_names_file(scheme_path)
+    scheme_changed = bool(shards_to_index or removed_locus_ids) or not os.path.exists(names_file)
+    if scheme_changed:
+        _replace_file(names_file, ''.join(f"{allele_name}\n" for allele_name in allele_names).encode('utf-8'))
+        _replace_file(scheme.get_lengths_file(scheme_path), np.array([len(allele_lengths)] + allele_lengths, dtype=np.int32).tobytes())
+
+    combined_extensions = previous_manifest.get('combined_extensions', []) if previous_manifest is not None else []
+    if combined and (scheme_changed or not combined_extensions):
+        logging.info(f"Indexing the whole scheme ({len(locus_ids)} loci)")
+        combined_extensions = build_kma_index([loci_by_locus_id[locus_id]['fasta'] for locus_id in locus_ids], index_dir, SCHEME_NAME)
+    elif not combined and combined_extensions and scheme_changed:
+        logging.warning(f"Removing the out of date kma index of the whole scheme (it is only updated with --combined): {scheme_path}")
+        for extension in combined_extensions:
+            if extension not in ['name', 'length.b'] and os.path.exists(f"{scheme_path}.{extension}"):
+                os.remove(f"{scheme_path}.{extension}")
+        combined_extensions = []
+
+    shard_manifest = {
+        'version': sharding.SHARD_MANIFEST_VERSION,
+        'scheme_names_file_hash': scheme.hash_file(names_file),
+        'shards': [
+            {
+                'name': shard_name,
+                'num_loci': len(shard_locus_ids),
+                'first_locus_id': shard_locus_ids[0],
+                'last_locus_id': shard_locus_ids[-1],
+                'total_allele_length': sum(locus_sizes[locus_id] for locus_id in shard_locus_ids),
+            }
+            for shard_name, shard_locus_ids in shards.items()
+        ],
+    }
+    _replace_file(sharding.get_shard_manifest_file(index_dir), json.dumps(shard_manifest, indent=2).encode('utf-8'))
+
+    shard_names = {locus_id: shard_name for shard_name, shard_locus_ids in shards.items() for locus_id in shard_locus_ids}
+    index_manifest = {
+        'version': INDEX_MANIFEST_VERSION,
+        'target_shard_size': target_shard_size,
+        'combined_extensions': combined_extensions,
+        'loci': [
+            {
+                'locus_id': locus_id,
+                'fasta': loci_by_locus_id[locus_id]['fasta'],
+                'hash': loci_by_locus_id[locus_id]['hash'],
+                'num_alleles': len(loci_by_locus_id[locus_id]['allele_names']),
+                'total_allele_length': locus_sizes[locus_id],
+                'shard': shard_names[locus_id],
+            }
+            for locus_id in locus_ids
+        ],
+    }
+    # The index manifest is written last, so if anything above fails, the next build re-indexes the same shards.
+    _replace_file(get_index_manifest_file(index_dir), json.dumps(index_manifest, indent=2).encode('utf-8'))
+    logging.info(f"Wrote index manifest: {get_index_manifest_file(index_dir)}")
+
+    counts = {
+        'num_loci': len(locus_ids),
+        'num_alleles': len(allele_names),
+        'num_shards': len(shards),
+        'num_shards_indexed': len(shards_to_index),
+        'num_loci_added': len([locus_id for locus_id in locus_ids if locus_id not in previous_loci_by_locus_id]),
+        'num_loci_changed': len(changed_locus_ids),
+        'num_loci_removed': len(removed_locus_ids),
+    }
+
+    return counts
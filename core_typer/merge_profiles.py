@@ -0,0 +1,128 @@
+import collections
+import concurrent.futures
+import logging
+
+from . import distance
+from . import parsers
+
+
+def _read_allele_profile(allele_profile_path):
+    try:
+        return parsers.parse_allele_profile(allele_profile_path), None
+    except (OSError, ValueError) as e:
+        return None, e
+
+
+def iter_allele_profiles(allele_profile_paths, threads=1):
+    """
+    Read allele profile files concurrently, yielding them in the order they were given.
+    At most a few files per thread are read ahead, so memory doesn't depend on the number of files.
+
+    :param allele_profile_paths: The paths to the allele profile files
+    :type allele_profile_paths: Iterable[str]
+    :param threads: Number of files to read concurrently
+    :type threads: int
+    :return: For each file: its path, the allele profile (as returned by parsers.parse_allele_profile, or None
+             if the file couldn't be read) and the error if it couldn't be read (otherwise None)
+    :rtype: Iterator[tuple[str, dict|None, Exception|None]]
+    """
+    max_in_flight = max(1, threads) * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        futures = collections.deque()
+        for allele_profile_path in allele_profile_paths:
+            futures.append((allele_profile_path, executor.submit(_read_allele_profile, allele_profile_path)))
+            if len(futures) >= max_in_flight:
+                allele_profile_path, future = futures.popleft()
+                yield (allele_profile_path, *future.result())
+        while futures:
+            allele_profile_path, future = futures.popleft()
+            yield (allele_profile_path, *future.result())
+
+
+def merge_allele_profiles(allele_profile_paths, output_path=None, locus_ids=None, delimiter=',', store=None, threads=1,
+                          skip_mismatched=False, batch_size=1000):
+    """
+    Merge single-sample allele profile files (as written by allele_calling.write_allele_profile) into a samples x loci
+    matrix, with a header row of locus IDs (as for ProfileStore.export_csv). Sample IDs are taken from the name of
+    the directory containing each file (see distance.get_sample_id).
+
+    Rows are written as each file is read, and appended to the profile store (if given) in batches, so memory
+    doesn't depend on the number of samples (apart from the set of sample IDs seen, used to detect duplicates).
+
+    :param allele_profile_paths: The paths to the allele profile files
+    :type allele_profile_paths: Iterable[str]
+    :param output_path: The path to write the matrix to (default: don't write a matrix)
+    :type output_path: str|None
+    :param locus_ids: The expected locus IDs, in scheme order (default: the loci of the first profile)
+    :type locus_ids: list[str]|None
+    :param delimiter: The field delimiter of the matrix
+    :type delimiter: str
+    :param store: A profile store to append the profiles to, as a compact binary matrix. Its loci must be locus_ids
+    :type store: profile_store.ProfileStore|None
+    :param threads: Number of files to read concurrently
+    :type threads: int
+    :param skip_mismatched: Skip (with a warning) files that can't be read, whose loci don't match, or whose sample ID
+                            is a duplicate (or already in the profile store), instead of raising an error
+    :type skip_mismatched: bool
+    :param batch_size: Number of profiles to append to the profile store at a time
+    :type batch_size: int
+    :return: Counts. Keys are: 'num_merged', 'num_skipped'
+    :rtype: dict[str, int]
+    :raises ValueError: If a file can't be read, its loci don't match, or its sample ID is a duplicate, and skip_mismatched is False
+    """
+    if store is not None:
+        if locus_ids is None:
+            locus_ids = store.locus_ids
+        elif store.locus_ids != locus_ids:
+            raise ValueError(f"Loci in profile store do not match the scheme: {store.store_dir}")
+    counts = {
+        'num_merged': 0,
+        'num_skipped': 0,
+    }
+    seen_sample_ids = set()
+    profiles_by_sample_id = {}
+    output_file = open(output_path, 'w') if output_path is not None else None
+    try:
+        for allele_profile_path, allele_profile, error in iter_allele_profiles(allele_profile_paths, threads=threads):
+            sample_id = distance.get_sample_id(allele_profile_path)
+            if error is not None:
+                problem = f"Unable to read allele profile: {allele_profile_path} ({error})"
+            elif locus_ids is not None and allele_profile['locus_ids'] != locus_ids:
+                problem = f"Loci in allele profile do not match the scheme: {allele_profile_path}"
+            elif sample_id in seen_sample_ids:
+                problem = f"Duplicate sample ID: {sample_id} ({allele_profile_path})"
+            elif store is not None and sample_id in store.sample_positions:
+                problem = f"Sample already in profile store: {sample_id} ({allele_profile_path})"
+            else:
+                problem = None
+            if problem is not None:
+                if not skip_mismatched:
+                    raise ValueError(problem)
+                logging.warning(f"Skipping: {problem}")
+                counts['num_skipped'] += 1
+                continue
+
+            if locus_ids is None:
+                locus_ids = allele_profile['locus_ids']
+            if output_file is not None and counts['num_merged'] == 0:
+                output_file.write(delimiter.join(['sample_id'] + locus_ids) + '\n')
+            seen_sample_ids.add(sample_id)
+            if output_file is not None:
+                output_file.write(delimiter.join([sample_id] + allele_profile['allele_ids']) + '\n')
+            if store is not None:
+                profiles_by_sample_id[sample_id] = dict(zip(locus_ids, allele_profile['allele_ids']))
+                if len(profiles_by_sample_id) >= batch_size:
+                    store.append(profiles_by_sample_id)
+                    profiles_by_sample_id = {}
+            counts['num_merged'] += 1
+            if counts['num_merged'] % 10000 == 0:
+                logging.info(f"Merged {counts['num_merged']} allele profiles")
+        if store is not None:
+            store.append(profiles_by_sample_id)
+        if output_file is not None and counts['num_merged'] == 0 and locus_ids is not None:
+            output_file.write(delimiter.join(['sample_id'] + locus_ids) + '\n')
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    return counts
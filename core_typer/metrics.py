@@ -0,0 +1,158 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from . import __version__
+
+
+class Metrics(object):
+    """
+    Collects timing, resource usage and input size metrics for a typing run.
+
+    Each stage records its wall time and the CPU time of the thread that ran it. If a
+    profile directory is given, stages can also be profiled with cProfile, and a
+    tracemalloc snapshot is taken at the end of each profiled stage.
+
+    tracemalloc traces (and resets the peak of) every allocation in the process, so the memory of a stage
+    is only its own if no other run is profiled at the same time. Set trace_memory to False when several
+    runs share the process (eg. concurrent samples in a batch).
+    """
+    def __init__(self, profile_dir=None, trace_memory=True):
+        """
+        :param profile_dir: Directory to write cProfile stats and tracemalloc snapshots to (default: don't profile)
+        :type profile_dir: str|None
+        :param trace_memory: Trace memory with tracemalloc while profiling
+        :type trace_memory: bool
+        """
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory and profile_dir is not None
+        self.stages = {}
+        self.processes = {}
+        self.inputs = {}
+        self.start_wall_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, profile=True):
+        """
+        Measure a stage of the run.
+
+        :param name: The name of the stage
+        :type name: str
+        :param profile: Profile the stage, if a profile directory was given
+        :type profile: bool
+        """
+        profiler = None
+        if profile and self.profile_dir is not None:
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                logging.warning(f"Unable to profile stage {name}: {e}")
+                profiler = None
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+        try:
+            yield
+        finally:
+            stage_metrics = {
+                'wall_seconds': round(time.perf_counter() - start_wall_time, 6),
+                'cpu_seconds': round(time.thread_time() - start_cpu_time, 6),
+            }
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+            if profile and self.trace_memory:
+                stage_metrics['traced_memory_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.take_snapshot().dump(os.path.join(self.profile_dir, f"{name}.tracemalloc"))
+            self.stages[name] = stage_metrics
+
+    def wrap(self, name, func, profile=True):
+        """
+        Wrap a function so that each call is measured as a stage.
+
+        :param name: The name of the stage
+        :type name: str
+        :param func: The function to wrap
+        :type func: Callable
+        :param profile: Profile the stage, if a profile directory was given
+        :type profile: bool
+        :return: The wrapped function
+        :rtype: Callable
+        """
+        def wrapped(*args, **kwargs):
+            with self.stage(name, profile=profile):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    def record_rusage(self, name, rusage):
+        """
+        Record the resource usage of a child process, as returned by os.wait4.
+
+        :param name: The name of the process (eg. 'kma')
+        :type name: str
+        :param rusage: The resource usage of the child process
+        :type rusage: resource.struct_rusage
+        :return: None
+        """
+        # ru_maxrss is reported in bytes on macOS, and in kilobytes elsewhere.
+        max_rss_scale = 1 if sys.platform == 'darwin' else 1024
+        self.processes[name] = {
+            'peak_rss_bytes': rusage.ru_maxrss * max_rss_scale,
+            'user_cpu_seconds': round(rusage.ru_utime, 6),
+            'system_cpu_seconds': round(rusage.ru_stime, 6),
+        }
+
+    def record_input(self, name, value):
+        """
+        Record the size of an input.
+
+        :param name: The name of the input (eg. 'num_hits')
+        :type name: str
+        :param value: The size of the input
+        :type value: int|float
+        :return: None
+        """
+        self.inputs[name] = value
+
+    def to_dict(self):
+        """
+        :return: All metrics collected so far. Keys are: 'core_typer_version', 'total', 'stages', 'processes', 'inputs'
+        :rtype: dict
+        """
+        metrics = {
+            'core_typer_version': __version__,
+            'total': {
+                'wall_seconds': round(time.perf_counter() - self.start_wall_time, 6),
+                'cpu_seconds': round(time.process_time() - self.start_cpu_time, 6),
+            },
+            'stages': self.stages,
+            'processes': self.processes,
+            'inputs': self.inputs,
+        }
+
+        return metrics
+
+    def write_json(self, metrics_json_path):
+        """
+        Write the metrics to a JSON file.
+
+        :param metrics_json_path: The path to the metrics file
+        :type metrics_json_path: str
+        :return: None
+        """
+        with open(metrics_json_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
@@ -0,0 +1,156 @@
+import concurrent.futures
+import csv
+import hashlib
+import logging
+import zlib
+
+from . import parsers
+
+HASH_METHODS = ['sha1', 'crc32']
+
+NUCLEOTIDES = frozenset('ACGT')
+
+
+def extract_consensus(alignment):
+    """
+    Extract the consensus sequence from a kma alignment, by removing gaps from the aligned query.
+
+    :param alignment: The alignment, as returned by parsers.iter_kma_aln
+    :type alignment: dict
+    :return: The consensus sequence (upper case)
+    :rtype: str
+    """
+    return alignment['query'].replace('-', '').upper()
+
+
+def hash_allele(sequence, hash_method='sha1'):
+    """
+    Make an allele ID by hashing an allele sequence, so the same sequence always gets the same ID.
+
+    :param sequence: The allele sequence
+    :type sequence: str
+    :param hash_method: One of 'sha1' (40 hex digits) or 'crc32' (8 hex digits)
+    :type hash_method: str
+    :return: The allele ID
+    :rtype: str
+    :raises ValueError: If the hash method is not recognized
+    """
+    sequence_bytes = sequence.encode('ascii')
+    if hash_method == 'sha1':
+        return hashlib.sha1(sequence_bytes).hexdigest()
+    elif hash_method == 'crc32':
+        return f"{zlib.crc32(sequence_bytes):08x}"
+    else:
+        raise ValueError(f"Unknown hash method: {hash_method}")
+
+
+def make_novel_allele(alignment, hash_method='sha1'):
+    """
+    Make a novel allele from a kma alignment. The consensus sequence must consist only of
+    unambiguous nucleotides (A, C, G, T), otherwise no allele is made.
+
+    :param alignment: The alignment, as returned by parsers.iter_kma_aln
+    :type alignment: dict
+    :param hash_method: The hash method for the allele ID (see hash_allele)
+    :type hash_method: str
+    :return: The novel allele, or None if the consensus is ambiguous or empty. Keys are: locus_id, allele_id, closest_allele_id, length, sequence
+    :rtype: dict|None
+    """
+    sequence = extract_consensus(alignment)
+    if not sequence or not NUCLEOTIDES.issuperset(sequence):
+        return None
+
+    novel_allele = {
+        'locus_id': alignment['locus_id'],
+        'allele_id': hash_allele(sequence, hash_method),
+        'closest_allele_id': alignment['allele_id'],
+        'length': len(sequence),
+        'sequence': sequence,
+    }
+
+    return novel_allele
+
+
+def find_novel_alleles(kma_aln_file, allele_calls, min_coverage=100.0, hash_method='sha1', threads=1):
+    """
+    Find novel alleles for loci whose best hit covers the locus but falls below the identity threshold.
+
+    The kma aln file is streamed one alignment at a time, and only the alignments of the best hits
+    of those loci are kept. Consensus sequences are extracted and hashed across a pool of workers,
+    with a bounded number of alignments in flight.
+
+    :param kma_aln_file: The path to the kma aln file
+    :type kma_aln_file: str
+    :param allele_calls: The allele calls, as returned by allele_calling.choose_best_allele (uncalled loci have allele_id "-")
+    :type allele_calls: list[records.AlleleCall]
+    :param min_coverage: The minimum template coverage of a best hit to make a novel allele from it
+    :type min_coverage: float
+    :param hash_method: The hash method for novel allele IDs (see hash_allele)
+    :type hash_method: str
+    :param threads: Number of workers
+    :type threads: int
+    :return: The novel alleles (see make_novel_allele), indexed by locus_id
+    :rtype: dict[str, dict]
+    """
+    candidate_template_ids = set()
+    for allele_call in allele_calls:
+        percent_coverage = allele_call.percent_coverage
+        if allele_call.allele_id == '-' and allele_call.template is not None and percent_coverage is not None and percent_coverage >= min_coverage:
+            candidate_template_ids.add(allele_call.template)
+    logging.debug(f"Looking for novel alleles at {len(candidate_template_ids)} loci")
+    if not candidate_template_ids:
+        return {}
+
+    novel_alleles_by_locus_id = {}
+    max_in_flight = max(1, threads) * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        futures = set()
+        for alignment in parsers.iter_kma_aln(kma_aln_file):
+            if alignment['template_id'] not in candidate_template_ids:
+                continue
+            futures.add(executor.submit(make_novel_allele, alignment, hash_method))
+            if len(futures) >= max_in_flight:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                _collect_novel_alleles(done, novel_alleles_by_locus_id)
+        _collect_novel_alleles(concurrent.futures.as_completed(futures), novel_alleles_by_locus_id)
+
+    return novel_alleles_by_locus_id
+
+
+def _collect_novel_alleles(futures, novel_alleles_by_locus_id):
+    for future in futures:
+        novel_allele = future.result()
+        if novel_allele is not None:
+            novel_alleles_by_locus_id[novel_allele['locus_id']] = novel_allele
+
+
+def write_novel_alleles(novel_alleles, novel_alleles_csv_path, novel_alleles_fasta_path):
+    """
+    Write novel alleles to a CSV file (without sequences) and a FASTA file. FASTA headers are
+    '<locus_id>_<allele_id>', as in the kma index.
+
+    :param novel_alleles: The novel alleles, as returned by find_novel_alleles
+    :type novel_alleles: list[dict]
+    :param novel_alleles_csv_path: The path to the novel alleles CSV file
+    :type novel_alleles_csv_path: str
+    :param novel_alleles_fasta_path: The path to the novel alleles FASTA file
+    :type novel_alleles_fasta_path: str
+    :return: None
+    """
+    output_fieldnames = [
+        'locus_id',
+        'allele_id',
+        'closest_allele_id',
+        'length',
+    ]
+    with open(novel_alleles_csv_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=output_fieldnames, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        for novel_allele in novel_alleles:
+            writer.writerow(novel_allele)
+
+    with open(novel_alleles_fasta_path, 'w') as f:
+        for novel_allele in novel_alleles:
+            f.write(f">{novel_allele['locus_id']}_{novel_allele['allele_id']}\n")
+            for line_start in range(0, len(novel_allele['sequence']), 80):
+                f.write(novel_allele['sequence'][line_start:line_start + 80] + '\n')
@@ -1,171 +1,552 @@
 import csv
 import logging
 
+import numpy as np
+
+from . import records
+
 logger = logging.getLogger(__name__)
 
-def parse_kma_result(kma_result_file):
+KMA_RESULT_INT_FIELDS = [
+    "score",
+    "expected",
+    "template_length",
+]
+
+
+def _read_kma_result_header(f):
+    """
+    Read the header line of a kma result file.
+
+    :param f: The open kma result file, positioned at the start of the file
+    :type f: TextIO
+    :return: The position of the template column, and the position (None if the column is missing)
+             and converter of each numeric field of KmaHit, in field order
+    :rtype: tuple[int, list[tuple[int | None, type]]]
+    """
+    header_line = f.readline()
+    header = [k.strip().lower().replace("#", "") for k in header_line.split('\t')]
+    template_position = header.index("template")
+    # Fields that aren't ints are floats.
+    numeric_columns = []
+    for field in records.KmaHit._fields[3:]:
+        position = header.index(field) if field in header else None
+        converter = int if field in KMA_RESULT_INT_FIELDS else float
+        numeric_columns.append((position, converter))
+
+    return template_position, numeric_columns
+
+
+def _make_kma_hit(values, template_position, numeric_columns):
     """
-    Parse a kma result file into a dict of lists of dicts.
+    Make a kma hit from the values of one row of a kma result file.
+
+    :param values: The tab-separated values of the row
+    :type values: list[str]
+    :param template_position: The position of the template column
+    :type template_position: int
+    :param numeric_columns: The position and converter of each numeric field of KmaHit
+    :type numeric_columns: list[tuple[int | None, type]]
+    :return: The kma hit
+    :rtype: records.KmaHit
+    """
+    template = values[template_position].strip()
+    template_split = template.split("_")
+    fields = [template, template_split[0], template_split[1]]
+    for position, converter in numeric_columns:
+        try:
+            fields.append(converter(values[position]))
+        except (ValueError, TypeError, IndexError) as e:
+            fields.append(None)
+
+    return records.KmaHit._make(fields)
+
+
+def iter_kma_result(kma_result_file):
+    """
+    Iterate over the hits in a kma result file, one row at a time.
 
     :param kma_result_file: The path to the kma result file
     :type kma_result_file: str
-    :return: The kma results, indexed by locus_id. Keys of kma results are: locus_id, allele_id, score, template_length, template_identity, template_coverage, query_identity, query_coverage, depth, q_value, p_value
-    :rtype: dict[str, list[dict]]
+    :return: The kma hits, one per row
+    :rtype: Iterator[records.KmaHit]
     """
-    kma_result_by_locus_id = {}
-    int_fields = [
-        "score",
-        "expected",
-        "template_length",
-    ]
-    float_fields = [
-        "template_identity",
-        "template_coverage",
-        "query_identity",
-        "query_coverage",
-        "depth",
-        "q_value",
-        "p_value",
-    ]
     with open(kma_result_file, 'r') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            record = {}
-            for k, v in row.items():
-                key = k.lower().replace("#", "")
-                if key in int_fields:
-                    try:
-                        record[key] = int(v.strip())
-                    except ValueError as e:
-                        record[key] = None
-                elif key in float_fields:
-                    try:
-                        record[key] = float(v.strip())
-                    except ValueError as e:
-                        record[key] = None
-                else:
-                    record[key] = v.strip()
-                locus_id = record["template"].split("_")[0]
-                allele_id = record["template"].split("_")[1]
-                record["locus_id"] = locus_id
-                record["allele_id"] = allele_id
-                if locus_id not in kma_result_by_locus_id:
-                    kma_result_by_locus_id[locus_id] = []
-                kma_result_by_locus_id[locus_id].append(record)
+        template_position, numeric_columns = _read_kma_result_header(f)
+        for line in f:
+            if not line.strip():
+                continue
+            yield _make_kma_hit(line.split('\t'), template_position, numeric_columns)
+
+
+def _read_kma_best_hits(kma_result_file, locus_ids=None):
+    """
+    Stream a kma result file, keeping the best hit for each locus (see parse_kma_result with best_hit_only).
+
+    :param kma_result_file: The path to the kma result file
+    :type kma_result_file: str
+    :param locus_ids: If provided, rows of other loci are skipped
+    :type locus_ids: set[str]|None
+    :return: The best hit for each locus, indexed by locus_id in the order that loci first appear, and the number of rows read
+    :rtype: tuple[dict[str, records.KmaHit], int]
+    """
+    best_rows_by_locus_id = {}
+    num_rows = 0
+    with open(kma_result_file, 'r') as f:
+        template_position, numeric_columns = _read_kma_result_header(f)
+        score_position = numeric_columns[0][0]
+        for line in f:
+            if not line.strip():
+                continue
+            values = line.split('\t')
+            locus_id = values[template_position].strip().split("_")[0]
+            if locus_ids is not None and locus_id not in locus_ids:
+                continue
+            num_rows += 1
+            try:
+                score = int(values[score_position])
+            except (ValueError, TypeError, IndexError) as e:
+                score = None
+            best_row = best_rows_by_locus_id.get(locus_id)
+            # A missing or unparsable score ranks below every other score.
+            if best_row is None or (score is not None and (best_row[0] is None or score > best_row[0])):
+                best_rows_by_locus_id[locus_id] = (score, values)
+
+    best_hits_by_locus_id = {
+        locus_id: _make_kma_hit(values, template_position, numeric_columns)
+        for locus_id, (score, values) in best_rows_by_locus_id.items()
+    }
+
+    return best_hits_by_locus_id, num_rows
+
+
+def parse_kma_result(kma_result_file, best_hit_only=False):
+    """
+    Parse a kma result file into a dict of lists of hits.
+
+    If best_hit_only is True, only the highest-scoring hit for each locus is kept
+    (the first one in the file, if several hits share the top score), so memory use
+    is proportional to the number of loci rather than the number of hits. Rows are
+    only fully converted once they are known to be the best hit for their locus.
+
+    :param kma_result_file: The path to the kma result file
+    :type kma_result_file: str
+    :param best_hit_only: Keep only the best-scoring hit for each locus
+    :type best_hit_only: bool
+    :return: The kma hits, indexed by locus_id, sorted by score (descending, with hits that have no score last)
+    :rtype: dict[str, list[records.KmaHit]]
+    """
+    kma_result_by_locus_id = {}
+    if best_hit_only:
+        best_hits_by_locus_id, num_rows = _read_kma_best_hits(kma_result_file)
+        for locus_id, kma_hit in best_hits_by_locus_id.items():
+            kma_result_by_locus_id[locus_id] = [kma_hit]
+
+        return kma_result_by_locus_id
+
+    for record in iter_kma_result(kma_result_file):
+        locus_id = record.locus_id
+        if locus_id not in kma_result_by_locus_id:
+            kma_result_by_locus_id[locus_id] = []
+        kma_result_by_locus_id[locus_id].append(record)
 
     for locus_id, kma_results in kma_result_by_locus_id.items():
-        kma_result_by_locus_id[locus_id] = sorted(kma_results, key=lambda k: k["score"], reverse=True)
+        kma_results.sort(key=lambda k: (k.score is not None, k.score), reverse=True)
 
     return kma_result_by_locus_id
 
 
+def parse_kma_result_columnar(kma_result_file):
+    """
+    Parse a kma result file into typed arrays, one per column, for vectorized allele calling
+    (see allele_calling.call_alleles).
+
+    Rows are kept in file order. Each row is assigned a locus index, which refers to a
+    position in the 'locus_ids' list (loci are numbered in the order that they first appear in the file).
+
+    :param kma_result_file: The path to the kma result file
+    :type kma_result_file: str
+    :return: The kma result columns. Keys are: locus_ids (list of locus IDs), locus_index (int32 array), template
+             (object array of template names), allele_id (object array), plus one array per numeric field of
+             records.KmaHit (int64 or float64; NaN if the value or column is missing from the file)
+    :rtype: dict[str, object]
+    """
+    with open(kma_result_file, 'r') as f:
+        header_line = f.readline()
+        data_lines = [line for line in f if line.strip()]
+    header = [k.strip().lower().replace("#", "") for k in header_line.split('\t')]
+    template_position = header.index("template")
+
+    templates = [line.split('\t')[template_position].strip() for line in data_lines]
+    locus_index_by_locus_id = {}
+    locus_index = np.empty(len(templates), dtype=np.int32)
+    allele_ids = np.empty(len(templates), dtype=object)
+    for idx, template in enumerate(templates):
+        template_split = template.split("_")
+        allele_ids[idx] = template_split[1]
+        locus_index[idx] = locus_index_by_locus_id.setdefault(template_split[0], len(locus_index_by_locus_id))
+
+    kma_result_columns = {
+        'locus_ids': list(locus_index_by_locus_id.keys()),
+        'locus_index': locus_index,
+        'template': np.array(templates, dtype=object),
+        'allele_id': allele_ids,
+    }
+    columns = [field for field in records.KmaHit._fields[3:] if field in header]
+    if data_lines and columns:
+        usecols = [header.index(column) for column in columns]
+        try:
+            values = np.loadtxt(data_lines, delimiter="\t", usecols=usecols, dtype=np.float64, ndmin=2)
+        except ValueError as e:
+            # Missing values are NaN, as they are None in parse_kma_result.
+            values = np.genfromtxt(data_lines, delimiter="\t", usecols=usecols, dtype=np.float64, ndmin=2)
+    for field in records.KmaHit._fields[3:]:
+        if not data_lines:
+            kma_result_columns[field] = np.empty(0, dtype=np.int64 if field in KMA_RESULT_INT_FIELDS else np.float64)
+        elif field not in columns:
+            kma_result_columns[field] = np.full(len(data_lines), np.nan)
+        elif field in KMA_RESULT_INT_FIELDS and not np.isnan(values[:, columns.index(field)]).any():
+            kma_result_columns[field] = values[:, columns.index(field)].astype(np.int64)
+        else:
+            kma_result_columns[field] = values[:, columns.index(field)].copy()
+
+    return kma_result_columns
+
+
+def kma_hits_to_columns(kma_hits, locus_ids=None):
+    """
+    Convert kma hits into columns, as returned by parse_kma_result_columnar.
+
+    :param kma_hits: The kma hits
+    :type kma_hits: Iterable[records.KmaHit]
+    :param locus_ids: The loci to number rows by, in order (default: in the order that they first appear in kma_hits).
+                      Every hit's locus must be included
+    :type locus_ids: list[str]|None
+    :return: The kma result columns. Numeric fields that are None are NaN
+    :rtype: dict[str, object]
+    """
+    kma_hits = list(kma_hits)
+    if locus_ids is None:
+        locus_ids = list(dict.fromkeys(kma_hit.locus_id for kma_hit in kma_hits))
+    locus_positions = {locus_id: position for position, locus_id in enumerate(locus_ids)}
+    kma_result_columns = {
+        'locus_ids': list(locus_ids),
+        'locus_index': np.array([locus_positions[kma_hit.locus_id] for kma_hit in kma_hits], dtype=np.int32),
+        'template': np.array([kma_hit.template for kma_hit in kma_hits] or [], dtype=object),
+        'allele_id': np.array([kma_hit.allele_id for kma_hit in kma_hits] or [], dtype=object),
+    }
+    for field_idx, field in enumerate(records.KmaHit._fields[3:], start=3):
+        values = np.array([np.nan if kma_hit[field_idx] is None else kma_hit[field_idx] for kma_hit in kma_hits], dtype=np.float64)
+        kma_result_columns[field] = values.astype(np.int64) if field in KMA_RESULT_INT_FIELDS and not np.isnan(values).any() else values
+
+    return kma_result_columns
+
+
+def parse_kma_best_hits_columnar(kma_result_file, locus_ids=None):
+    """
+    Parse the best-scoring hit for each locus in a kma result file into columns.
+
+    The file is streamed, so memory use is proportional to the number of loci rather than the number of hits.
+    Allele calls made from these columns are the same as from parse_kma_result_columnar, which keeps every hit.
+
+    :param kma_result_file: The path to the kma result file
+    :type kma_result_file: str
+    :param locus_ids: If provided, only hits at these loci are kept
+    :type locus_ids: set[str]|None
+    :return: The kma result columns, as returned by parse_kma_result_columnar, with one row per locus,
+             plus the number of hits kept before keeping the best (num_rows)
+    :rtype: dict[str, object]
+    """
+    best_hits_by_locus_id, num_rows = _read_kma_best_hits(kma_result_file, locus_ids=locus_ids)
+    kma_result_columns = kma_hits_to_columns(best_hits_by_locus_id.values())
+    kma_result_columns['num_rows'] = num_rows
+
+    return kma_result_columns
+
+
+def concatenate_kma_result_columns(kma_result_columns_list, locus_ids):
+    """
+    Concatenate kma result columns (eg. from alignments against disjoint sets of loci), renumbering loci
+    and ordering rows by locus_ids. Rows for the same locus keep their order.
+
+    :param kma_result_columns_list: The kma result columns to concatenate, as returned by parse_kma_result_columnar
+    :type kma_result_columns_list: list[dict[str, object]]
+    :param locus_ids: The loci in the concatenated columns, in order. Loci that aren't in any of the columns are dropped
+    :type locus_ids: list[str]
+    :return: The concatenated kma result columns. num_rows (if present) is the total over kma_result_columns_list
+    :rtype: dict[str, object]
+    """
+    locus_positions = {locus_id: position for position, locus_id in enumerate(locus_ids)}
+    locus_index = np.concatenate([
+        np.array([locus_positions[locus_id] for locus_id in kma_result_columns['locus_ids']], dtype=np.int32)[kma_result_columns['locus_index']]
+        for kma_result_columns in kma_result_columns_list
+    ])
+    order = np.argsort(locus_index, kind='stable')
+    present_locus_positions = np.unique(locus_index)
+    renumbered_locus_index = np.searchsorted(present_locus_positions, locus_index[order]).astype(np.int32)
+
+    columns = [column for column in kma_result_columns_list[0] if column not in ['locus_ids', 'locus_index', 'num_rows']]
+    concatenated_columns = {
+        'locus_ids': [locus_ids[position] for position in present_locus_positions.tolist()],
+        'locus_index': renumbered_locus_index,
+    }
+    if any('num_rows' in kma_result_columns for kma_result_columns in kma_result_columns_list):
+        concatenated_columns['num_rows'] = sum(kma_result_columns.get('num_rows', len(kma_result_columns['template'])) for kma_result_columns in kma_result_columns_list)
+    for column in columns:
+        concatenated_columns[column] = np.concatenate([kma_result_columns[column] for kma_result_columns in kma_result_columns_list])[order]
+
+    return concatenated_columns
+
+
+KMA_MAPSTAT_INT_FIELDS = [
+    "read_count",
+    "fragment_count",
+    "map_score_sum",
+    "ref_covered_positions",
+    "ref_consensus_sum",
+    "bp_total",
+    "nuc_high_depth_variance",
+    "depth_max",
+    "snp_sum",
+    "insert_sum",
+    "deletion_sum",
+    "read_count_aln",
+    "fragment_count_aln",
+]
+
+KMA_MAPSTAT_FLOAT_FIELDS = [
+    "depth_variance",
+]
+
+KMA_MAPSTAT_HEADER = [
+    "ref_sequence",
+    "read_count",
+    "fragment_count",
+    "map_score_sum",
+    "ref_covered_positions",
+    "ref_consensus_sum",
+    "bp_total",
+    "depth_variance",
+    "nuc_high_depth_variance",
+    "depth_max",
+    "snp_sum",
+    "insert_sum",
+    "deletion_sum",
+    "read_count_aln",
+    "fragment_count_aln",
+]
+
+
 def parse_kma_mapstat(kma_mapstat_file):
     """
-    Parse a kma mapstat file into a dict of lists of dicts.
+    Parse a kma mapstat file into a dict of lists of records.
 
     :param kma_mapstat_file: The path to the kma mapstat file
     :type kma_mapstat_file: str
-    :return: The kma mapstat, indexed by locus_id. Keys of kma mapstat are: locus_id, allele_id, ref_sequence, read_count, fragment_count, map_score_sum, ref_covered_positions, ref_consensus_sum, bp_total, depth_variance, nuc_high_depth_variance, depth_max, snp_sum, insert_sum, deletion_sum, read_count_aln, fragment_count_aln
-    :rtype: dict[str, list[dict]]
+    :return: The kma mapstat records, indexed by locus_id, sorted by map_score_sum (descending)
+    :rtype: dict[str, list[records.MapstatRecord]]
     """
     parsed_kma_mapstat_by_locus_id = {}
-    header = [
-        "ref_sequence",
-        "read_count",
-        "fragment_count",
-        "map_score_sum",
-        "ref_covered_positions",
-        "ref_consensus_sum",
-        "bp_total",
-        "depth_variance",
-        "nuc_high_depth_variance",
-        "depth_max",
-        "snp_sum",
-        "insert_sum",
-        "deletion_sum",
-        "read_count_aln",
-        "fragment_count_aln",
-    ]
-    int_fields = [
-        "read_count",
-        "fragment_count",
-        "map_score_sum",
-        "ref_covered_positions",
-        "ref_consensus_sum",
-        "bp_total",
-        "nuc_high_depth_variance",
-        "depth_max",
-        "snp_sum",
-        "insert_sum",
-        "deletion_sum",
-        "read_count_aln",
-        "fragment_count_aln",
-    ]
-    float_fields = [
-        "depth_variance",
-    ]
+    header = KMA_MAPSTAT_HEADER
+    int_fields = KMA_MAPSTAT_INT_FIELDS
+    float_fields = KMA_MAPSTAT_FLOAT_FIELDS
+    converters = []
+    for field in header[1:]:
+        if field in int_fields:
+            converters.append(int)
+        elif field in float_fields:
+            converters.append(float)
     with open(kma_mapstat_file, 'r') as f:
         for line in f:
             if line.startswith("#"):
                 continue
             else:
-                record = dict(zip(header, line.strip().split("\t")))
-                locus_id = record['ref_sequence'].split("_")[0]
-                allele_id = record['ref_sequence'].split("_")[1]
-                record['locus_id'] = locus_id
-                record['allele_id'] = allele_id
-                for field in int_fields:
-                    try:
-                        record[field] = int(record[field])
-                    except ValueError as e:
-                        record[field] = None
-                for field in float_fields:
+                values = line.strip().split("\t")
+                ref_sequence = values[0]
+                ref_sequence_split = ref_sequence.split("_")
+                locus_id = ref_sequence_split[0]
+                allele_id = ref_sequence_split[1]
+                numeric_values = []
+                for converter, v in zip(converters, values[1:]):
                     try:
-                        record[field] = float(record[field])
+                        numeric_values.append(converter(v))
                     except ValueError as e:
-                        record[field] = None
+                        numeric_values.append(None)
+                record = records.MapstatRecord(ref_sequence, locus_id, allele_id, *numeric_values)
                 if locus_id not in parsed_kma_mapstat_by_locus_id:
                     parsed_kma_mapstat_by_locus_id[locus_id] = []
                 parsed_kma_mapstat_by_locus_id[locus_id].append(record)
 
     for locus_id, kma_mapstat in parsed_kma_mapstat_by_locus_id.items():
-        parsed_kma_mapstat_by_locus_id[locus_id] = sorted(kma_mapstat, key=lambda k: k["map_score_sum"], reverse=True)
+        parsed_kma_mapstat_by_locus_id[locus_id] = sorted(kma_mapstat, key=lambda k: k.map_score_sum, reverse=True)
 
     return parsed_kma_mapstat_by_locus_id
 
 
-def parse_kma_aln(kma_aln_file):
+def parse_kma_mapstat_columnar(kma_mapstat_file, columns=None, templates=None):
     """
-    Parse a kma aln file into a dict of lists of dicts.
+    Parse a kma mapstat file into typed arrays, one per column.
+
+    Rows are kept in file order. Each row is assigned a locus index, which
+    refers to a position in the 'locus_ids' list (loci are numbered in the
+    order that they first appear in the file).
+
+    The file is read one line at a time. If templates are given, only the rows
+    for those templates are kept (eg. the best hit for each locus), so memory use
+    is proportional to the number of templates rather than the number of rows.
+
+    :param kma_mapstat_file: The path to the kma mapstat file
+    :type kma_mapstat_file: str
+    :param columns: The numeric columns to load (default: all). Available columns are: read_count, fragment_count, map_score_sum, ref_covered_positions, ref_consensus_sum, bp_total, depth_variance, nuc_high_depth_variance, depth_max, snp_sum, insert_sum, deletion_sum, read_count_aln, fragment_count_aln
+    :type columns: list[str]|None
+    :param templates: The templates to keep the rows of (default: all)
+    :type templates: Iterable[str]|None
+    :return: The kma mapstat columns. Keys are: locus_ids (list of locus IDs), locus_index (int32 array), ref_sequence (object array of template names), allele_id (object array), metadata (the '## key value' header lines, eg. fragmentCount), num_rows (the number of rows in the file, including those that weren't kept), plus one array per requested column (int64 or float64)
+    :rtype: dict[str, object]
+    :raises ValueError: If an unknown column is requested
     """
-    alignments_by_template_id = {}
+    if columns is None:
+        columns = [field for field in KMA_MAPSTAT_HEADER if field != "ref_sequence"]
+    for column in columns:
+        if column not in KMA_MAPSTAT_INT_FIELDS and column not in KMA_MAPSTAT_FLOAT_FIELDS:
+            raise ValueError(f"Unknown kma mapstat column: {column}")
+
+    if templates is not None:
+        templates = set(templates)
+
+    metadata = {}
+    data_lines = []
+    num_rows = 0
+    with open(kma_mapstat_file, 'r') as f:
+        for line in f:
+            if line.startswith("##"):
+                key, _, value = line[2:].strip().partition("\t")
+                metadata[key.strip()] = value.strip()
+            elif not line.startswith("#") and line.strip():
+                num_rows += 1
+                if templates is None or line.split("\t", 1)[0] in templates:
+                    data_lines.append(line)
+
+    ref_sequences = [line.split("\t", 1)[0] for line in data_lines]
+    locus_index_by_locus_id = {}
+    locus_index = np.empty(len(ref_sequences), dtype=np.int32)
+    allele_ids = np.empty(len(ref_sequences), dtype=object)
+    for idx, ref_sequence in enumerate(ref_sequences):
+        ref_sequence_split = ref_sequence.split("_")
+        locus_id = ref_sequence_split[0]
+        allele_ids[idx] = ref_sequence_split[1]
+        locus_index[idx] = locus_index_by_locus_id.setdefault(locus_id, len(locus_index_by_locus_id))
+
+    mapstat_columns = {
+        'locus_ids': list(locus_index_by_locus_id.keys()),
+        'locus_index': locus_index,
+        'ref_sequence': np.array(ref_sequences, dtype=object),
+        'allele_id': allele_ids,
+        'metadata': metadata,
+        'num_rows': num_rows,
+    }
+    if columns:
+        usecols = [KMA_MAPSTAT_HEADER.index(column) for column in columns]
+        if data_lines:
+            values = np.loadtxt(data_lines, delimiter="\t", usecols=usecols, dtype=np.float64, ndmin=2)
+        else:
+            values = np.empty((0, len(columns)), dtype=np.float64)
+        for column_idx, column in enumerate(columns):
+            if column in KMA_MAPSTAT_INT_FIELDS:
+                mapstat_columns[column] = values[:, column_idx].astype(np.int64)
+            else:
+                mapstat_columns[column] = values[:, column_idx].copy()
+
+    return mapstat_columns
+
+
+def select_top_n_per_locus(locus_index, values, top_n=1):
+    """
+    Select the rows with the highest values within each locus.
+
+    Ties are broken by row order, so the row that appears first wins.
+
+    :param locus_index: The locus index of each row
+    :type locus_index: numpy.ndarray
+    :param values: The values to rank rows by, one per row (eg. the 'map_score_sum' column)
+    :type values: numpy.ndarray
+    :param top_n: The maximum number of rows to select for each locus
+    :type top_n: int
+    :return: Row indices, grouped by locus index (ascending) and ordered by value (descending) within each locus
+    :rtype: numpy.ndarray
+    """
+    if len(locus_index) == 0:
+        return np.empty(0, dtype=np.intp)
+    # np.lexsort is stable, so rows with equal values stay in file order.
+    order = np.lexsort((-values, locus_index))
+    sorted_locus_index = locus_index[order]
+    is_group_start = np.empty(len(order), dtype=bool)
+    is_group_start[0] = True
+    np.not_equal(sorted_locus_index[1:], sorted_locus_index[:-1], out=is_group_start[1:])
+    group_starts = np.flatnonzero(is_group_start)
+    group_sizes = np.diff(np.append(group_starts, len(order)))
+    rank_within_locus = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+
+    return order[rank_within_locus < top_n]
+
+
+def iter_kma_aln(kma_aln_file):
+    """
+    Iterate over the alignments in a kma aln file, one template at a time, so that
+    memory use is bounded by the size of a single alignment.
+
+    :param kma_aln_file: The path to the kma aln file
+    :type kma_aln_file: str
+    :return: The alignments, in file order. Keys of alignments are: template_id, locus_id, allele_id, template (aligned template sequence), query (aligned consensus sequence)
+    :rtype: Iterator[dict]
+    """
+    def make_alignment(template_id, template_seq_lines, query_seq_lines):
+        template_id_split = template_id.split("_")
+        alignment = {
+            'template_id': template_id,
+            'locus_id': template_id_split[0],
+            'allele_id': template_id_split[1] if len(template_id_split) > 1 else None,
+            'template': "".join(template_seq_lines),
+            'query': "".join(query_seq_lines),
+        }
+
+        return alignment
+
     with open(kma_aln_file, 'r') as f:
-        alignment = {}
         template_id = None
-        template_seq = ""
-        query_seq = ""
+        template_seq_lines = []
+        query_seq_lines = []
         for line in f:
             line = line.strip()
             if line.startswith("#"):
-                if template_id:
-                    alignment[template_id] = {
-                        'template': template_seq,
-                        'query': query_seq,
-                    }
-                    template_seq = ""
-                    query_seq = ""
-                template_id = line.split(" ")[1]
-            else:
-                if line.startswith('template'):
-                    template_seq_line = line.split(":")[1].strip()
-                    template_seq += template_seq_line
-                elif line.startswith('query'):
-                    query_seq_line = line.split(":")[1].strip()
-                    query_seq += query_seq_line
-
-        alignment[template_id] = {
-            'template': template_seq,
-            'query': query_seq,
+                if template_id is not None:
+                    yield make_alignment(template_id, template_seq_lines, query_seq_lines)
+                template_id = line[1:].strip().split(" ")[0]
+                template_seq_lines = []
+                query_seq_lines = []
+            elif line.startswith('template'):
+                template_seq_lines.append(line.split(":", 1)[1].strip())
+            elif line.startswith('query'):
+                query_seq_lines.append(line.split(":", 1)[1].strip())
+
+        if template_id is not None:
+            yield make_alignment(template_id, template_seq_lines, query_seq_lines)
+
+
+def parse_kma_aln(kma_aln_file):
+    """
+    Parse a kma aln file into a dict of alignments. For large files, use iter_kma_aln instead.
+
+    :param kma_aln_file: The path to the kma aln file
+    :type kma_aln_file: str
+    :return: The alignments, indexed by template ID. Keys of alignments are: template (aligned template sequence), query (aligned consensus sequence)
+    :rtype: dict[str, dict[str, str]]
+    """
+    alignments_by_template_id = {}
+    for alignment in iter_kma_aln(kma_aln_file):
+        alignments_by_template_id[alignment['template_id']] = {
+            'template': alignment['template'],
+            'query': alignment['query'],
         }
 
     return alignments_by_template_id
@@ -173,6 +554,16 @@ def parse_kma_aln(kma_aln_file):
 
 def parse_allele_calls(allele_calls_path):
     """
+    Parse an allele calls file, as written by allele_calling.write_allele_calls.
+
+    Files written before the kma mapstat columns were added (see records.ALLELE_CALL_MAPSTAT_FIELDS)
+    can also be parsed. Those fields are None if the column is missing or empty.
+
+    :param allele_calls_path: The path to the allele calls file
+    :type allele_calls_path: str
+    :return: The allele calls, in file order
+    :rtype: list[records.AlleleCall]
+    :raises ValueError: If a required column is missing, or a value can't be parsed
     """
     allele_calls = []
     int_fields = [
@@ -187,38 +578,77 @@ def parse_allele_calls(allele_calls_path):
     
     with open(allele_calls_path, 'r') as f:
         reader = csv.DictReader(f, delimiter=',')
+        missing_fields = [field for field in ['locus_id', 'allele_id'] + int_fields + float_fields if field not in (reader.fieldnames or [])]
+        if missing_fields:
+            raise ValueError(f"Missing columns in allele calls file: {', '.join(missing_fields)} ({allele_calls_path})")
         for row in reader:
             for field in float_fields:
                 try:
                     row[field] = float(row[field])
-                except ValueError as e:
-                    logger.error(f"Error parsing value: {row[field]} as float.")
-                    exit(-1)
+                except (ValueError, TypeError) as e:
+                    raise ValueError(f"Error parsing value: {row[field]} as float, in column {field} on line {reader.line_num} of {allele_calls_path}")
             for field in int_fields:
                 try:
                     row[field] = int(row[field])
+                except (ValueError, TypeError) as e:
+                    raise ValueError(f"Error parsing value: {row[field]} as int, in column {field} on line {reader.line_num} of {allele_calls_path}")
+            for field in records.ALLELE_CALL_MAPSTAT_FIELDS:
+                value = row.get(field)
+                if not value:
+                    row[field] = None
+                    continue
+                converter = float if field in KMA_MAPSTAT_FLOAT_FIELDS else int
+                try:
+                    row[field] = converter(value)
                 except ValueError as e:
-                    logger.error(f"Error parsing value: {row[field]} as int.")
-                    exit(-1)
+                    raise ValueError(f"Error parsing value: {value} as {converter.__name__}, in column {field} on line {reader.line_num} of {allele_calls_path}")
 
-            allele_calls.append(row)
+            allele_calls.append(records.AlleleCall(**{field: row[field] for field in records.ALLELE_CALL_FIELDNAMES}))
 
     return allele_calls
                 
 
+def parse_allele_profile(allele_profile_path):
+    """
+    Parse an allele profile file, as written by allele_calling.write_allele_profile.
+
+    :param allele_profile_path: The path to the allele profile file
+    :type allele_profile_path: str
+    :return: The allele profile. Keys are: 'locus_ids' (from the header), 'allele_ids' (in the same order as locus_ids)
+    :rtype: dict[str, list[str]]
+    :raises ValueError: If the number of allele IDs doesn't match the number of locus IDs
+    """
+    with open(allele_profile_path, 'r') as f:
+        locus_ids = f.readline().strip().split(',')
+        allele_ids = f.readline().strip().split(',')
+
+    if len(locus_ids) != len(allele_ids):
+        raise ValueError(f"Allele profile has {len(locus_ids)} loci but {len(allele_ids)} allele IDs: {allele_profile_path}")
+
+    allele_profile = {
+        'locus_ids': locus_ids,
+        'allele_ids': allele_ids,
+    }
+
+    return allele_profile
+
+
 def parse_locus_names(locus_names_path):
     """
     Parse the kma index .names file to get the names of all loci
     in the order that they appear in the file.
+
+    :param locus_names_path: The path to the kma index .name file
+    :type locus_names_path: str
+    :return: The locus names, in the order that they first appear
+    :rtype: list[str]
     """
-    locus_names = []
+    locus_names = {}
     with open(locus_names_path, 'r') as f:
         for line in f:
             line_split = line.strip().split('_')
             locus_name = line_split[0]
-
             if locus_name not in locus_names:
-                locus_names.append(locus_name)
+                locus_names[locus_name] = None
 
-    return locus_names
-            
+    return list(locus_names)
@@ -0,0 +1,352 @@
+import contextlib
+import logging
+import os
+import shutil
+
+from . import alignment
+from . import alignment_cache
+from . import allele_calling
+from . import assembly
+from . import downsampling
+from . import metrics
+from . import novel_alleles
+from . import parsers
+from . import profile_store
+from . import qc
+from . import query
+from . import records
+from . import scheme
+from . import sharding
+
+
+def run_typing(params):
+    """
+    Type a single sample: align reads against the scheme, call alleles
+    and write the allele calls, allele profile and QC stats to the output directory.
+
+    :param params: Dictionary of parameters. Keys of params are: 'R1', 'R2', 'scheme', 'threads', 'tmpdir', 'outdir',
+                   'min_identity', 'min_coverage', 'no_cleanup'. Optional keys are: 'sample_id' (default: the name of the
+                   output directory), 'profile_store' (path to a profile store to append the allele calls to),
+                   'query_db' (path to a profile store to search for the nearest profiles), 'query_k' (default: 10),
+                   'query_max_distance', 'io_mode' (one of 'disk', 'tmpfs' or 'fifo', default: 'disk'), 'target_depth'
+                   (downsample read pairs to this depth before alignment), 'genome_size' (length in bp that depth is measured
+                   over, default: estimated from the scheme's kma index), 'alignment_cache' (directory to cache kma outputs in,
+                   so that re-typing the same reads skips alignment), 'alignment_cache_max_bytes', 'sweep' (identity and coverage
+                   thresholds to evaluate, as returned by allele_calling.parse_threshold_sweep), 'novel_alleles' (call
+                   hash-named novel alleles at loci that fail the identity threshold), 'novel_allele_hash' (one of 'sha1'
+                   or 'crc32', default: 'sha1'), 'kma_shm' (kma shared memory level, if the kma index has been loaded
+                   into shared memory), 'scheme_shards' (directory of scheme shards built by sharding.build_scheme_shards,
+                   to align against concurrently instead of the whole scheme), 'max_concurrent_shards' (default: 'threads'), 'metrics_json'
+                   (path to write run metrics to), 'profile' (write cProfile stats and tracemalloc snapshots for each stage
+                   to a 'profile' sub-directory of the output directory), 'profile_memory' (trace memory with tracemalloc when
+                   profiling, default: True; see metrics.Metrics), 'assembly' (type the contigs in this FASTA file instead of
+                   R1 and R2, which may then be None: alleles found exactly are called with the assembly index, and only the other loci
+                   are aligned), 'assembly_index' (assembly index built by assembly.build_assembly_index, default: next to the scheme)
+                   and 'exit_on_failure' (default: True)
+    :type params: dict
+    :return: Paths to the output files, and the QC stats. Keys are: 'allele_calls', 'allele_profile', 'qc', 'qc_stats'
+    :rtype: dict
+    """
+    sample_id = params.get('sample_id', None)
+    io_mode = params.get('io_mode', 'disk')
+    assembly_index = None
+    if params.get('assembly'):
+        assembly_index_dir = params.get('assembly_index') or assembly.get_default_assembly_index_dir(params['scheme'])
+        assembly_index = assembly.load_assembly_index(assembly_index_dir, params['scheme'])
+        for ignored_param in ['alignment_cache', 'scheme_shards', 'target_depth', 'kma_shm']:
+            if params.get(ignored_param):
+                logging.info(f"Typing an assembly. Ignoring parameter: {ignored_param}")
+        params = dict(params, alignment_cache=None, scheme_shards=None, target_depth=None, kma_shm=None)
+    cache = None
+    if params.get('alignment_cache'):
+        cache = alignment_cache.AlignmentCache(params['alignment_cache'], max_bytes=params.get('alignment_cache_max_bytes', alignment_cache.DEFAULT_MAX_BYTES))
+        if io_mode == 'fifo':
+            logging.info("kma outputs must be written to files to be cached. Using I/O mode: tmpfs")
+            io_mode = 'tmpfs'
+    shard_manifest = None
+    if params.get('scheme_shards'):
+        shard_manifest = sharding.load_shard_manifest(params['scheme_shards'], params['scheme'])
+        if io_mode == 'fifo':
+            logging.info("kma outputs from scheme shards must be written to files to be merged. Using I/O mode: tmpfs")
+            io_mode = 'tmpfs'
+    analysis_tmpdir = alignment.create_analysis_tmpdir(params['tmpdir'], io_mode=io_mode, sample_id=sample_id)
+
+    if not os.path.exists(params['outdir']):
+        os.makedirs(params['outdir'])
+
+    profile_dir = os.path.join(params['outdir'], 'profile') if params.get('profile') else None
+    run_metrics = metrics.Metrics(profile_dir=profile_dir, trace_memory=params.get('profile_memory', True))
+    for input_field in ['R1', 'R2', 'assembly']:
+        if params.get(input_field) and os.path.exists(params[input_field]):
+            run_metrics.record_input(f"{input_field}_bytes", os.path.getsize(params[input_field]))
+
+    alignment_params = {
+        'R1': params.get('R1'),
+        'R2': params.get('R2'),
+        'assembly': params.get('assembly'),
+        'threads': params['threads'],
+        'scheme': params['scheme'],
+        'tmpdir': analysis_tmpdir,
+        'io_mode': io_mode,
+        'kma_shm': params.get('kma_shm'),
+        'exit_on_failure': params.get('exit_on_failure', True),
+    }
+    output_parsers = {
+        'res': run_metrics.wrap('parse_kma_result', parsers.parse_kma_best_hits_columnar),
+    }
+    # Only the mapstat rows of the best hits are kept, so the kma mapstat file is read after the kma result file.
+    # It is never a named pipe, since kma may write it while the kma result file is being read.
+    parse_kma_mapstat = run_metrics.wrap('parse_kma_mapstat', lambda kma_mapstat_file, kma_result_columns: parsers.parse_kma_mapstat_columnar(
+        kma_mapstat_file,
+        columns=records.ALLELE_CALL_MAPSTAT_FIELDS,
+        templates=kma_result_columns['template'].tolist(),
+    ))
+
+    # The kma aln file is only needed to find novel alleles. It is never a named pipe, so it can be read after allele calling.
+    kma_aln_file = alignment.get_output_paths(alignment_params, ['aln'])['aln']
+    kma_mapstat_file = alignment.get_output_paths(alignment_params, ['mapstat'])['mapstat']
+    cached_output_extensions = list(alignment.EXPECTED_OUTPUT_EXTENSIONS)
+    if params.get('novel_alleles'):
+        cached_output_extensions.append('aln')
+
+    try:
+        parsed_outputs = None
+        if cache is not None:
+            cache_key_extra = {}
+            if params.get('target_depth'):
+                cache_key_extra['downsampling'] = [params['target_depth'], params.get('genome_size'), downsampling.DEFAULT_SEED]
+            if params.get('novel_alleles'):
+                cache_key_extra['outputs'] = sorted(cached_output_extensions)
+            with run_metrics.stage('alignment_cache_lookup', profile=False):
+                if shard_manifest is not None:
+                    # An index built by `core-typer index` only has the .name and .length.b files of the whole scheme,
+                    # so the shards' own kma index files are hashed too.
+                    cache_key_extra['scheme_shards'] = [{'name': shard['name'], 'index': cache.hash_kma_index(shard['path'])} for shard in shard_manifest['shards']]
+                cache_key = cache.make_key([params['R1'], params['R2']], params['scheme'], alignment_cache.normalize_alignment_command(alignment_params), extra=cache_key_extra)
+                with cache.lookup(cache_key) as cache_entry:
+                    if cache_entry is not None:
+                        logging.info(f"Using cached alignment: {cache_key}")
+                        parsed_outputs = {extension: output_parser(cache_entry['paths'][extension]) for extension, output_parser in output_parsers.items()}
+                        parsed_outputs['mapstat'] = parse_kma_mapstat(cache_entry['paths']['mapstat'], parsed_outputs['res'])
+                        downsampling_result = cache_entry['metadata'].get('downsampling')
+                        if params.get('novel_alleles'):
+                            shutil.copyfile(cache_entry['paths']['aln'], kma_aln_file)
+        if assembly_index is not None:
+            parsed_outputs = _type_assembly(params, alignment_params, output_parsers, parse_kma_mapstat, run_metrics, assembly_index)
+            downsampling_result = None
+        elif parsed_outputs is None:
+            parsed_outputs, downsampling_result = _align_reads(params, alignment_params, output_parsers, run_metrics, shard_manifest=shard_manifest, output_extensions=cached_output_extensions)
+            if cache is not None:
+                output_paths = alignment.get_output_paths(alignment_params, cached_output_extensions)
+                try:
+                    cache.put(cache_key, output_paths, metadata={'downsampling': downsampling_result})
+                except OSError as e:
+                    logging.warning(f"Unable to add alignment to cache: {params['alignment_cache']} ({e})")
+        parsed_kma_result = parsed_outputs['res']
+        parsed_kma_mapstat = parsed_outputs.get('mapstat')
+        if parsed_kma_mapstat is None:
+            parsed_kma_mapstat = parse_kma_mapstat(kma_mapstat_file, parsed_kma_result)
+        run_metrics.record_input('num_hits', parsed_kma_result['num_rows'])
+        run_metrics.record_input('num_mapstat_rows', parsed_kma_mapstat['num_rows'])
+        run_metrics.record_input('num_loci_hit', len(parsed_kma_result['locus_ids']))
+        if 'fragmentCount' in parsed_kma_mapstat['metadata']:
+            run_metrics.record_input('fragment_count', int(parsed_kma_mapstat['metadata']['fragmentCount']))
+
+        if params.get('sweep'):
+            threshold_sweep_file = os.path.join(params['outdir'], "threshold_sweep.csv")
+            with run_metrics.stage('threshold_sweep'):
+                sweep_result = allele_calling.sweep_thresholds(parsed_kma_result, params['sweep']['min_identity'], params['sweep']['min_coverage'])
+                logging.info(f"Writing threshold sweep ({len(sweep_result['min_identity'])} threshold combinations): {threshold_sweep_file}")
+                allele_calling.write_threshold_sweep(sweep_result, params['scheme'], threshold_sweep_file)
+
+        with run_metrics.stage('allele_calling'):
+            allele_calls = allele_calling.call_alleles(
+                parsed_kma_result,
+                min_identity=params['min_identity'],
+                min_coverage=params['min_coverage'],
+                kma_mapstat_columns=parsed_kma_mapstat,
+            )
+
+        if params.get('novel_alleles'):
+            with run_metrics.stage('novel_alleles', profile=False):
+                novel_alleles_by_locus_id = novel_alleles.find_novel_alleles(
+                    kma_aln_file,
+                    allele_calls,
+                    min_coverage=params['min_coverage'],
+                    hash_method=params.get('novel_allele_hash', 'sha1'),
+                    threads=params['threads'],
+                )
+            logging.info(f"Found {len(novel_alleles_by_locus_id)} novel alleles")
+            novel_alleles_found = []
+            for allele_call_idx, allele_call in enumerate(allele_calls):
+                if allele_call.allele_id == '-' and allele_call.locus_id in novel_alleles_by_locus_id:
+                    novel_allele = novel_alleles_by_locus_id[allele_call.locus_id]
+                    allele_calls[allele_call_idx] = allele_call._replace(allele_id=novel_allele['allele_id'])
+                    novel_alleles_found.append(novel_allele)
+            novel_alleles_csv_file = os.path.join(params['outdir'], "novel_alleles.csv")
+            novel_alleles_fasta_file = os.path.join(params['outdir'], "novel_alleles.fasta")
+            logging.info(f"Writing novel alleles: {novel_alleles_csv_file}")
+            novel_alleles.write_novel_alleles(novel_alleles_found, novel_alleles_csv_file, novel_alleles_fasta_file)
+
+        with run_metrics.stage('qc'):
+            qc_stats = qc.calculate_qc_stats(allele_calls)
+        if downsampling_result is not None:
+            qc_stats['depth_before_downsampling'] = round(downsampling_result['depth_before_downsampling'], 3)
+            qc_stats['depth_after_downsampling'] = round(downsampling_result['depth_after_downsampling'], 3)
+
+        qc_stats_file = os.path.join(params['outdir'], 'qc.csv')
+        logging.info(f"Writing QC stats: {qc_stats_file}")
+        with run_metrics.stage('write_qc_stats'):
+            qc.write_qc_stats(qc_stats, qc_stats_file)
+        logging.debug(f"Writing QC stats completed: {qc_stats_file}")
+
+        allele_calls_file = os.path.join(params['outdir'], "allele_calls.csv")
+        logging.info(f"Writing allele calls: {allele_calls_file}")
+        with run_metrics.stage('write_allele_calls'):
+            allele_calling.write_allele_calls(allele_calls_file, allele_calls)
+        logging.debug(f"Writing allele calls completed: {allele_calls_file}")
+
+        allele_profile_file = os.path.join(params['outdir'], "allele_profile.csv")
+        logging.info(f"Writing allele profile: {allele_profile_file}")
+        with run_metrics.stage('write_allele_profile'):
+            allele_calling.write_allele_profile(allele_calls, params['scheme'], allele_profile_file)
+        logging.debug(f"Writing allele profile completed: {allele_profile_file}")
+
+        store_sample_id = sample_id or os.path.basename(os.path.abspath(params['outdir']))
+        if params.get('query_db'):
+            logging.info(f"Querying profile store for nearest profiles: {params['query_db']}")
+            query_store = profile_store.ProfileStore(params['query_db'])
+            allele_ids_by_locus_id = {allele_call.locus_id: allele_call.allele_id for allele_call in allele_calls}
+            with run_metrics.stage('query'):
+                nearest_profiles = query.query_profile_store(
+                    query_store,
+                    allele_ids_by_locus_id,
+                    k=params.get('query_k', 10),
+                    max_distance=params.get('query_max_distance'),
+                    exclude_sample_id=store_sample_id,
+                )
+            nearest_profiles_file = os.path.join(params['outdir'], "nearest_profiles.csv")
+            logging.info(f"Writing nearest profiles: {nearest_profiles_file}")
+            query.write_nearest_profiles(nearest_profiles, nearest_profiles_file)
+
+        if params.get('profile_store'):
+            logging.info(f"Appending allele calls for sample {store_sample_id} to profile store: {params['profile_store']}")
+            with run_metrics.stage('append_to_profile_store'):
+                store = profile_store.ProfileStore.open_or_create(params['profile_store'], scheme.load_scheme_index(params['scheme'])['locus_ids'])
+                store.append_allele_calls(store_sample_id, allele_calls)
+    finally:
+        if not params['no_cleanup']:
+            shutil.rmtree(analysis_tmpdir, ignore_errors=True)
+            logging.info(f"Deleted tmp directory: {analysis_tmpdir}")
+        else:
+            logging.info(f"Skipped deleting tmp directory: {analysis_tmpdir}")
+
+    if params.get('metrics_json'):
+        logging.info(f"Writing metrics: {params['metrics_json']}")
+        run_metrics.write_json(params['metrics_json'])
+
+    typing_result = {
+        'allele_calls': allele_calls_file,
+        'allele_profile': allele_profile_file,
+        'qc': qc_stats_file,
+        'qc_stats': qc_stats,
+    }
+
+    return typing_result
+
+
+def _align_reads(params, alignment_params, output_parsers, run_metrics, shard_manifest=None, output_extensions=None):
+    """
+    Align reads against the scheme (downsampling them first if a target depth is set), and parse the kma outputs.
+    If a shard manifest is given, reads are aligned against each scheme shard and the outputs are merged.
+
+    :return: The parsed kma outputs (indexed by extension), and the estimated read depth before and after downsampling
+             (None if no target depth is set). Keys of the downsampling result are: 'depth_before_downsampling', 'depth_after_downsampling'
+    :rtype: tuple[dict[str, object], dict[str, float]|None]
+    """
+    with contextlib.ExitStack() as downsampling_stack:
+        downsampled_reads = None
+        if params.get('target_depth'):
+            with run_metrics.stage('count_reads', profile=False):
+                read_counts = downsampling.count_read_pairs(params['R1'], params['R2'])
+            target_length = params.get('genome_size') or scheme.estimate_scheme_length(params['scheme'])
+            num_pairs_to_keep = downsampling.calculate_num_pairs_to_keep(read_counts['num_pairs'], read_counts['num_bases'], target_length, params['target_depth'])
+            run_metrics.record_input('read_pairs', read_counts['num_pairs'])
+            run_metrics.record_input('read_pairs_after_downsampling', num_pairs_to_keep)
+            depth_before_downsampling = read_counts['num_bases'] / target_length
+            if num_pairs_to_keep < read_counts['num_pairs']:
+                logging.info(f"Downsampling {read_counts['num_pairs']} read pairs to {num_pairs_to_keep} (estimated depth: {round(depth_before_downsampling, 1)}, target depth: {params['target_depth']})")
+                downsampled_reads = downsampling_stack.enter_context(downsampling.downsampled_read_pairs(
+                    params['R1'],
+                    params['R2'],
+                    alignment_params['tmpdir'],
+                    read_counts['num_pairs'],
+                    num_pairs_to_keep,
+                    named_pipes=shard_manifest is None,
+                ))
+                alignment_params['R1'] = downsampled_reads['R1']
+                alignment_params['R2'] = downsampled_reads['R2']
+            else:
+                logging.info(f"Estimated depth {round(depth_before_downsampling, 1)} is not above target depth {params['target_depth']}. Skipping downsampling.")
+        with run_metrics.stage('alignment', profile=False):
+            if shard_manifest is not None:
+                parsed_outputs = sharding.run_sharded_alignment(
+                    alignment_params,
+                    shard_manifest,
+                    output_parsers,
+                    output_extensions=output_extensions,
+                    max_concurrent_shards=params.get('max_concurrent_shards'),
+                    metrics=run_metrics,
+                )
+            else:
+                parsed_outputs = alignment.run_alignment(alignment_params, output_parsers, metrics=run_metrics)
+
+    downsampling_result = None
+    if params.get('target_depth'):
+        num_bases = downsampled_reads['num_bases'] if downsampled_reads is not None else read_counts['num_bases']
+        downsampling_result = {
+            'depth_before_downsampling': depth_before_downsampling,
+            'depth_after_downsampling': num_bases / target_length,
+        }
+
+    return parsed_outputs, downsampling_result
+
+
+def _type_assembly(params, alignment_params, output_parsers, parse_kma_mapstat, run_metrics, assembly_index):
+    """
+    Find alleles that occur exactly in the assembly, then align the assembly against the scheme,
+    and parse the kma outputs, keeping only the hits at the remaining loci.
+
+    The scheme's kma index is used as it is, rather than indexing the remaining loci for each assembly.
+
+    :return: The parsed kma outputs (indexed by extension), with the exact matches added to the kma result, in scheme order,
+             and the mapstat rows of the other hits ('mapstat')
+    :rtype: dict[str, object]
+    """
+    with run_metrics.stage('exact_allele_matching'):
+        exact_hits_by_locus_id = assembly.find_exact_alleles(params['assembly'], assembly_index)
+    remaining_locus_ids = [locus_id for locus_id in assembly_index['locus_ids'] if locus_id not in exact_hits_by_locus_id]
+    run_metrics.record_input('num_loci_exact', len(exact_hits_by_locus_id))
+    logging.info(f"Found exact matches for {len(exact_hits_by_locus_id)} loci. Aligning {len(remaining_locus_ids)} remaining loci")
+
+    if remaining_locus_ids:
+        remaining_locus_ids_set = set(remaining_locus_ids)
+        remaining_output_parsers = dict(output_parsers)
+        remaining_output_parsers['res'] = run_metrics.wrap('parse_kma_result', lambda kma_result_file: parsers.parse_kma_best_hits_columnar(kma_result_file, locus_ids=remaining_locus_ids_set))
+        with run_metrics.stage('alignment', profile=False):
+            parsed_outputs = alignment.run_alignment(alignment_params, remaining_output_parsers, metrics=run_metrics)
+    else:
+        # Nothing to align: write empty kma outputs, so that they are parsed (and the .aln file read) as usual
+        output_paths = alignment.get_output_paths(alignment_params, set(alignment.EXPECTED_OUTPUT_EXTENSIONS) | set(output_parsers) | {'aln'})
+        for extension, output_path in output_paths.items():
+            with open(output_path, 'w') as f:
+                if extension == 'res':
+                    f.write('#Template\n')
+        parsed_outputs = {extension: output_parser(output_paths[extension]) for extension, output_parser in output_parsers.items()}
+
+    # The mapstat rows are those of the kma hits only. Exact matches have no mapstat row, even though kma aligns to them too.
+    parsed_outputs['mapstat'] = parse_kma_mapstat(alignment.get_output_paths(alignment_params, ['mapstat'])['mapstat'], parsed_outputs['res'])
+    exact_kma_result = parsers.kma_hits_to_columns(exact_hits_by_locus_id.values())
+    parsed_outputs['res'] = parsers.concatenate_kma_result_columns([exact_kma_result, parsed_outputs['res']], assembly_index['locus_ids'])
+
+    return parsed_outputs
@@ -0,0 +1,330 @@
+import contextlib
+import fcntl
+import logging
+import os
+
+import numpy as np
+
+from . import distance
+from . import parsers
+
+PROFILE_DTYPE = np.dtype('<u4')
+
+LOCI_FILENAME = 'loci.txt'
+SAMPLE_IDS_FILENAME = 'sample_ids.txt'
+ALLELE_CODES_FILENAME = 'allele_codes.tsv'
+PROFILES_FILENAME = 'profiles.u32'
+LOCK_FILENAME = '.lock'
+
+
+class ProfileStore(object):
+    """
+    An append-only store of allele profiles.
+
+    Profiles are stored as a fixed-width integer matrix (samples x loci, in scheme order),
+    which is memory-mapped for reading. Allele IDs are encoded as per-locus integer codes
+    (see distance.encode_allele_profiles), with missing alleles encoded as 0. The store is
+    a directory containing:
+
+      loci.txt           Locus IDs, one per line, in column order
+      sample_ids.txt     Sample IDs, one per line, in row order
+      allele_codes.tsv   Allele codes: locus_id, allele_id, code
+      profiles.u32       The profile matrix, as raw little-endian uint32
+
+    Appends are serialized with a lock file, so several processes can append to the same store.
+    A sample is only visible once its ID has been written to sample_ids.txt, which happens last.
+    """
+    def __init__(self, store_dir):
+        """
+        Open an existing profile store.
+
+        :param store_dir: The path to the profile store directory
+        :type store_dir: str
+        :raises FileNotFoundError: If the profile store does not exist
+        """
+        self.store_dir = store_dir
+        loci_path = os.path.join(store_dir, LOCI_FILENAME)
+        if not os.path.exists(loci_path):
+            raise FileNotFoundError(f"Profile store not found: {store_dir}")
+        with open(loci_path, 'r') as f:
+            self.locus_ids = [line.rstrip('\n') for line in f if line.strip()]
+        self.locus_positions = {locus_id: position for position, locus_id in enumerate(self.locus_ids)}
+        self.sample_ids = []
+        self.sample_positions = {}
+        self.allele_codes = [{distance.MISSING_ALLELE: distance.MISSING_ALLELE_CODE} for _ in self.locus_ids]
+        self._sample_ids_offset = 0
+        self._allele_codes_offset = 0
+        self.refresh()
+
+    @classmethod
+    def create(cls, store_dir, locus_ids):
+        """
+        Create a new, empty profile store.
+
+        :param store_dir: The path to the profile store directory
+        :type store_dir: str
+        :param locus_ids: The locus IDs, in scheme order
+        :type locus_ids: list[str]
+        :return: The profile store
+        :rtype: ProfileStore
+        :raises FileExistsError: If a profile store already exists at store_dir
+        """
+        if os.path.exists(os.path.join(store_dir, LOCI_FILENAME)):
+            raise FileExistsError(f"Profile store already exists: {store_dir}")
+        os.makedirs(store_dir, exist_ok=True)
+        for filename in [SAMPLE_IDS_FILENAME, ALLELE_CODES_FILENAME, PROFILES_FILENAME]:
+            open(os.path.join(store_dir, filename), 'w').close()
+        loci_tmp_path = os.path.join(store_dir, f".{LOCI_FILENAME}.tmp")
+        with open(loci_tmp_path, 'w') as f:
+            for locus_id in locus_ids:
+                f.write(locus_id + '\n')
+        os.replace(loci_tmp_path, os.path.join(store_dir, LOCI_FILENAME))
+        logging.info(f"Created profile store with {len(locus_ids)} loci: {store_dir}")
+
+        return cls(store_dir)
+
+    @classmethod
+    def open_or_create(cls, store_dir, locus_ids):
+        """
+        Open a profile store, creating it if it doesn't exist yet.
+
+        :param store_dir: The path to the profile store directory
+        :type store_dir: str
+        :param locus_ids: The locus IDs, in scheme order. Used if the store is created
+        :type locus_ids: list[str]
+        :return: The profile store
+        :rtype: ProfileStore
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        with _locked(store_dir):
+            if not os.path.exists(os.path.join(store_dir, LOCI_FILENAME)):
+                return cls.create(store_dir, locus_ids)
+
+        return cls(store_dir)
+
+    def refresh(self):
+        """
+        Read any sample IDs and allele codes that have been appended since the store was opened.
+
+        :return: None
+        """
+        with open(os.path.join(self.store_dir, ALLELE_CODES_FILENAME), 'r') as f:
+            f.seek(self._allele_codes_offset)
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                locus_id, allele_id, code = line.rstrip('\n').split('\t')
+                self.allele_codes[self.locus_positions[locus_id]][allele_id] = int(code)
+                self._allele_codes_offset = f.tell()
+
+        with open(os.path.join(self.store_dir, SAMPLE_IDS_FILENAME), 'r') as f:
+            f.seek(self._sample_ids_offset)
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                sample_id = line.rstrip('\n')
+                self.sample_positions[sample_id] = len(self.sample_ids)
+                self.sample_ids.append(sample_id)
+                self._sample_ids_offset = f.tell()
+
+    @property
+    def num_samples(self):
+        return len(self.sample_ids)
+
+    @property
+    def profiles(self):
+        """
+        The profile matrix (samples x loci), memory-mapped read-only.
+
+        :rtype: numpy.ndarray
+        """
+        shape = (self.num_samples, len(self.locus_ids))
+        if self.num_samples == 0 or len(self.locus_ids) == 0:
+            return np.zeros(shape, dtype=PROFILE_DTYPE)
+
+        return np.memmap(os.path.join(self.store_dir, PROFILES_FILENAME), dtype=PROFILE_DTYPE, mode='r', shape=shape)
+
+    def encode_profile(self, allele_ids_by_locus_id, new_allele_codes=None):
+        """
+        Encode an allele profile as a row of the profile matrix.
+
+        :param allele_ids_by_locus_id: Allele IDs, indexed by locus ID. Loci not in the dict are treated as missing
+        :type allele_ids_by_locus_id: dict[str, str]
+        :param new_allele_codes: If provided, alleles that are not yet in the store are assigned new codes, which
+                                 are recorded here as (locus_id, allele_id, code). Otherwise they are encoded as -1
+        :type new_allele_codes: list[tuple[str, str, int]]|None
+        :return: The encoded profile
+        :rtype: numpy.ndarray
+        :raises ValueError: If the profile contains a locus that is not in the store
+        """
+        for locus_id in allele_ids_by_locus_id:
+            if locus_id not in self.locus_positions:
+                raise ValueError(f"Locus not found in profile store: {locus_id}")
+        profile = np.zeros(len(self.locus_ids), dtype=np.int64)
+        for locus_idx, locus_id in enumerate(self.locus_ids):
+            allele_id = allele_ids_by_locus_id.get(locus_id, distance.MISSING_ALLELE)
+            locus_allele_codes = self.allele_codes[locus_idx]
+            code = locus_allele_codes.get(allele_id)
+            if code is None:
+                if new_allele_codes is None:
+                    code = -1
+                else:
+                    code = len(locus_allele_codes)
+                    locus_allele_codes[allele_id] = code
+                    new_allele_codes.append((locus_id, allele_id, code))
+            profile[locus_idx] = code
+
+        return profile
+
+    def decode_profile(self, profile):
+        """
+        Decode a row of the profile matrix back to allele IDs.
+
+        :param profile: The encoded profile
+        :type profile: numpy.ndarray
+        :return: Allele IDs, in locus order
+        :rtype: list[str]
+        """
+        allele_ids_by_code = self._get_allele_ids_by_code()
+
+        return [allele_ids_by_code[locus_idx][code] for locus_idx, code in enumerate(profile.tolist())]
+
+    def _get_allele_ids_by_code(self):
+        allele_ids_by_code = []
+        for locus_allele_codes in self.allele_codes:
+            locus_allele_ids = [None] * len(locus_allele_codes)
+            for allele_id, code in locus_allele_codes.items():
+                locus_allele_ids[code] = allele_id
+            allele_ids_by_code.append(locus_allele_ids)
+
+        return allele_ids_by_code
+
+    def append(self, profiles_by_sample_id):
+        """
+        Append allele profiles to the store.
+
+        :param profiles_by_sample_id: Allele IDs, indexed by locus ID, for each sample
+        :type profiles_by_sample_id: dict[str, dict[str, str]]
+        :return: None
+        :raises ValueError: If a sample ID is already in the store, or a profile contains a locus that is not in the store
+        """
+        if not profiles_by_sample_id:
+            return
+        with _locked(self.store_dir):
+            self.refresh()
+            for sample_id in profiles_by_sample_id:
+                if sample_id in self.sample_positions:
+                    raise ValueError(f"Sample already in profile store: {sample_id}")
+                if '\n' in sample_id:
+                    raise ValueError(f"Invalid sample ID: {sample_id!r}")
+                for locus_id in profiles_by_sample_id[sample_id]:
+                    if locus_id not in self.locus_positions:
+                        raise ValueError(f"Locus not found in profile store: {locus_id}")
+
+            new_allele_codes = []
+            rows = np.empty((len(profiles_by_sample_id), len(self.locus_ids)), dtype=PROFILE_DTYPE)
+            for row_idx, allele_ids_by_locus_id in enumerate(profiles_by_sample_id.values()):
+                rows[row_idx] = self.encode_profile(allele_ids_by_locus_id, new_allele_codes)
+
+            with open(os.path.join(self.store_dir, ALLELE_CODES_FILENAME), 'a') as f:
+                for locus_id, allele_id, code in new_allele_codes:
+                    f.write(f"{locus_id}\t{allele_id}\t{code}\n")
+
+            # Discard any partial rows left behind by an interrupted append before writing new rows.
+            with open(os.path.join(self.store_dir, PROFILES_FILENAME), 'r+b') as f:
+                f.truncate(self.num_samples * len(self.locus_ids) * PROFILE_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(rows.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(os.path.join(self.store_dir, SAMPLE_IDS_FILENAME), 'a') as f:
+                for sample_id in profiles_by_sample_id:
+                    f.write(sample_id + '\n')
+
+            self.refresh()
+
+    def append_allele_calls(self, sample_id, allele_calls):
+        """
+        Append a sample's allele calls to the store.
+
+        :param sample_id: The sample ID
+        :type sample_id: str
+        :param allele_calls: The allele calls
+        :type allele_calls: list[records.AlleleCall]
+        :return: None
+        """
+        allele_ids_by_locus_id = {allele_call.locus_id: allele_call.allele_id for allele_call in allele_calls}
+        self.append({sample_id: allele_ids_by_locus_id})
+
+    def import_allele_profiles(self, allele_profile_paths, batch_size=1000):
+        """
+        Import allele profile files (as written by allele_calling.write_allele_profile). Sample IDs
+        are taken from the name of the directory containing each file (see distance.get_sample_id).
+
+        :param allele_profile_paths: The paths to the allele profile files
+        :type allele_profile_paths: list[str]
+        :param batch_size: Number of profiles to append at a time
+        :type batch_size: int
+        :return: The number of profiles imported
+        :rtype: int
+        :raises ValueError: If a sample ID occurs more than once, or is already in the store. Nothing is imported
+        """
+        self.refresh()
+        seen_sample_ids = set()
+        for allele_profile_path in allele_profile_paths:
+            sample_id = distance.get_sample_id(allele_profile_path)
+            if sample_id in seen_sample_ids:
+                raise ValueError(f"Duplicate sample ID: {sample_id} ({allele_profile_path})")
+            if sample_id in self.sample_positions:
+                raise ValueError(f"Sample already in profile store: {sample_id} ({allele_profile_path})")
+            seen_sample_ids.add(sample_id)
+
+        num_imported = 0
+        profiles_by_sample_id = {}
+        for allele_profile_path in allele_profile_paths:
+            sample_id = distance.get_sample_id(allele_profile_path)
+            allele_profile = parsers.parse_allele_profile(allele_profile_path)
+            profiles_by_sample_id[sample_id] = dict(zip(allele_profile['locus_ids'], allele_profile['allele_ids']))
+            if len(profiles_by_sample_id) >= batch_size:
+                self.append(profiles_by_sample_id)
+                num_imported += len(profiles_by_sample_id)
+                profiles_by_sample_id = {}
+        self.append(profiles_by_sample_id)
+        num_imported += len(profiles_by_sample_id)
+
+        return num_imported
+
+    def export_csv(self, output_path, delimiter=',', sample_ids=None):
+        """
+        Export profiles as a samples x loci matrix, with a header row of locus IDs.
+
+        :param output_path: The path to the output file
+        :type output_path: str
+        :param delimiter: The field delimiter
+        :type delimiter: str
+        :param sample_ids: Export only these samples (default: all samples)
+        :type sample_ids: list[str]|None
+        :return: None
+        :raises KeyError: If a requested sample is not in the store
+        """
+        allele_ids_by_code = self._get_allele_ids_by_code()
+        profiles = self.profiles
+        if sample_ids is None:
+            sample_ids = self.sample_ids
+        with open(output_path, 'w') as f:
+            f.write(delimiter.join(['sample_id'] + self.locus_ids) + '\n')
+            for sample_id in sample_ids:
+                profile = profiles[self.sample_positions[sample_id]].tolist()
+                allele_ids = [allele_ids_by_code[locus_idx][code] for locus_idx, code in enumerate(profile)]
+                f.write(delimiter.join([sample_id] + allele_ids) + '\n')
+
+
+@contextlib.contextmanager
+def _locked(store_dir):
+    with open(os.path.join(store_dir, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -10,9 +10,9 @@ def calculate_qc_stats(allele_calls):
     num_called_alleles = 0
     for allele_call in allele_calls:
         num_loci += 1
-        if allele_call['allele_id'] != '-':
+        if allele_call.allele_id != '-':
             num_called_alleles += 1
-        depths.append(allele_call['depth'])
+        depths.append(allele_call.depth)
 
     mean_depth = round(sum(depths) / len(depths), 3)
     stdev_depth = round(statistics.stdev(depths), 3)
@@ -35,6 +35,10 @@ def write_qc_stats(qc_stats, qc_stats_file):
         'stdev_depth',
         'percent_called',
     ]
+    # Read depth before and after downsampling is only known when reads were downsampled (--target-depth).
+    for downsampling_fieldname in ['depth_before_downsampling', 'depth_after_downsampling']:
+        if downsampling_fieldname in qc_stats:
+            qc_fieldnames.append(downsampling_fieldname)
     with open(qc_stats_file, 'w') as f:
         writer = csv.DictWriter(f, fieldnames=qc_fieldnames, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
         writer.writeheader()
@@ -0,0 +1,453 @@
+import collections
+import concurrent.futures
+import csv
+import logging
+import math
+import os
+
+import numpy as np
+
+from . import parsers
+
+MISSING_ALLELE = '-'
+
+QC_METRICS = [
+    'mean_depth',
+    'stdev_depth',
+    'percent_called',
+    'depth_before_downsampling',
+    'depth_after_downsampling',
+]
+
+PERCENT_METRICS = [
+    'percent_called',
+]
+
+DEFAULT_DEPTH_BIN_WIDTH = 5.0
+DEFAULT_NUM_DEPTH_BINS = 100
+DEFAULT_QUANTILE_RELATIVE_ACCURACY = 0.01
+
+SUMMARY_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class RunningStats(object):
+    """
+    Count, mean, variance, min and max of a stream of values, in constant memory (Welford's algorithm).
+    Two RunningStats can be merged (Chan et al.), so partial results can be combined.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        """
+        :param value: The value to add
+        :type value: float
+        :return: None
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """
+        :param other: Stats to merge into these stats
+        :type other: RunningStats
+        :return: None
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def stdev(self):
+        """
+        :return: The sample standard deviation, or None if there are fewer than two values
+        :rtype: float|None
+        """
+        if self.count < 2:
+            return None
+
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+class Histogram(object):
+    """
+    Counts of values in fixed-width bins. Values below the first bin are counted in the first bin,
+    and values at or above the end of the last bin are counted in the last bin.
+    """
+    def __init__(self, bin_width, num_bins, start=0.0):
+        """
+        :param bin_width: The width of each bin
+        :type bin_width: float
+        :param num_bins: The number of bins
+        :type num_bins: int
+        :param start: The start of the first bin
+        :type start: float
+        """
+        self.bin_width = bin_width
+        self.num_bins = num_bins
+        self.start = start
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+
+    def add(self, value):
+        """
+        :param value: The value to add
+        :type value: float
+        :return: None
+        """
+        bin_idx = int((value - self.start) // self.bin_width)
+        self.counts[min(max(bin_idx, 0), self.num_bins - 1)] += 1
+
+    def iter_bins(self):
+        """
+        :return: The bins, as tuples of (bin_start, bin_end, count). bin_end of the last bin is None (unbounded)
+        :rtype: Iterator[tuple[float, float|None, int]]
+        """
+        for bin_idx, count in enumerate(self.counts):
+            bin_start = self.start + bin_idx * self.bin_width
+            bin_end = bin_start + self.bin_width if bin_idx < self.num_bins - 1 else None
+            yield bin_start, bin_end, int(count)
+
+
+class QuantileSketch(object):
+    """
+    A mergeable quantile sketch for non-negative values, with bounded relative error (as in DDSketch).
+
+    Values are counted in logarithmically-spaced buckets, so that every value in a bucket is within
+    relative_accuracy of the bucket's representative value. Memory depends on the range of the values,
+    not on how many there are. Zeros are counted separately.
+    """
+    def __init__(self, relative_accuracy=DEFAULT_QUANTILE_RELATIVE_ACCURACY):
+        """
+        :param relative_accuracy: The maximum relative error of quantile estimates
+        :type relative_accuracy: float
+        """
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bucket_counts = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        """
+        :param value: The value to add. Negative values are counted as zero
+        :type value: float
+        :return: None
+        """
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        bucket_idx = math.ceil(math.log(value) / self.log_gamma)
+        self.bucket_counts[bucket_idx] = self.bucket_counts.get(bucket_idx, 0) + 1
+
+    def merge(self, other):
+        """
+        :param other: A sketch with the same relative accuracy, to merge into this sketch
+        :type other: QuantileSketch
+        :return: None
+        """
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for bucket_idx, bucket_count in other.bucket_counts.items():
+            self.bucket_counts[bucket_idx] = self.bucket_counts.get(bucket_idx, 0) + bucket_count
+
+    def quantile(self, q):
+        """
+        :param q: The quantile, between 0 and 1
+        :type q: float
+        :return: The estimated quantile, or None if the sketch is empty
+        :rtype: float|None
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative_count = self.zero_count
+        for bucket_idx in sorted(self.bucket_counts):
+            cumulative_count += self.bucket_counts[bucket_idx]
+            if cumulative_count > rank:
+                return 2 * self.gamma ** bucket_idx / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.bucket_counts) / (self.gamma + 1)
+
+
+class LocusCallRates(object):
+    """
+    Per-locus counts across a cohort: how many samples had a kma hit at each locus, how many
+    were called, and the mean and variance of the depth of the hits (Welford's algorithm, vectorized over loci).
+    Memory depends on the number of loci, not the number of samples.
+    """
+    def __init__(self, locus_ids):
+        """
+        :param locus_ids: The locus IDs, in scheme order
+        :type locus_ids: list[str]
+        """
+        self.locus_ids = locus_ids
+        self.num_samples = 0
+        self.num_hit = np.zeros(len(locus_ids), dtype=np.int64)
+        self.num_called = np.zeros(len(locus_ids), dtype=np.int64)
+        self.depth_mean = np.zeros(len(locus_ids), dtype=np.float64)
+        self.depth_m2 = np.zeros(len(locus_ids), dtype=np.float64)
+
+    def add_sample(self, called, hit, depths):
+        """
+        :param called: Whether each locus was called in the sample
+        :type called: numpy.ndarray
+        :param hit: Whether each locus had a kma hit in the sample
+        :type hit: numpy.ndarray
+        :param depths: The depth of the hit at each locus (ignored where there was no hit)
+        :type depths: numpy.ndarray
+        :return: None
+        """
+        self.num_samples += 1
+        self.num_called += called
+        self.num_hit += hit
+        hit_count = self.num_hit[hit]
+        delta = depths[hit] - self.depth_mean[hit]
+        self.depth_mean[hit] += delta / hit_count
+        self.depth_m2[hit] += delta * (depths[hit] - self.depth_mean[hit])
+
+    def iter_rows(self):
+        """
+        :return: One row per locus, in scheme order. Keys are as in LOCUS_CALL_RATE_FIELDNAMES
+        :rtype: Iterator[dict]
+        """
+        for locus_idx, locus_id in enumerate(self.locus_ids):
+            num_hit = int(self.num_hit[locus_idx])
+            num_called = int(self.num_called[locus_idx])
+            row = {
+                'locus_id': locus_id,
+                'num_samples': self.num_samples,
+                'num_hit': num_hit,
+                'num_called': num_called,
+                'percent_hit': round(num_hit / self.num_samples * 100, 3) if self.num_samples > 0 else None,
+                'percent_called': round(num_called / self.num_samples * 100, 3) if self.num_samples > 0 else None,
+                'mean_depth': round(float(self.depth_mean[locus_idx]), 3) if num_hit > 0 else None,
+                'stdev_depth': round(math.sqrt(self.depth_m2[locus_idx] / (num_hit - 1)), 3) if num_hit > 1 else None,
+            }
+            yield row
+
+
+LOCUS_CALL_RATE_FIELDNAMES = [
+    'locus_id',
+    'num_samples',
+    'num_hit',
+    'num_called',
+    'percent_hit',
+    'percent_called',
+    'mean_depth',
+    'stdev_depth',
+]
+
+
+def read_sample_qc(output_dir):
+    """
+    Read the QC stats, allele profile and allele calls of a single typing run.
+
+    :param output_dir: The output directory of the typing run
+    :type output_dir: str
+    :return: The sample's QC. Keys are: 'sample_id', 'qc_stats' (from qc.csv, parsed as floats), 'locus_ids' (from the
+             allele profile header), 'called' (bool array, by locus), 'hit' (bool array, by locus), 'depths' (float array, by locus)
+    :rtype: dict
+    :raises ValueError: If the allele calls include a locus that isn't in the allele profile
+    """
+    qc_stats = {}
+    with open(os.path.join(output_dir, 'qc.csv'), 'r') as f:
+        for row in csv.DictReader(f):
+            for metric, value in row.items():
+                if metric in QC_METRICS and value not in [None, '']:
+                    qc_stats[metric] = float(value)
+            break
+
+    allele_profile = parsers.parse_allele_profile(os.path.join(output_dir, 'allele_profile.csv'))
+    locus_ids = allele_profile['locus_ids']
+    locus_positions = {locus_id: locus_idx for locus_idx, locus_id in enumerate(locus_ids)}
+    called = np.array([allele_id != MISSING_ALLELE for allele_id in allele_profile['allele_ids']], dtype=bool)
+    hit = np.zeros(len(locus_ids), dtype=bool)
+    depths = np.zeros(len(locus_ids), dtype=np.float64)
+    for allele_call in parsers.parse_allele_calls(os.path.join(output_dir, 'allele_calls.csv')):
+        locus_idx = locus_positions.get(allele_call.locus_id)
+        if locus_idx is None:
+            raise ValueError(f"Locus {allele_call.locus_id} in allele calls is not in the allele profile: {output_dir}")
+        hit[locus_idx] = True
+        depths[locus_idx] = allele_call.depth
+
+    sample_qc = {
+        'sample_id': os.path.basename(os.path.abspath(output_dir)),
+        'qc_stats': qc_stats,
+        'locus_ids': locus_ids,
+        'called': called,
+        'hit': hit,
+        'depths': depths,
+    }
+
+    return sample_qc
+
+
+def _try_read_sample_qc(output_dir):
+    try:
+        return read_sample_qc(output_dir)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Skipping output directory {output_dir}: {e!r}")
+        return None
+
+
+def summarize_cohort_qc(output_dirs, threads=1, depth_bin_width=DEFAULT_DEPTH_BIN_WIDTH, num_depth_bins=DEFAULT_NUM_DEPTH_BINS,
+                        relative_accuracy=DEFAULT_QUANTILE_RELATIVE_ACCURACY):
+    """
+    Summarize QC across the output directories of many typing runs, in a single pass.
+
+    Output directories are read concurrently, with a bounded number in flight, and each sample is folded
+    into running statistics, histograms and quantile sketches as it is read, so memory depends on the
+    number of loci, not the number of samples. Output directories that can't be read, or whose allele
+    profile has different loci from the first one read, are skipped (and counted).
+
+    :param output_dirs: The output directories of the typing runs
+    :type output_dirs: Iterable[str]
+    :param threads: Number of output directories to read concurrently
+    :type threads: int
+    :param depth_bin_width: Width of the histogram bins for depth metrics
+    :type depth_bin_width: float
+    :param num_depth_bins: Number of histogram bins for depth metrics
+    :type num_depth_bins: int
+    :param relative_accuracy: Relative accuracy of the quantile sketches
+    :type relative_accuracy: float
+    :return: The cohort QC summary. Keys are: 'num_samples', 'num_skipped', 'stats' (RunningStats, by metric),
+             'histograms' (Histogram, by metric), 'sketches' (QuantileSketch, by metric), 'locus_call_rates' (LocusCallRates)
+    :rtype: dict
+    """
+    cohort_qc = {
+        'num_samples': 0,
+        'num_skipped': 0,
+        'stats': {},
+        'histograms': {},
+        'sketches': {},
+        'locus_call_rates': None,
+    }
+
+    def add_sample_qc(sample_qc):
+        if sample_qc is None:
+            cohort_qc['num_skipped'] += 1
+            return
+        if cohort_qc['locus_call_rates'] is None:
+            cohort_qc['locus_call_rates'] = LocusCallRates(sample_qc['locus_ids'])
+        locus_call_rates = cohort_qc['locus_call_rates']
+        if sample_qc['locus_ids'] != locus_call_rates.locus_ids:
+            logging.warning(f"Skipping sample {sample_qc['sample_id']}: loci in allele profile do not match the other samples")
+            cohort_qc['num_skipped'] += 1
+            return
+        cohort_qc['num_samples'] += 1
+        locus_call_rates.add_sample(sample_qc['called'], sample_qc['hit'], sample_qc['depths'])
+        for metric, value in sample_qc['qc_stats'].items():
+            if metric not in cohort_qc['stats']:
+                cohort_qc['stats'][metric] = RunningStats()
+                if metric in PERCENT_METRICS:
+                    cohort_qc['histograms'][metric] = Histogram(1.0, 101)
+                else:
+                    cohort_qc['histograms'][metric] = Histogram(depth_bin_width, num_depth_bins)
+                cohort_qc['sketches'][metric] = QuantileSketch(relative_accuracy)
+            cohort_qc['stats'][metric].add(value)
+            cohort_qc['histograms'][metric].add(value)
+            cohort_qc['sketches'][metric].add(value)
+
+    max_in_flight = max(1, threads) * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        futures = collections.deque()
+        for output_dir in output_dirs:
+            futures.append(executor.submit(_try_read_sample_qc, output_dir))
+            if len(futures) >= max_in_flight:
+                # Fold samples in in the order they were given, so results don't depend on timing.
+                add_sample_qc(futures.popleft().result())
+        for future in futures:
+            add_sample_qc(future.result())
+
+    return cohort_qc
+
+
+def write_qc_summary(cohort_qc, qc_summary_path):
+    """
+    Write summary statistics of each QC metric across the cohort to a CSV file, one row per metric.
+
+    :param cohort_qc: The cohort QC summary, as returned by summarize_cohort_qc
+    :type cohort_qc: dict
+    :param qc_summary_path: The path to the QC summary file
+    :type qc_summary_path: str
+    :return: None
+    """
+    quantile_fieldnames = [f"p{int(round(q * 100)):02d}" for q in SUMMARY_QUANTILES]
+    output_fieldnames = ['metric', 'count', 'mean', 'stdev', 'min'] + quantile_fieldnames + ['max']
+    with open(qc_summary_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=output_fieldnames, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        for metric in QC_METRICS:
+            stats = cohort_qc['stats'].get(metric)
+            if stats is None:
+                continue
+            stdev = stats.stdev()
+            row = {
+                'metric': metric,
+                'count': stats.count,
+                'mean': round(stats.mean, 3),
+                'stdev': round(stdev, 3) if stdev is not None else None,
+                'min': round(stats.min, 3),
+                'max': round(stats.max, 3),
+            }
+            for q, quantile_fieldname in zip(SUMMARY_QUANTILES, quantile_fieldnames):
+                # Sketch estimates are bucket midpoints, so clamp them to the observed range.
+                quantile = min(max(cohort_qc['sketches'][metric].quantile(q), stats.min), stats.max)
+                row[quantile_fieldname] = round(quantile, 3)
+            writer.writerow(row)
+
+
+def write_qc_histograms(cohort_qc, qc_histograms_path):
+    """
+    Write histograms of each QC metric across the cohort to a CSV file, one row per bin.
+
+    :param cohort_qc: The cohort QC summary, as returned by summarize_cohort_qc
+    :type cohort_qc: dict
+    :param qc_histograms_path: The path to the QC histograms file
+    :type qc_histograms_path: str
+    :return: None
+    """
+    output_fieldnames = ['metric', 'bin_start', 'bin_end', 'count']
+    with open(qc_histograms_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=output_fieldnames, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        for metric in QC_METRICS:
+            histogram = cohort_qc['histograms'].get(metric)
+            if histogram is None:
+                continue
+            for bin_start, bin_end, count in histogram.iter_bins():
+                writer.writerow({'metric': metric, 'bin_start': bin_start, 'bin_end': bin_end, 'count': count})
+
+
+def write_locus_call_rates(cohort_qc, locus_call_rates_path):
+    """
+    Write per-locus call rates across the cohort to a CSV file, one row per locus, in scheme order.
+
+    :param cohort_qc: The cohort QC summary, as returned by summarize_cohort_qc
+    :type cohort_qc: dict
+    :param locus_call_rates_path: The path to the locus call rates file
+    :type locus_call_rates_path: str
+    :return: None
+    """
+    with open(locus_call_rates_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=LOCUS_CALL_RATE_FIELDNAMES, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        if cohort_qc['locus_call_rates'] is not None:
+            for row in cohort_qc['locus_call_rates'].iter_rows():
+                writer.writerow(row)
@@ -0,0 +1,377 @@
+import csv
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from . import distance
+
+INDEX_DIRNAME = 'index'
+INDEX_METADATA_FILENAME = 'metadata.json'
+INDEX_POSTINGS_FILENAME = 'postings.u32'
+INDEX_OFFSETS_FILENAME = 'offsets.u64'
+INDEX_LOCUS_OFFSETS_FILENAME = 'locus_offsets.u64'
+
+# Number of stored profiles loaded at a time when calculating distances.
+CANDIDATE_BLOCK_SIZE = 1024
+# Number of loci compared between checks for candidates that can be abandoned.
+LOCUS_BLOCK_SIZE = 256
+# Maximum number of profiles compared to find an initial distance threshold when searching for the k nearest profiles.
+KNN_SEED_SIZE = 4096
+
+
+def build_allele_index(store):
+    """
+    Build an inverted index over a profile store, listing the samples that carry each allele at each locus.
+
+    For each locus, the indices of all samples are stored sorted by allele code (a CSR layout), so
+    the samples carrying a given allele form a contiguous slice. The index is written to an 'index'
+    directory inside the profile store, and covers the samples that were in the store when it was
+    built. Samples appended afterwards are still found by queries, but are compared without pruning.
+
+    :param store: The profile store
+    :type store: profile_store.ProfileStore
+    :return: None
+    """
+    store.refresh()
+    num_samples = store.num_samples
+    num_loci = len(store.locus_ids)
+    profiles = store.profiles
+    index_dir = os.path.join(store.store_dir, INDEX_DIRNAME)
+    tmp_index_dir = os.path.join(store.store_dir, f".{INDEX_DIRNAME}.tmp-{os.getpid()}")
+    os.makedirs(tmp_index_dir)
+    try:
+        postings_shape = (num_loci, num_samples)
+        if num_samples > 0 and num_loci > 0:
+            postings = np.memmap(os.path.join(tmp_index_dir, INDEX_POSTINGS_FILENAME), dtype='<u4', mode='w+', shape=postings_shape)
+        else:
+            open(os.path.join(tmp_index_dir, INDEX_POSTINGS_FILENAME), 'wb').close()
+            postings = np.zeros(postings_shape, dtype='<u4')
+        locus_offsets = np.zeros(num_loci + 1, dtype='<u8')
+        offsets = []
+        for locus_start in range(0, num_loci, LOCUS_BLOCK_SIZE):
+            locus_end = min(locus_start + LOCUS_BLOCK_SIZE, num_loci)
+            profiles_block = np.asarray(profiles[:, locus_start:locus_end])
+            for locus_idx in range(locus_start, locus_end):
+                column = profiles_block[:, locus_idx - locus_start]
+                postings[locus_idx] = np.argsort(column, kind='stable')
+                counts = np.bincount(column, minlength=len(store.allele_codes[locus_idx]))
+                locus_code_offsets = np.zeros(len(counts) + 1, dtype='<u8')
+                np.cumsum(counts, out=locus_code_offsets[1:])
+                offsets.append(locus_code_offsets)
+                locus_offsets[locus_idx + 1] = locus_offsets[locus_idx] + len(locus_code_offsets)
+        if isinstance(postings, np.memmap):
+            postings.flush()
+        del postings
+
+        np.concatenate(offsets or [np.zeros(0, dtype='<u8')]).astype('<u8').tofile(os.path.join(tmp_index_dir, INDEX_OFFSETS_FILENAME))
+        locus_offsets.tofile(os.path.join(tmp_index_dir, INDEX_LOCUS_OFFSETS_FILENAME))
+        with open(os.path.join(tmp_index_dir, INDEX_METADATA_FILENAME), 'w') as f:
+            json.dump({'num_samples': num_samples, 'num_loci': num_loci}, f)
+
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_index_dir, index_dir)
+    except BaseException:
+        shutil.rmtree(tmp_index_dir, ignore_errors=True)
+        raise
+    logging.info(f"Built allele index for {num_samples} samples over {num_loci} loci: {index_dir}")
+
+
+def load_allele_index(store):
+    """
+    Load the inverted allele index for a profile store, if it has one.
+
+    :param store: The profile store
+    :type store: profile_store.ProfileStore
+    :return: The allele index, or None if the store has not been indexed. Keys are: 'num_samples' (number of samples
+             covered by the index), 'postings' (loci x samples), 'offsets', 'locus_offsets'
+    :rtype: dict|None
+    """
+    index_dir = os.path.join(store.store_dir, INDEX_DIRNAME)
+    metadata_path = os.path.join(index_dir, INDEX_METADATA_FILENAME)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+    num_samples = metadata['num_samples']
+    num_loci = metadata['num_loci']
+    if num_loci != len(store.locus_ids):
+        logging.warning(f"Allele index does not match profile store, ignoring it: {index_dir}")
+        return None
+
+    if num_samples > 0 and num_loci > 0:
+        postings = np.memmap(os.path.join(index_dir, INDEX_POSTINGS_FILENAME), dtype='<u4', mode='r', shape=(num_loci, num_samples))
+    else:
+        postings = np.zeros((num_loci, num_samples), dtype='<u4')
+    allele_index = {
+        'num_samples': num_samples,
+        'postings': postings,
+        'offsets': np.fromfile(os.path.join(index_dir, INDEX_OFFSETS_FILENAME), dtype='<u8'),
+        'locus_offsets': np.fromfile(os.path.join(index_dir, INDEX_LOCUS_OFFSETS_FILENAME), dtype='<u8'),
+    }
+
+    return allele_index
+
+
+def _get_postings(allele_index, locus_idx, code):
+    locus_start = int(allele_index['locus_offsets'][locus_idx])
+    locus_end = int(allele_index['locus_offsets'][locus_idx + 1])
+    num_codes = locus_end - locus_start - 1
+    if code < 0 or code >= num_codes:
+        return 0, 0
+    start = int(allele_index['offsets'][locus_start + code])
+    end = int(allele_index['offsets'][locus_start + code + 1])
+
+    return start, end
+
+
+def _count_query_alleles(query_profile, allele_index):
+    """
+    For each locus called in the query, count the indexed samples that carry the query's allele,
+    and the indexed samples that are missing that locus.
+    """
+    called_loci = np.flatnonzero(query_profile != distance.MISSING_ALLELE_CODE)
+    offsets = allele_index['offsets'].astype(np.int64)
+    locus_starts = allele_index['locus_offsets'][called_loci].astype(np.int64)
+    num_codes = allele_index['locus_offsets'][called_loci + 1].astype(np.int64) - locus_starts - 1
+    codes = query_profile[called_loci]
+    is_indexed_code = (codes >= 0) & (codes < num_codes)
+    code_starts = locus_starts + np.where(is_indexed_code, codes, 0)
+    allele_counts = np.where(is_indexed_code, offsets[code_starts + 1] - offsets[code_starts], 0)
+    missing_counts = offsets[locus_starts + 1] - offsets[locus_starts]
+
+    return called_loci, allele_counts, missing_counts
+
+
+def find_seed_candidates(query_profile, allele_index, max_candidates, num_seed_loci=32):
+    """
+    Use the allele index to find indexed samples that are likely to be near the query: those that share
+    the query's allele at the most of a set of selective loci (the loci where the fewest samples carry
+    the query's allele).
+
+    :param query_profile: The encoded query profile (unknown alleles encoded as -1)
+    :type query_profile: numpy.ndarray
+    :param allele_index: The allele index, as returned by load_allele_index
+    :type allele_index: dict
+    :param max_candidates: The maximum number of candidates to return
+    :type max_candidates: int
+    :param num_seed_loci: The number of selective loci to use
+    :type num_seed_loci: int
+    :return: The candidate sample indices, most shared alleles first
+    :rtype: numpy.ndarray
+    """
+    called_loci, allele_counts, _ = _count_query_alleles(query_profile, allele_index)
+    seed_positions = np.flatnonzero(allele_counts > 0)
+    if len(seed_positions) > num_seed_loci:
+        seed_positions = seed_positions[np.argpartition(allele_counts[seed_positions], num_seed_loci - 1)[:num_seed_loci]]
+
+    postings = allele_index['postings']
+    candidate_slices = []
+    for locus_idx in called_loci[seed_positions].tolist():
+        start, end = _get_postings(allele_index, locus_idx, int(query_profile[locus_idx]))
+        candidate_slices.append(np.asarray(postings[locus_idx, start:end]))
+    if not candidate_slices:
+        return np.empty(0, dtype=np.int64)
+
+    candidates, num_shared_alleles = np.unique(np.concatenate(candidate_slices), return_counts=True)
+    order = np.argsort(-num_shared_alleles, kind='stable')[:max_candidates]
+
+    return candidates[order].astype(np.int64)
+
+
+def find_candidates(query_profile, allele_index, max_distance):
+    """
+    Use the allele index to find the indexed samples that could be within max_distance of the query.
+
+    A sample within max_distance must agree with the query at all but max_distance of the loci that
+    are called in both. So among any (max_distance + 1) loci called in the query, the sample must
+    either carry the query's allele or be missing at one or more of them. The loci where the fewest
+    samples carry the query allele (or are missing) are chosen, to keep the candidate set small.
+
+    :param query_profile: The encoded query profile (unknown alleles encoded as -1)
+    :type query_profile: numpy.ndarray
+    :param allele_index: The allele index, as returned by load_allele_index
+    :type allele_index: dict
+    :param max_distance: The maximum distance
+    :type max_distance: int
+    :return: The candidate sample indices, or None if the index can't narrow down the candidates
+    :rtype: numpy.ndarray|None
+    """
+    called_loci, allele_counts, missing_counts = _count_query_alleles(query_profile, allele_index)
+    num_pivot_loci = max_distance + 1
+    if num_pivot_loci > len(called_loci):
+        return None
+
+    costs = allele_counts + missing_counts
+    pivot_positions = np.argpartition(costs, num_pivot_loci - 1)[:num_pivot_loci]
+    if costs[pivot_positions].sum() >= allele_index['num_samples']:
+        return None
+    pivot_loci = called_loci[pivot_positions]
+
+    postings = allele_index['postings']
+    candidate_slices = []
+    for locus_idx in pivot_loci.tolist():
+        for code in [int(query_profile[locus_idx]), distance.MISSING_ALLELE_CODE]:
+            start, end = _get_postings(allele_index, locus_idx, code)
+            if end > start:
+                candidate_slices.append(np.asarray(postings[locus_idx, start:end]))
+    if not candidate_slices:
+        return np.empty(0, dtype=np.int64)
+
+    return np.unique(np.concatenate(candidate_slices)).astype(np.int64)
+
+
+def calculate_candidate_distances(query_profile, profiles, candidates, max_distance=None):
+    """
+    Calculate the distance between the query and each candidate profile, ignoring loci that are missing in either
+    (pairwise deletion). Loci are compared a block at a time, and candidates are abandoned as soon as their
+    distance exceeds max_distance.
+
+    :param query_profile: The encoded query profile (unknown alleles encoded as -1)
+    :type query_profile: numpy.ndarray
+    :param profiles: The stored profiles (samples x loci)
+    :type profiles: numpy.ndarray
+    :param candidates: Indices of the candidate profiles
+    :type candidates: numpy.ndarray
+    :param max_distance: The maximum distance (default: no maximum)
+    :type max_distance: int|None
+    :return: Indices of the candidates within max_distance, their distances, and the number of loci called in both
+    :rtype: tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+    """
+    num_loci = len(query_profile)
+    query_profile = query_profile.astype(np.int64)
+    query_called = query_profile != distance.MISSING_ALLELE_CODE
+    result_indices = []
+    result_distances = []
+    result_shared_loci = []
+    for candidate_start in range(0, len(candidates), CANDIDATE_BLOCK_SIZE):
+        block_candidates = candidates[candidate_start:candidate_start + CANDIDATE_BLOCK_SIZE]
+        active = np.arange(len(block_candidates))
+        mismatches = np.zeros(len(block_candidates), dtype=np.int64)
+        shared_loci = np.zeros(len(block_candidates), dtype=np.int64)
+        for locus_start in range(0, num_loci, LOCUS_BLOCK_SIZE):
+            locus_end = min(locus_start + LOCUS_BLOCK_SIZE, num_loci)
+            # Only read the loci in this block, for the candidates that haven't been abandoned yet.
+            active_profiles = np.asarray(profiles[:, locus_start:locus_end])[block_candidates[active]]
+            both_called = (active_profiles != distance.MISSING_ALLELE_CODE) & query_called[locus_start:locus_end]
+            mismatches[active] += np.count_nonzero(both_called & (active_profiles != query_profile[locus_start:locus_end]), axis=1)
+            shared_loci[active] += np.count_nonzero(both_called, axis=1)
+            if max_distance is not None:
+                active = active[mismatches[active] <= max_distance]
+                if len(active) == 0:
+                    break
+        result_indices.append(block_candidates[active])
+        result_distances.append(mismatches[active])
+        result_shared_loci.append(shared_loci[active])
+
+    if not result_indices:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    return np.concatenate(result_indices), np.concatenate(result_distances), np.concatenate(result_shared_loci)
+
+
+def query_profile_store(store, allele_ids_by_locus_id, k=10, max_distance=None, exclude_sample_id=None, allele_index=None):
+    """
+    Find the stored profiles nearest to a query profile.
+
+    If max_distance is given, all profiles within max_distance are returned. Otherwise the k nearest
+    profiles are returned. To find them, the query is first compared against a small seed set of likely
+    neighbours (see find_seed_candidates). The k-th smallest distance in the
+    seed set bounds the distance to the true k nearest profiles, and is used as the threshold for a full
+    search. Ties are broken by the order that samples were added to the store.
+
+    :param store: The profile store
+    :type store: profile_store.ProfileStore
+    :param allele_ids_by_locus_id: The query's allele IDs, indexed by locus ID
+    :type allele_ids_by_locus_id: dict[str, str]
+    :param k: The number of nearest profiles to return, if max_distance is None
+    :type k: int
+    :param max_distance: Return all profiles within this distance
+    :type max_distance: int|None
+    :param exclude_sample_id: Don't return the stored profile with this sample ID (eg. the query itself)
+    :type exclude_sample_id: str|None
+    :param allele_index: The allele index (default: loaded from the store, if it has one)
+    :type allele_index: dict|None
+    :return: The nearest profiles, ordered by distance. Keys are: 'sample_id', 'distance', 'shared_loci'
+    :rtype: list[dict]
+    """
+    store.refresh()
+    if allele_index is None:
+        allele_index = load_allele_index(store)
+    profiles = store.profiles
+    num_samples = store.num_samples
+    num_indexed_samples = allele_index['num_samples'] if allele_index is not None else 0
+    query_profile = store.encode_profile(allele_ids_by_locus_id)
+    if allele_index is not None and num_samples > num_indexed_samples:
+        logging.debug(f"{num_samples - num_indexed_samples} samples in profile store are not covered by the allele index")
+
+    def search(search_max_distance):
+        candidates = None
+        if allele_index is not None and search_max_distance is not None:
+            candidates = find_candidates(query_profile, allele_index, search_max_distance)
+        if candidates is None:
+            candidates = np.arange(num_samples, dtype=np.int64)
+        else:
+            candidates = np.concatenate([candidates, np.arange(num_indexed_samples, num_samples, dtype=np.int64)])
+        if exclude_sample_id is not None and exclude_sample_id in store.sample_positions:
+            candidates = candidates[candidates != store.sample_positions[exclude_sample_id]]
+
+        return calculate_candidate_distances(query_profile, profiles, candidates, search_max_distance)
+
+    if max_distance is not None:
+        indices, distances, shared_loci = search(max_distance)
+    else:
+        seed_candidates = None
+        if allele_index is not None:
+            seed_candidates = find_seed_candidates(query_profile, allele_index, KNN_SEED_SIZE)
+        if seed_candidates is None or len(seed_candidates) < k:
+            seed_candidates = np.arange(min(num_samples, KNN_SEED_SIZE), dtype=np.int64)
+        # The fallback seeds can overlap the samples that the index doesn't cover. Each sample must only be
+        # counted once, or the k-th smallest seed distance can be smaller than the true k-th nearest distance.
+        seed_candidates = np.unique(np.concatenate([seed_candidates, np.arange(num_indexed_samples, num_samples, dtype=np.int64)]))
+        if exclude_sample_id is not None and exclude_sample_id in store.sample_positions:
+            seed_candidates = seed_candidates[seed_candidates != store.sample_positions[exclude_sample_id]]
+        _, seed_distances, _ = calculate_candidate_distances(query_profile, profiles, seed_candidates)
+        search_max_distance = None
+        if len(seed_distances) >= k:
+            search_max_distance = int(np.partition(seed_distances, k - 1)[k - 1])
+        indices, distances, shared_loci = search(search_max_distance)
+
+    order = np.lexsort((indices, distances))
+    if max_distance is None:
+        order = order[:k]
+    nearest = []
+    for idx in order.tolist():
+        nearest.append({
+            'sample_id': store.sample_ids[indices[idx]],
+            'distance': int(distances[idx]),
+            'shared_loci': int(shared_loci[idx]),
+        })
+
+    return nearest
+
+
+def write_nearest_profiles(nearest_profiles, nearest_profiles_file):
+    """
+    Write the nearest profiles to a CSV file.
+
+    :param nearest_profiles: The nearest profiles, as returned by query_profile_store
+    :type nearest_profiles: list[dict]
+    :param nearest_profiles_file: The path to the output file
+    :type nearest_profiles_file: str
+    :return: None
+    """
+    output_fieldnames = [
+        'sample_id',
+        'distance',
+        'shared_loci',
+    ]
+    with open(nearest_profiles_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=output_fieldnames, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+        writer.writeheader()
+        for nearest_profile in nearest_profiles:
+            writer.writerow(nearest_profile)
@@ -0,0 +1,90 @@
+import typing
+
+
+class KmaHit(typing.NamedTuple):
+    """
+    A hit from a kma result (.res) file. Numeric fields that can't be parsed are None.
+    """
+    template: str
+    locus_id: str
+    allele_id: str
+    score: typing.Optional[int] = None
+    expected: typing.Optional[int] = None
+    template_length: typing.Optional[int] = None
+    template_identity: typing.Optional[float] = None
+    template_coverage: typing.Optional[float] = None
+    query_identity: typing.Optional[float] = None
+    query_coverage: typing.Optional[float] = None
+    depth: typing.Optional[float] = None
+    q_value: typing.Optional[float] = None
+    p_value: typing.Optional[float] = None
+
+
+class MapstatRecord(typing.NamedTuple):
+    """
+    A row from a kma mapstat file. Numeric fields that can't be parsed are None.
+    """
+    ref_sequence: str
+    locus_id: str
+    allele_id: str
+    read_count: typing.Optional[int] = None
+    fragment_count: typing.Optional[int] = None
+    map_score_sum: typing.Optional[int] = None
+    ref_covered_positions: typing.Optional[int] = None
+    ref_consensus_sum: typing.Optional[int] = None
+    bp_total: typing.Optional[int] = None
+    depth_variance: typing.Optional[float] = None
+    nuc_high_depth_variance: typing.Optional[int] = None
+    depth_max: typing.Optional[int] = None
+    snp_sum: typing.Optional[int] = None
+    insert_sum: typing.Optional[int] = None
+    deletion_sum: typing.Optional[int] = None
+    read_count_aln: typing.Optional[int] = None
+    fragment_count_aln: typing.Optional[int] = None
+
+
+class AlleleCall(typing.NamedTuple):
+    """
+    The allele call for a locus. allele_id is "-" if the locus was not called. The other fields
+    describe the best hit for the locus (template is None for calls read back from allele_calls.csv).
+    The read and variant counts are taken from the best hit's kma mapstat row, and are None if it has none
+    (eg. for exact matches in an assembly).
+
+    Allele calls are immutable. Use _replace to make a modified copy (eg. to assign a novel allele ID).
+    """
+    locus_id: str
+    allele_id: str
+    score: typing.Optional[int] = None
+    template_length: typing.Optional[int] = None
+    percent_identity: typing.Optional[float] = None
+    percent_coverage: typing.Optional[float] = None
+    depth: typing.Optional[float] = None
+    template: typing.Optional[str] = None
+    read_count: typing.Optional[int] = None
+    fragment_count: typing.Optional[int] = None
+    snp_sum: typing.Optional[int] = None
+    insert_sum: typing.Optional[int] = None
+    deletion_sum: typing.Optional[int] = None
+    depth_variance: typing.Optional[float] = None
+
+
+# Fields of AlleleCall that are taken from the best hit's kma mapstat row (named as in MapstatRecord), in order.
+ALLELE_CALL_MAPSTAT_FIELDS = [
+    'read_count',
+    'fragment_count',
+    'snp_sum',
+    'insert_sum',
+    'deletion_sum',
+    'depth_variance',
+]
+
+# Columns of allele_calls.csv, in order.
+ALLELE_CALL_FIELDNAMES = [
+    'locus_id',
+    'allele_id',
+    'score',
+    'template_length',
+    'percent_identity',
+    'percent_coverage',
+    'depth',
+] + ALLELE_CALL_MAPSTAT_FIELDS
@@ -0,0 +1,266 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+SCHEME_INDEX_VERSION = 1
+
+_scheme_index_cache = {}
+_scheme_index_cache_lock = threading.Lock()
+
+
+def get_names_file(scheme_path):
+    """
+    Get the path to the kma index .name file for a scheme.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :return: The path to the .name file
+    :rtype: str
+    """
+    return f"{scheme_path}.name"
+
+
+def get_scheme_index_file(scheme_path):
+    """
+    Get the path to the cached scheme index, which is stored next to the kma index.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :return: The path to the scheme index file
+    :rtype: str
+    """
+    return f"{scheme_path}.core-typer-index.npz"
+
+
+def get_lengths_file(scheme_path):
+    """
+    Get the path to the kma index .length.b file for a scheme, which holds the length of each template.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :return: The path to the .length.b file
+    :rtype: str
+    """
+    return f"{scheme_path}.length.b"
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Calculate the sha1 hash of a file's contents.
+
+    :param path: The path to the file
+    :type path: str
+    :param chunk_size: Number of bytes to read at a time
+    :type chunk_size: int
+    :return: The hex digest of the file's sha1 hash
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def build_scheme_index(names_file):
+    """
+    Build a scheme index from a kma index .name file, in a single pass.
+
+    :param names_file: The path to the kma index .name file
+    :type names_file: str
+    :return: The scheme index. Keys are: 'locus_ids' (loci in the order that they first appear in the .name file),
+             'locus_positions' (position of each locus in locus_ids), 'allele_counts' (number of alleles per locus)
+    :rtype: dict
+    """
+    allele_counts = {}
+    with open(names_file, 'r') as f:
+        for line in f:
+            locus_id = line.strip().split('_')[0]
+            allele_counts[locus_id] = allele_counts.get(locus_id, 0) + 1
+
+    scheme_index = _make_scheme_index(list(allele_counts), list(allele_counts.values()))
+
+    return scheme_index
+
+
+def _make_scheme_index(locus_ids, allele_counts):
+    scheme_index = {
+        'locus_ids': locus_ids,
+        'locus_positions': {locus_id: position for position, locus_id in enumerate(locus_ids)},
+        'allele_counts': dict(zip(locus_ids, allele_counts)),
+    }
+
+    return scheme_index
+
+
+def write_scheme_index(scheme_index, names_file_stat, names_file_hash, scheme_index_file):
+    """
+    Write a scheme index to a compact binary (.npz) file, along with the size, mtime
+    and hash of the .name file it was built from. The file is written to a temporary
+    file and moved into place, so concurrent readers never see a partial index.
+
+    :param scheme_index: The scheme index, as returned by build_scheme_index
+    :type scheme_index: dict
+    :param names_file_stat: The result of os.stat on the .name file
+    :type names_file_stat: os.stat_result
+    :param names_file_hash: The sha1 hash of the .name file
+    :type names_file_hash: str
+    :param scheme_index_file: The path to write the scheme index to
+    :type scheme_index_file: str
+    :return: None
+    """
+    locus_ids = scheme_index['locus_ids']
+    locus_ids_bytes = '\n'.join(locus_ids).encode('utf-8')
+    allele_counts = np.array([scheme_index['allele_counts'][locus_id] for locus_id in locus_ids], dtype=np.uint32)
+    metadata = np.array([SCHEME_INDEX_VERSION, names_file_stat.st_size, names_file_stat.st_mtime_ns], dtype=np.int64)
+
+    scheme_index_dir = os.path.dirname(os.path.abspath(scheme_index_file))
+    fd, tmp_path = tempfile.mkstemp(dir=scheme_index_dir, prefix='.core-typer-index-', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(
+                f,
+                metadata=metadata,
+                names_file_hash=np.frombuffer(names_file_hash.encode('ascii'), dtype=np.uint8),
+                locus_ids=np.frombuffer(locus_ids_bytes, dtype=np.uint8),
+                allele_counts=allele_counts,
+            )
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, scheme_index_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_scheme_index(scheme_index_file):
+    """
+    Read a scheme index file.
+
+    :param scheme_index_file: The path to the scheme index file
+    :type scheme_index_file: str
+    :return: The scheme index (see build_scheme_index), and the metadata it was built from. Keys of metadata are:
+             'version', 'names_file_size', 'names_file_mtime_ns', 'names_file_hash'
+    :rtype: tuple[dict, dict]
+    """
+    with np.load(scheme_index_file, allow_pickle=False) as data:
+        version, names_file_size, names_file_mtime_ns = (int(x) for x in data['metadata'])
+        metadata = {
+            'version': version,
+            'names_file_size': names_file_size,
+            'names_file_mtime_ns': names_file_mtime_ns,
+            'names_file_hash': data['names_file_hash'].tobytes().decode('ascii'),
+        }
+        locus_ids_bytes = data['locus_ids'].tobytes()
+        allele_counts = data['allele_counts'].tolist()
+
+    locus_ids = locus_ids_bytes.decode('utf-8').split('\n') if locus_ids_bytes else []
+    scheme_index = _make_scheme_index(locus_ids, allele_counts)
+
+    return scheme_index, metadata
+
+
+def estimate_scheme_length(scheme_path):
+    """
+    Estimate the total length of a scheme, as the sum over all loci of the mean allele length.
+
+    Template lengths are read from the kma index .length.b file, which holds the number of
+    templates as a 32-bit int, followed by the length of each template (in .name file order)
+    as 32-bit ints. kma numbers templates from 1, so the count may include an unused first slot.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :return: The estimated scheme length, in bp
+    :rtype: int
+    :raises ValueError: If the number of template lengths doesn't match the number of templates in the .name file
+    """
+    names_file = get_names_file(scheme_path)
+    locus_positions = load_scheme_index(scheme_path)['locus_positions']
+    with open(names_file, 'r') as f:
+        template_locus_positions = np.array([locus_positions[line.strip().split('_')[0]] for line in f if line.strip()], dtype=np.int64)
+
+    lengths_file = get_lengths_file(scheme_path)
+    with open(lengths_file, 'rb') as f:
+        num_templates = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+        template_lengths = np.fromfile(f, dtype=np.int32, count=num_templates)
+    if len(template_lengths) == len(template_locus_positions) + 1:
+        template_lengths = template_lengths[1:]
+    if len(template_lengths) != len(template_locus_positions):
+        raise ValueError(f"Found {len(template_lengths)} template lengths in {lengths_file}, but {len(template_locus_positions)} templates in {names_file}")
+
+    num_loci = len(locus_positions)
+    allele_counts = np.bincount(template_locus_positions, minlength=num_loci)
+    total_allele_lengths = np.bincount(template_locus_positions, weights=template_lengths, minlength=num_loci)
+    mean_allele_lengths = total_allele_lengths[allele_counts > 0] / allele_counts[allele_counts > 0]
+
+    return int(round(mean_allele_lengths.sum()))
+
+
+def load_scheme_index(scheme_path):
+    """
+    Load the scheme index for a kma index, building it if necessary.
+
+    The persisted index is reused as long as the .name file's size and mtime are unchanged.
+    If they have changed, the .name file is hashed, and the index is rebuilt only if the
+    hash has also changed. Loaded indexes are shared within the process, so batch runs
+    don't re-read them for every sample.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :return: The scheme index (see build_scheme_index)
+    :rtype: dict
+    """
+    names_file = get_names_file(scheme_path)
+    names_file_stat = os.stat(names_file)
+    cache_key = os.path.abspath(names_file)
+    names_file_version = (names_file_stat.st_size, names_file_stat.st_mtime_ns)
+    with _scheme_index_cache_lock:
+        if cache_key in _scheme_index_cache:
+            cached_names_file_version, scheme_index = _scheme_index_cache[cache_key]
+            if cached_names_file_version == names_file_version:
+                return scheme_index
+
+        scheme_index = _load_or_build_scheme_index(scheme_path, names_file, names_file_stat)
+        _scheme_index_cache[cache_key] = (names_file_version, scheme_index)
+
+    return scheme_index
+
+
+def _load_or_build_scheme_index(scheme_path, names_file, names_file_stat):
+    scheme_index_file = get_scheme_index_file(scheme_path)
+    names_file_hash = None
+    if os.path.exists(scheme_index_file):
+        try:
+            scheme_index, metadata = read_scheme_index(scheme_index_file)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Unable to read scheme index: {scheme_index_file} ({e})")
+        else:
+            if metadata['version'] == SCHEME_INDEX_VERSION:
+                if metadata['names_file_size'] == names_file_stat.st_size and metadata['names_file_mtime_ns'] == names_file_stat.st_mtime_ns:
+                    logging.debug(f"Loaded scheme index: {scheme_index_file}")
+                    return scheme_index
+                names_file_hash = hash_file(names_file)
+                if metadata['names_file_hash'] == names_file_hash:
+                    logging.debug(f"Loaded scheme index: {scheme_index_file} (.name file touched but unchanged)")
+                    _try_write_scheme_index(scheme_index, names_file_stat, names_file_hash, scheme_index_file)
+                    return scheme_index
+
+    logging.info(f"Building scheme index from: {names_file}")
+    if names_file_hash is None:
+        names_file_hash = hash_file(names_file)
+    scheme_index = build_scheme_index(names_file)
+    _try_write_scheme_index(scheme_index, names_file_stat, names_file_hash, scheme_index_file)
+
+    return scheme_index
+
+
+def _try_write_scheme_index(scheme_index, names_file_stat, names_file_hash, scheme_index_file):
+    try:
+        write_scheme_index(scheme_index, names_file_stat, names_file_hash, scheme_index_file)
+        logging.debug(f"Wrote scheme index: {scheme_index_file}")
+    except OSError as e:
+        logging.warning(f"Unable to write scheme index: {scheme_index_file} ({e})")
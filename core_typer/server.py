@@ -0,0 +1,370 @@
+import asyncio
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import os
+import signal
+
+from . import pipeline
+from . import scheme
+from . import utils
+
+# Job parameters that can be set per job. Everything else (eg. the scheme) is fixed when the server starts.
+JOB_PARAMS = [
+    'sample_id',
+    'R1',
+    'R2',
+    'outdir',
+    'min_identity',
+    'min_coverage',
+    'target_depth',
+    'genome_size',
+    'novel_alleles',
+    'metrics_json',
+]
+
+REQUIRED_JOB_PARAMS = [
+    'R1',
+    'R2',
+    'outdir',
+]
+
+# Job parameters that are paths the job writes to. They must be inside the server's output root.
+OUTPUT_PATH_JOB_PARAMS = [
+    'outdir',
+    'metrics_json',
+]
+
+LOOPBACK_HOSTS = [
+    '127.0.0.1',
+    '::1',
+    'localhost',
+]
+
+DEFAULT_KMA_SHM_LEVEL = 1
+
+
+def resolve_output_path(path, output_root):
+    """
+    Resolve an output path given in a job, which must be inside the server's output root.
+
+    :param path: The output path. Relative paths are relative to the output root
+    :type path: str
+    :param output_root: The server's output root, as returned by os.path.realpath
+    :type output_root: str
+    :return: The resolved output path
+    :rtype: str
+    :raises ValueError: If the path is not inside the output root
+    """
+    if not isinstance(path, str):
+        raise ValueError(f"Invalid output path: {path!r}")
+    resolved_path = os.path.realpath(os.path.join(output_root, path))
+    if os.path.commonpath([output_root, resolved_path]) != output_root:
+        raise ValueError(f"Output path is outside the server's output root ({output_root}): {path}")
+
+    return resolved_path
+
+
+def load_kma_shared_memory(scheme_path, shm_level=DEFAULT_KMA_SHM_LEVEL):
+    """
+    Load a kma index into shared memory (kma shm), so that kma runs using it don't each load the index.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :param shm_level: The kma shared memory level (see kma shm -h)
+    :type shm_level: int
+    :return: Whether the index was loaded
+    :rtype: bool
+    """
+    try:
+        utils.run_command(["kma", "shm", "-t_db", scheme_path, "-shmLvl", str(shm_level)], exit_on_failure=False)
+    except Exception as e:
+        logging.warning(f"Unable to load kma index into shared memory: {scheme_path} ({e!r}). kma will load the index for each job.")
+        return False
+    logging.info(f"Loaded kma index into shared memory: {scheme_path}")
+
+    return True
+
+
+def release_kma_shared_memory(scheme_path, shm_level=DEFAULT_KMA_SHM_LEVEL):
+    """
+    Release a kma index loaded into shared memory by load_kma_shared_memory.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :param shm_level: The kma shared memory level used to load the index
+    :type shm_level: int
+    :return: None
+    """
+    try:
+        utils.run_command(["kma", "shm", "-t_db", scheme_path, "-shmLvl", str(shm_level), "-destroy"], exit_on_failure=False)
+        logging.info(f"Released kma index from shared memory: {scheme_path}")
+    except Exception as e:
+        logging.warning(f"Unable to release kma index from shared memory: {scheme_path} ({e!r})")
+
+
+class TypingServer(object):
+    """
+    A long-lived typing service. The scheme index is loaded once, and (where kma supports it) the
+    kma index is kept in shared memory, so jobs don't pay for loading either.
+
+    Clients connect over a unix socket or TCP, and send jobs as JSON objects, one per line. Each job
+    is acknowledged with a 'queued' message, and jobs are run from a queue, at most max_concurrent_jobs
+    at a time. A 'completed' or 'failed' message is sent to the client as soon as each job finishes,
+    so results stream back in the order that jobs complete. Messages are JSON objects, one per line.
+
+    A job is an object with keys from JOB_PARAMS ('R1', 'R2' and 'outdir' are required), plus an
+    optional 'job_id' (default: assigned by the server). An object with 'action': 'status' gets the
+    number of queued and running jobs. Jobs whose output paths (see OUTPUT_PATH_JOB_PARAMS) are outside
+    the server's output root fail without being queued. Clients are not authenticated.
+    """
+    def __init__(self, params, max_concurrent_jobs=1, output_root=None):
+        """
+        :param params: Default typing parameters, as for pipeline.run_typing. Must include 'scheme'
+        :type params: dict
+        :param max_concurrent_jobs: Maximum number of jobs to run at once
+        :type max_concurrent_jobs: int
+        :param output_root: Directory that jobs' output paths must be inside (default: the current directory)
+        :type output_root: str|None
+        """
+        self.params = params
+        self.max_concurrent_jobs = max(1, max_concurrent_jobs)
+        self.output_root = os.path.realpath(output_root or os.getcwd())
+        self.job_ids = itertools.count(1)
+        self.queue = None
+        self.num_running_jobs = 0
+        self.executor = None
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        """
+        Run the server until it receives SIGINT or SIGTERM. Queued and running jobs are finished before it stops.
+
+        :param socket_path: Path to a unix socket to listen on
+        :type socket_path: str|None
+        :param host: Host to listen on, if port is given
+        :type host: str
+        :param port: TCP port to listen on
+        :type port: int|None
+        :return: None
+        :raises ValueError: If neither a socket path nor a port is given
+        """
+        if socket_path is None and port is None:
+            raise ValueError("A unix socket path or TCP port is required")
+
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_jobs)
+        workers = [asyncio.create_task(self._run_worker()) for _ in range(self.max_concurrent_jobs)]
+
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signal_number, stop_event.set)
+
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self._handle_connection, path=socket_path)
+            logging.info(f"Listening on unix socket: {socket_path}")
+        else:
+            server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+            logging.info(f"Listening on {host}:{port}")
+
+        try:
+            async with server:
+                await stop_event.wait()
+                logging.info("Stopping server. Waiting for queued jobs to finish")
+                server.close()
+                await self.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.executor.shutdown(wait=True)
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+    async def _handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+
+        async def send(message):
+            async with write_lock:
+                if writer.is_closing():
+                    return
+                writer.write((json.dumps(message) + '\n').encode('utf-8'))
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+        pending_reports = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request must be a JSON object")
+                except ValueError as e:
+                    await send({'event': 'error', 'error': f"Invalid request: {e}"})
+                    continue
+
+                if request.get('action') == 'status':
+                    await send({'event': 'status', 'queued_jobs': self.queue.qsize(), 'running_jobs': self.num_running_jobs})
+                    continue
+
+                job_id = str(request.get('job_id') or next(self.job_ids))
+                missing_params = [param for param in REQUIRED_JOB_PARAMS if not request.get(param)]
+                if missing_params:
+                    await send({'event': 'failed', 'job_id': job_id, 'error': f"Missing required job parameters: {', '.join(missing_params)}"})
+                    continue
+                job_params = {param: request[param] for param in JOB_PARAMS if param in request}
+                try:
+                    for param in OUTPUT_PATH_JOB_PARAMS:
+                        if job_params.get(param):
+                            job_params[param] = resolve_output_path(job_params[param], self.output_root)
+                except ValueError as e:
+                    await send({'event': 'failed', 'job_id': job_id, 'error': str(e)})
+                    continue
+                job = {
+                    'job_id': job_id,
+                    'params': job_params,
+                    'done': asyncio.get_running_loop().create_future(),
+                }
+                await self.queue.put(job)
+                logging.info(f"Queued job {job_id}")
+                await send({'event': 'queued', 'job_id': job_id, 'queued_jobs': self.queue.qsize()})
+                pending_reports.append(asyncio.create_task(self._report_job(job, send)))
+
+            # Keep the connection open until all of this client's jobs have finished and been reported.
+            await asyncio.gather(*pending_reports)
+        finally:
+            async with write_lock:
+                writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _report_job(self, job, send):
+        await send(await job['done'])
+
+    async def _run_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.num_running_jobs += 1
+            try:
+                message = await loop.run_in_executor(self.executor, self.run_job, job['job_id'], job['params'])
+            finally:
+                self.num_running_jobs -= 1
+                self.queue.task_done()
+            job['done'].set_result(message)
+
+    def run_job(self, job_id, job_params):
+        """
+        Run a typing job. Failures are reported in the result, rather than raised.
+
+        :param job_id: The job ID
+        :type job_id: str
+        :param job_params: The job parameters (see JOB_PARAMS). These override the server's default typing parameters
+        :type job_params: dict
+        :return: The job result. Keys are: 'event' ('completed' or 'failed'), 'job_id', 'elapsed_seconds', plus 'result'
+                 (paths to the output files and the QC stats, as returned by pipeline.run_typing) or 'error'
+        :rtype: dict
+        """
+        typing_params = dict(self.params)
+        typing_params.update(job_params)
+        typing_params['exit_on_failure'] = False
+        logging.info(f"Job {job_id} started")
+        start_timestamp = datetime.datetime.now()
+        message = {
+            'event': None,
+            'job_id': job_id,
+            'elapsed_seconds': None,
+        }
+        try:
+            message['result'] = pipeline.run_typing(typing_params)
+            message['event'] = 'completed'
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e!r}")
+            message['event'] = 'failed'
+            message['error'] = repr(e)
+        elapsed_time = datetime.datetime.now() - start_timestamp
+        message['elapsed_seconds'] = round(elapsed_time.total_seconds(), 2)
+        logging.info(f"Job {job_id} {message['event']}. Elapsed time: {message['elapsed_seconds']} seconds.")
+
+        return message
+
+
+def run_server(params, socket_path=None, host='127.0.0.1', port=None, max_concurrent_jobs=1, kma_shm=True, output_root=None):
+    """
+    Load the scheme and run a typing server until it is stopped.
+
+    :param params: Default typing parameters, as for pipeline.run_typing. Must include 'scheme'
+    :type params: dict
+    :param socket_path: Path to a unix socket to listen on
+    :type socket_path: str|None
+    :param host: Host to listen on, if port is given
+    :type host: str
+    :param port: TCP port to listen on
+    :type port: int|None
+    :param max_concurrent_jobs: Maximum number of jobs to run at once
+    :type max_concurrent_jobs: int
+    :param kma_shm: Load the kma index into shared memory, if kma supports it
+    :type kma_shm: bool
+    :param output_root: Directory that jobs' output paths must be inside (default: the current directory)
+    :type output_root: str|None
+    :return: None
+    """
+    scheme_index = scheme.load_scheme_index(params['scheme'])
+    logging.info(f"Loaded scheme index: {params['scheme']} ({len(scheme_index['locus_ids'])} loci)")
+    params = dict(params)
+    if kma_shm and params.get('scheme_shards'):
+        logging.info("Aligning against scheme shards. Not loading the kma index into shared memory")
+        kma_shm = False
+    shm_loaded = kma_shm and load_kma_shared_memory(params['scheme'])
+    if shm_loaded:
+        params['kma_shm'] = DEFAULT_KMA_SHM_LEVEL
+    try:
+        typing_server = TypingServer(params, max_concurrent_jobs=max_concurrent_jobs, output_root=output_root)
+        asyncio.run(typing_server.serve(socket_path=socket_path, host=host, port=port))
+    finally:
+        if shm_loaded:
+            release_kma_shared_memory(params['scheme'])
+
+
+async def submit_jobs(jobs, socket_path=None, host='127.0.0.1', port=None):
+    """
+    Submit jobs to a typing server, and yield the server's messages as they arrive, until every job has finished.
+
+    :param jobs: The jobs (see TypingServer)
+    :type jobs: list[dict]
+    :param socket_path: Path to the server's unix socket
+    :type socket_path: str|None
+    :param host: The server's host, if port is given
+    :type host: str
+    :param port: The server's TCP port
+    :type port: int|None
+    :return: The server's messages
+    :rtype: AsyncIterator[dict]
+    """
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for job in jobs:
+            writer.write((json.dumps(job) + '\n').encode('utf-8'))
+        await writer.drain()
+        writer.write_eof()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            yield json.loads(line)
+    finally:
+        writer.close()
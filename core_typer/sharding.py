@@ -0,0 +1,366 @@
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import subprocess
+
+from . import alignment
+from . import scheme
+from . import utils
+
+SHARD_MANIFEST_FILENAME = 'shards.json'
+SHARD_MANIFEST_VERSION = 1
+
+MERGED_OUTPUT_EXTENSIONS = [
+    'res',
+    'mapstat',
+    'aln',
+]
+
+
+def get_shard_manifest_file(shards_dir):
+    """
+    Get the path to the shard manifest in a scheme shards directory.
+
+    :param shards_dir: The scheme shards directory, as created by build_scheme_shards
+    :type shards_dir: str
+    :return: The path to the shard manifest
+    :rtype: str
+    """
+    return os.path.join(shards_dir, SHARD_MANIFEST_FILENAME)
+
+
+def iter_fasta(fasta_path):
+    """
+    Iterate over the records in a FASTA file.
+
+    :param fasta_path: The path to the FASTA file
+    :type fasta_path: str
+    :return: The FASTA records, as tuples of (header without '>', sequence)
+    :rtype: Iterator[tuple[str, str]]
+    """
+    header = None
+    sequence_lines = []
+    with open(fasta_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(sequence_lines)
+                header = line[1:].split()[0]
+                sequence_lines = []
+            elif line:
+                sequence_lines.append(line)
+    if header is not None:
+        yield header, ''.join(sequence_lines)
+
+
+def partition_loci(locus_ids, locus_sizes, num_shards):
+    """
+    Partition loci into contiguous, locus-disjoint shards of roughly equal total size.
+    Loci keep their scheme order, so concatenating the shards gives back the scheme.
+
+    :param locus_ids: The locus IDs, in scheme order
+    :type locus_ids: list[str]
+    :param locus_sizes: The size of each locus (eg. total allele length), indexed by locus_id
+    :type locus_sizes: dict[str, int]
+    :param num_shards: The number of shards. Capped at the number of loci
+    :type num_shards: int
+    :return: The locus IDs in each shard
+    :rtype: list[list[str]]
+    :raises ValueError: If num_shards is less than 1
+    """
+    if num_shards < 1:
+        raise ValueError(f"Number of shards must be at least 1: {num_shards}")
+    num_shards = min(num_shards, len(locus_ids))
+    total_size = sum(locus_sizes.get(locus_id, 0) for locus_id in locus_ids)
+    shards = []
+    shard = []
+    cumulative_size = 0
+    for locus_idx, locus_id in enumerate(locus_ids):
+        shard.append(locus_id)
+        cumulative_size += locus_sizes.get(locus_id, 0)
+        num_loci_remaining = len(locus_ids) - locus_idx - 1
+        num_shards_remaining = num_shards - len(shards) - 1
+        # Close the shard once it reaches its share of the total size, keeping at least one locus for each remaining shard.
+        shard_full = cumulative_size * num_shards >= total_size * (len(shards) + 1)
+        if num_shards_remaining > 0 and (shard_full or num_loci_remaining == num_shards_remaining):
+            shards.append(shard)
+            shard = []
+    if shard:
+        shards.append(shard)
+
+    return shards
+
+
+def build_scheme_shards(scheme_path, num_shards, shards_dir, fasta_path=None):
+    """
+    Split a scheme into locus-disjoint kma indexes (shards), which can be aligned against concurrently.
+
+    Allele sequences are taken from fasta_path if given, otherwise they are extracted from the
+    kma index with `kma seq2fasta`. Each shard is indexed with `kma index`, and a manifest
+    (shards.json) records the shards and the .name file hash of the scheme they were built from.
+    Shard paths in the manifest are relative to the shards directory, so it can be moved or shared.
+
+    :param scheme_path: The path to the kma index (as passed to kma -t_db)
+    :type scheme_path: str
+    :param num_shards: The number of shards
+    :type num_shards: int
+    :param shards_dir: The directory to write the shards and manifest to (created if it does not exist)
+    :type shards_dir: str
+    :param fasta_path: A FASTA file of all alleles in the scheme, with headers '<locus_id>_<allele_id>'
+    :type fasta_path: str|None
+    :return: The shard manifest (see load_shard_manifest)
+    :rtype: dict
+    :raises ValueError: If the allele sequences don't match the scheme's .name file
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    scheme_index = scheme.load_scheme_index(scheme_path)
+    extracted_fasta = fasta_path is None
+    if extracted_fasta:
+        fasta_path = os.path.join(shards_dir, 'scheme.fasta')
+        logging.info(f"Extracting allele sequences from kma index: {scheme_path}")
+        with open(fasta_path, 'w') as f:
+            subprocess.run(["kma", "seq2fasta", "-t_db", scheme_path], stdout=f, check=True)
+
+    locus_sizes = {}
+    for header, sequence in iter_fasta(fasta_path):
+        locus_id = header.split('_')[0]
+        if locus_id not in scheme_index['locus_positions']:
+            raise ValueError(f"Allele {header} in {fasta_path} is not in scheme: {scheme_path}")
+        locus_sizes[locus_id] = locus_sizes.get(locus_id, 0) + len(sequence)
+    missing_locus_ids = [locus_id for locus_id in scheme_index['locus_ids'] if locus_id not in locus_sizes]
+    if missing_locus_ids:
+        raise ValueError(f"No alleles found in {fasta_path} for {len(missing_locus_ids)} loci, eg. {missing_locus_ids[0]}")
+
+    locus_shards = partition_loci(scheme_index['locus_ids'], locus_sizes, num_shards)
+    shard_positions = {locus_id: shard_idx for shard_idx, shard_locus_ids in enumerate(locus_shards) for locus_id in shard_locus_ids}
+    shard_names = [f"shard-{shard_idx + 1:03d}" for shard_idx in range(len(locus_shards))]
+    shard_fasta_files = []
+    try:
+        for shard_name in shard_names:
+            shard_fasta_files.append(open(os.path.join(shards_dir, f"{shard_name}.fasta"), 'w'))
+        for header, sequence in iter_fasta(fasta_path):
+            shard_fasta_file = shard_fasta_files[shard_positions[header.split('_')[0]]]
+            shard_fasta_file.write(f">{header}\n{sequence}\n")
+    finally:
+        for shard_fasta_file in shard_fasta_files:
+            shard_fasta_file.close()
+
+    shard_manifest = {
+        'version': SHARD_MANIFEST_VERSION,
+        'scheme_names_file_hash': scheme.hash_file(scheme.get_names_file(scheme_path)),
+        'shards': [],
+    }
+    for shard_name, shard_locus_ids in zip(shard_names, locus_shards):
+        shard_fasta_path = os.path.join(shards_dir, f"{shard_name}.fasta")
+        logging.info(f"Indexing scheme shard {shard_name} ({len(shard_locus_ids)} loci)")
+        utils.run_command(["kma", "index", "-i", shard_fasta_path, "-o", os.path.join(shards_dir, shard_name)])
+        os.remove(shard_fasta_path)
+        shard_manifest['shards'].append({
+            'name': shard_name,
+            'num_loci': len(shard_locus_ids),
+            'first_locus_id': shard_locus_ids[0],
+            'last_locus_id': shard_locus_ids[-1],
+            'total_allele_length': sum(locus_sizes[locus_id] for locus_id in shard_locus_ids),
+        })
+    if extracted_fasta:
+        os.remove(fasta_path)
+
+    shard_manifest_file = get_shard_manifest_file(shards_dir)
+    with open(shard_manifest_file, 'w') as f:
+        json.dump(shard_manifest, f, indent=2)
+    logging.info(f"Wrote shard manifest: {shard_manifest_file}")
+
+    return load_shard_manifest(shards_dir, scheme_path)
+
+
+def load_shard_manifest(shards_dir, scheme_path):
+    """
+    Load the manifest of a scheme shards directory, and check that it was built from the scheme.
+
+    :param shards_dir: The scheme shards directory, as created by build_scheme_shards
+    :type shards_dir: str
+    :param scheme_path: The path to the kma index (as passed to kma -t_db) that the shards should have been built from
+    :type scheme_path: str
+    :return: The shard manifest. Keys are: 'version', 'scheme_names_file_hash', 'shards'. Keys of each shard are: 'name',
+             'path' (the shard's kma index, as passed to kma -t_db), 'num_loci', 'first_locus_id', 'last_locus_id', 'total_allele_length'
+    :rtype: dict
+    :raises ValueError: If the manifest version is not supported, or the shards were built from a different scheme
+    """
+    shard_manifest_file = get_shard_manifest_file(shards_dir)
+    with open(shard_manifest_file, 'r') as f:
+        shard_manifest = json.load(f)
+    if shard_manifest.get('version') != SHARD_MANIFEST_VERSION:
+        raise ValueError(f"Unsupported shard manifest version {shard_manifest.get('version')}: {shard_manifest_file}")
+    names_file_hash = scheme.hash_file(scheme.get_names_file(scheme_path))
+    if shard_manifest['scheme_names_file_hash'] != names_file_hash:
+        raise ValueError(f"Scheme shards in {shards_dir} were not built from scheme: {scheme_path}. Rebuild them with `core-typer shard-scheme`")
+    for shard in shard_manifest['shards']:
+        shard['path'] = os.path.join(shards_dir, shard['name'])
+
+    return shard_manifest
+
+
+def _merge_header_lines(shard_header_lines, database=None):
+    """
+    Merge the header lines of one kma output file from each shard.
+
+    Column header lines ('#' followed by column names) are the same for every shard, and are taken from the first.
+    The '## key value' lines in .mapstat files describe each shard's own kma run, so they are combined: fragmentCount
+    (the number of fragments that mapped to the shard) is summed over the shards, database is set to the unsharded scheme,
+    and other keys are kept only if every shard has the same value (so command, which names the shard's index, is dropped).
+
+    :param shard_header_lines: The header lines of each shard's output file, in shard order
+    :type shard_header_lines: list[list[str]]
+    :param database: The unsharded scheme, to record as the database (default: keep the first shard's, if it is the same for every shard)
+    :type database: str|None
+    :return: The merged header lines
+    :rtype: list[str]
+    """
+    shard_metadata = []
+    for header_lines in shard_header_lines:
+        metadata = {}
+        for line in header_lines:
+            if line.startswith('##'):
+                key, _, value = line[2:].strip().partition('\t')
+                metadata[key.strip()] = value.strip()
+        shard_metadata.append(metadata)
+
+    merged_header_lines = []
+    for line in shard_header_lines[0] if shard_header_lines else []:
+        if not line.startswith('##'):
+            merged_header_lines.append(line)
+            continue
+        key = line[2:].strip().partition('\t')[0].strip()
+        values = [metadata.get(key) for metadata in shard_metadata]
+        if key == 'database' and database is not None:
+            value = database
+        elif key == 'fragmentCount' and all(value is not None and value.isdigit() for value in values):
+            value = str(sum(int(value) for value in values))
+        elif all(value == values[0] for value in values):
+            value = values[0]
+        else:
+            continue
+        merged_header_lines.append(f"## {key}\t{value}\n")
+
+    return merged_header_lines
+
+
+def merge_shard_outputs(shard_output_paths, output_paths, locus_positions, database=None):
+    """
+    Merge kma outputs from scheme shards into single output files, in the same layout as kma's outputs for the whole scheme.
+
+    Hits in the .res and .mapstat files are ordered by the position of their locus in the scheme, keeping kma's
+    order within each locus (shards are locus-disjoint, so all hits for a locus come from one shard). Header lines
+    are merged as described in _merge_header_lines. Alignments in .aln files are concatenated in shard order.
+
+    Each hit is copied from its shard unchanged. Score, identity, coverage and depth only depend on the reads that were
+    assigned to the hit's template, so allele calls are the same as for an unsharded run, as long as no read matches
+    loci in two shards (kma -1t1 assigns each read to one template per shard, so such a read is counted in both).
+    The .res columns Expected, q_value and p_value depend on the size of the database that was searched, so they are
+    relative to the hit's shard, and differ from an unsharded run. They aren't used for allele calls.
+
+    :param shard_output_paths: The paths to the output files of each shard, indexed by extension, in shard order
+    :type shard_output_paths: list[dict[str, str]]
+    :param output_paths: The paths to write the merged output files to, indexed by extension
+    :type output_paths: dict[str, str]
+    :param locus_positions: The position of each locus in the scheme (see scheme.build_scheme_index)
+    :type locus_positions: dict[str, int]
+    :param database: The unsharded scheme, to record as the database in the merged .mapstat header
+    :type database: str|None
+    :return: None
+    """
+    for extension, output_path in output_paths.items():
+        if extension == 'aln':
+            with open(output_path, 'wb') as output_file:
+                for paths in shard_output_paths:
+                    with open(paths[extension], 'rb') as shard_file:
+                        shutil.copyfileobj(shard_file, output_file)
+            continue
+
+        shard_header_lines = []
+        data_lines = []
+        for paths in shard_output_paths:
+            header_lines = []
+            with open(paths[extension], 'r') as shard_file:
+                for line in shard_file:
+                    if line.startswith('#'):
+                        header_lines.append(line)
+                    elif line.strip():
+                        data_lines.append(line)
+            shard_header_lines.append(header_lines)
+        data_lines.sort(key=lambda line: locus_positions.get(line.split('\t', 1)[0].strip().split('_')[0], len(locus_positions)))
+        with open(output_path, 'w') as output_file:
+            output_file.writelines(_merge_header_lines(shard_header_lines, database=database))
+            output_file.writelines(data_lines)
+
+
+def run_sharded_alignment(alignment_params, shard_manifest, output_parsers=None, output_extensions=None, max_concurrent_shards=None, metrics=None):
+    """
+    Align reads against each scheme shard concurrently, merge the shard outputs, and parse them.
+
+    The thread budget is divided between the concurrently running shards. Shard outputs are always written
+    to files (in the analysis tmpdir), since they are merged before parsing.
+
+    :param alignment_params: Dictionary of parameters, as for alignment.run_alignment. 'scheme' is the unsharded scheme,
+                             and the merged outputs are written where alignment.get_output_paths expects them
+    :type alignment_params: dict
+    :param shard_manifest: The shard manifest, as returned by load_shard_manifest
+    :type shard_manifest: dict
+    :param output_parsers: Parsers for the merged kma output files, indexed by output file extension
+    :type output_parsers: dict[str, Callable[[str], object]]|None
+    :param output_extensions: Extra kma output files to merge (eg. 'aln'), besides those with parsers
+    :type output_extensions: Iterable[str]|None
+    :param max_concurrent_shards: Maximum number of shards to align at once (default: the number of threads)
+    :type max_concurrent_shards: int|None
+    :param metrics: If provided, the resource usage of each shard's kma process is recorded here
+    :type metrics: metrics.Metrics|None
+    :return: The parsed outputs, indexed by output file extension
+    :rtype: dict[str, object]
+    :raises subprocess.CalledProcessError: If kma fails for any shard and exit_on_failure is False
+    """
+    output_parsers = output_parsers or {}
+    shards = shard_manifest['shards']
+    # Each shard's kma gets at least one thread, so by default at most one shard per thread runs at once.
+    num_concurrent_shards = max(1, min(len(shards), max_concurrent_shards or int(alignment_params['threads'])))
+    threads_per_shard = max(1, int(alignment_params['threads']) // num_concurrent_shards)
+    extensions = set(alignment.EXPECTED_OUTPUT_EXTENSIONS) | set(output_parsers) | set(output_extensions or [])
+    extensions = [extension for extension in MERGED_OUTPUT_EXTENSIONS if extension in extensions]
+
+    shard_alignment_params = []
+    for shard in shards:
+        shard_tmpdir = os.path.join(alignment_params['tmpdir'], shard['name'])
+        os.makedirs(shard_tmpdir, exist_ok=True)
+        shard_params = dict(alignment_params)
+        shard_params.update({
+            'scheme': shard['path'],
+            'threads': threads_per_shard,
+            'tmpdir': shard_tmpdir,
+            'io_mode': 'disk',
+            'kma_shm': None,
+        })
+        shard_alignment_params.append(shard_params)
+
+    logging.info(f"Aligning against {len(shards)} scheme shards ({num_concurrent_shards} at a time, {threads_per_shard} threads each)")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_concurrent_shards) as executor:
+        shard_futures = [
+            executor.submit(alignment.run_alignment, shard_params, metrics=metrics, process_name=f"kma_{shard['name']}")
+            for shard, shard_params in zip(shards, shard_alignment_params)
+        ]
+        # Wait for every shard, so no kma process outlives a failure, then re-raise the first error.
+        concurrent.futures.wait(shard_futures)
+        for shard_future in shard_futures:
+            shard_future.result()
+
+    output_paths = alignment.get_output_paths(alignment_params, extensions)
+    shard_output_paths = [alignment.get_output_paths(shard_params, extensions) for shard_params in shard_alignment_params]
+    locus_positions = scheme.load_scheme_index(alignment_params['scheme'])['locus_positions']
+    merge_shard_outputs(shard_output_paths, output_paths, locus_positions, database=alignment_params['scheme'])
+    if metrics is not None:
+        metrics.record_input('num_scheme_shards', len(shards))
+
+    parsed_outputs = {extension: output_parser(output_paths[extension]) for extension, output_parser in output_parsers.items()}
+
+    return parsed_outputs
@@ -1,19 +1,26 @@
+import collections
 import json
 import logging
+import os
 import subprocess
 import sys
+import threading
 
-def validate_args(args, parser):
+def validate_args(args, parser, required_args=('R1', 'R2', 'scheme', 'outdir')):
     """
-    Validate the arguments.
-    
+    Validate the arguments. Print the help message and exit if
+    any of the required arguments are missing.
+
+    :param args: The parsed arguments
+    :type args: argparse.Namespace
+    :param parser: The argument parser
+    :type parser: argparse.ArgumentParser
+    :param required_args: Names of the arguments that must be provided
+    :type required_args: tuple[str]
+    :return: The validated arguments
+    :rtype: argparse.Namespace
     """
-    conditions = [
-        args.R1 is not None,
-        args.R2 is not None,
-        args.scheme is not None,
-        args.outdir is not None,
-    ]
+    conditions = [getattr(args, arg) is not None for arg in required_args]
     all_conditions_met = all(conditions)
     if not all_conditions_met:
         parser.print_help()
@@ -22,25 +29,82 @@ def validate_args(args, parser):
         return args
 
 
-def run_command(command):
+def collect_paths(paths, paths_list_file=None):
+    """
+    Combine paths given on the command line with paths listed in a file (one per line).
+
+    :param paths: Paths given on the command line
+    :type paths: list[str]|None
+    :param paths_list_file: The path to a file listing more paths, one per line. Blank lines are ignored
+    :type paths_list_file: str|None
+    :return: All paths, command line paths first
+    :rtype: list[str]
+    """
+    all_paths = list(paths or [])
+    if paths_list_file is not None:
+        with open(paths_list_file, 'r') as f:
+            for line in f:
+                path = line.strip()
+                if path:
+                    all_paths.append(path)
+
+    return all_paths
+
+
+def _log_stream(stream, log_prefix, tail):
+    for line in stream:
+        line = line.rstrip('\n')
+        tail.append(line)
+        if line:
+            logging.info(f"{log_prefix}: {line}")
+
+
+def run_command(command, exit_on_failure=True, tail_lines=50):
     """
-    Runs a command as a subprocess, and returns the result.
+    Runs a command as a subprocess (without a shell), and returns the result.
 
-    :param command: The command to run
-    :type command: str
-    :return: The result of the command
+    The command's stdout and stderr are streamed to the log line by line as they
+    are produced, rather than being buffered in memory. Only the last few lines of
+    each are kept, for the result and for error reporting.
+
+    :param command: The command to run, as a list of arguments
+    :type command: list[str]
+    :param exit_on_failure: Exit the program if the command fails. If False, the error is re-raised instead
+    :type exit_on_failure: bool
+    :param tail_lines: Number of lines of stdout and stderr to keep
+    :type tail_lines: int
+    :return: The result of the command. The stdout and stderr attributes hold the last tail_lines lines of each,
+             and the rusage attribute holds the resource usage of the command (as returned by os.wait4)
     :rtype: subprocess.CompletedProcess
+    :raises subprocess.CalledProcessError: If the command fails and exit_on_failure is False
     """
-    try:
-        result = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError as e:
+    log_prefix = os.path.basename(command[0])
+    stdout_tail = collections.deque(maxlen=tail_lines)
+    stderr_tail = collections.deque(maxlen=tail_lines)
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        stdout_thread = threading.Thread(target=_log_stream, args=(process.stdout, log_prefix, stdout_tail), daemon=True)
+        stdout_thread.start()
+        _log_stream(process.stderr, log_prefix, stderr_tail)
+        stdout_thread.join()
+        _, wait_status, rusage = os.wait4(process.pid, 0)
+        returncode = os.waitstatus_to_exitcode(wait_status)
+        process.returncode = returncode
+
+    stdout = '\n'.join(stdout_tail)
+    stderr = '\n'.join(stderr_tail)
+    if returncode != 0:
         logging.error(json.dumps({
             "event_type": "command_failed",
             "command": command,
-            "returncode": e.returncode,
-            "stdout": e.stdout,
-            "stderr": e.stderr,
+            "returncode": returncode,
+            "stdout": stdout,
+            "stderr": stderr,
         }))
+        if not exit_on_failure:
+            raise subprocess.CalledProcessError(returncode, command, output=stdout, stderr=stderr)
         sys.exit(-1)
 
+    result = subprocess.CompletedProcess(command, returncode, stdout=stdout, stderr=stderr)
+    result.rusage = rusage
+
     return result
@@ -14,6 +14,7 @@ setup(
     package_data={
     },
     install_requires=[
+        'numpy',
     ],
     description='A cgMLST Typing Tool',
     url='https://github.com/dfornika/core-typer',
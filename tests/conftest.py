@@ -0,0 +1,98 @@
+import os
+import stat
+import sys
+
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+# A stand-in for kma alignment: it copies the hits in tests/data/kma-out.res and .mapstat for the templates
+# in the -t_db index's .name file, so that it can be run against a whole scheme or against shards of it.
+# The mapstat fragmentCount is the number of fragments that mapped to the index's templates.
+# `kma index -i <fasta> -o <index>` writes the index's .name file, and its sequences to .seq.b.
+STUB_KMA = '''#!{python}
+import sys
+
+args = sys.argv[1:]
+if args[0] == 'index':
+    fasta = args[args.index('-i') + 1]
+    index = args[args.index('-o') + 1]
+    with open(fasta) as fasta_file, open(index + '.name', 'w') as names_file, open(index + '.seq.b', 'w') as seq_file:
+        for line in fasta_file:
+            if line.startswith('>'):
+                names_file.write(line[1:].strip() + '\\n')
+            else:
+                seq_file.write(line.strip() + '\\n')
+    sys.exit(0)
+
+db = args[args.index('-t_db') + 1]
+out = args[args.index('-o') + 1]
+with open(db + '.name') as f:
+    templates = set(line.strip() for line in f)
+
+with open({data_dir!r} + '/kma-out.res') as res_file, open(out + '.res', 'w') as f:
+    for line_idx, line in enumerate(res_file):
+        if line_idx == 0 or line.split('\\t', 1)[0].strip() in templates:
+            f.write(line)
+
+mapstat_header_lines = []
+mapstat_lines = []
+with open({data_dir!r} + '/kma-out.mapstat') as mapstat_file:
+    for line in mapstat_file:
+        if line.startswith('#'):
+            mapstat_header_lines.append(line)
+        elif line.split('\\t', 1)[0] in templates:
+            mapstat_lines.append(line)
+fragment_count = sum(int(line.split('\\t')[2]) for line in mapstat_lines)
+with open(out + '.mapstat', 'w') as f:
+    for line in mapstat_header_lines:
+        if line.startswith('## database'):
+            line = '## database\\t' + db + '\\n'
+        elif line.startswith('## fragmentCount'):
+            line = '## fragmentCount\\t' + str(fragment_count) + '\\n'
+        elif line.startswith('## command'):
+            line = '## command\\tkma ' + ' '.join(args) + '\\n'
+        f.write(line)
+    f.writelines(mapstat_lines)
+
+with open(out + '.aln', 'w') as f:
+    for line in mapstat_lines:
+        f.write('# ' + line.split('\\t', 1)[0] + '\\n')
+        f.write('template: ACGT\\n\\nquery:    ACGT\\n\\n')
+'''
+
+
+@pytest.fixture
+def stub_kma(tmp_path, monkeypatch):
+    """
+    Put a stub kma (see STUB_KMA) first on the PATH.
+
+    :return: The path to the stub kma
+    :rtype: str
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    kma_path = bin_dir / 'kma'
+    kma_path.write_text(STUB_KMA.format(python=sys.executable, data_dir=DATA_DIR))
+    kma_path.chmod(kma_path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+
+    return str(kma_path)
+
+
+@pytest.fixture
+def scheme_path(tmp_path):
+    """
+    Write a scheme .name file listing every template in tests/data/kma-out.mapstat.
+
+    :return: The path to the scheme (as passed to kma -t_db)
+    :rtype: str
+    """
+    scheme_dir = tmp_path / 'scheme'
+    scheme_dir.mkdir()
+    with open(os.path.join(DATA_DIR, 'kma-out.mapstat')) as mapstat_file, open(scheme_dir / 'scheme.name', 'w') as names_file:
+        for line in mapstat_file:
+            if not line.startswith('#'):
+                names_file.write(line.split('\t', 1)[0] + '\n')
+
+    return str(scheme_dir / 'scheme')
@@ -0,0 +1,110 @@
+#Template	Score	Expected	Template_length	Template_Identity	Template_Coverage	Query_Identity	Query_Coverage	Depth	q_value	p_value
+L00000_6	    4259	      31	     881	  100.00	  100.00	  100.00	  100.00	   51.13	  846.20	 1.0e-26
+L00000_5	    3411	      44	     654	   98.00	   97.00	   98.00	   97.00	   35.70	  775.84	 1.0e-26
+L00000_4	    1441	      30	    1302	   98.00	  100.00	   98.00	  100.00	   61.29	   43.49	 1.0e-26
+L00001_1	    1734	      36	    1352	  100.00	  100.00	  100.00	  100.00	   34.07	  353.27	 1.0e-26
+L00002_5	    4698	      23	     414	  100.00	  100.00	  100.00	  100.00	   43.68	  570.00	 1.0e-26
+L00002_2	     112	      40	     357	   99.50	  100.00	   99.50	  100.00	   66.32	  177.21	 1.0e-26
+L00002_7	    2191	       1	     444	  100.00	   97.00	  100.00	   97.00	   15.83	  453.00	 1.0e-26
+L00003_3	    1471	      42	    1380	  100.00	  100.00	  100.00	  100.00	   76.64	  272.91	 1.0e-26
+L00003_1	    1035	      50	    1091	  100.00	  100.00	  100.00	  100.00	   34.03	  188.04	 1.0e-26
+L00004_2	     246	      10	     372	   98.00	  100.00	   98.00	  100.00	   60.32	  445.67	 1.0e-26
+L00005_2	     351	      42	    1479	   98.00	   97.00	   98.00	   97.00	   66.24	  630.95	 1.0e-26
+L00005_5	     679	      26	     910	  100.00	  100.00	  100.00	  100.00	   62.07	  564.94	 1.0e-26
+L00006_4	    4268	      13	     710	  100.00	  100.00	  100.00	  100.00	   34.29	  573.38	 1.0e-26
+L00006_2	    2525	      25	     966	   98.00	  100.00	   98.00	  100.00	   52.85	  899.68	 1.0e-26
+L00006_5	    1207	       6	     736	   99.50	  100.00	   99.50	  100.00	   28.66	  837.70	 1.0e-26
+L00007_1	     430	      34	     647	  100.00	  100.00	  100.00	  100.00	   21.66	  212.97	 1.0e-26
+L00008_2	    4104	      20	    1428	  100.00	   97.00	  100.00	   97.00	   63.92	   39.14	 1.0e-26
+L00008_5	    2892	      35	    1074	  100.00	   97.00	  100.00	   97.00	   15.37	  223.71	 1.0e-26
+L00009_3	     474	       7	     329	   99.50	  100.00	   99.50	  100.00	   16.42	  826.12	 1.0e-26
+L00009_1	    3793	       6	     794	  100.00	   97.00	  100.00	   97.00	   21.13	  435.10	 1.0e-26
+L00010_1	    2700	      18	     321	  100.00	  100.00	  100.00	  100.00	   65.08	  726.48	 1.0e-26
+L00010_2	    2699	      39	     812	   98.00	  100.00	   98.00	  100.00	   25.06	  777.92	 1.0e-26
+L00011_2	    3052	      28	     483	  100.00	  100.00	  100.00	  100.00	   78.84	   90.49	 1.0e-26
+L00011_7	     436	      37	     948	   99.50	  100.00	   99.50	  100.00	   65.49	  893.50	 1.0e-26
+L00012_2	    1903	      35	    1122	  100.00	  100.00	  100.00	  100.00	   15.06	  867.56	 1.0e-26
+L00013_4	     926	      11	    1342	   99.50	  100.00	   99.50	  100.00	   76.45	  179.57	 1.0e-26
+L00013_2	    4313	      46	     723	   99.50	  100.00	   99.50	  100.00	   19.92	   31.76	 1.0e-26
+L00014_2	    2548	      42	     623	   98.00	   97.00	   98.00	   97.00	   13.40	  247.30	 1.0e-26
+L00015_4	     189	       1	     651	   98.00	  100.00	   98.00	  100.00	   28.06	  793.07	 1.0e-26
+L00015_5	    4962	      17	     830	  100.00	  100.00	  100.00	  100.00	   78.83	  397.80	 1.0e-26
+L00015_7	    1554	      40	    1197	   99.50	   97.00	   99.50	   97.00	   75.11	  731.42	 1.0e-26
+L00016_5	    1897	      23	    1347	  100.00	  100.00	  100.00	  100.00	   55.17	  159.47	 1.0e-26
+L00016_6	    2554	       7	    1251	   99.50	  100.00	   99.50	  100.00	   51.62	  896.60	 1.0e-26
+L00016_3	    1882	      22	    1106	  100.00	  100.00	  100.00	  100.00	   60.20	  383.98	 1.0e-26
+L00017_1	    1239	      24	     793	  100.00	  100.00	  100.00	  100.00	   77.98	  940.00	 1.0e-26
+L00017_3	    4097	      26	    1183	  100.00	  100.00	  100.00	  100.00	   52.05	  909.30	 1.0e-26
+L00017_7	     132	       1	    1198	  100.00	   97.00	  100.00	   97.00	   50.54	  627.53	 1.0e-26
+L00018_3	    2648	      10	    1214	   99.50	   97.00	   99.50	   97.00	   65.38	  545.38	 1.0e-26
+L00019_7	     297	      43	     327	  100.00	   97.00	  100.00	   97.00	   48.17	  761.07	 1.0e-26
+L00020_6	    2751	      22	    1205	  100.00	  100.00	  100.00	  100.00	   60.26	  304.80	 1.0e-26
+L00020_3	    3192	      17	    1440	   98.00	  100.00	   98.00	  100.00	   10.27	  635.53	 1.0e-26
+L00020_5	    4334	      28	     925	   98.00	   97.00	   98.00	   97.00	   59.20	  620.03	 1.0e-26
+L00021_3	    4887	      41	     807	  100.00	  100.00	  100.00	  100.00	   54.82	  290.89	 1.0e-26
+L00021_5	    3354	      38	     450	   99.50	  100.00	   99.50	  100.00	   67.07	   10.13	 1.0e-26
+L00022_4	    3926	      37	    1345	  100.00	  100.00	  100.00	  100.00	   16.90	  422.60	 1.0e-26
+L00022_2	    1424	      13	     864	  100.00	  100.00	  100.00	  100.00	   52.35	  528.09	 1.0e-26
+L00023_3	    4668	      45	     908	  100.00	  100.00	  100.00	  100.00	   55.71	  996.37	 1.0e-26
+L00023_4	    3374	      21	     831	  100.00	  100.00	  100.00	  100.00	   70.67	  716.05	 1.0e-26
+L00023_5	    3398	      12	     808	   99.50	  100.00	   99.50	  100.00	   64.98	   72.54	 1.0e-26
+L00024_4	    1431	      48	    1202	  100.00	  100.00	  100.00	  100.00	   35.28	  400.76	 1.0e-26
+L00024_5	    1964	      11	    1308	   98.00	  100.00	   98.00	  100.00	   75.00	   44.98	 1.0e-26
+L00025_7	    3723	      44	     862	   99.50	   97.00	   99.50	   97.00	   18.26	  172.69	 1.0e-26
+L00025_6	    1481	      37	     880	  100.00	  100.00	  100.00	  100.00	   42.38	  389.59	 1.0e-26
+L00025_5	    1851	      30	     331	  100.00	  100.00	  100.00	  100.00	   65.82	  319.57	 1.0e-26
+L00026_2	    3272	      24	    1411	  100.00	   97.00	  100.00	   97.00	   14.00	  254.17	 1.0e-26
+L00026_1	    4498	      17	     564	  100.00	   97.00	  100.00	   97.00	   13.00	  780.79	 1.0e-26
+L00026_6	    2387	      40	    1216	  100.00	   97.00	  100.00	   97.00	   37.28	  267.97	 1.0e-26
+L00027_2	    4689	      12	    1420	  100.00	  100.00	  100.00	  100.00	   38.89	  711.65	 1.0e-26
+L00027_3	     692	      13	     497	   99.50	  100.00	   99.50	  100.00	   20.57	  854.57	 1.0e-26
+L00027_4	    3943	      34	     940	   99.50	  100.00	   99.50	  100.00	   12.81	   33.19	 1.0e-26
+L00028_3	    2765	       3	     370	  100.00	  100.00	  100.00	  100.00	   70.18	  732.61	 1.0e-26
+L00029_1	    2110	      25	     993	  100.00	  100.00	  100.00	  100.00	   45.65	  956.30	 1.0e-26
+L00029_4	    4862	      24	     621	  100.00	  100.00	  100.00	  100.00	   24.00	  521.08	 1.0e-26
+L00030_5	    2543	      47	     858	   99.50	  100.00	   99.50	  100.00	   32.77	  520.10	 1.0e-26
+L00030_3	    2783	      23	     872	  100.00	  100.00	  100.00	  100.00	   43.58	  927.62	 1.0e-26
+L00030_4	     559	      16	    1372	  100.00	  100.00	  100.00	  100.00	   44.45	  783.95	 1.0e-26
+L00031_4	    2888	      14	     603	  100.00	  100.00	  100.00	  100.00	   27.51	  562.78	 1.0e-26
+L00031_5	    4570	       4	     519	   99.50	   97.00	   99.50	   97.00	   24.30	  632.14	 1.0e-26
+L00032_5	    3639	      31	    1053	  100.00	   97.00	  100.00	   97.00	   73.00	  710.28	 1.0e-26
+L00033_3	    4049	      47	    1134	  100.00	  100.00	  100.00	  100.00	   24.10	  531.99	 1.0e-26
+L00033_5	    4278	      29	    1020	   98.00	  100.00	   98.00	  100.00	   69.58	    6.40	 1.0e-26
+L00033_2	    2579	      18	    1471	   99.50	   97.00	   99.50	   97.00	   79.57	  525.63	 1.0e-26
+L00034_4	    1172	      10	     587	   98.00	   97.00	   98.00	   97.00	   48.50	  252.74	 1.0e-26
+L00034_3	    3394	       5	     337	   99.50	   97.00	   99.50	   97.00	   72.91	  846.34	 1.0e-26
+L00035_4	    1054	       1	     596	   98.00	  100.00	   98.00	  100.00	   39.06	  995.00	 1.0e-26
+L00035_7	    2452	      26	    1352	   98.00	  100.00	   98.00	  100.00	   30.11	  691.32	 1.0e-26
+L00036_6	     848	      14	     722	  100.00	  100.00	  100.00	  100.00	   77.66	  730.17	 1.0e-26
+L00036_4	    1635	       3	    1175	  100.00	  100.00	  100.00	  100.00	   52.83	  549.60	 1.0e-26
+L00037_6	    2383	      43	     397	  100.00	  100.00	  100.00	  100.00	   65.05	  644.27	 1.0e-26
+L00037_1	    4260	      30	     537	   98.00	  100.00	   98.00	  100.00	   52.43	  105.83	 1.0e-26
+L00037_3	    2210	      31	    1399	   98.00	   97.00	   98.00	   97.00	   30.20	  633.66	 1.0e-26
+L00038_6	     562	      17	     506	   98.00	  100.00	   98.00	  100.00	   26.00	  270.34	 1.0e-26
+L00038_3	    4694	      26	    1343	  100.00	   97.00	  100.00	   97.00	   20.42	  270.16	 1.0e-26
+L00038_7	    3112	      48	     993	   98.00	  100.00	   98.00	  100.00	   22.33	  181.20	 1.0e-26
+L00039_2	    2683	       8	     975	   98.00	  100.00	   98.00	  100.00	   18.29	  698.35	 1.0e-26
+L00039_6	    1051	      42	     708	  100.00	   97.00	  100.00	   97.00	   45.21	  884.29	 1.0e-26
+L00039_7	    1904	      40	     759	  100.00	   97.00	  100.00	   97.00	   29.61	  984.99	 1.0e-26
+L00040_2	    2154	       4	    1475	  100.00	   97.00	  100.00	   97.00	   12.87	   91.82	 1.0e-26
+L00040_1	    3063	      23	     584	  100.00	  100.00	  100.00	  100.00	   74.80	  933.71	 1.0e-26
+L00041_1	    1131	      39	     486	   99.50	  100.00	   99.50	  100.00	   57.53	  725.37	 1.0e-26
+L00041_3	    2579	      15	    1341	  100.00	  100.00	  100.00	  100.00	   17.69	  215.02	 1.0e-26
+L00042_4	    3403	      34	    1064	  100.00	   97.00	  100.00	   97.00	   14.84	  363.14	 1.0e-26
+L00042_2	     349	      37	     570	   99.50	  100.00	   99.50	  100.00	   20.90	  141.93	 1.0e-26
+L00043_7	    3423	      42	     597	  100.00	   97.00	  100.00	   97.00	   28.88	  686.95	 1.0e-26
+L00043_4	    1186	       6	    1450	   98.00	   97.00	   98.00	   97.00	   75.96	  459.53	 1.0e-26
+L00044_4	    3956	       7	     301	  100.00	   97.00	  100.00	   97.00	   66.85	  587.39	 1.0e-26
+L00044_1	    4754	      39	     802	   99.50	  100.00	   99.50	  100.00	   74.93	  239.81	 1.0e-26
+L00044_6	    2669	      40	    1009	   98.00	   97.00	   98.00	   97.00	   27.74	  995.79	 1.0e-26
+L00045_4	    2050	      32	     999	  100.00	  100.00	  100.00	  100.00	   57.11	  172.20	 1.0e-26
+L00045_6	    1095	      11	     728	  100.00	  100.00	  100.00	  100.00	   36.83	  397.24	 1.0e-26
+L00046_6	    3127	      25	     696	   98.00	   97.00	   98.00	   97.00	   40.24	  542.02	 1.0e-26
+L00046_4	    3181	      11	     353	   98.00	  100.00	   98.00	  100.00	   55.67	  458.80	 1.0e-26
+L00047_3	     253	      25	     767	   98.00	  100.00	   98.00	  100.00	   47.64	  991.65	 1.0e-26
+L00048_2	    4669	      32	    1069	  100.00	  100.00	  100.00	  100.00	   50.97	  216.86	 1.0e-26
+L00048_1	    4229	       7	    1115	  100.00	  100.00	  100.00	  100.00	   64.56	  567.01	 1.0e-26
+L00048_5	    4023	       1	     789	  100.00	   97.00	  100.00	   97.00	   64.41	  955.26	 1.0e-26
+L00049_6	    3775	      44	     643	   98.00	   97.00	   98.00	   97.00	   58.92	  389.09	 1.0e-26
+L00049_3	    4743	      21	     471	   99.50	  100.00	   99.50	  100.00	   61.17	  928.36	 1.0e-26
+L00049_5	    3931	      14	     566	  100.00	  100.00	  100.00	  100.00	   77.12	  196.50	 1.0e-26
@@ -0,0 +1,10 @@
+#Template	Score	Expected	Template_length	Template_Identity	Template_Coverage	Query_Identity	Query_Coverage	Depth	q_value	p_value
+L1_3	     980	      10	     300	  100.00	  100.00	  100.00	  100.00	   20.50	  900.10	 1.0e-26
+L1_7	     980	      12	     300	   99.67	  100.00	   99.67	  100.00	   20.10	  880.00	 1.0e-26
+L1_2	     450	       9	     300	   96.00	   88.00	   96.00	   88.00	    9.50	  300.20	 1.0e-26
+L2_1	    1500	      20	     450	   98.50	  100.00	   98.50	  100.00	   30.00	 1200.30	 1.0e-26
+L2_4	    1620	      22	     450	  100.00	  100.00	  100.00	  100.00	   31.20	 1300.00	 1.0e-26
+L3_12	     700	      15	     410	  100.00	   97.50	  100.00	   97.50	   14.00	  600.00	 1.0e-26
+L4_1	     800	      11	     360	  100.00	  100.00	  100.00	  100.00	   17.90	        	 1.0e-26
+L4_2	     800	      11	     360	  100.00	  100.00	  100.00	  100.00	   17.50	  650.00	 1.0e-26
+
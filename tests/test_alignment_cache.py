@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import threading
+
+from core_typer import alignment_cache
+from core_typer import indexing
+from core_typer import pipeline
+
+from test_indexing import write_locus_fasta
+
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+    return str(path)
+
+
+def make_alignment_params(tmp_path, **kwargs):
+    alignment_params = {
+        'R1': str(tmp_path / 'R1.fastq'),
+        'R2': str(tmp_path / 'R2.fastq'),
+        'threads': 2,
+        'scheme': str(tmp_path / 'scheme'),
+        'tmpdir': str(tmp_path / 'tmp'),
+    }
+    alignment_params.update(kwargs)
+
+    return alignment_params
+
+
+def put_entry(cache, key, tmp_path, size_bytes):
+    output_path = write_file(tmp_path / f"{key}.res", 'x' * size_bytes)
+    cache.put(key, {'res': output_path})
+
+    return os.path.join(cache.cache_dir, alignment_cache.ENTRIES_DIRNAME, key[:2], key)
+
+
+def get_cached_keys(cache):
+    entries_dir = os.path.join(cache.cache_dir, alignment_cache.ENTRIES_DIRNAME)
+    return sorted(key for prefix in os.listdir(entries_dir) for key in os.listdir(os.path.join(entries_dir, prefix)))
+
+
+def get_cached_bytes(cache):
+    total_bytes = 0
+    for key in get_cached_keys(cache):
+        with open(os.path.join(cache.cache_dir, alignment_cache.ENTRIES_DIRNAME, key[:2], key, alignment_cache.ENTRY_METADATA_FILENAME), 'r') as f:
+            total_bytes += json.load(f)['size_bytes']
+
+    return total_bytes
+
+
+def test_make_key(tmp_path):
+    cache = alignment_cache.AlignmentCache(str(tmp_path / 'cache'))
+    read_paths = [write_file(tmp_path / 'R1.fastq', '@r1\nACGT\n+\nIIII\n'), write_file(tmp_path / 'R2.fastq', '@r1\nTTGA\n+\nIIII\n')]
+    scheme_path = str(tmp_path / 'scheme')
+    write_file(scheme_path + '.name', 'L1_1\nL1_2\n')
+    write_file(scheme_path + '.seq.b', 'ACGT\nACGA\n')
+    alignment_command = alignment_cache.normalize_alignment_command(make_alignment_params(tmp_path))
+    key = cache.make_key(read_paths, scheme_path, alignment_command)
+
+    # Thread counts and paths don't change kma's outputs, so they aren't part of the key.
+    assert alignment_command == alignment_cache.normalize_alignment_command(make_alignment_params(tmp_path, threads=8, tmpdir=str(tmp_path / 'other'), kma_shm=1))
+    assert cache.make_key(read_paths, scheme_path, alignment_command) == key
+    # A changed kma argument misses the cache.
+    assert cache.make_key(read_paths, scheme_path, alignment_command + ['-mrs', '0.5']) != key
+    assert alignment_cache.normalize_alignment_command(make_alignment_params(tmp_path, assembly=str(tmp_path / 'contigs.fasta'))) != alignment_command
+    assert cache.make_key(read_paths, scheme_path, alignment_command, extra={'downsampling': [100, None, 0]}) != key
+
+    # So does a changed scheme file, even if the allele names are unchanged.
+    write_file(scheme_path + '.seq.b', 'ACGT\nACGC\n')
+    changed_scheme_key = cache.make_key(read_paths, scheme_path, alignment_command)
+    assert changed_scheme_key != key
+    write_file(read_paths[1], '@r1\nTTGC\n+\nIIII\n')
+    assert cache.make_key(read_paths, scheme_path, alignment_command) not in [key, changed_scheme_key]
+
+
+def test_put_evicts_least_recently_used(tmp_path):
+    cache = alignment_cache.AlignmentCache(str(tmp_path / 'cache'), max_bytes=250)
+    keys = [f"{key_idx:02d}" + 'a' * 62 for key_idx in range(4)]
+    for key_idx, key in enumerate(keys[:3]):
+        entry_dir = put_entry(cache, key, tmp_path, size_bytes=80)
+        os.utime(entry_dir, ns=(0, (key_idx + 1) * 10 ** 9))
+    # Looking up the oldest entry makes it the most recently used.
+    with cache.lookup(keys[0]) as cache_entry:
+        assert cache_entry is not None
+        with open(cache_entry['paths']['res'], 'r') as f:
+            assert f.read() == 'x' * 80
+
+    put_entry(cache, keys[3], tmp_path, size_bytes=80)
+
+    assert get_cached_keys(cache) == [keys[0], keys[2], keys[3]]
+    assert get_cached_bytes(cache) <= cache.max_bytes
+    with cache.lookup(keys[1]) as cache_entry:
+        assert cache_entry is None
+
+    # An entry bigger than the limit evicts everything older, then itself.
+    put_entry(cache, 'ff' + 'b' * 62, tmp_path, size_bytes=300)
+
+    assert get_cached_keys(cache) == []
+
+
+def test_lookup_blocks_eviction(tmp_path):
+    cache = alignment_cache.AlignmentCache(str(tmp_path / 'cache'), max_bytes=1000)
+    key = 'ab' * 32
+    put_entry(cache, key, tmp_path, size_bytes=100)
+    cache.max_bytes = 0
+
+    with cache.lookup(key) as cache_entry:
+        # Shared locks don't block each other.
+        with cache.lookup(key) as other_cache_entry:
+            assert other_cache_entry == cache_entry
+        # Eviction takes an exclusive lock, so it waits until the entry has been read.
+        evict_thread = threading.Thread(target=cache.evict)
+        evict_thread.start()
+        evict_thread.join(timeout=0.5)
+        assert evict_thread.is_alive()
+        assert os.path.exists(cache_entry['paths']['res'])
+
+    evict_thread.join(timeout=10)
+    assert not evict_thread.is_alive()
+    assert get_cached_keys(cache) == []
+
+
+def test_run_typing_cache_misses_changed_scheme_shard(tmp_path, stub_kma, caplog):
+    fasta_dir = str(tmp_path / 'loci')
+    index_dir = str(tmp_path / 'index')
+    # The stub kma has hits for alleles of these loci.
+    alleles = ['ACGT' + 'A' * allele_idx for allele_idx in range(7)]
+    locus_fasta_paths = [write_locus_fasta(fasta_dir, f"L{locus_idx:05d}", alleles) for locus_idx in range(4)]
+    indexing.build_index(locus_fasta_paths, index_dir, num_shards=2)
+    reads = {}
+    for read in ['R1', 'R2']:
+        reads[read] = str(tmp_path / f"{read}.fastq")
+        open(reads[read], 'w').close()
+    params = dict(
+        reads,
+        scheme=indexing.get_scheme_path(index_dir),
+        scheme_shards=index_dir,
+        alignment_cache=str(tmp_path / 'cache'),
+        threads=1,
+        min_identity=100.0,
+        min_coverage=100.0,
+        no_cleanup=False,
+        io_mode='disk',
+    )
+
+    def run_typing(run_name):
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            pipeline.run_typing(dict(params, outdir=str(tmp_path / run_name), tmpdir=str(tmp_path / run_name / 'tmp')))
+        return any(record.getMessage().startswith('Using cached alignment') for record in caplog.records)
+
+    assert not run_typing('run-1')
+    assert run_typing('run-2')
+
+    # Allele names and lengths are unchanged, so only the shard's kma index files differ.
+    write_locus_fasta(fasta_dir, 'L00002', alleles[:-1] + ['ACGT' + 'C' * 6])
+    indexing.build_index(locus_fasta_paths, index_dir)
+
+    assert not run_typing('run-3')
+    assert run_typing('run-4')
@@ -0,0 +1,91 @@
+import csv
+import os
+
+import pytest
+
+from core_typer import allele_calling
+from core_typer import parsers
+from core_typer import records
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def write_and_read_allele_calls(kma_result_file, kma_mapstat_file, output_dir):
+    """
+    Call alleles the way the pipeline does, write them to allele_calls.csv and read the file back.
+
+    :return: The rows of allele_calls.csv
+    :rtype: list[dict[str, str]]
+    """
+    kma_result_columns = parsers.parse_kma_best_hits_columnar(kma_result_file)
+    kma_mapstat_columns = parsers.parse_kma_mapstat_columnar(
+        kma_mapstat_file,
+        columns=records.ALLELE_CALL_MAPSTAT_FIELDS,
+        templates=kma_result_columns['template'].tolist(),
+    )
+    allele_calls = allele_calling.call_alleles(kma_result_columns, kma_mapstat_columns=kma_mapstat_columns)
+    allele_calls_file = os.path.join(output_dir, 'allele_calls.csv')
+    allele_calling.write_allele_calls(allele_calls_file, allele_calls)
+    with open(allele_calls_file, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_allele_calls_csv_joined_columns(tmp_path):
+    rows = write_and_read_allele_calls(os.path.join(DATA_DIR, 'ties.res'), os.path.join(DATA_DIR, 'ties.mapstat'), str(tmp_path))
+
+    assert list(rows[0]) == records.ALLELE_CALL_FIELDNAMES
+    mapstat_fields = records.ALLELE_CALL_MAPSTAT_FIELDS
+    joined_columns = {row['locus_id']: (row['allele_id'], row['score'], [row[field] for field in mapstat_fields]) for row in rows}
+    assert joined_columns == {
+        'L1': ('3', '980', ['120', '61', '0', '0', '0', '1.25']),
+        'L2': ('4', '1620', ['190', '97', '0', '0', '0', '2.1']),
+        # No mapstat row for the best hit
+        'L3': ('-', '700', ['', '', '', '', '', '']),
+        'L4': ('1', '800', ['99', '50', '0', '1', '2', '1.5']),
+    }
+
+
+def test_allele_calls_csv_joined_columns_match_mapstat_rows(tmp_path):
+    kma_result_file = os.path.join(DATA_DIR, 'kma-out.res')
+    kma_mapstat_file = os.path.join(DATA_DIR, 'kma-out.mapstat')
+    rows = write_and_read_allele_calls(kma_result_file, kma_mapstat_file, str(tmp_path))
+    best_hits_by_locus_id = parsers.parse_kma_result(kma_result_file, best_hit_only=True)
+    mapstat_records_by_template = {
+        mapstat_record.ref_sequence: mapstat_record
+        for mapstat_records in parsers.parse_kma_mapstat(kma_mapstat_file).values()
+        for mapstat_record in mapstat_records
+    }
+
+    assert len(rows) == len(best_hits_by_locus_id)
+    for row in rows:
+        mapstat_record = mapstat_records_by_template[best_hits_by_locus_id[row['locus_id']][0].template]
+        assert [row[field] for field in records.ALLELE_CALL_MAPSTAT_FIELDS] == [str(getattr(mapstat_record, field)) for field in records.ALLELE_CALL_MAPSTAT_FIELDS]
+
+
+def test_parse_kma_mapstat_columnar_keeps_only_requested_templates():
+    kma_mapstat_file = os.path.join(DATA_DIR, 'ties.mapstat')
+    all_rows = parsers.parse_kma_mapstat_columnar(kma_mapstat_file)
+    best_hit_rows = parsers.parse_kma_mapstat_columnar(kma_mapstat_file, templates=['L1_3', 'L2_4', 'L3_12'])
+
+    assert all_rows['num_rows'] == best_hit_rows['num_rows'] == 7
+    assert best_hit_rows['ref_sequence'].tolist() == ['L1_3', 'L2_4']
+    assert best_hit_rows['read_count'].tolist() == [120, 190]
+    assert best_hit_rows['metadata']['fragmentCount'] == '2500'
+
+
+@pytest.mark.parametrize('min_identity,min_coverage', [(100.0, 100.0), (95.0, 90.0)])
+def test_call_alleles_with_filtered_mapstat_matches_full_mapstat(min_identity, min_coverage):
+    kma_result_columns = parsers.parse_kma_result_columnar(os.path.join(DATA_DIR, 'kma-out.res'))
+    kma_mapstat_file = os.path.join(DATA_DIR, 'kma-out.mapstat')
+    full_mapstat = parsers.parse_kma_mapstat_columnar(kma_mapstat_file, columns=records.ALLELE_CALL_MAPSTAT_FIELDS)
+    best_hit_mapstat = parsers.parse_kma_mapstat_columnar(
+        kma_mapstat_file,
+        columns=records.ALLELE_CALL_MAPSTAT_FIELDS,
+        templates=parsers.parse_kma_best_hits_columnar(os.path.join(DATA_DIR, 'kma-out.res'))['template'].tolist(),
+    )
+
+    expected = allele_calling.call_alleles(kma_result_columns, min_identity=min_identity, min_coverage=min_coverage, kma_mapstat_columns=full_mapstat)
+    allele_calls = allele_calling.call_alleles(kma_result_columns, min_identity=min_identity, min_coverage=min_coverage, kma_mapstat_columns=best_hit_mapstat)
+
+    assert allele_calls == expected
+    assert len(best_hit_mapstat['ref_sequence']) < len(full_mapstat['ref_sequence'])
@@ -0,0 +1,112 @@
+import csv
+import os
+import random
+
+import pytest
+
+from core_typer import assembly
+from core_typer import pipeline
+
+_REVERSE_COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def reverse_complement(sequence):
+    return sequence[::-1].translate(_REVERSE_COMPLEMENT)
+
+
+def write_fasta(path, records):
+    with open(path, 'w') as f:
+        for header, sequence in records:
+            f.write(f">{header}\n{sequence}\n")
+
+    return path
+
+
+def write_scheme(scheme_dir, alleles):
+    """
+    Write a scheme .name file and a FASTA file of its alleles, and build an assembly index of them.
+
+    :return: The path to the scheme (as passed to kma -t_db), and the assembly index
+    :rtype: tuple[str, dict]
+    """
+    os.makedirs(scheme_dir)
+    scheme_path = os.path.join(scheme_dir, 'scheme')
+    with open(scheme_path + '.name', 'w') as f:
+        f.writelines(f"{allele_name}\n" for allele_name in alleles)
+    fasta_path = write_fasta(os.path.join(scheme_dir, 'alleles.fasta'), alleles.items())
+    assembly_index = assembly.build_assembly_index(scheme_path, assembly.get_default_assembly_index_dir(scheme_path), fasta_path=fasta_path, kmer_size=11)
+
+    return scheme_path, assembly_index
+
+
+@pytest.fixture
+def alleles():
+    rng = random.Random(1)
+    return {
+        f"L{locus_idx}_{allele_idx}": ''.join(rng.choice('ACGT') for _ in range(60 + locus_idx))
+        for locus_idx in range(1, 7)
+        for allele_idx in range(1, 3)
+    }
+
+
+def test_find_exact_alleles(tmp_path, alleles):
+    scheme_path, assembly_index = write_scheme(str(tmp_path / 'scheme'), alleles)
+    rng = random.Random(2)
+
+    def random_sequence(length):
+        return ''.join(rng.choice('ACGT') for _ in range(length))
+
+    contigs = [
+        # Forward and reverse strands, within a contig
+        ('contig_1', random_sequence(20) + alleles['L1_2'] + random_sequence(20) + reverse_complement(alleles['L2_1']) + random_sequence(20)),
+        # At the end of a contig on the forward strand, and at its start on the reverse strand (the end of the reverse complement)
+        ('contig_2', reverse_complement(alleles['L4_1']) + random_sequence(20) + alleles['L3_2'] + alleles['L5_1'][:30]),
+        # Split across the end of one contig and the start of the next, so not found
+        ('contig_3', alleles['L5_1'][30:] + random_sequence(20) + alleles['L6_1'][:-1]),
+    ]
+    assembly_path = write_fasta(str(tmp_path / 'contigs.fasta'), contigs)
+
+    exact_hits_by_locus_id = assembly.find_exact_alleles(assembly_path, assembly_index)
+
+    assert {locus_id: kma_hit.template for locus_id, kma_hit in exact_hits_by_locus_id.items()} == {
+        'L1': 'L1_2',
+        'L2': 'L2_1',
+        'L3': 'L3_2',
+        'L4': 'L4_1',
+    }
+    assert list(exact_hits_by_locus_id) == ['L1', 'L2', 'L3', 'L4']
+    assert exact_hits_by_locus_id['L3'].score == len(alleles['L3_2'])
+
+
+def test_run_typing_assembly_keeps_kma_hits_at_remaining_loci(tmp_path, stub_kma):
+    # The stub kma has hits for alleles of these loci (see conftest.STUB_KMA), whatever the assembly.
+    rng = random.Random(3)
+    alleles = {
+        f"L{locus_idx:05d}_{allele_idx}": ''.join(rng.choice('ACGT') for _ in range(50))
+        for locus_idx in range(4)
+        for allele_idx in range(1, 8)
+    }
+    scheme_path, assembly_index = write_scheme(str(tmp_path / 'scheme'), alleles)
+    assembly_path = write_fasta(str(tmp_path / 'contigs.fasta'), [('contig_1', alleles['L00001_1'] + alleles['L00003_2'])])
+
+    outputs = pipeline.run_typing({
+        'assembly': assembly_path,
+        'scheme': scheme_path,
+        'outdir': str(tmp_path / 'out'),
+        'tmpdir': str(tmp_path / 'tmp'),
+        'threads': 1,
+        'min_identity': 100.0,
+        'min_coverage': 100.0,
+        'no_cleanup': False,
+        'io_mode': 'disk',
+    })
+
+    with open(outputs['allele_calls'], 'r') as f:
+        allele_calls = {row['locus_id']: row for row in csv.DictReader(f)}
+    assert list(allele_calls) == ['L00000', 'L00001', 'L00002', 'L00003']
+    # Exact matches are reported as such, without the stub kma's hits or mapstat rows at those loci.
+    for locus_id, allele_id in [('L00001', '1'), ('L00003', '2')]:
+        assert (allele_calls[locus_id]['allele_id'], allele_calls[locus_id]['score'], allele_calls[locus_id]['depth']) == (allele_id, '50', '1.0')
+        assert allele_calls[locus_id]['read_count'] == ''
+    for locus_id in ['L00000', 'L00002']:
+        assert allele_calls[locus_id]['read_count'] != ''
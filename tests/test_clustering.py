@@ -0,0 +1,108 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from core_typer import clustering
+
+LOCUS_IDS = [f"L{locus_idx}" for locus_idx in range(10)]
+
+
+def pairwise_distance(profile_a, profile_b):
+    # The number of loci with different alleles, not counting loci missing in either profile
+    return sum(1 for a, b in zip(profile_a, profile_b) if a != 0 and b != 0 and a != b)
+
+
+def brute_force_mst_weight(profiles):
+    """
+    Find the total weight of a minimum spanning tree with Kruskal's algorithm, over every pair of profiles.
+
+    :return: The total weight
+    :rtype: int
+    """
+    edges = sorted((pairwise_distance(profiles[a], profiles[b]), a, b) for a, b in itertools.combinations(range(len(profiles)), 2))
+    roots = list(range(len(profiles)))
+
+    def find_root(sample_idx):
+        while roots[sample_idx] != sample_idx:
+            sample_idx = roots[sample_idx]
+        return sample_idx
+
+    total_weight = 0
+    for edge_distance, a, b in edges:
+        root_a, root_b = find_root(a), find_root(b)
+        if root_a != root_b:
+            roots[root_a] = root_b
+            total_weight += edge_distance
+
+    return total_weight
+
+
+def random_profiles(num_samples, seed):
+    rng = np.random.default_rng(seed)
+    profiles = rng.integers(1, 4, size=(num_samples, len(LOCUS_IDS))).astype(np.uint32)
+    profiles[rng.random(profiles.shape) < 0.1] = 0
+
+    return profiles
+
+
+@pytest.mark.parametrize('num_base', [0, 12])
+def test_minimum_spanning_tree_weight_matches_brute_force(num_base):
+    profiles = random_profiles(30, seed=1)
+    base_edges = clustering.build_minimum_spanning_tree(profiles[:num_base]) if num_base else None
+
+    edges = clustering.build_minimum_spanning_tree(profiles, base_edges=base_edges, num_base=num_base)
+
+    assert len(edges) == len(profiles) - 1
+    assert len({child for _, child, _ in edges}) == len(profiles) - 1
+    for parent, child, edge_distance in edges:
+        assert edge_distance == pairwise_distance(profiles[parent], profiles[child])
+    assert sum(edge_distance for _, _, edge_distance in edges) == brute_force_mst_weight(profiles.tolist())
+
+
+def test_cluster_profiles_keeps_previous_codes(tmp_path):
+    profiles = random_profiles(20, seed=2)
+    sample_ids = [f"sample-{sample_idx}" for sample_idx in range(len(profiles))]
+    previous = clustering.cluster_profiles(sample_ids[:15], profiles[:15], [2, 5])
+    clustering.write_clustering(previous, LOCUS_IDS, str(tmp_path / 'clusters'))
+    previous = clustering.load_clustering(str(tmp_path / 'clusters'), LOCUS_IDS)
+
+    # New samples are given in any order, among the previous ones.
+    order = [19, 3, 15, 0] + [sample_idx for sample_idx in range(len(profiles)) if sample_idx not in [19, 3, 15, 0]]
+    result = clustering.cluster_profiles([sample_ids[sample_idx] for sample_idx in order], profiles[order], [5, 2], previous=previous)
+
+    assert result['sample_ids'][:15] == sample_ids[:15]
+    assert result['cluster_codes'][:15].tolist() == previous['cluster_codes'].tolist()
+    assert sum(edge_distance for _, _, edge_distance in result['mst_edges']) == brute_force_mst_weight(profiles.tolist())
+    # New clusters get new codes, and codes are never reused.
+    for threshold_idx, next_code in enumerate(previous['next_codes']):
+        new_codes = set(result['cluster_codes'][15:, threshold_idx].tolist()) - set(previous['cluster_codes'][:, threshold_idx].tolist())
+        assert all(code >= next_code for code in new_codes)
+        assert result['next_codes'][threshold_idx] == next_code + len(new_codes)
+
+
+def test_cluster_profiles_merged_clusters_take_lowest_code():
+    cluster_a = np.ones(len(LOCUS_IDS), dtype=np.uint32)
+    cluster_b = cluster_a.copy()
+    cluster_b[:8] = 2
+    bridge = cluster_a.copy()
+    bridge[:4] = 2
+    previous = clustering.cluster_profiles(['b', 'a'], np.array([cluster_b, cluster_a]), [5])
+    assert previous['cluster_codes'][:, 0].tolist() == [1, 2]
+
+    result = clustering.cluster_profiles(['a', 'b', 'bridge'], np.array([cluster_a, cluster_b, bridge]), [5], previous=previous)
+
+    assert result['sample_ids'] == ['b', 'a', 'bridge']
+    assert result['cluster_codes'][:, 0].tolist() == [1, 1, 1]
+    assert result['next_codes'] == [3]
+
+
+def test_assign_cluster_codes():
+    clusters = np.array([0, 0, 1, 1, 2, 3])
+    previous_codes = np.array([4, 2, clustering.NO_CLUSTER_CODE, 3, clustering.NO_CLUSTER_CODE, 5])
+
+    cluster_codes, next_code, merged_codes = clustering.assign_cluster_codes(clusters, previous_codes, next_code=6)
+
+    assert cluster_codes.tolist() == [2, 2, 3, 3, 6, 5]
+    assert next_code == 7
+    assert merged_codes == [[2, 4]]
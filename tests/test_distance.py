@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from core_typer import distance
+
+# Allele IDs of four samples at five loci. Some loci are missing in both samples of a pair
+# (L3 in s2 and s3), others in just one.
+ALLELE_IDS_BY_SAMPLE = [
+    ['1', '2', '3', '4', '5'],
+    ['1', '2', '-', '4', '6'],
+    ['2', '-', '-', '4', '5'],
+    ['-', '9', '3', '7', '-'],
+]
+
+# Counted by hand: loci where both alleles are called and differ.
+#   s1-s2: L5                 s2-s3: L1, L5 (L3 missing in both)
+#   s1-s3: L1                 s2-s4: L2, L4
+#   s1-s4: L2, L4             s3-s4: L4
+PAIRWISE_DISTANCES = [
+    [0, 1, 1, 2],
+    [1, 0, 2, 2],
+    [1, 2, 0, 1],
+    [2, 2, 1, 0],
+]
+
+# Only L4 is called in every sample.
+COMPLETE_DISTANCES = [
+    [0, 0, 0, 1],
+    [0, 0, 0, 1],
+    [0, 0, 0, 1],
+    [1, 1, 1, 0],
+]
+
+
+def encode(allele_ids_by_sample):
+    profiles, _ = distance.encode_allele_profiles(allele_ids_by_sample, len(allele_ids_by_sample[0]))
+    return profiles
+
+
+def test_encode_allele_profiles():
+    profiles, allele_codes = distance.encode_allele_profiles(ALLELE_IDS_BY_SAMPLE, 5)
+
+    assert profiles.tolist() == [
+        [1, 1, 1, 1, 1],
+        [1, 1, 0, 1, 2],
+        [2, 0, 0, 1, 1],
+        [0, 2, 1, 2, 0],
+    ]
+    assert allele_codes[3] == {distance.MISSING_ALLELE: distance.MISSING_ALLELE_CODE, '4': 1, '7': 2}
+
+
+@pytest.mark.parametrize('threads,block_size', [(1, 256), (1, 1), (2, 1)])
+def test_calculate_distance_matrix_pairwise(threads, block_size):
+    distance_matrix = distance.calculate_distance_matrix(encode(ALLELE_IDS_BY_SAMPLE), missing='pairwise', threads=threads, block_size=block_size)
+
+    assert distance_matrix.tolist() == PAIRWISE_DISTANCES
+
+
+def test_calculate_distance_matrix_complete():
+    distance_matrix = distance.calculate_distance_matrix(encode(ALLELE_IDS_BY_SAMPLE), missing='complete')
+
+    assert distance_matrix.tolist() == COMPLETE_DISTANCES
+
+
+def test_calculate_distance_matrix_unknown_missing_mode():
+    with pytest.raises(ValueError):
+        distance.calculate_distance_matrix(encode(ALLELE_IDS_BY_SAMPLE), missing='none')
+
+
+def test_calculate_distance_rows_in_blocks(monkeypatch):
+    rng = np.random.default_rng(1)
+    profiles = rng.integers(0, 3, size=(23, 17)).astype(np.uint8)
+    expected = [
+        [sum(1 for a, b in zip(query_profile, profile) if a != 0 and b != 0 and a != b) for profile in profiles.tolist()]
+        for query_profile in profiles[:5].tolist()
+    ]
+
+    assert distance.calculate_distance_rows(profiles[:5], profiles).tolist() == expected
+    # Small blocks of queries and profiles give the same distances.
+    monkeypatch.setattr(distance, 'MAX_BLOCK_ELEMENTS', 40)
+    assert distance.calculate_distance_rows(profiles[:5], profiles).tolist() == expected
@@ -0,0 +1,101 @@
+import gzip
+import os
+
+import pytest
+
+from core_typer import downsampling
+
+NUM_PAIRS = 200
+
+
+def write_read_pairs(tmp_path, num_pairs, gzipped=False):
+    """
+    Write a pair of FASTQ files. Read names are numbered, and each read's sequence length depends on its number,
+    so a pair can be matched up by name and every read counted.
+
+    :return: The paths to the R1 and R2 files
+    :rtype: tuple[str, str]
+    """
+    read_paths = []
+    for read in ['R1', 'R2']:
+        records = []
+        for pair_idx in range(num_pairs):
+            sequence = 'ACGT'[pair_idx % 4] * (50 + pair_idx % 7)
+            records.append(f"@pair_{pair_idx}/{read[1]}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+        read_path = str(tmp_path / f"{read}.fastq.gz" if gzipped else tmp_path / f"{read}.fastq")
+        with (gzip.open(read_path, 'wt') if gzipped else open(read_path, 'w')) as f:
+            f.writelines(records)
+        read_paths.append(read_path)
+
+    return tuple(read_paths)
+
+
+def read_names(fastq_path):
+    with open(fastq_path, 'rb') as f:
+        return [header.decode().strip()[1:].split('/')[0] for header, _, _, _ in downsampling.iter_fastq_records(f)]
+
+
+@pytest.mark.parametrize('num_pairs,num_bases,target_length,target_depth,expected', [
+    (1000, 300000, 1000, 100.0, 333),
+    (1000, 300000, 1000, 300.0, 1000),
+    (1000, 300000, 1000, 500.0, 1000),
+    (1000, 300000, 1000, 0.1, 1),
+    (0, 0, 1000, 100.0, 0),
+])
+def test_calculate_num_pairs_to_keep(num_pairs, num_bases, target_length, target_depth, expected):
+    assert downsampling.calculate_num_pairs_to_keep(num_pairs, num_bases, target_length, target_depth) == expected
+
+
+@pytest.mark.parametrize('num_records_to_keep', [0, 1, 37, NUM_PAIRS - 1, NUM_PAIRS])
+def test_iter_sampled_indices_keeps_exactly_k(num_records_to_keep):
+    for seed in range(20):
+        keep = list(downsampling.iter_sampled_indices(NUM_PAIRS, num_records_to_keep, seed=seed))
+
+        assert len(keep) == NUM_PAIRS
+        assert sum(keep) == num_records_to_keep
+
+
+def test_iter_sampled_indices_is_deterministic():
+    keep = list(downsampling.iter_sampled_indices(NUM_PAIRS, 50, seed=1))
+
+    assert list(downsampling.iter_sampled_indices(NUM_PAIRS, 50, seed=1)) == keep
+    assert list(downsampling.iter_sampled_indices(NUM_PAIRS, 50, seed=2)) != keep
+
+
+def test_count_read_pairs(tmp_path):
+    r1_path, r2_path = write_read_pairs(tmp_path, NUM_PAIRS, gzipped=True)
+
+    counts = downsampling.count_read_pairs(r1_path, r2_path)
+
+    assert counts == {'num_pairs': NUM_PAIRS, 'num_bases': 2 * sum(50 + pair_idx % 7 for pair_idx in range(NUM_PAIRS))}
+
+
+@pytest.mark.parametrize('named_pipes', [True, False])
+def test_downsampled_read_pairs(tmp_path, named_pipes):
+    r1_path, r2_path = write_read_pairs(tmp_path, NUM_PAIRS, gzipped=True)
+    downsampled_names = []
+    for run_idx in range(2):
+        output_dir = tmp_path / f"run-{run_idx}"
+        output_dir.mkdir()
+        with downsampling.downsampled_read_pairs(r1_path, r2_path, str(output_dir), NUM_PAIRS, 60, named_pipes=named_pipes) as downsampled_reads:
+            # Like kma, read both pipes (a FIFO blocks its writer until it is opened for reading).
+            r1_names = read_names(downsampled_reads['R1'])
+            r2_names = read_names(downsampled_reads['R2'])
+        downsampled_names.append(r1_names)
+
+        assert len(r1_names) == 60
+        assert r2_names == r1_names
+        assert downsampled_reads['num_bases'] == 2 * sum(50 + int(name.split('_')[1]) % 7 for name in r1_names)
+
+    # Reads are kept in file order, and the same seed keeps the same reads.
+    assert downsampled_names[0] == sorted(downsampled_names[0], key=lambda name: int(name.split('_')[1]))
+    assert downsampled_names[1] == downsampled_names[0]
+
+
+def test_count_read_pairs_different_numbers_of_reads(tmp_path):
+    r1_path, _ = write_read_pairs(tmp_path, NUM_PAIRS)
+    os.makedirs(tmp_path / 'other')
+    _, r2_path = write_read_pairs(tmp_path / 'other', NUM_PAIRS - 1)
+
+    with pytest.raises(ValueError):
+        downsampling.count_read_pairs(r1_path, r2_path)
@@ -0,0 +1,85 @@
+import os
+
+from core_typer import indexing
+from core_typer import scheme
+
+
+def write_locus_fasta(fasta_dir, locus_id, sequences):
+    """
+    Write a per-locus FASTA file, with alleles numbered from 1.
+
+    :return: The path to the FASTA file
+    :rtype: str
+    """
+    os.makedirs(fasta_dir, exist_ok=True)
+    locus_fasta_path = os.path.join(fasta_dir, f"{locus_id}.fasta")
+    with open(locus_fasta_path, 'w') as f:
+        for allele_idx, sequence in enumerate(sequences, start=1):
+            f.write(f">{locus_id}_{allele_idx}\n{sequence}\n")
+
+    return locus_fasta_path
+
+
+def read_names(index_path):
+    with open(scheme.get_names_file(index_path), 'r') as f:
+        return [line.strip() for line in f]
+
+
+def get_shard_inodes(index_dir):
+    return {filename: os.stat(os.path.join(index_dir, filename)).st_ino for filename in os.listdir(index_dir) if filename.startswith('shard-')}
+
+
+def test_assign_shards():
+    locus_sizes = {'A': 5, 'B': 5, 'C': 5, 'D': 4, 'E': 8, 'F': 1}
+    previous_shards = {'A': 'shard-001', 'B': 'shard-001', 'C': 'shard-003'}
+
+    shards = indexing.assign_shards(['A', 'B', 'C', 'D', 'E', 'F'], locus_sizes, previous_shards, target_shard_size=10)
+
+    # New loci fill the last shard until it reaches the target size, then start a new shard after the highest numbered one.
+    assert shards == {'shard-001': ['A', 'B'], 'shard-003': ['C', 'D', 'E'], 'shard-004': ['F']}
+
+
+def test_assign_shards_new_index():
+    shards = indexing.assign_shards(['A', 'B', 'C'], {'A': 5, 'B': 5, 'C': 5}, {}, target_shard_size=10)
+
+    assert shards == {'shard-001': ['A', 'B'], 'shard-002': ['C']}
+
+
+def test_build_index_reindexes_changed_shards_only(tmp_path, stub_kma):
+    fasta_dir = str(tmp_path / 'loci')
+    index_dir = str(tmp_path / 'index')
+    locus_fasta_paths = [write_locus_fasta(fasta_dir, f"L{locus_idx}", ['ACGT', 'ACGA']) for locus_idx in range(1, 7)]
+
+    counts = indexing.build_index(locus_fasta_paths, index_dir, num_shards=3)
+
+    assert counts['num_shards'] == 3
+    assert counts['num_shards_indexed'] == 3
+    scheme_path = indexing.get_scheme_path(index_dir)
+    assert read_names(scheme_path) == [f"L{locus_idx}_{allele_idx}" for locus_idx in range(1, 7) for allele_idx in [1, 2]]
+    shard_by_locus_id = {locus['locus_id']: locus['shard'] for locus in indexing.load_index_manifest(index_dir)['loci']}
+
+    # Changing one locus re-indexes its shard only.
+    shard_inodes = get_shard_inodes(index_dir)
+    write_locus_fasta(fasta_dir, 'L3', ['ACGT', 'ACGC'])
+    counts = indexing.build_index(locus_fasta_paths, index_dir)
+
+    assert (counts['num_shards_indexed'], counts['num_loci_changed']) == (1, 1)
+    assert {filename for filename, inode in get_shard_inodes(index_dir).items() if shard_inodes[filename] != inode} == {
+        f"{shard_by_locus_id['L3']}.name",
+        f"{shard_by_locus_id['L3']}.seq.b",
+    }
+
+    # Removing a locus and adding one keeps the order of the others, whatever the input order, with the new locus last.
+    os.remove(locus_fasta_paths[1])
+    locus_fasta_paths = [write_locus_fasta(fasta_dir, 'L0', ['ACGT'])] + list(reversed(locus_fasta_paths[:1] + locus_fasta_paths[2:]))
+    counts = indexing.build_index(locus_fasta_paths, index_dir)
+
+    assert (counts['num_loci_added'], counts['num_loci_removed']) == (1, 1)
+    assert read_names(scheme_path) == [f"L{locus_idx}_{allele_idx}" for locus_idx in [1, 3, 4, 5, 6] for allele_idx in [1, 2]] + ['L0_1']
+    assert [locus['locus_id'] for locus in indexing.load_index_manifest(index_dir)['loci']] == ['L1', 'L3', 'L4', 'L5', 'L6', 'L0']
+    # The other loci keep their shards. The last shard was full, so the new locus starts a new one.
+    new_shard_by_locus_id = {locus['locus_id']: locus['shard'] for locus in indexing.load_index_manifest(index_dir)['loci']}
+    assert new_shard_by_locus_id == dict({locus_id: shard_name for locus_id, shard_name in shard_by_locus_id.items() if locus_id != 'L2'}, L0='shard-004')
+    assert counts['num_shards_indexed'] == 2
+    assert read_names(os.path.join(index_dir, shard_by_locus_id['L2'])) == ['L1_1', 'L1_2']
+    assert read_names(os.path.join(index_dir, 'shard-004')) == ['L0_1']
@@ -0,0 +1,25 @@
+import os
+import tracemalloc
+
+import pytest
+
+from core_typer import metrics
+
+
+@pytest.mark.parametrize('trace_memory', [True, False])
+def test_stage_traces_memory_while_profiling(tmp_path, trace_memory):
+    was_tracing = tracemalloc.is_tracing()
+    run_metrics = metrics.Metrics(profile_dir=str(tmp_path / 'profile'), trace_memory=trace_memory)
+
+    with run_metrics.stage('allocate'):
+        data = bytearray(1024 * 1024)
+    del data
+    assert tracemalloc.is_tracing() == (was_tracing or trace_memory)
+    if not was_tracing:
+        tracemalloc.stop()
+
+    assert ('traced_memory_peak_bytes' in run_metrics.stages['allocate']) == trace_memory
+    if trace_memory:
+        assert run_metrics.stages['allocate']['traced_memory_peak_bytes'] >= 1024 * 1024
+    assert os.path.exists(tmp_path / 'profile' / 'allocate.prof')
+    assert os.path.exists(tmp_path / 'profile' / 'allocate.tracemalloc') == trace_memory
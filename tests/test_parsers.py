@@ -0,0 +1,147 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+from core_typer import allele_calling
+from core_typer import parsers
+from core_typer import records
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+KMA_RESULT_FILES = [
+    os.path.join(DATA_DIR, 'kma-out.res'),
+    os.path.join(DATA_DIR, 'ties.res'),
+]
+
+
+def parse_kma_result_baseline(kma_result_file):
+    """
+    The csv.DictReader-based kma result parser that parsers.parse_kma_result replaced, kept as a reference.
+    It adds each row to its locus once per column, so rows are deduplicated by identity here.
+
+    :param kma_result_file: The path to the kma result file
+    :type kma_result_file: str
+    :return: The kma results, indexed by locus_id, sorted by score (descending)
+    :rtype: dict[str, list[dict]]
+    """
+    kma_result_by_locus_id = {}
+    int_fields = [
+        "score",
+        "expected",
+        "template_length",
+    ]
+    float_fields = [
+        "template_identity",
+        "template_coverage",
+        "query_identity",
+        "query_coverage",
+        "depth",
+        "q_value",
+        "p_value",
+    ]
+    with open(kma_result_file, 'r') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        for row in reader:
+            record = {}
+            for k, v in row.items():
+                key = k.lower().replace("#", "")
+                if key in int_fields:
+                    try:
+                        record[key] = int(v.strip())
+                    except ValueError as e:
+                        record[key] = None
+                elif key in float_fields:
+                    try:
+                        record[key] = float(v.strip())
+                    except ValueError as e:
+                        record[key] = None
+                else:
+                    record[key] = v.strip()
+                locus_id = record["template"].split("_")[0]
+                allele_id = record["template"].split("_")[1]
+                record["locus_id"] = locus_id
+                record["allele_id"] = allele_id
+                if locus_id not in kma_result_by_locus_id:
+                    kma_result_by_locus_id[locus_id] = []
+                kma_result_by_locus_id[locus_id].append(record)
+
+    for locus_id, kma_results in kma_result_by_locus_id.items():
+        unique_kma_results = list({id(kma_result): kma_result for kma_result in kma_results}.values())
+        kma_result_by_locus_id[locus_id] = sorted(unique_kma_results, key=lambda k: k["score"], reverse=True)
+
+    return kma_result_by_locus_id
+
+
+@pytest.mark.parametrize('kma_result_file', KMA_RESULT_FILES)
+def test_parse_kma_result_matches_baseline(kma_result_file):
+    expected = parse_kma_result_baseline(kma_result_file)
+    parsed = parsers.parse_kma_result(kma_result_file)
+
+    assert list(parsed) == list(expected)
+    for locus_id, kma_hits in parsed.items():
+        assert [kma_hit._asdict() for kma_hit in kma_hits] == [{field: kma_result[field] for field in records.KmaHit._fields} for kma_result in expected[locus_id]]
+
+
+@pytest.mark.parametrize('kma_result_file', KMA_RESULT_FILES)
+def test_parse_kma_result_best_hit_only_matches_baseline(kma_result_file):
+    expected = parse_kma_result_baseline(kma_result_file)
+    parsed = parsers.parse_kma_result(kma_result_file, best_hit_only=True)
+
+    assert list(parsed) == list(expected)
+    for locus_id, kma_hits in parsed.items():
+        assert len(kma_hits) == 1
+        assert kma_hits[0]._asdict() == {field: expected[locus_id][0][field] for field in records.KmaHit._fields}
+
+
+def test_parse_kma_result_keeps_first_of_tied_hits():
+    parsed = parsers.parse_kma_result(os.path.join(DATA_DIR, 'ties.res'), best_hit_only=True)
+
+    assert parsed['L1'][0].template == 'L1_3'
+    assert parsed['L2'][0].template == 'L2_4'
+    assert parsed['L4'][0].template == 'L4_1'
+    assert parsed['L4'][0].q_value is None
+
+
+@pytest.mark.parametrize('best_hit_only', [True, False])
+def test_parse_kma_result_ranks_missing_score_lowest(tmp_path, best_hit_only):
+    kma_result_file = tmp_path / 'missing-score.res'
+    kma_result_file.write_text(
+        '#Template\tScore\tExpected\tTemplate_length\tTemplate_Identity\tTemplate_Coverage\tQuery_Identity\tQuery_Coverage\tDepth\tq_value\tp_value\n'
+        'L1_1\tNA\t10\t300\t100.00\t100.00\t100.00\t100.00\t20.50\t900.10\t1.0e-26\n'
+        'L1_2\t950\t10\t300\t99.67\t100.00\t99.67\t100.00\t20.10\t880.00\t1.0e-26\n'
+        'L1_3\t\t10\t300\t100.00\t100.00\t100.00\t100.00\t20.50\t900.10\t1.0e-26\n'
+        'L2_1\tNA\t10\t300\t100.00\t100.00\t100.00\t100.00\t20.50\t900.10\t1.0e-26\n'
+        'L2_2\t\t10\t300\t100.00\t100.00\t100.00\t100.00\t20.50\t900.10\t1.0e-26\n'
+    )
+
+    parsed = parsers.parse_kma_result(str(kma_result_file), best_hit_only=best_hit_only)
+
+    assert parsed['L1'][0].template == 'L1_2'
+    assert parsed['L1'][0].score == 950
+    assert parsed['L2'][0].template == 'L2_1'
+    assert parsed['L2'][0].score is None
+    if not best_hit_only:
+        assert [kma_hit.template for kma_hit in parsed['L1']] == ['L1_2', 'L1_1', 'L1_3']
+
+
+@pytest.mark.parametrize('kma_result_file', KMA_RESULT_FILES)
+@pytest.mark.parametrize('min_identity,min_coverage', [(100.0, 100.0), (95.0, 90.0)])
+def test_best_hits_columnar_allele_calls_match_all_hits(kma_result_file, min_identity, min_coverage):
+    expected = allele_calling.call_alleles(parsers.parse_kma_result_columnar(kma_result_file), min_identity=min_identity, min_coverage=min_coverage)
+    allele_calls = allele_calling.call_alleles(parsers.parse_kma_best_hits_columnar(kma_result_file), min_identity=min_identity, min_coverage=min_coverage)
+
+    assert allele_calls == expected
+    assert parsers.parse_kma_best_hits_columnar(kma_result_file)['num_rows'] == len(parsers.parse_kma_result_columnar(kma_result_file)['template'])
+
+
+def test_parse_kma_best_hits_columnar_empty(tmp_path):
+    kma_result_file = tmp_path / 'empty.res'
+    kma_result_file.write_text('#Template\tScore\tExpected\tTemplate_length\tTemplate_Identity\tTemplate_Coverage\tQuery_Identity\tQuery_Coverage\tDepth\tq_value\tp_value\n')
+
+    kma_result_columns = parsers.parse_kma_best_hits_columnar(str(kma_result_file))
+
+    assert kma_result_columns['locus_ids'] == []
+    assert kma_result_columns['num_rows'] == 0
+    assert kma_result_columns['score'].dtype == np.int64
+    assert allele_calling.call_alleles(kma_result_columns) == []
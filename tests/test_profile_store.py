@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from core_typer import profile_store
+
+LOCUS_IDS = ['L1', 'L2', 'L3']
+
+
+def write_allele_profile(outdir, allele_ids):
+    """
+    Write an allele profile, as allele_calling.write_allele_profile does, to an output directory named by sample ID.
+
+    :return: The path to the allele profile
+    :rtype: str
+    """
+    os.makedirs(outdir, exist_ok=True)
+    allele_profile_path = os.path.join(outdir, 'allele_profile.csv')
+    with open(allele_profile_path, 'w') as f:
+        f.write(','.join(LOCUS_IDS) + '\n')
+        f.write(','.join(allele_ids) + '\n')
+
+    return allele_profile_path
+
+
+def read_store_files(store_dir):
+    store_files = {}
+    for filename in [profile_store.SAMPLE_IDS_FILENAME, profile_store.ALLELE_CODES_FILENAME, profile_store.PROFILES_FILENAME]:
+        with open(os.path.join(store_dir, filename), 'rb') as f:
+            store_files[filename] = f.read()
+
+    return store_files
+
+
+def test_import_allele_profiles(tmp_path):
+    store = profile_store.ProfileStore.create(str(tmp_path / 'store'), LOCUS_IDS)
+    allele_profile_paths = [
+        write_allele_profile(str(tmp_path / 'run-1' / 'sample-a'), ['1', '2', '-']),
+        write_allele_profile(str(tmp_path / 'run-1' / 'sample-b'), ['1', '3', '4']),
+        write_allele_profile(str(tmp_path / 'run-2' / 'sample-c'), ['2', '2', '4']),
+    ]
+
+    assert store.import_allele_profiles(allele_profile_paths, batch_size=2) == 3
+
+    assert store.sample_ids == ['sample-a', 'sample-b', 'sample-c']
+    assert store.decode_profile(store.profiles[1]) == ['1', '3', '4']
+
+
+@pytest.mark.parametrize('batch_size', [1, 1000])
+def test_import_allele_profiles_duplicate_sample_id(tmp_path, batch_size):
+    store = profile_store.ProfileStore.create(str(tmp_path / 'store'), LOCUS_IDS)
+    store_files = read_store_files(store.store_dir)
+    allele_profile_paths = [
+        write_allele_profile(str(tmp_path / 'run-1' / 'sample-a'), ['1', '2', '-']),
+        write_allele_profile(str(tmp_path / 'run-1' / 'sample-b'), ['1', '3', '4']),
+        write_allele_profile(str(tmp_path / 'run-2' / 'sample-a'), ['2', '2', '4']),
+    ]
+
+    with pytest.raises(ValueError, match='Duplicate sample ID: sample-a'):
+        store.import_allele_profiles(allele_profile_paths, batch_size=batch_size)
+
+    assert read_store_files(store.store_dir) == store_files
+    store.refresh()
+    assert store.num_samples == 0
+
+
+def test_import_allele_profiles_sample_already_in_store(tmp_path):
+    store = profile_store.ProfileStore.create(str(tmp_path / 'store'), LOCUS_IDS)
+    store.append({'sample-b': {'L1': '1', 'L2': '1', 'L3': '1'}})
+    store_files = read_store_files(store.store_dir)
+    allele_profile_paths = [
+        write_allele_profile(str(tmp_path / 'run-1' / 'sample-a'), ['1', '2', '-']),
+        write_allele_profile(str(tmp_path / 'run-1' / 'sample-b'), ['1', '3', '4']),
+    ]
+
+    with pytest.raises(ValueError, match='Sample already in profile store: sample-b'):
+        store.import_allele_profiles(allele_profile_paths, batch_size=1)
+
+    assert read_store_files(store.store_dir) == store_files
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from core_typer import parsers
+from core_typer import qc_summary
+
+ALLELE_CALLS_HEADER = 'locus_id,allele_id,score,template_length,percent_identity,percent_coverage,depth,read_count,fragment_count,snp_sum,insert_sum,deletion_sum,depth_variance\n'
+
+
+def write_output_dir(output_dir, allele_calls_lines, allele_calls_header=ALLELE_CALLS_HEADER):
+    """
+    Write the outputs of a typing run that qc-summary reads (qc.csv, allele_profile.csv and allele_calls.csv).
+
+    :return: The output directory
+    :rtype: str
+    """
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'qc.csv'), 'w') as f:
+        f.write('mean_depth,stdev_depth,percent_called\n')
+        f.write('30.5,2.5,50.0\n')
+    with open(os.path.join(output_dir, 'allele_profile.csv'), 'w') as f:
+        f.write('L1,L2\n')
+        f.write('1,-\n')
+    with open(os.path.join(output_dir, 'allele_calls.csv'), 'w') as f:
+        f.write(allele_calls_header)
+        f.writelines(allele_calls_lines)
+
+    return output_dir
+
+
+GOOD_ALLELE_CALLS = [
+    'L1,1,980,300,100.0,100.0,32.0,120,61,0,0,0,1.25\n',
+    'L2,-,450,300,96.0,88.0,29.0,,,,,,\n',
+]
+
+
+@pytest.mark.parametrize('allele_calls_lines,allele_calls_header', [
+    (['L1,1,980,300,100.0,100.0,NA,120,61,0,0,0,1.25\n'], ALLELE_CALLS_HEADER),
+    (['L1,1,980,300,100.0,100.0,32.0,NA,61,0,0,0,1.25\n'], ALLELE_CALLS_HEADER),
+    (['L1,1,980,300,100.0\n'], ALLELE_CALLS_HEADER),
+    (['L1,1,980,300,100.0,100.0\n'], 'locus_id,allele_id,score,template_length,percent_identity,percent_coverage\n'),
+], ids=['bad_value', 'bad_mapstat_value', 'short_row', 'missing_column'])
+def test_summarize_cohort_qc_skips_unreadable_output_dir(tmp_path, allele_calls_lines, allele_calls_header):
+    output_dirs = [
+        write_output_dir(str(tmp_path / 'good'), GOOD_ALLELE_CALLS),
+        write_output_dir(str(tmp_path / 'bad'), allele_calls_lines, allele_calls_header=allele_calls_header),
+    ]
+
+    with pytest.raises(ValueError):
+        parsers.parse_allele_calls(os.path.join(output_dirs[1], 'allele_calls.csv'))
+    cohort_qc = qc_summary.summarize_cohort_qc(output_dirs, threads=2)
+
+    assert cohort_qc['num_samples'] == 1
+    assert cohort_qc['num_skipped'] == 1
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from core_typer import distance
+from core_typer import profile_store
+from core_typer import query
+
+NUM_LOCI = 24
+NUM_SAMPLES = 80
+
+
+def make_profiles(num_samples, num_loci, seed):
+    """
+    Make random allele profiles, with a few alleles per locus and some missing loci.
+
+    :return: Allele IDs, indexed by locus ID, for each sample
+    :rtype: dict[str, dict[str, str]]
+    """
+    rng = np.random.default_rng(seed)
+    locus_ids = [f"L{locus_idx}" for locus_idx in range(num_loci)]
+    profiles_by_sample_id = {}
+    for sample_idx in range(num_samples):
+        allele_ids = rng.integers(1, 4, size=num_loci)
+        missing = rng.random(num_loci) < 0.1
+        profiles_by_sample_id[f"sample-{sample_idx}"] = {
+            locus_id: distance.MISSING_ALLELE if is_missing else str(allele_id)
+            for locus_id, allele_id, is_missing in zip(locus_ids, allele_ids, missing)
+        }
+
+    return profiles_by_sample_id
+
+
+def brute_force_nearest(store, allele_ids_by_locus_id, k=None, max_distance=None, exclude_sample_id=None):
+    """
+    Compare the query against every stored profile.
+
+    :return: The nearest profiles, as returned by query.query_profile_store
+    :rtype: list[dict]
+    """
+    query_profile = store.encode_profile(allele_ids_by_locus_id)
+    profiles = np.asarray(store.profiles).astype(np.int64)
+    both_called = (profiles != distance.MISSING_ALLELE_CODE) & (query_profile != distance.MISSING_ALLELE_CODE)
+    distances = np.count_nonzero(both_called & (profiles != query_profile), axis=1)
+    shared_loci = np.count_nonzero(both_called, axis=1)
+    nearest = []
+    for sample_idx in np.lexsort((np.arange(len(distances)), distances)).tolist():
+        sample_id = store.sample_ids[sample_idx]
+        if sample_id == exclude_sample_id or (max_distance is not None and distances[sample_idx] > max_distance):
+            continue
+        nearest.append({'sample_id': sample_id, 'distance': int(distances[sample_idx]), 'shared_loci': int(shared_loci[sample_idx])})
+
+    return nearest if k is None else nearest[:k]
+
+
+def test_knn_without_index_does_not_count_samples_twice(tmp_path):
+    store = profile_store.ProfileStore.create(str(tmp_path / 'store'), ['L1', 'L2'])
+    store.append({
+        'a': {'L1': '1', 'L2': '1'},
+        'b': {'L1': '1', 'L2': '2'},
+        'c': {'L1': '2', 'L2': '2'},
+    })
+
+    nearest = query.query_profile_store(store, {'L1': '1', 'L2': '1'}, k=2, allele_index=None)
+
+    assert [nearest_profile['sample_id'] for nearest_profile in nearest] == ['a', 'b']
+
+
+@pytest.mark.parametrize('num_indexed_samples', [None, NUM_SAMPLES // 2, NUM_SAMPLES])
+@pytest.mark.parametrize('knn_seed_size', [4, query.KNN_SEED_SIZE])
+def test_query_profile_store_matches_brute_force(tmp_path, monkeypatch, num_indexed_samples, knn_seed_size):
+    monkeypatch.setattr(query, 'KNN_SEED_SIZE', knn_seed_size)
+    profiles_by_sample_id = make_profiles(NUM_SAMPLES, NUM_LOCI, seed=1)
+    sample_ids = list(profiles_by_sample_id)
+    store = profile_store.ProfileStore.create(str(tmp_path / 'store'), [f"L{locus_idx}" for locus_idx in range(NUM_LOCI)])
+    if num_indexed_samples is None:
+        store.append(profiles_by_sample_id)
+    else:
+        # Samples appended after the index is built aren't covered by it.
+        store.append({sample_id: profiles_by_sample_id[sample_id] for sample_id in sample_ids[:num_indexed_samples]})
+        query.build_allele_index(store)
+        store.append({sample_id: profiles_by_sample_id[sample_id] for sample_id in sample_ids[num_indexed_samples:]})
+    allele_index = query.load_allele_index(store)
+    assert (allele_index['num_samples'] if allele_index is not None else None) == num_indexed_samples
+
+    queries = list(make_profiles(10, NUM_LOCI, seed=2).values()) + [profiles_by_sample_id['sample-3']]
+    for allele_ids_by_locus_id in queries:
+        for k in [1, 3, 10, NUM_SAMPLES + 5]:
+            expected = brute_force_nearest(store, allele_ids_by_locus_id, k=k, exclude_sample_id='sample-3')
+            assert query.query_profile_store(store, allele_ids_by_locus_id, k=k, exclude_sample_id='sample-3') == expected
+        for max_distance in [0, 5, 12]:
+            expected = brute_force_nearest(store, allele_ids_by_locus_id, max_distance=max_distance)
+            assert query.query_profile_store(store, allele_ids_by_locus_id, max_distance=max_distance) == expected
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import signal
+
+import pytest
+
+from core_typer import pipeline
+from core_typer import server
+
+
+def read_text(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+async def submit_and_stop(typing_server, socket_path, jobs):
+    """
+    Start the server, submit the jobs, then stop the server with SIGTERM once every job has been reported.
+
+    :return: The server's messages
+    :rtype: list[dict]
+    """
+    serve_task = asyncio.create_task(typing_server.serve(socket_path=socket_path))
+    while not os.path.exists(socket_path):
+        assert not serve_task.done()
+        await asyncio.sleep(0.01)
+    messages = [message async for message in server.submit_jobs(jobs, socket_path=socket_path)]
+    os.kill(os.getpid(), signal.SIGTERM)
+    await serve_task
+
+    return messages
+
+
+@pytest.fixture
+def server_params(tmp_path, scheme_path):
+    return {
+        'scheme': scheme_path,
+        'threads': 1,
+        'tmpdir': str(tmp_path / 'tmp'),
+        'min_identity': 100.0,
+        'min_coverage': 100.0,
+        'no_cleanup': False,
+        'io_mode': 'disk',
+    }
+
+
+def test_submit_and_serve(tmp_path, stub_kma, server_params):
+    reads = {}
+    for read in ['R1', 'R2']:
+        reads[read] = str(tmp_path / f"{read}.fastq")
+        open(reads[read], 'w').close()
+    output_root = tmp_path / 'outputs'
+    output_root.mkdir()
+    jobs = [
+        dict(reads, job_id='relative', outdir='sample-1', metrics_json='sample-1/metrics.json'),
+        dict(reads, job_id='absolute', outdir=str(output_root / 'sample-2')),
+        dict(reads, job_id='outside', outdir=str(tmp_path / 'elsewhere')),
+        dict(reads, job_id='escape', outdir='../elsewhere'),
+        dict(reads, job_id='metrics_outside', outdir='sample-3', metrics_json=str(tmp_path / 'metrics.json')),
+    ]
+    typing_server = server.TypingServer(server_params, output_root=str(output_root))
+
+    messages = asyncio.run(submit_and_stop(typing_server, str(tmp_path / 's.sock'), jobs))
+
+    events_by_job_id = {}
+    for message in messages:
+        events_by_job_id.setdefault(message['job_id'], []).append(message['event'])
+    assert events_by_job_id == {
+        'relative': ['queued', 'completed'],
+        'absolute': ['queued', 'completed'],
+        'outside': ['failed'],
+        'escape': ['failed'],
+        'metrics_outside': ['failed'],
+    }
+    assert not os.path.exists(tmp_path / 'elsewhere')
+    assert not os.path.exists(tmp_path / 'metrics.json')
+    assert not os.path.exists(output_root / 'sample-3')
+    assert os.path.exists(output_root / 'sample-1' / 'metrics.json')
+    completed = {message['job_id']: message['result'] for message in messages if message['event'] == 'completed'}
+    assert completed['relative']['allele_calls'] == str(output_root / 'sample-1' / 'allele_calls.csv')
+
+    # Typing through the server gives the same outputs as typing directly.
+    expected = pipeline.run_typing(dict(server_params, outdir=str(tmp_path / 'direct'), **reads))
+    for job_id in ['relative', 'absolute']:
+        for output in ['allele_calls', 'allele_profile', 'qc']:
+            assert read_text(completed[job_id][output]) == read_text(expected[output])
+        assert completed[job_id]['qc_stats'] == expected['qc_stats']
+
+
+def test_resolve_output_path(tmp_path):
+    output_root = os.path.realpath(str(tmp_path))
+
+    assert server.resolve_output_path('a/b', output_root) == os.path.join(output_root, 'a', 'b')
+    assert server.resolve_output_path(os.path.join(output_root, 'a'), output_root) == os.path.join(output_root, 'a')
+    for path in ['..', '../a', '/', 'a/../../b', 3]:
+        with pytest.raises(ValueError):
+            server.resolve_output_path(path, output_root)
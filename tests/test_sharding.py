@@ -0,0 +1,99 @@
+import logging
+import os
+
+import pytest
+
+from core_typer import alignment
+from core_typer import parsers
+from core_typer import sharding
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        return f.readlines()
+
+
+def write_shards(scheme_path, shards_dir, num_shards):
+    """
+    Split a scheme's templates into shards, assigning loci to shards in turn, so that concatenating
+    the shards' hits doesn't give scheme order.
+
+    :return: The shard manifest, as returned by sharding.load_shard_manifest
+    :rtype: dict
+    """
+    locus_ids = list(dict.fromkeys(line.split('_')[0] for line in read_lines(scheme_path + '.name')))
+    shard_by_locus_id = {locus_id: locus_idx % num_shards for locus_idx, locus_id in enumerate(locus_ids)}
+    os.makedirs(shards_dir)
+    shards = []
+    for shard_idx in range(num_shards):
+        shard_name = f"shard-{shard_idx + 1:03d}"
+        shard_path = os.path.join(shards_dir, shard_name)
+        with open(shard_path + '.name', 'w') as f:
+            f.writelines(line for line in read_lines(scheme_path + '.name') if shard_by_locus_id[line.split('_')[0]] == shard_idx)
+        shards.append({'name': shard_name, 'path': shard_path, 'num_loci': sum(1 for shard in shard_by_locus_id.values() if shard == shard_idx)})
+
+    return {'shards': shards}
+
+
+def make_alignment_params(scheme_path, tmpdir):
+    os.makedirs(tmpdir)
+    return {
+        'R1': os.path.join(tmpdir, 'R1.fastq'),
+        'R2': os.path.join(tmpdir, 'R2.fastq'),
+        'threads': 2,
+        'scheme': scheme_path,
+        'tmpdir': tmpdir,
+        'io_mode': 'disk',
+        'exit_on_failure': False,
+    }
+
+
+def test_sharded_alignment_matches_unsharded(tmp_path, stub_kma, scheme_path):
+    shard_manifest = write_shards(scheme_path, str(tmp_path / 'shards'), num_shards=3)
+    output_parsers = {'res': parsers.parse_kma_best_hits_columnar}
+    unsharded_params = make_alignment_params(scheme_path, str(tmp_path / 'unsharded'))
+    sharded_params = make_alignment_params(scheme_path, str(tmp_path / 'sharded'))
+
+    unsharded_outputs = alignment.run_alignment(unsharded_params, output_parsers)
+    sharded_outputs = sharding.run_sharded_alignment(sharded_params, shard_manifest, output_parsers, output_extensions=['aln'])
+
+    unsharded_paths = alignment.get_output_paths(unsharded_params, ['res', 'mapstat', 'aln'])
+    sharded_paths = alignment.get_output_paths(sharded_params, ['res', 'mapstat', 'aln'])
+    assert read_lines(sharded_paths['res']) == read_lines(unsharded_paths['res'])
+    assert sharded_outputs['res']['template'].tolist() == unsharded_outputs['res']['template'].tolist()
+
+    unsharded_mapstat = read_lines(unsharded_paths['mapstat'])
+    sharded_mapstat = read_lines(sharded_paths['mapstat'])
+    assert [line for line in sharded_mapstat if not line.startswith('##')] == [line for line in unsharded_mapstat if not line.startswith('##')]
+    # The command line names each shard's index, so it is dropped. The other header lines match an unsharded run.
+    assert [line for line in sharded_mapstat if line.startswith('##')] == [line for line in unsharded_mapstat if line.startswith('##') and not line.startswith('## command')]
+
+    sharded_aln_templates = [line[2:].strip() for line in read_lines(sharded_paths['aln']) if line.startswith('# ')]
+    assert sorted(sharded_aln_templates) == sorted(line[2:].strip() for line in read_lines(unsharded_paths['aln']) if line.startswith('# '))
+
+
+@pytest.mark.parametrize('threads,max_concurrent_shards,expected', [
+    (2, None, '2 at a time, 1 threads each'),
+    (1, None, '1 at a time, 1 threads each'),
+    (8, None, '3 at a time, 2 threads each'),
+    (8, 2, '2 at a time, 4 threads each'),
+])
+def test_sharded_alignment_stays_within_threads(tmp_path, stub_kma, scheme_path, caplog, threads, max_concurrent_shards, expected):
+    shard_manifest = write_shards(scheme_path, str(tmp_path / 'shards'), num_shards=3)
+    alignment_params = dict(make_alignment_params(scheme_path, str(tmp_path / 'sharded')), threads=threads)
+
+    with caplog.at_level(logging.INFO):
+        sharding.run_sharded_alignment(alignment_params, shard_manifest, max_concurrent_shards=max_concurrent_shards)
+
+    assert f"Aligning against 3 scheme shards ({expected})" in caplog.text
+
+
+def test_merge_header_lines():
+    shard_header_lines = [
+        ["## method\tKMA\n", "## database\tshard-001\n", "## fragmentCount\t10\n", "## command\tkma -t_db shard-001\n", "# refSequence\treadCount\n"],
+        ["## method\tKMA\n", "## database\tshard-002\n", "## fragmentCount\t32\n", "## command\tkma -t_db shard-002\n", "# refSequence\treadCount\n"],
+    ]
+
+    merged_header_lines = sharding._merge_header_lines(shard_header_lines, database='scheme')
+
+    assert merged_header_lines == ["## method\tKMA\n", "## database\tscheme\n", "## fragmentCount\t42\n", "# refSequence\treadCount\n"]